@@ -1,6 +1,7 @@
 from enum import StrEnum, IntEnum
 import asyncio
 import json
+from collections import deque
 import redis.asyncio as redis
 from typing import AsyncIterator, Optional, Any, Callable, Dict, Type, Literal, TypeVar, Generic
 
@@ -16,6 +17,16 @@ REDIS_PORT = 6379
 
 SubscribeCallback = Callable[[str, dict], Any]
 
+# Optionally we also append every run event to a durable per-run Redis stream. Readers
+# can then XREAD from a cursor and resume without gaps, instead of relying on being
+# subscribed to the pub/sub logs channel when events are published.
+RUN_EVENT_STREAMS = str(config.get_option("RUN_EVENT_STREAMS", default="")).strip().lower() in ("1", "true", "yes")
+RUN_STREAM_MAXLEN = int(config.get_option("RUN_STREAM_MAXLEN", default=5000))
+RUN_STREAM_TTL = int(config.get_option("RUN_STREAM_TTL", default=24*3600))  # seconds
+
+def run_stream_name(run_id: str) -> str:
+    return f"run_events:{run_id}"
+
 T = TypeVar('T', bound='AgentEvent')
 
 class EventRegistry(Generic[T]):
@@ -80,6 +91,7 @@ class AgentLogEventTypes(StrEnum):
     AUDIO_STREAM_EVENT = "audio_stream"
     CHANGE_STATE_EVENT = "change_state"
     ASSET_CREATED = "asset_created"
+    ASSET_UPLOAD = "asset_upload"
 
 class AgentEvent(BaseModel):
     type: Optional[str] = ""
@@ -224,11 +236,224 @@ class AssetCreatedEvent(AgentEvent):
     asset_name: str
     asset_url: str
 
+@EventRegistry.register
+class AssetUploadEvent(AgentEvent):
+    # Reports the progress of uploading a file created by the agent to S3
+    type: str = Field(default=AgentLogEventTypes.ASSET_UPLOAD)
+    asset_id: str
+    status: str     # uploading, uploaded, skipped or failed
+    bytes_uploaded: int = 0
+    total_bytes: int = 0
+    asset_url: str = ""
+    message: str = ""
+
+
+class DropPolicy(StrEnum):
+    BLOCK = "block"                # Hold messages for a slow reader, each waits up to BLOCK_TIMEOUT
+    DROP_OLDEST = "drop_oldest"    # Discard the oldest queued message
+    DROP_NEWEST = "drop_newest"    # Discard the incoming message
+
+SUBSCRIBER_QUEUE_SIZE = 10000
+BLOCK_TIMEOUT = 5.0
+
+class Subscription:
+    """ 
+        An in-process subscriber to a channel pattern. Messages are pushed into our queue by the
+        SubscriptionManager. Supports the same 'get_message' and 'unsubscribe' calls as a
+        redis PubSub object, but reads never poll Redis.
+    """
+    def __init__(
+            self, 
+            manager: "SubscriptionManager", 
+            pattern: str, 
+            maxsize: int = SUBSCRIBER_QUEUE_SIZE,
+            drop_policy: DropPolicy = DropPolicy.BLOCK,
+        ):
+        self.manager = manager
+        self.pattern = pattern
+        self.drop_policy = drop_policy
+        self.queue: asyncio.Queue[dict] = asyncio.Queue(maxsize)
+        # Messages waiting for room in a full queue, for the BLOCK policy
+        self.backlog: deque[dict] = deque()
+        self.backlog_task: Optional[asyncio.Task] = None
+        self.dropped = 0
+        self.callback_task: Optional[asyncio.Task] = None
+        self.active = True
+
+    def deliver(self, message: dict):
+        # Called by the manager's reader task, so this never waits: a slow subscriber
+        # must not hold up the subscribers after it
+        if not self.backlog and not self.queue.full():
+            self.queue.put_nowait(message)
+        elif self.drop_policy == DropPolicy.BLOCK:
+            if self.queue.maxsize and len(self.backlog) >= self.queue.maxsize:
+                self.dropped += 1
+                print(f"Subscriber on '{self.pattern}' is too far behind, dropped message")
+                return
+            self.backlog.append(message)
+            if self.backlog_task is None or self.backlog_task.done():
+                self.backlog_task = asyncio.create_task(self.drain_backlog())
+        elif self.drop_policy == DropPolicy.DROP_OLDEST:
+            self.queue.get_nowait()
+            self.queue.put_nowait(message)
+            self.dropped += 1
+        else:
+            self.dropped += 1
+
+    async def drain_backlog(self):
+        # Moves the backlog into the queue as the subscriber reads, in order
+        while self.backlog:
+            try:
+                await asyncio.wait_for(self.queue.put(self.backlog[0]), timeout=BLOCK_TIMEOUT)
+            except asyncio.TimeoutError:
+                self.dropped += 1
+                print(f"Subscriber on '{self.pattern}' is not reading, dropped message")
+            self.backlog.popleft()
+
+    async def get_message(self, ignore_subscribe_messages: bool=True, timeout: Optional[float]=None) -> Optional[dict]:
+        # Waits up to 'timeout' seconds (forever if None) for the next message
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout=timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    async def listen(self) -> AsyncIterator[dict]:
+        while self.active:
+            yield await self.queue.get()
+
+    async def unsubscribe(self, *args):
+        await self.manager.remove(self)
+
+
+class SubscriptionManager:
+    """
+        Multiplexes all the subscriptions in this process over one Redis pubsub connection.
+        A single reader task blocks on the connection and fans each message out to the
+        subscriber queues for its pattern, so idle subscribers never wake up. The reader
+        never waits on a subscriber, each one applies its own DropPolicy.
+    """
+    def __init__(self, get_client: Callable[[], Any]):
+        self._get_client = get_client
+        self._pubsub: Optional[redis.client.PubSub] = None
+        self._reader: Optional[asyncio.Task] = None
+        self._subscribers: dict[str, list[Subscription]] = {}
+        self._lock = asyncio.Lock()
+
+    async def add(
+            self, 
+            pattern: str, 
+            maxsize: int = SUBSCRIBER_QUEUE_SIZE,
+            drop_policy: DropPolicy = DropPolicy.BLOCK,
+        ) -> Subscription:
+        sub = Subscription(self, pattern, maxsize, drop_policy)
+        async with self._lock:
+            if self._pubsub is None:
+                client = await self._get_client()
+                self._pubsub = client.pubsub()
+            if pattern not in self._subscribers:
+                self._subscribers[pattern] = []
+                await self._pubsub.psubscribe(pattern)
+            self._subscribers[pattern].append(sub)
+            if self._reader is None or self._reader.done():
+                self._reader = asyncio.create_task(self._read_loop())
+        return sub
+
+    async def remove(self, sub: Subscription):
+        sub.active = False
+        if sub.callback_task is not None and sub.callback_task is not asyncio.current_task():
+            sub.callback_task.cancel()
+        if sub.backlog_task is not None:
+            sub.backlog_task.cancel()
+            try:
+                await sub.backlog_task
+            except asyncio.CancelledError:
+                pass
+        sub.backlog.clear()
+        async with self._lock:
+            subs = self._subscribers.get(sub.pattern, [])
+            if sub in subs:
+                subs.remove(sub)
+            if not subs and sub.pattern in self._subscribers:
+                del self._subscribers[sub.pattern]
+                await self._pubsub.punsubscribe(sub.pattern)
+
+    async def _read_loop(self):
+        while self._subscribers:
+            try:
+                async for message in self._pubsub.listen():
+                    if message.get("type") != "pmessage":
+                        continue
+                    for sub in list(self._subscribers.get(message["pattern"], [])):
+                        sub.deliver(message)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # redis-py re-subscribes our patterns when it reconnects
+                print(f"Error reading pubsub messages, retrying: {e}")
+                await asyncio.sleep(1)
+
+    async def close(self):
+        for subs in list(self._subscribers.values()):
+            for sub in list(subs):
+                await self.remove(sub)
+        if self._reader is not None:
+            self._reader.cancel()
+            try:
+                await self._reader
+            except asyncio.CancelledError:
+                pass
+            self._reader = None
+
+    def stats(self) -> dict:
+        return {
+            pattern: {
+                "subscribers": len(subs), 
+                "queued": sum(s.queue.qsize() + len(s.backlog) for s in subs), 
+                "dropped": sum(s.dropped for s in subs),
+            }
+            for pattern, subs in self._subscribers.items()
+        }
+
+
+class RunEventReader:
+    """
+        Reads a run's events from its Redis stream, starting after 'cursor'. Has the same
+        'get_message' and 'unsubscribe' calls as a Subscription. Each message includes
+        its stream 'id', and the reader advances its cursor as messages are consumed.
+    """
+    def __init__(self, pubsub: "AsyncPubSub", run_id: str, cursor: str = "0-0"):
+        self.pubsub = pubsub
+        self.stream = run_stream_name(run_id)
+        self.cursor = cursor
+        self.pending: deque[dict] = deque()
+
+    async def get_message(self, ignore_subscribe_messages: bool=True, timeout: Optional[float]=None) -> Optional[dict]:
+        if not self.pending:
+            client = await self.pubsub.get_client()
+            # XREAD treats block=0 as 'wait forever'
+            block = max(int(timeout * 1000), 1) if timeout is not None else 0
+            response = await client.xread({self.stream: self.cursor}, count=100, block=block)
+            for _stream, entries in response or []:
+                for entry_id, fields in entries:
+                    self.pending.append(
+                        {"type": "message", "channel": self.stream, "id": entry_id, "data": fields["data"]}
+                    )
+        if not self.pending:
+            return None
+        message = self.pending.popleft()
+        self.cursor = message["id"]
+        return message
+
+    async def unsubscribe(self, *args):
+        self.pending.clear()
+
 
-SUBSCRIBER_POOL: dict[str, redis.client.PubSub] = {}
+SUBSCRIBER_POOL: dict[str, Subscription|RunEventReader] = {}
 class AsyncPubSub:
     def __init__(self):
         self._client: redis.Redis = None
+        self._manager: Optional[SubscriptionManager] = None
+        self._manager_loop: Optional[asyncio.AbstractEventLoop] = None
         self.alive = True
 
     def stop(self):
@@ -240,6 +465,19 @@ class AsyncPubSub:
             self._client = await redis.from_url(url or "redis://localhost", decode_responses=True)
         return self._client
 
+    def get_subscription_manager(self) -> SubscriptionManager:
+        # One manager per event loop (agent workers run in their own loop)
+        loop = asyncio.get_running_loop()
+        if self._manager is None or self._manager_loop is not loop:
+            self._manager = SubscriptionManager(self.get_client)
+            self._manager_loop = loop
+        return self._manager
+
+    async def close_subscriptions(self):
+        if self._manager is not None:
+            await self._manager.close()
+            self._manager = None
+
     async def publish(self, channel: str, message: str|dict|AgentEvent):
         if isinstance(message, AgentEvent):
             message = message.json()
@@ -251,16 +489,51 @@ class AsyncPubSub:
         #print(f">> Publishing ({channel}): ", message)
         await client.publish(channel, message)
 
+    async def append_run_event(self, run_id: str, message: dict):
+        client = await self.get_client()
+        stream = run_stream_name(run_id)
+        async with client.pipeline(transaction=False) as pipe:
+            pipe.xadd(
+                stream, 
+                {"data": json.dumps(jsonable_encoder(message))}, 
+                maxlen=RUN_STREAM_MAXLEN, 
+                approximate=True,
+            )
+            pipe.expire(stream, RUN_STREAM_TTL)
+            await pipe.execute()
+
+    async def get_run_events_cursor(self, run_id: str) -> str:
+        # Returns the ID of the latest event in the run's stream, so a reader can
+        # start from "now". Capture this BEFORE sending input to the run.
+        client = await self.get_client()
+        entries = await client.xrevrange(run_stream_name(run_id), count=1)
+        return entries[0][0] if entries else "0-0"
+
+    async def subscribe_run_events(
+            self, 
+            run_id: Optional[str], 
+            logs_channel: str, 
+            cursor: Optional[str] = None,
+        ) -> "Subscription|RunEventReader":
+        # Returns a reader for a run's events. Reads the durable run stream if enabled,
+        # otherwise subscribes to the run's logs channel.
+        if RUN_EVENT_STREAMS and run_id:
+            if cursor is None:
+                cursor = await self.get_run_events_cursor(run_id)
+            return RunEventReader(self, run_id, cursor)
+        return await self.subscribe(logs_channel, drop_policy=DropPolicy.DROP_OLDEST)
+
     async def subscribe(
             self, 
             channel: str, 
-            callback: Optional[SubscribeCallback]=None) -> redis.client.PubSub:
-        client = await self.get_client()
-        pub = client.pubsub()
-        await pub.psubscribe(channel)
+            callback: Optional[SubscribeCallback]=None,
+            maxsize: int = SUBSCRIBER_QUEUE_SIZE,
+            drop_policy: DropPolicy = DropPolicy.BLOCK,
+        ) -> Subscription:
+        sub = await self.get_subscription_manager().add(channel, maxsize, drop_policy)
         if callback:
-            asyncio.create_task(self.reader(pub, channel, callback))
-        return pub
+            sub.callback_task = asyncio.create_task(self.reader(sub, channel, callback))
+        return sub
 
     # Creates a subscriber keyed by the indicated ID, and maintains that object in a pool
     # The subscriber returned, but you can use ...
@@ -269,13 +542,19 @@ class AsyncPubSub:
             sub_id: str,
             channel: str,
             recreate: bool=True,
-    ) -> redis.client.PubSub:
+            run_id: Optional[str]=None,
+    ) -> Subscription|RunEventReader:
         if sub_id in SUBSCRIBER_POOL and not recreate:
             print("Returning existing channel for ", sub_id, " on topic ", channel)
             return SUBSCRIBER_POOL[sub_id]
         else:
             print("Subscribing channel for ", sub_id, " on topic ", channel)
-            sub = await self.subscribe(channel)
+            if sub_id in SUBSCRIBER_POOL:
+                await SUBSCRIBER_POOL[sub_id].unsubscribe()
+            # These subscribers feed a browser session, which may go away without
+            # unsubscribing, so never let them block the shared reader. With run streams
+            # the pooled reader keeps its cursor, so a reconnect resumes where it left off.
+            sub = await self.subscribe_run_events(run_id, channel)
             SUBSCRIBER_POOL[sub_id] = sub
             return sub
         
@@ -286,25 +565,18 @@ class AsyncPubSub:
     ):
         if sub_id in SUBSCRIBER_POOL:
             sub = SUBSCRIBER_POOL[sub_id]
-            await sub.unsubscribe([channel])
+            await sub.unsubscribe()
             del SUBSCRIBER_POOL[sub_id]
 
-
-    async def unsubscribe(
-            self, 
-            channel: str):
-        client = await self.get_client()
-        pub = client.pubsub()
-        await pub.unsubscribe(channel)
-
-    async def reader(self, pubsub, channel: str, callback: SubscribeCallback):
-        while self.alive:
-            message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=0.5)
-            if message is not None:
+    async def reader(self, sub: Subscription, channel: str, callback: SubscribeCallback):
+        async for message in sub.listen():
+            if not self.alive:
+                break
+            try:
                 event = json.loads(message['data'])
                 await callback(event['type'], event)
-            else:
-                await asyncio.sleep(0.1)
+            except Exception as e:
+                print(f"Error in subscriber callback for '{channel}': {e}")
 
     async def set(self, key: str, value: str, ttl: Optional[int]=None):
         client = await self.get_client()
@@ -3,14 +3,27 @@
 # simple service wrapper which stores credentials, encrypted,
 # in the main database.
 
+import asyncio
+import json
 import os
+import threading
+import time
+import uuid
 from typing import Optional
 
+import redis
 from sqlmodel import SQLModel, Field
 from sqlmodel import Session, select
 
 from .services import db_connect, config
 
+# How long decrypted secrets stay in the per-process cache
+SECRETS_CACHE_TTL = int(config.get_option("SECRETS_CACHE_TTL", default=60))  # seconds
+# Engine workers broadcast cache invalidations to each other on this channel
+SECRETS_INVALIDATE_CHANNEL = "secrets_invalidate"
+# Seconds we'll wait on Redis when broadcasting an invalidation
+SECRETS_BROADCAST_TIMEOUT = float(config.get_option("SECRETS_BROADCAST_TIMEOUT", default=2))
+
 class CredentialSecret(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
     tenant_id: str
@@ -39,6 +52,84 @@ class EncryptionHelper:
         return self.fernet.decrypt(data)
 
 
+class SecretsCache:
+    """
+        A short-lived, per-process cache of decrypted secrets keyed by 
+        (tenant_id, user_id, credential_id). We also cache prefix listings with values,
+        like the user's "ENV:" secrets which we load for every run. Entries are dropped 
+        when the secret is set or deleted, here or in another process.
+
+        Each tenant also has a version number which changes whenever any of its secrets
+        change, so callers can tell when something they built from secrets is stale.
+    """
+    def __init__(self, ttl: float=SECRETS_CACHE_TTL):
+        self.ttl = ttl
+        self._values: dict[tuple, tuple[float, str]] = {}
+        self._lists: dict[tuple, tuple[float, list]] = {}
+        self._versions: dict[str, int] = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, tenant_id: str, user_id: str, credential_id: str) -> Optional[str]:
+        with self._lock:
+            entry = self._values.get((tenant_id, user_id, credential_id))
+            if entry and entry[0] > time.time():
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            return None
+
+    def put(self, tenant_id: str, user_id: str, credential_id: str, value: str):
+        with self._lock:
+            self._values[(tenant_id, user_id, credential_id)] = (time.time() + self.ttl, value)
+
+    def get_list(self, tenant_id: str, user_id: str, prefix: str|None) -> Optional[list]:
+        with self._lock:
+            entry = self._lists.get((tenant_id, user_id, prefix))
+            if entry and entry[0] > time.time():
+                self.hits += 1
+                return list(entry[1])
+            self.misses += 1
+            return None
+
+    def put_list(self, tenant_id: str, user_id: str, prefix: str|None, values: list):
+        with self._lock:
+            self._lists[(tenant_id, user_id, prefix)] = (time.time() + self.ttl, list(values))
+
+    def invalidate(self, tenant_id: str, user_id: str|None, credential_ids: list[str]|None=None):
+        # Drops the indicated secrets, or all of the user's secrets if no IDs are given
+        with self._lock:
+            self._versions[tenant_id] = self._versions.get(tenant_id, 0) + 1
+            for key in list(self._values):
+                if key[0:2] == (tenant_id, user_id) and (credential_ids is None or key[2] in credential_ids):
+                    del self._values[key]
+            for key in list(self._lists):
+                if key[0:2] != (tenant_id, user_id):
+                    continue
+                prefix = key[2]
+                if credential_ids is None or prefix is None or any(c.startswith(prefix) for c in credential_ids):
+                    del self._lists[key]
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+            self._lists.clear()
+            self._generation += 1
+
+    def version(self, tenant_id: str) -> tuple[int, int]:
+        return (self._generation, self._versions.get(tenant_id, 0))
+
+    def stats(self) -> dict:
+        return {
+            "secrets": len(self._values),
+            "lists": len(self._lists),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
 class SecretsService:
     """
         The Secrets services stores credential secrets for us. The Credential model
@@ -53,10 +144,60 @@ class SecretsService:
         self.engine = db_connect(SecretsService.SERVICE_NAME)
         SQLModel.metadata.create_all(self.engine)
         self.encrypter = EncryptionHelper()
+        self.cache = SecretsCache()
+        # Identifies our own invalidation broadcasts so we can ignore them
+        self.cache_id = uuid.uuid4().hex
+        self._redis: redis.Redis|None = None
+        self._broadcasts: set[asyncio.Task] = set()
 
     def reconnect(self):
         self.engine.dispose()
         self.engine = db_connect(SecretsService.SERVICE_NAME)
+        self.cache.clear()
+
+    def invalidate(self, tenant_id: str, user_id: str|None, credential_ids: list[str]):
+        self.cache.invalidate(tenant_id, user_id, credential_ids)
+        self._broadcast_invalidation(tenant_id, user_id, credential_ids)
+
+    def _broadcast_invalidation(self, tenant_id: str, user_id: str|None, credential_ids: list[str]):
+        # Tell the other engine workers to drop these secrets from their caches
+        url = config.get_global("REDIS_URL", False)
+        if not url:
+            return
+        message = json.dumps({
+            "type": "secrets_invalidate",
+            "origin": self.cache_id,
+            "tenant_id": tenant_id,
+            "user_id": user_id,
+            "credential_ids": credential_ids,
+        })
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self._publish_invalidation(url, message)
+            return
+        # We're called from async handlers, so publish from a thread rather than block the loop
+        task = loop.create_task(asyncio.to_thread(self._publish_invalidation, url, message))
+        self._broadcasts.add(task)
+        task.add_done_callback(self._broadcasts.discard)
+
+    def _publish_invalidation(self, url: str, message: str):
+        try:
+            if self._redis is None:
+                self._redis = redis.from_url(
+                    url, 
+                    decode_responses=True, 
+                    socket_timeout=SECRETS_BROADCAST_TIMEOUT,
+                    socket_connect_timeout=SECRETS_BROADCAST_TIMEOUT,
+                )
+            self._redis.publish(SECRETS_INVALIDATE_CHANNEL, message)
+        except Exception as e:
+            print(f"Failed to broadcast secrets invalidation: {e}")
+
+    async def receive_invalidation(self, event_type: str, event: dict):
+        # Subscribe this to SECRETS_INVALIDATE_CHANNEL
+        if event.get("origin") != self.cache_id:
+            self.cache.invalidate(event["tenant_id"], event.get("user_id"), event.get("credential_ids"))
 
     def set_credential(
             self, 
@@ -93,7 +234,8 @@ class SecretsService:
             session.add(cred_secret)
             session.commit()
             session.refresh(cred_secret)
-            return cred_secret
+        self.invalidate(tenant_id, user_id, [credential_id])
+        return cred_secret
 
     def get_credential(
             self, 
@@ -101,8 +243,33 @@ class SecretsService:
             user_id: str, 
             credential_id: str
         ) -> Optional[str]:
-        bval: bytes = self._get_credential(tenant_id, user_id, credential_id)
-        return bval.decode() if bval else None
+        return self.get_credentials(tenant_id, user_id, [credential_id])[credential_id]
+
+    def get_credentials(
+            self,
+            tenant_id: str,
+            user_id: str,
+            credential_ids: list[str],
+        ) -> dict[str, Optional[str]]:
+        """ Returns the secrets for a set of credential IDs, using the cache and then
+            a single query for any we don't have. Missing secrets are returned as None. """
+        result: dict[str, Optional[str]] = {}
+        missing = []
+        for credential_id in credential_ids:
+            result[credential_id] = self.cache.get(tenant_id, user_id, credential_id)
+            if result[credential_id] is None:
+                missing.append(credential_id)
+        if missing:
+            with Session(self.engine) as session:
+                query = select(CredentialSecret).where(
+                    CredentialSecret.tenant_id == tenant_id,
+                    CredentialSecret.user_id == user_id,
+                    CredentialSecret.credential_id.in_(missing))
+                for cred_secret in session.exec(query):
+                    value = self.encrypter.decrypt(cred_secret.secret).decode()
+                    result[cred_secret.credential_id] = value
+                    self.cache.put(tenant_id, user_id, cred_secret.credential_id, value)
+        return result
 
     def _get_credential(
             self, 
@@ -138,6 +305,7 @@ class SecretsService:
             if cred_secret:
                 session.delete(cred_secret)
                 session.commit()
+        self.invalidate(tenant_id, user_id, [credential_id])
 
     def delete_credentials(
             self,
@@ -155,6 +323,7 @@ class SecretsService:
             for cred_secret in cred_secrets:
                 session.delete(cred_secret)
             session.commit()
+        self.invalidate(tenant_id, user_id, credential_ids)
 
     def list_credentials(
             self,
@@ -165,6 +334,10 @@ class SecretsService:
     ):
         """ Returns a list of credential ID's matching the prefix owned by the user. If
             include_value is True then returns a list of (key,value) tuples. """
+        if include_values:
+            cached = self.cache.get_list(tenant_id, user_id, prefix)
+            if cached is not None:
+                return cached
         with Session(self.engine) as session:
             if prefix is None:
                 query = select(CredentialSecret).where(
@@ -178,7 +351,9 @@ class SecretsService:
                 )
             creds = session.exec(query).all()
             if include_values:
-                return [(c.credential_id, self.encrypter.decrypt(c.secret).decode()) for c in creds]
+                values = [(c.credential_id, self.encrypter.decrypt(c.secret).decode()) for c in creds]
+                self.cache.put_list(tenant_id, user_id, prefix, values)
+                return values
             else:
                 return [c.credential_id for c in creds]
 
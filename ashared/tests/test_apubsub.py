@@ -0,0 +1,180 @@
+import asyncio
+import json
+import pytest
+import pytest_asyncio
+
+from supercog.shared.apubsub import AsyncPubSub, DropPolicy, RunEventReader
+
+class FakeRedisPubSub:
+    # Stands in for a redis.asyncio PubSub connection
+    def __init__(self):
+        self.patterns: set[str] = set()
+        self.incoming: asyncio.Queue = asyncio.Queue()
+
+    async def psubscribe(self, pattern):
+        self.patterns.add(pattern)
+
+    async def punsubscribe(self, pattern):
+        self.patterns.discard(pattern)
+
+    async def listen(self):
+        while self.patterns:
+            yield await self.incoming.get()
+
+class FakeRedis:
+    def __init__(self):
+        self.connection = FakeRedisPubSub()
+        self.pubsub_count = 0
+        self.streams: dict[str, list] = {}
+        self.expires: dict[str, int] = {}
+
+    def pubsub(self):
+        self.pubsub_count += 1
+        return self.connection
+
+    # Just enough of Redis streams for the run event streams
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    async def xadd(self, stream, fields, maxlen=None, approximate=True):
+        entries = self.streams.setdefault(stream, [])
+        entry_id = f"{len(entries) + 1}-0"
+        entries.append((entry_id, fields))
+        return entry_id
+
+    async def expire(self, key, seconds):
+        self.expires[key] = seconds
+
+    async def xrevrange(self, stream, count=None):
+        return list(reversed(self.streams.get(stream, [])))[:count]
+
+    async def xread(self, streams, count=None, block=None):
+        result = []
+        for stream, cursor in streams.items():
+            after = int(cursor.split("-")[0])
+            entries = [e for e in self.streams.get(stream, []) if int(e[0].split("-")[0]) > after]
+            if entries:
+                result.append((stream, entries[:count]))
+        if not result and block:
+            await asyncio.sleep(block / 1000)
+        return result
+
+    async def publish(self, channel, message):
+        for pattern in self.connection.patterns:
+            if pattern == channel or (pattern.endswith("*") and channel.startswith(pattern[:-1])):
+                await self.connection.incoming.put(
+                    {"type": "pmessage", "pattern": pattern, "channel": channel, "data": message}
+                )
+
+class FakePipeline:
+    def __init__(self, client):
+        self.client = client
+        self.calls = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    def xadd(self, *args, **kwargs):
+        self.calls.append(self.client.xadd(*args, **kwargs))
+
+    def expire(self, *args):
+        self.calls.append(self.client.expire(*args))
+
+    async def execute(self):
+        return [await call for call in self.calls]
+
+@pytest_asyncio.fixture
+async def pubsub():
+    ps = AsyncPubSub()
+    ps._client = FakeRedis()
+    yield ps
+    await ps.close_subscriptions()
+
+@pytest.mark.asyncio
+async def test_fanout_over_one_connection(pubsub):
+    received = []
+
+    async def callback(event_type, event):
+        received.append(event)
+
+    await pubsub.subscribe("logs*", callback)
+    sub1 = await pubsub.subscribe("logs:run1")
+    sub2 = await pubsub.subscribe("logs:run1")
+
+    await pubsub.publish("logs:run1", {"type": "output", "n": 1})
+    await pubsub.publish("logs:run2", {"type": "output", "n": 2})
+
+    msg1 = await sub1.get_message(timeout=1)
+    msg2 = await sub2.get_message(timeout=1)
+    assert json.loads(msg1["data"])["n"] == 1
+    assert json.loads(msg2["data"])["n"] == 1
+    assert await sub1.get_message(timeout=0.05) is None
+
+    await asyncio.sleep(0.05)
+    assert [e["n"] for e in received] == [1, 2]
+    assert pubsub._client.pubsub_count == 1
+
+    await sub1.unsubscribe()
+    assert "logs:run1" in pubsub._client.connection.patterns
+    await sub2.unsubscribe()
+    assert "logs:run1" not in pubsub._client.connection.patterns
+
+@pytest.mark.asyncio
+async def test_drop_policies(pubsub):
+    oldest = await pubsub.subscribe("chan", maxsize=2, drop_policy=DropPolicy.DROP_OLDEST)
+    newest = await pubsub.subscribe("chan", maxsize=2, drop_policy=DropPolicy.DROP_NEWEST)
+    for n in range(4):
+        await pubsub.publish("chan", str(n))
+    await asyncio.sleep(0.05)
+
+    assert [(await oldest.get_message(timeout=1))["data"] for _ in range(2)] == ["2", "3"]
+    assert [(await newest.get_message(timeout=1))["data"] for _ in range(2)] == ["0", "1"]
+    assert oldest.dropped == 2 and newest.dropped == 2
+
+@pytest.mark.asyncio
+async def test_run_event_stream_resume(pubsub):
+    run_id = "run1"
+    await pubsub.append_run_event(run_id, {"n": 0})
+    # A reader that starts from 'now' doesn't see earlier events
+    cursor = await pubsub.get_run_events_cursor(run_id)
+    reader = RunEventReader(pubsub, run_id, cursor)
+    for n in range(1, 4):
+        await pubsub.append_run_event(run_id, {"n": n})
+
+    message = await reader.get_message(timeout=0.01)
+    assert json.loads(message["data"]) == {"n": 1}
+
+    # Reconnect from the last consumed id and continue without gaps
+    resumed = RunEventReader(pubsub, run_id, message["id"])
+    events = [json.loads((await resumed.get_message(timeout=0.01))["data"])["n"] for _ in range(2)]
+    assert events == [2, 3]
+    assert await resumed.get_message(timeout=0.01) is None
+    assert pubsub._client.expires["run_events:run1"] > 0
+
+@pytest.mark.asyncio
+async def test_subscribe_run_events_falls_back_to_pubsub(pubsub, monkeypatch):
+    sub = await pubsub.subscribe_run_events("run1", "logs:run1")
+    assert not isinstance(sub, RunEventReader)
+
+    monkeypatch.setattr("supercog.shared.apubsub.RUN_EVENT_STREAMS", True)
+    reader = await pubsub.subscribe_run_events("run1", "logs:run1")
+    assert isinstance(reader, RunEventReader)
+    assert reader.cursor == "0-0"
+
+@pytest.mark.asyncio
+async def test_slow_blocking_subscriber_does_not_hold_up_others(pubsub, monkeypatch):
+    monkeypatch.setattr("supercog.shared.apubsub.BLOCK_TIMEOUT", 10)
+    slow = await pubsub.subscribe("logs*", maxsize=2, drop_policy=DropPolicy.BLOCK)
+    fast = await pubsub.subscribe("logs*")
+    for n in range(5):
+        await pubsub.publish("logs:run1", str(n))
+
+    # The slow subscriber hasn't read anything, but the other one gets every message
+    assert [(await fast.get_message(timeout=1))["data"] for _ in range(5)] == ["0", "1", "2", "3", "4"]
+    # The slow one holds a full queue plus as many again, and drops the rest
+    assert pubsub.get_subscription_manager().stats()["logs*"]["queued"] == 4
+    assert [(await slow.get_message(timeout=1))["data"] for _ in range(4)] == ["0", "1", "2", "3"]
+    assert slow.dropped == 1
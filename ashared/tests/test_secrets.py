@@ -1,5 +1,10 @@
+import asyncio
+import json
+import time
+
 import pytest
-from supercog.shared.credentials import SecretsService, EncryptionHelper, CredentialSecret
+from supercog.shared.credentials import SecretsService, EncryptionHelper, CredentialSecret, SECRETS_INVALIDATE_CHANNEL
+from supercog.shared.services import config
 from sqlmodel import SQLModel
 import os
 
@@ -46,3 +51,73 @@ def test_delete_credential(setup_test_env, sample_credential):
     creds_service.delete_credential(cred.tenant_id, cred.user_id, cred.credential_id)
     stored_cred =  creds_service.get_credential(cred.tenant_id, cred.user_id, cred.credential_id)
     assert stored_cred is None, "Credential was not deleted successfully"
+
+def test_bulk_get_and_cache(setup_test_env):
+    creds_service = setup_test_env
+    creds_service.cache.clear()
+    for key in ["a", "b", "c"]:
+        creds_service.set_credential("bulk_tenant", "bulk_user", f"cred1:{key}", f"secret-{key}")
+
+    ids = ["cred1:a", "cred1:b", "cred1:c", "cred1:missing"]
+    assert creds_service.get_credentials("bulk_tenant", "bulk_user", ids) == {
+        "cred1:a": "secret-a", "cred1:b": "secret-b", "cred1:c": "secret-c", "cred1:missing": None,
+    }
+    hits = creds_service.cache.hits
+    assert creds_service.get_credential("bulk_tenant", "bulk_user", "cred1:b") == "secret-b"
+    assert creds_service.cache.hits == hits + 1
+
+    # Setting or deleting a secret invalidates the cached value
+    creds_service.set_credential("bulk_tenant", "bulk_user", "cred1:b", "changed")
+    assert creds_service.get_credential("bulk_tenant", "bulk_user", "cred1:b") == "changed"
+    creds_service.delete_credentials("bulk_tenant", "bulk_user", ["cred1:a", "cred1:b", "cred1:c"])
+    assert creds_service.get_credential("bulk_tenant", "bulk_user", "cred1:a") is None
+
+def test_env_list_cache_invalidation(setup_test_env):
+    creds_service = setup_test_env
+    creds_service.set_credential("env_tenant", "env_user", "ENV:ONE", "1")
+    assert creds_service.list_credentials("env_tenant", "env_user", "ENV:", include_values=True) == [("ENV:ONE", "1")]
+
+    creds_service.set_credential("env_tenant", "env_user", "ENV:TWO", "2")
+    assert sorted(creds_service.list_credentials("env_tenant", "env_user", "ENV:", include_values=True)) == [
+        ("ENV:ONE", "1"), ("ENV:TWO", "2"),
+    ]
+    creds_service.delete_credentials("env_tenant", "env_user", ["ENV:ONE", "ENV:TWO"])
+
+@pytest.mark.asyncio
+async def test_remote_invalidation(setup_test_env):
+    creds_service = setup_test_env
+    creds_service.cache.put("t1", "u1", "cred2:key", "stale")
+    # Our own broadcasts are ignored, others drop the cached value
+    await creds_service.receive_invalidation("secrets_invalidate", {
+        "origin": creds_service.cache_id, "tenant_id": "t1", "user_id": "u1", "credential_ids": ["cred2:key"],
+    })
+    assert creds_service.cache.get("t1", "u1", "cred2:key") == "stale"
+    await creds_service.receive_invalidation("secrets_invalidate", {
+        "origin": "other", "tenant_id": "t1", "user_id": "u1", "credential_ids": ["cred2:key"],
+    })
+    assert creds_service.cache.get("t1", "u1", "cred2:key") is None
+
+class SlowRedis:
+    def __init__(self):
+        self.published = []
+
+    def publish(self, channel, message):
+        time.sleep(0.2)
+        self.published.append((channel, json.loads(message)))
+
+@pytest.mark.asyncio
+async def test_broadcast_does_not_block_the_event_loop(setup_test_env, monkeypatch):
+    creds_service = setup_test_env
+    monkeypatch.setattr(config, "get_global", lambda key, required=True: "redis://fake" if key == "REDIS_URL" else None)
+    monkeypatch.setattr(creds_service, "_redis", SlowRedis())
+
+    start = time.perf_counter()
+    creds_service.invalidate("t1", "u1", ["cred3:key"])
+    assert time.perf_counter() - start < 0.1
+    assert creds_service._redis.published == []
+
+    await asyncio.gather(*creds_service._broadcasts)
+    assert creds_service._redis.published == [(SECRETS_INVALIDATE_CHANNEL, {
+        "type": "secrets_invalidate", "origin": creds_service.cache_id,
+        "tenant_id": "t1", "user_id": "u1", "credential_ids": ["cred3:key"],
+    })]
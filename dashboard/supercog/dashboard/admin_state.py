@@ -54,6 +54,9 @@ class AdminState(GlobalState):
                 {"name": "Dashboard SHA", "value": self.git_sha},
                 {"name": "Agents Start Time", "value": start_time},
                 {"name": "Agents Address", "value": address},
+            ] + [
+                {"name": f"Engine cache {key}", "value": str(value)}
+                for key, value in info.get("engine_cache", {}).items()
             ])
 
             df = pd.DataFrame(agents)
@@ -1033,7 +1033,8 @@ class EditorState(AgentsCommonState, PromptHelpers):
 
         await pubsub.create_subscriber(
             self.router.session.client_token,
-            self.__run["logs_channel"]
+            self.__run["logs_channel"],
+            run_id=self.__run["id"],
         )
 
         self._agentsvc.send_input(self.__run["id"], question, attached_file)
@@ -2058,18 +2059,19 @@ class EditorState(AgentsCommonState, PromptHelpers):
             self.router.session.client_token,
             self.__run["logs_channel"],
             recreate=False,
+            run_id=self.__run["id"],
         )
 
         start = time.time()
         timeout = float(self.app.max_agent_time)  # Ensure this is a float
         while time.time() - start < timeout:
-            message = await channel.get_message(ignore_subscribe_messages=True, timeout=0.05)
+            message = await channel.get_message(timeout=timeout - (time.time() - start))
             if message:
                 try:
                     data = json.loads(message['data'])
                     yield data
                     if isinstance(data, dict) and data.get("type") == AgentLogEventTypes.END:
-                        message = await channel.get_message(ignore_subscribe_messages=True, timeout=0.05)
+                        message = await channel.get_message(timeout=0.05)
                         if message is None:
                             return
                         else:
@@ -176,7 +176,7 @@ class ChatManager:
             else:
                 return ""
 
-        channel = await pubsub.subscribe(reply_channel) # type: ignore
+        channel = await pubsub.subscribe_run_events(run_id, reply_channel)
         start = time.time()
         # NOW send the prompt to the agent after we have created the run and subcribed the logs channel
         # Forward access token to the agent for use in the Slack tool
@@ -188,7 +188,7 @@ class ChatManager:
         )
 
         while time.time() - start < timeout:
-            message = await channel.get_message(ignore_subscribe_messages=True, timeout=0.5)
+            message = await channel.get_message(timeout=timeout - (time.time() - start))
             if message:
                 try:
                     event = json.loads(message['data'])
@@ -196,7 +196,7 @@ class ChatManager:
                     agevent: AgentEvent = EventRegistry.get_event(runlog) # type: ignore
                     yield agevent
                     if isinstance(agevent, AgentEndEvent):
-                        message = await channel.get_message(ignore_subscribe_messages=True, timeout=0.5)
+                        message = await channel.get_message(timeout=0.5)
                         if message is None:
                             await channel.unsubscribe()
                             return
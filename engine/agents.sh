@@ -43,6 +43,8 @@ if [ "$#" -ge 1 ]; then
         docker run -it -v ./storage:/code/storage -e RPC_PORT=9999 --env-file ~/envs/docker-agents.env -p 8080:8080 agents python -m supercog.engine.agent_runner
     elif [ "$1" == "worker" ]; then
         $BASECMD python -m supercog.engine.enginemgr $2
+    elif [ "$1" == "compactlogs" ]; then
+        $BASECMD python -m supercog.engine.chat_logger $2
     elif [ "$1" == "ragservice" ]; then
         $BASECMD python -m supercog.rag.ragservice
     else
@@ -1,187 +1,279 @@
+import importlib
+import json
 import os
+from collections.abc import MutableMapping
+from typing import Iterator
+
+from supercog.shared.services import config
+from supercog.shared.logging import logger
 from supercog.engine.tool_factory import ToolFactory, TOOL_REGISTRY
 
-from supercog.engine.tools.admin_tool               import AdminTool
-from supercog.engine.tools.auth_rest_api_tool       import AuthorizedRESTAPITool
-from supercog.engine.tools.caldav_tool              import CalDAVTool
-from supercog.engine.tools.auto_dynamic_tools       import AutoDynamicTools
-from supercog.engine.tools.csv_tool                 import CSVTool
-from supercog.engine.tools.code_interpreter_tool    import CodeInterpreterTool
-from supercog.engine.tools.database_tool            import DatabaseTool
-from supercog.engine.tools.discord_tool             import DiscordTool
-from supercog.engine.tools.dynamic_agent_tool       import DynamicAgentTool
-from supercog.engine.tools.duckdb                   import DuckdbTool
-from supercog.engine.tools.email_tool               import BasicEmailerTool
-from supercog.engine.tools.emotion_logic            import EmotionLogicTool
-from supercog.engine.tools.excel_tool               import ExcelTool
-from supercog.engine.tools.file_download_tool       import FileDownloadTool
-from supercog.engine.tools.ftp_tool                 import FTPTool
-from supercog.engine.tools.gdocs_tool               import GoogleDocsTool
-from supercog.engine.tools.generate_image           import ImageGeneratorTool
-from supercog.engine.tools.gmail_tool               import GmailAPITool
-from supercog.engine.tools.git_tool                 import GitTool
-from supercog.engine.tools.google_calendar_tool     import GoogleCalendarTool
-from supercog.engine.tools.google_news_tool         import GoogleNewsTool
-from supercog.engine.tools.HubspotCRMTool           import HubspotCRMTool
-from supercog.engine.tools.imap_tool                import IMAPTool
-from supercog.engine.tools.image_analysis           import ImageAnalysisTool
-from supercog.engine.tools.jira_tool                import JIRATool
-from supercog.engine.tools.linkedin_data_tool       import LinkedinDataTool
-from supercog.engine.tools.local_folder_doc_source  import LocalFolderDocSource
-from supercog.engine.tools.mapping_tool             import MappingTool
-from supercog.engine.tools.MatplotlibChartTool      import MatplotlibChartTool
-from supercog.engine.tools.memory_compression_tool  import MemoryCompressionTool
-from supercog.engine.tools.notion                   import NotionDocSource
-from supercog.engine.tools.nmap_tool                import NmapTool
-from supercog.engine.tools.pandas_tool              import PandasTool
-from supercog.engine.tools.playwright_tool          import PlaywrightTool
-from supercog.engine.tools.rag_tool                 import RAGTool
-from supercog.engine.tools.read_file                import ReadFileTool
-from supercog.engine.tools.reflection_tool          import ReflectionTool
-from supercog.engine.tools.rest_api_tool            import RESTAPITool
-from supercog.engine.tools.rest_tool_v2             import RESTAPIToolV2
-from supercog.engine.tools.s3_tool                  import S3Tool
-from supercog.engine.tools.salesforce               import SalesforceTool
-from supercog.engine.tools.salesforce_dev_tool      import SalesforceDevTool
-from supercog.engine.tools.sample_data_tool         import SampleDataTool
-from supercog.engine.tools.scaleserp_browser        import ScaleSerpBrowserTool
-from supercog.engine.tools.servicenow_tool          import ServiceNowCustomTool
-from supercog.engine.tools.slack_tool               import SlackTool, SlackAppSlackTool
-from supercog.engine.tools.sms_tool                 import SMSTool
-from supercog.engine.tools.snowflake_tool           import SnowflakeTool
-from supercog.engine.tools.speech_to_text           import SpeechToTextTool
-from supercog.engine.tools.swagger_tool             import SwaggerTool
-from supercog.engine.tools.tavily_search_tool       import TavilySearchTool
-from supercog.engine.tools.text_to_speech_tool      import TextToSpeechTool
-from supercog.engine.tools.website_docs             import WebsiteDocSource
-from supercog.engine.tools.weather_tool             import WeatherTool
-from supercog.engine.tools.yt_transcription_tool    import YouTubeTranscriptionTool
-from supercog.engine.tools.zap_tool                 import ZapTool
-from supercog.engine.tools.zapier_tool              import ZapierTool
-from supercog.engine.tools.zyte                     import ZyteScraperTool
-from supercog.engine.tools.zyte_screenshot          import ZyteScreenshotTool
-from supercog.engine.tools.swagger_tool             import SwaggerTool
-from supercog.engine.tools.yt_transcription_tool    import YouTubeTranscriptionTool
-from supercog.engine.tools.discord_tool             import DiscordTool
-from supercog.engine.tools.pdf_tool                 import PDFTool
-from supercog.engine.tools.ragie_tool               import RagieTool
-from supercog.engine.tools.google_drive             import GoogleDriveDocSource
-
-
-TOOL_FACTORIES: list[ToolFactory] = [
-    AdminTool(),
-    AuthorizedRESTAPITool(),
-    AutoDynamicTools(),
-    BasicEmailerTool(),
-    CalDAVTool(),
-    CSVTool(),
-    CodeInterpreterTool(),
-    DatabaseTool(),
-    DiscordTool(),
-    DynamicAgentTool(),
-    DuckdbTool(),
-    EmotionLogicTool(),
-    ExcelTool(),
-    FileDownloadTool(),
-    FTPTool(),
-    # GmailAPITool(),
-    GitTool(),
-    # GoogleDocsTool(),
-    GoogleCalendarTool(),
-    GoogleNewsTool(),
-    HubspotCRMTool(),
-    IMAPTool(),
-    ImageAnalysisTool(),
-    ImageGeneratorTool(),
-    JIRATool(),
-    LinkedinDataTool(),
-    LocalFolderDocSource(),
-    MappingTool(),
-    MatplotlibChartTool(),
-    MemoryCompressionTool(),
-    NmapTool(),
-    NotionDocSource(),
-    PandasTool(),
-    PDFTool(),
-    PlaywrightTool(),
-    RAGTool(),
-    # RESTAPITool(),
-    RESTAPIToolV2(),
-    ReadFileTool(),
-    # ReflectionTool(),
-    S3Tool(),
-    SalesforceTool(),
-    SalesforceDevTool(),
-    SampleDataTool(),
-    ScaleSerpBrowserTool(),
-    ServiceNowCustomTool(),
-    SlackTool(),
-    SMSTool(),
-    SnowflakeTool(),
-    SpeechToTextTool(),
-    SwaggerTool(),
-    TavilySearchTool(),
-    TextToSpeechTool(),
-    WebsiteDocSource(),
-    WeatherTool(),
-    YouTubeTranscriptionTool(),
-    ZapTool(),
-    ZapierTool(),
-    ZyteScraperTool(),
-    ZyteScreenshotTool(),
-    RagieTool(),
-    GoogleDriveDocSource(),
-] 
-
-SLACK_TOOL_FACTORIES: list[ToolFactory] = [
-    AutoDynamicTools(),
-    BasicEmailerTool(),
-    CSVTool(),
-    DatabaseTool(),
-    DiscordTool(),
-    DuckdbTool(),
-    ExcelTool(),
-    FileDownloadTool(),
-    FTPTool(),
-    # GmailAPITool(),
-    GitTool(),
-    # GoogleDocsTool(),
-    GoogleNewsTool(),
-    HubspotCRMTool(),
-    IMAPTool(),
-    ImageAnalysisTool(),
-    ImageGeneratorTool(),
-    JIRATool(),
-    LinkedinDataTool(),
-    LocalFolderDocSource(),
-    MatplotlibChartTool(),
-    NotionDocSource(),
-    PDFTool(),
-#    RAGTool(),
-    RagieTool(),
-    RESTAPIToolV2(),
-    ReadFileTool(),
-    S3Tool(),
-    SalesforceTool(),
-    SampleDataTool(),
-    ServiceNowCustomTool(),
-    SlackAppSlackTool(),
-    SMSTool(),
-    SnowflakeTool(),
-    SpeechToTextTool(),
-    TavilySearchTool(),
-    TextToSpeechTool(),
-    WeatherTool(),
-    YouTubeTranscriptionTool(),
-    ZyteScraperTool(),
-    ZyteScreenshotTool(),
-] 
-
-
-if os.environ.get("SPECIAL_TOOLS"):
-    from supercog.engine.tools.native_interpreter import NativeInterpreterTool
-    from supercog.engine.tools.dynamic_tool_builder import DynamicToolBuilder
-    TOOL_FACTORIES.extend([NativeInterpreterTool(), DynamicToolBuilder()])
-
-FACTORY_MAP: dict[str, ToolFactory] = {tf.id: tf for tf in TOOL_FACTORIES + SLACK_TOOL_FACTORIES}
+# Our tool factories, as (module, class name) under supercog.engine.tools.
+#
+# Importing all the tool modules pulls in pandas, duckdb, matplotlib, playwright, llama_index,
+# boto3, snowflake and so on, which makes engine start-up slow. So instead we describe the
+# factories in 'tool_manifest.json' (id, name, category, auth_config, functions, etc...) and
+# only import a factory's module the first time an agent actually uses it.
+#
+# If you add or change a tool then regenerate the manifest with:
+#
+#   python -m supercog.engine.all_tools
+#
+TOOLS_PACKAGE = "supercog.engine.tools"
+
+TOOL_CLASSES: list[tuple[str, str]] = [
+    ("admin_tool",              "AdminTool"),
+    ("auth_rest_api_tool",      "AuthorizedRESTAPITool"),
+    ("auto_dynamic_tools",      "AutoDynamicTools"),
+    ("email_tool",              "BasicEmailerTool"),
+    ("caldav_tool",             "CalDAVTool"),
+    ("csv_tool",                "CSVTool"),
+    ("code_interpreter_tool",   "CodeInterpreterTool"),
+    ("database_tool",           "DatabaseTool"),
+    ("discord_tool",            "DiscordTool"),
+    ("dynamic_agent_tool",      "DynamicAgentTool"),
+    ("duckdb",                  "DuckdbTool"),
+    ("emotion_logic",           "EmotionLogicTool"),
+    ("excel_tool",              "ExcelTool"),
+    ("file_download_tool",      "FileDownloadTool"),
+    ("ftp_tool",                "FTPTool"),
+    # ("gmail_tool",            "GmailAPITool"),
+    ("git_tool",                "GitTool"),
+    # ("gdocs_tool",            "GoogleDocsTool"),
+    ("google_calendar_tool",    "GoogleCalendarTool"),
+    ("google_news_tool",        "GoogleNewsTool"),
+    ("HubspotCRMTool",          "HubspotCRMTool"),
+    ("imap_tool",               "IMAPTool"),
+    ("image_analysis",          "ImageAnalysisTool"),
+    ("generate_image",          "ImageGeneratorTool"),
+    ("jira_tool",               "JIRATool"),
+    ("linkedin_data_tool",      "LinkedinDataTool"),
+    ("local_folder_doc_source", "LocalFolderDocSource"),
+    ("mapping_tool",            "MappingTool"),
+    ("MatplotlibChartTool",     "MatplotlibChartTool"),
+    ("memory_compression_tool", "MemoryCompressionTool"),
+    ("nmap_tool",               "NmapTool"),
+    ("notion",                  "NotionDocSource"),
+    ("pandas_tool",             "PandasTool"),
+    ("pdf_tool",                "PDFTool"),
+    ("playwright_tool",         "PlaywrightTool"),
+    ("rag_tool",                "RAGTool"),
+    # ("rest_api_tool",         "RESTAPITool"),
+    ("rest_tool_v2",            "RESTAPIToolV2"),
+    ("read_file",               "ReadFileTool"),
+    # ("reflection_tool",       "ReflectionTool"),
+    ("s3_tool",                 "S3Tool"),
+    ("salesforce",              "SalesforceTool"),
+    ("salesforce_dev_tool",     "SalesforceDevTool"),
+    ("sample_data_tool",        "SampleDataTool"),
+    ("scaleserp_browser",       "ScaleSerpBrowserTool"),
+    ("servicenow_tool",         "ServiceNowCustomTool"),
+    ("slack_tool",              "SlackTool"),
+    ("sms_tool",                "SMSTool"),
+    ("snowflake_tool",          "SnowflakeTool"),
+    ("speech_to_text",          "SpeechToTextTool"),
+    ("swagger_tool",            "SwaggerTool"),
+    ("tavily_search_tool",      "TavilySearchTool"),
+    ("text_to_speech_tool",     "TextToSpeechTool"),
+    ("website_docs",            "WebsiteDocSource"),
+    ("weather_tool",            "WeatherTool"),
+    ("yt_transcription_tool",   "YouTubeTranscriptionTool"),
+    ("zap_tool",                "ZapTool"),
+    ("zapier_tool",             "ZapierTool"),
+    ("zyte",                    "ZyteScraperTool"),
+    ("zyte_screenshot",         "ZyteScreenshotTool"),
+    ("ragie_tool",              "RagieTool"),
+    ("google_drive",            "GoogleDriveDocSource"),
+]
+
+SLACK_TOOL_CLASSES: list[tuple[str, str]] = [
+    ("auto_dynamic_tools",      "AutoDynamicTools"),
+    ("email_tool",              "BasicEmailerTool"),
+    ("csv_tool",                "CSVTool"),
+    ("database_tool",           "DatabaseTool"),
+    ("discord_tool",            "DiscordTool"),
+    ("duckdb",                  "DuckdbTool"),
+    ("excel_tool",              "ExcelTool"),
+    ("file_download_tool",      "FileDownloadTool"),
+    ("ftp_tool",                "FTPTool"),
+    # ("gmail_tool",            "GmailAPITool"),
+    ("git_tool",                "GitTool"),
+    # ("gdocs_tool",            "GoogleDocsTool"),
+    ("google_news_tool",        "GoogleNewsTool"),
+    ("HubspotCRMTool",          "HubspotCRMTool"),
+    ("imap_tool",               "IMAPTool"),
+    ("image_analysis",          "ImageAnalysisTool"),
+    ("generate_image",          "ImageGeneratorTool"),
+    ("jira_tool",               "JIRATool"),
+    ("linkedin_data_tool",      "LinkedinDataTool"),
+    ("local_folder_doc_source", "LocalFolderDocSource"),
+    ("MatplotlibChartTool",     "MatplotlibChartTool"),
+    ("notion",                  "NotionDocSource"),
+    ("pdf_tool",                "PDFTool"),
+#    ("rag_tool",               "RAGTool"),
+    ("ragie_tool",              "RagieTool"),
+    ("rest_tool_v2",            "RESTAPIToolV2"),
+    ("read_file",               "ReadFileTool"),
+    ("s3_tool",                 "S3Tool"),
+    ("salesforce",              "SalesforceTool"),
+    ("sample_data_tool",        "SampleDataTool"),
+    ("servicenow_tool",         "ServiceNowCustomTool"),
+    ("slack_tool",              "SlackAppSlackTool"),
+    ("sms_tool",                "SMSTool"),
+    ("snowflake_tool",          "SnowflakeTool"),
+    ("speech_to_text",          "SpeechToTextTool"),
+    ("tavily_search_tool",      "TavilySearchTool"),
+    ("text_to_speech_tool",     "TextToSpeechTool"),
+    ("weather_tool",            "WeatherTool"),
+    ("yt_transcription_tool",   "YouTubeTranscriptionTool"),
+    ("zyte",                    "ZyteScraperTool"),
+    ("zyte_screenshot",         "ZyteScreenshotTool"),
+]
+
+# Only enabled with the SPECIAL_TOOLS env var
+SPECIAL_TOOL_CLASSES: list[tuple[str, str]] = [
+    ("native_interpreter",      "NativeInterpreterTool"),
+    ("dynamic_tool_builder",    "DynamicToolBuilder"),
+]
+
+LAZY_TOOL_FACTORIES = config.get_option("LAZY_TOOL_FACTORIES", default="1") != "0"
+MANIFEST_PATH = os.path.join(os.path.dirname(__file__), "tool_manifest.json")
+
+
+def load_factory_class(module: str, class_name: str) -> type[ToolFactory]:
+    return getattr(importlib.import_module(f"{TOOLS_PACKAGE}.{module}"), class_name)
+
+def tool_factory_info(factory: "ToolFactory|LazyToolFactory") -> dict:
+    # The public description of a tool factory (as returned by /tool_factories)
+    if type(factory) is LazyToolFactory:
+        if not FACTORY_MAP.is_loaded(factory.id):
+            return factory.model_dump()
+        # Some tools only offer functions when configured, so prefer the live factory
+        factory = FACTORY_MAP[factory.id]
+    return factory.model_dump(mode="json", include=set(ToolFactory.model_fields) | {"agent_functions"})
+
+def build_manifest() -> list[dict]:
+    # Imports every tool factory and records its metadata
+    manifest = []
+    for module, class_name in dict.fromkeys(TOOL_CLASSES + SLACK_TOOL_CLASSES + SPECIAL_TOOL_CLASSES):
+        factory = load_factory_class(module, class_name)()
+        info = tool_factory_info(factory)
+        info.update({"module": module, "class_name": class_name})
+        manifest.append(info)
+    return manifest
+
+def load_manifest() -> dict[tuple[str, str], dict]:
+    try:
+        with open(MANIFEST_PATH) as f:
+            return {(info["module"], info["class_name"]): info for info in json.load(f)}
+    except FileNotFoundError:
+        logger.warn(f"Tool manifest {MANIFEST_PATH} not found, loading all tools")
+        return {}
+
+
+class ToolFactoryMap(MutableMapping):
+    """ Maps tool factory ids to ToolFactory instances. Static factories are created
+        (and their module imported) the first time they are looked up. """
+    def __init__(self, manifest: list[dict]):
+        self._manifest: dict[str, dict] = {info["id"]: info for info in manifest}
+        self._factories: dict[str, ToolFactory] = {}
+
+    def __getitem__(self, factory_id: str) -> ToolFactory:
+        if factory_id not in self._factories:
+            info = self._manifest[factory_id]
+            logger.info(f"Loading tool factory {info['class_name']}")
+            self._factories[factory_id] = load_factory_class(info["module"], info["class_name"])()
+        return self._factories[factory_id]
+
+    def __setitem__(self, factory_id: str, factory: ToolFactory):
+        self._factories[factory_id] = factory
+
+    def __delitem__(self, factory_id: str):
+        if factory_id not in self:
+            raise KeyError(factory_id)
+        self._factories.pop(factory_id, None)
+        self._manifest.pop(factory_id, None)
+
+    def __contains__(self, factory_id) -> bool:
+        return factory_id in self._factories or factory_id in self._manifest
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(list(dict.fromkeys(list(self._manifest) + list(self._factories))))
+
+    def __len__(self) -> int:
+        return len(set(self._manifest) | set(self._factories))
+
+    def is_loaded(self, factory_id: str) -> bool:
+        return factory_id in self._factories
+
+
+class LazyToolFactory:
+    """ Stands in for a ToolFactory in TOOL_FACTORIES using its manifest entry, so we can
+        list the tools without importing them. Anything that isn't in the manifest is read
+        from the real factory in FACTORY_MAP. """
+    def __init__(self, info: dict):
+        self._info = info
+
+    def __getattr__(self, name: str):
+        info = self.__dict__["_info"]
+        if name in info:
+            return info[name]
+        if name.startswith("__"):
+            # Don't load the tool for protocol checks (like pydantic's isinstance)
+            raise AttributeError(name)
+        return getattr(self.load(), name)
+
+    def factory_class(self) -> type[ToolFactory]:
+        # Imports the tool's module
+        return type(self.load())
+
+    def load(self) -> ToolFactory:
+        return FACTORY_MAP[self._info["id"]]
+
+    def model_dump(self, **kwargs) -> dict:
+        return {k: v for k, v in self._info.items() if k not in ("module", "class_name")}
+
+    def __repr__(self) -> str:
+        return f"LazyToolFactory({self._info['id']})"
+
+
+def _make_factories(classes: list[tuple[str, str]]) -> list[ToolFactory|LazyToolFactory]:
+    factories = []
+    for module, class_name in classes:
+        info = MANIFEST.get((module, class_name))
+        if LAZY_TOOL_FACTORIES and info is not None:
+            factories.append(LazyToolFactory(info))
+        else:
+            factories.append(load_factory_class(module, class_name)())
+    return factories
+
+def _tool_classes() -> tuple[list[tuple[str, str]], list[tuple[str, str]]]:
+    if os.environ.get("SPECIAL_TOOLS"):
+        return TOOL_CLASSES + SPECIAL_TOOL_CLASSES, SLACK_TOOL_CLASSES
+    return TOOL_CLASSES, SLACK_TOOL_CLASSES
+
+
+MANIFEST = load_manifest()
+_classes, _slack_classes = _tool_classes()
+TOOL_FACTORIES: list[ToolFactory|LazyToolFactory] = _make_factories(_classes)
+SLACK_TOOL_FACTORIES: list[ToolFactory|LazyToolFactory] = _make_factories(_slack_classes)
+
+FACTORY_MAP = ToolFactoryMap([MANIFEST[c] for c in dict.fromkeys(_classes + _slack_classes) if c in MANIFEST])
+for tf in TOOL_FACTORIES + SLACK_TOOL_FACTORIES:
+    if type(tf) is not LazyToolFactory:
+        FACTORY_MAP[tf.id] = tf
 TOOL_REGISTRY.load_registry_from_filesystem()
+
+def __getattr__(name: str):
+    # Keep 'from supercog.engine.all_tools import WeatherTool' working
+    for module, class_name in TOOL_CLASSES + SLACK_TOOL_CLASSES + SPECIAL_TOOL_CLASSES:
+        if class_name == name:
+            return load_factory_class(module, class_name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+if __name__ == "__main__":
+    manifest = build_manifest()
+    with open(MANIFEST_PATH, "w") as f:
+        json.dump(manifest, f, indent=2)
+        f.write("\n")
+    print(f"Wrote {len(manifest)} tool factories to {MANIFEST_PATH}")
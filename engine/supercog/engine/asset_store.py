@@ -0,0 +1,192 @@
+import asyncio
+import hashlib
+import io
+import json
+import os
+import tempfile
+import time
+from typing import AsyncIterator, Callable, Optional
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import redis.asyncio as redis
+
+from supercog.shared.logging import logger
+from supercog.shared.services import config
+from supercog.shared.utils import get_boto_client
+
+from .filesystem import unrestricted_filesystem
+
+# Assets (dataframes, long tool results, etc...) are created while the agent is running
+# and served by the /asset endpoint. Small assets are kept in Redis, with their metadata,
+# written in one pipelined round trip. Larger assets "spill" to the local filesystem or
+# to S3 and Redis just keeps a pointer to them.
+
+ASSET_TTL = int(config.get_option("ASSET_TTL", default=60*60*24))
+ASSET_INLINE_MAX_BYTES = int(config.get_option("ASSET_INLINE_MAX_KB", default=256)) * 1024
+ASSET_SPILL_STORE = config.get_option("ASSET_SPILL_STORE", default="local")  # "local" or "s3"
+ASSET_SPILL_DIR = config.get_option("ASSET_SPILL_DIR", default=os.path.join(tempfile.gettempdir(), "supercog_assets"))
+ASSET_S3_PREFIX = "assets/"
+READ_CHUNK_SIZE = 256 * 1024
+
+PARQUET_CONTENT_TYPE = "application/vnd.apache.parquet"
+
+def dataframe_to_parquet(df: pd.DataFrame|pa.Table) -> bytes:
+    buffer = io.BytesIO()
+    if isinstance(df, pa.Table):
+        pq.write_table(df, buffer)
+        return buffer.getvalue()
+    try:
+        df.to_parquet(buffer, index=False)
+    except Exception:
+        # Arrow can't store every object column (like mixed types), so those become strings
+        df = df.rename(columns=str)
+        for column in df.select_dtypes(include="object").columns:
+            df[column] = df[column].astype(str)
+        buffer = io.BytesIO()
+        df.to_parquet(buffer, index=False)
+    return buffer.getvalue()
+
+
+class LocalSpillStore:
+    """ Keeps large assets as files in a local directory. This can be called while an
+        agent is running, so we lift the agent filesystem restrictions. """
+    name = "local"
+
+    def __init__(self, directory: str = ASSET_SPILL_DIR, ttl: int = ASSET_TTL):
+        self.directory = directory
+        self.ttl = ttl
+        self.last_sweep = 0.0
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, hashlib.sha256(key.encode()).hexdigest())
+
+    def put(self, key: str, content: bytes) -> str:
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with unrestricted_filesystem(), open(tmp_path, "wb") as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+        self.sweep()
+        return path
+
+    def read(self, location: str) -> Optional[Callable[[], Optional[bytes]]]:
+        try:
+            with unrestricted_filesystem():
+                f = open(location, "rb")
+        except FileNotFoundError:
+            return None
+        def read_chunk() -> Optional[bytes]:
+            chunk = f.read(READ_CHUNK_SIZE)
+            if not chunk:
+                f.close()
+                return None
+            return chunk
+        return read_chunk
+
+    def sweep(self):
+        # Removes expired assets, at most once an hour
+        now = time.time()
+        if now - self.last_sweep < 3600:
+            return
+        self.last_sweep = now
+        for entry in os.scandir(self.directory):
+            try:
+                if entry.stat().st_mtime < now - self.ttl:
+                    os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+
+
+class S3SpillStore:
+    """ Keeps large assets in the files bucket. Expiry is left to the bucket's lifecycle rules. """
+    name = "s3"
+
+    def __init__(self, bucket: str|None = None, client_factory: Callable = get_boto_client):
+        self.bucket = bucket or config.get_global("S3_FILES_BUCKET_NAME")
+        self.client_factory = client_factory
+        self._client = None
+
+    def get_client(self):
+        if self._client is None:
+            self._client = self.client_factory("s3")
+        return self._client
+
+    def put(self, key: str, content: bytes) -> str:
+        object_name = ASSET_S3_PREFIX + key
+        self.get_client().put_object(Bucket=self.bucket, Key=object_name, Body=content)
+        return object_name
+
+    def read(self, location: str) -> Optional[Callable[[], Optional[bytes]]]:
+        try:
+            body = self.get_client().get_object(Bucket=self.bucket, Key=location)["Body"]
+        except Exception as e:
+            logger.error(f"Error reading asset {location} from S3: {e}")
+            return None
+        chunks = body.iter_chunks(READ_CHUNK_SIZE)
+        return lambda: next(chunks, None)
+
+
+class AssetStore:
+    def __init__(self, spill_store=None, get_client: Callable|None = None):
+        if spill_store is None:
+            spill_store = S3SpillStore() if ASSET_SPILL_STORE == "s3" else LocalSpillStore()
+        self.spill_store = spill_store
+        self._get_client = get_client
+        self._client = None
+
+    async def get_client(self) -> redis.Redis:
+        if self._get_client:
+            return await self._get_client()
+        if self._client is None:
+            # Assets are binary, so we can't share the pubsub client which decodes responses
+            url = config.get_global("REDIS_URL", False)
+            self._client = redis.from_url(url or "redis://localhost", decode_responses=False)
+        return self._client
+
+    async def put(self, key: str, content: bytes|str, content_type: str, ttl: int = ASSET_TTL):
+        if isinstance(content, str):
+            content = content.encode("utf-8")
+        meta = {"content_type": content_type, "size": len(content), "store": "redis"}
+        if len(content) > ASSET_INLINE_MAX_BYTES:
+            location = await asyncio.to_thread(self.spill_store.put, key, content)
+            meta |= {"store": self.spill_store.name, "location": location}
+            content = b""
+
+        client = await self.get_client()
+        async with client.pipeline(transaction=False) as pipe:
+            pipe.set(key + "/meta", json.dumps(meta), ex=ttl)
+            if meta["store"] == "redis":
+                pipe.set(key, content, ex=ttl)
+            await pipe.execute()
+
+    async def get(self, key: str) -> tuple[Optional[AsyncIterator[bytes]], Optional[str]]:
+        """ Returns an async iterator over the asset's content, and its content type. """
+        client = await self.get_client()
+        meta, content = await client.mget([key + "/meta", key])
+        if meta is None:
+            return None, None
+        meta = json.loads(meta)
+
+        if meta["store"] == "redis":
+            if content is None:
+                return None, None
+            async def inline():
+                yield content
+            return inline(), meta["content_type"]
+
+        if meta["store"] != self.spill_store.name:
+            logger.error(f"Asset {key} is in the '{meta['store']}' store, but we're using '{self.spill_store.name}'")
+            return None, None
+        read_chunk = await asyncio.to_thread(self.spill_store.read, meta["location"])
+        if read_chunk is None:
+            return None, None
+
+        async def spilled():
+            while (chunk := await asyncio.to_thread(read_chunk)) is not None:
+                yield chunk
+        return spilled(), meta["content_type"]
+
+asset_store = AssetStore()
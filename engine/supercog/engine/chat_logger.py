@@ -1,9 +1,17 @@
+import asyncio
 import redis.asyncio as redis
 from typing import AsyncIterator, Optional, Sequence
 import json
 import os
+import sys
+import time
+from collections import deque
+from datetime import datetime, timedelta
+from uuid import UUID
 
 from sqlmodel import Session, select
+from sqlalchemy import insert, update, delete, func, or_
+from sqlalchemy.exc import OperationalError
 
 from fastapi import FastAPI
 from fastapi_lifespan_manager import LifespanManager, State
@@ -11,56 +19,213 @@ from fastapi_lifespan_manager import LifespanManager, State
 from supercog.shared.pubsub import REDIS_HOST, REDIS_PORT
 from supercog.shared.apubsub import pubsub
 from supercog.shared.models import RunLogBase
-from supercog.shared.services import db_connect
+from supercog.shared.services import config, db_connect
 from supercog.shared.apubsub import AgentLogEventTypes, EventRegistry, TokenUsageEvent
 
-from .db import lifespan_manager, RunLog, Run
+from .db import lifespan_manager, RunLog, RunLogCompaction, Run
 
 
 MYDEBUG = os.environ.get('CHAT_LOG_DEBUG')
+FLUSH_MAX_ROWS = int(config.get_option("CHAT_LOG_FLUSH_ROWS", default=200))
+FLUSH_INTERVAL = int(config.get_option("CHAT_LOG_FLUSH_MS", default=250)) / 1000.0
+# Most rows we buffer while the database is unavailable, older rows are dropped past this
+MAX_QUEUE_ROWS = int(config.get_option("CHAT_LOG_MAX_QUEUE_ROWS", default=50000))
+# Flushes a batch may fail (with no row getting written) before its rows are dead-lettered
+MAX_FLUSH_ATTEMPTS = int(config.get_option("CHAT_LOG_MAX_FLUSH_ATTEMPTS", default=20))
+DEAD_LETTER_ROWS = 1000
 
 class ChatLogger:
+    # Persists the events published on the logs* channels as RunLog rows. Events are
+    # buffered in memory and written behind with multi-row inserts, either when the
+    # buffer reaches FLUSH_MAX_ROWS or every FLUSH_INTERVAL seconds. Token usage
+    # is summed per run and applied with a single UPDATE per run per flush.
+    #
+    # If a batch insert fails we insert its rows one by one, so one bad row can't hold back
+    # the rest. Rows that still fail are dead-lettered (kept in memory and logged). If no row
+    # can be written, or we can't connect, the database is probably down, so the batch is
+    # retried on the next flush, up to MAX_FLUSH_ATTEMPTS times.
     def __init__(self):
         self.client = None
         self.next_logs: dict[str, RunLog] = {}
         self.engine = db_connect("engine") 
+        self.pending_logs: list[dict] = []
+        self.pending_tokens: dict[str, list[int]] = {}
+        self.flush_lock = asyncio.Lock()
+        self.flusher_task: Optional[asyncio.Task] = None
+        self.rows_flushed = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self.failed_flushes = 0
+        self.rows_dropped = 0
+        self.dead_letters: deque[dict] = deque(maxlen=DEAD_LETTER_ROWS)
+        self.rows_dead_lettered = 0
 
     def reconnect(self):
         self.engine.dispose()
         self.engine = db_connect("engine")
 
-    async def save_event(self, event, session: Session):
-        # Always saves a new run_log record
+    def queue_event(self, event: dict):
         log = RunLog.model_validate(event)
-        session.add(log)
-        session.commit()
+        self.pending_logs.append(log.model_dump(exclude={"id"}))
+        if len(self.pending_logs) > MAX_QUEUE_ROWS:
+            overflow = len(self.pending_logs) - MAX_QUEUE_ROWS
+            del self.pending_logs[:overflow]
+            self.rows_dropped += overflow
+            print(f"Chat log queue is full, dropped {overflow} rows ({self.rows_dropped} total)")
 
-    async def update_token_usage(self, event, session: Session):
+    def queue_token_usage(self, event: dict):
         if 'run_id' not in event:
             return
-        # Might be worth just doing this as an update query
-        run = session.get(Run, event['run_id'])
         runlog = RunLogBase.model_validate(event)
         agevent = EventRegistry.get_event(runlog)
-        if run and isinstance(agevent, TokenUsageEvent):
-            run.input_tokens += int(agevent.usage_metadata.get("input_tokens", 0))
-            run.output_tokens += int(agevent.usage_metadata.get("output_tokens", 0))
-            session.add(run)
-            session.commit()
+        if isinstance(agevent, TokenUsageEvent):
+            totals = self.pending_tokens.setdefault(event['run_id'], [0, 0])
+            totals[0] += int(agevent.usage_metadata.get("input_tokens", 0))
+            totals[1] += int(agevent.usage_metadata.get("output_tokens", 0))
 
     async def start(self):
         print(f"########## STARTING CHAT LOGGER ############ {id(self)}")
         await pubsub.subscribe("logs*", self.receive_message)
+        self.flusher_task = asyncio.create_task(self.run_flusher())
+
+    async def stop(self):
+        if self.flusher_task:
+            self.flusher_task.cancel()
+            try:
+                await self.flusher_task
+            except asyncio.CancelledError:
+                pass
+            self.flusher_task = None
+        await self.flush()
+
+    async def run_flusher(self):
+        while True:
+            await asyncio.sleep(FLUSH_INTERVAL)
+            try:
+                await self.flush()
+            except Exception as e:
+                print(f"Error flushing chat logs: {e}")
 
     async def receive_message(self, event_type: str, event: dict):
         if MYDEBUG:
             print(f"[CHAT LOGGER EVENT {id(self)}] ", event)
+        self.queue_event(event)
+        if event_type == AgentLogEventTypes.TOKEN_USAGE:
+            self.queue_token_usage(event)
+        # While flushes are failing we leave the retries to the flusher
+        if len(self.pending_logs) >= FLUSH_MAX_ROWS and not self.failed_flushes:
+            try:
+                await self.flush()
+            except Exception as e:
+                # The rows stay queued for the flusher, don't fail the subscriber
+                print(f"Error flushing chat logs: {e}")
+
+    async def flush(self):
+        async with self.flush_lock:
+            if not self.pending_logs and not self.pending_tokens:
+                return
+            logs, self.pending_logs = self.pending_logs, []
+            tokens, self.pending_tokens = self.pending_tokens, {}
+            start = time.perf_counter()
+            try:
+                await asyncio.to_thread(self._write_batch, logs, tokens)
+            except Exception as e:
+                print(f"Error writing chat log batch of {len(logs)} rows: {e}")
+                if isinstance(e, OperationalError):
+                    # We can't reach the database, so writing row by row won't help
+                    written, failed_logs, failed_tokens = 0, logs, tokens
+                else:
+                    written, failed_logs, failed_tokens = await asyncio.to_thread(self._write_rows, logs, tokens)
+                if written:
+                    self.failed_flushes = 0
+                    self.dead_letter(failed_logs, failed_tokens)
+                else:
+                    self.failed_flushes += 1
+                    if self.failed_flushes >= MAX_FLUSH_ATTEMPTS:
+                        self.failed_flushes = 0
+                        self.dead_letter(failed_logs, failed_tokens)
+                    else:
+                        self.requeue(failed_logs, failed_tokens)
+                    raise
+                rows = len(logs) - len(failed_logs)
+            else:
+                self.failed_flushes = 0
+                rows = len(logs)
+            self.last_flush_ms = (time.perf_counter() - start) * 1000
+            self.max_flush_ms = max(self.max_flush_ms, self.last_flush_ms)
+            self.rows_flushed += rows
+
+    def requeue(self, logs: list[dict], tokens: dict[str, list[int]]):
+        # Put the rows back in front of the queue so we retry them on the next flush
+        self.pending_logs = logs + self.pending_logs
+        for run_id, (input_tokens, output_tokens) in tokens.items():
+            totals = self.pending_tokens.setdefault(run_id, [0, 0])
+            totals[0] += input_tokens
+            totals[1] += output_tokens
+
+    def dead_letter(self, logs: list[dict], tokens: dict[str, list[int]]):
+        for log in logs:
+            print(f"Dead-lettered chat log row for run {log.get('run_id')}: {log.get('type')}")
+            self.dead_letters.append(log)
+        for run_id, (input_tokens, output_tokens) in tokens.items():
+            print(f"Dead-lettered token usage for run {run_id}: {input_tokens} in, {output_tokens} out")
+            self.dead_letters.append({"run_id": run_id, "input_tokens": input_tokens, "output_tokens": output_tokens})
+        self.rows_dead_lettered += len(logs) + len(tokens)
+
+    def _write_rows(self, logs: list[dict], tokens: dict[str, list[int]]) -> tuple[int, list[dict], dict[str, list[int]]]:
+        # Writes each row (and each run's token usage) on its own. Returns the number of rows
+        # written, and the rows and token totals which failed.
+        written = 0
+        failed_logs: list[dict] = []
+        failed_tokens: dict[str, list[int]] = {}
+        for log in logs:
+            try:
+                self._write_batch([log], {})
+                written += 1
+            except Exception:
+                failed_logs.append(log)
+        for run_id, totals in tokens.items():
+            try:
+                self._write_batch([], {run_id: totals})
+                written += 1
+            except Exception:
+                failed_tokens[run_id] = totals
+        return written, failed_logs, failed_tokens
+
+    def _write_batch(self, logs: list[dict], tokens: dict[str, list[int]]):
         with Session(self.engine) as session:
-            await self.save_event(event, session)
-            if event_type == AgentLogEventTypes.TOKEN_USAGE:
-                await self.update_token_usage(event, session)
+            if logs:
+                session.execute(insert(RunLog), logs)
+            for run_id, (input_tokens, output_tokens) in tokens.items():
+                try:
+                    run_uuid = UUID(run_id)
+                except ValueError:
+                    continue
+                session.execute(
+                    update(Run)
+                    .where(Run.id == run_uuid)
+                    .values(
+                        input_tokens=Run.input_tokens + input_tokens,
+                        output_tokens=Run.output_tokens + output_tokens,
+                    )
+                )
+            session.commit()
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": len(self.pending_logs),
+            "pending_token_runs": len(self.pending_tokens),
+            "rows_flushed": self.rows_flushed,
+            "last_flush_ms": round(self.last_flush_ms, 2),
+            "max_flush_ms": round(self.max_flush_ms, 2),
+            "failed_flushes": self.failed_flushes,
+            "rows_dropped": self.rows_dropped,
+            "rows_dead_lettered": self.rows_dead_lettered,
+        }
 
     async def retrieve_run_history(self, run_id: str) -> Sequence[RunLog]:
+        # Make sure any buffered logs are written first
+        await self.flush()
         with Session(self.engine) as session:
             query = select(RunLog).where(
                 RunLog.run_id == run_id
@@ -69,6 +234,78 @@ class ChatLogger:
             )
             return session.exec(query).all()
 
+    def compact_output_logs(self, run_id: str) -> int:
+        # Merges runs of adjacent OUTPUT rows that share an lc_run_id into a single row. Older
+        # runs stored one row per streamed chunk, which makes them slow to replay. Rows without
+        # an lc_run_id can't be attributed to an LLM call, so they are left alone.
+        # Returns the number of rows removed, and records that the run was compacted.
+        with Session(self.engine) as session:
+            logs = session.exec(
+                select(RunLog).where(RunLog.run_id == run_id).order_by(RunLog.created_at.asc(), RunLog.id.asc())
+            ).all()
+            removed_ids: list[int] = []
+            segment: list[tuple[RunLog, dict]] = []
+
+            def merge_segment():
+                if len(segment) > 1:
+                    first, first_event = segment[0]
+                    first_event["str_result"] = "".join(event["str_result"] for _, event in segment)
+                    first.content = json.dumps(first_event)
+                    session.add(first)
+                    removed_ids.extend(log.id for log, _ in segment[1:])
+                segment.clear()
+
+            for log in logs:
+                event = None
+                if log.type == AgentLogEventTypes.OUTPUT:
+                    try:
+                        event = json.loads(log.content)
+                    except json.JSONDecodeError:
+                        event = None
+                    if event and (event.get("object_result") or not isinstance(event.get("str_result"), str)):
+                        event = None
+                # The lc_run_id is only recorded inside the event content
+                if event is None or not event.get("lc_run_id"):
+                    merge_segment()
+                    continue
+                if segment and (
+                    segment[0][1].get("lc_run_id") != event.get("lc_run_id") or segment[0][0].role != log.role
+                ):
+                    merge_segment()
+                segment.append((log, event))
+            merge_segment()
+
+            if removed_ids:
+                session.execute(delete(RunLog).where(RunLog.id.in_(removed_ids)))
+            session.merge(RunLogCompaction(run_id=run_id, compacted_at=datetime.utcnow()))
+            session.commit()
+            return len(removed_ids)
+
+    def compact_old_runs(self, older_than: timedelta, limit: int = 1000) -> int:
+        # Compacts the output logs of runs with no output newer than 'older_than', skipping
+        # runs which haven't logged any output since they were last compacted. Oldest first,
+        # so repeated calls work through the backlog.
+        cutoff = datetime.utcnow() - older_than
+        last_output = func.max(RunLog.created_at)
+        compacted_at = func.max(RunLogCompaction.compacted_at)
+        with Session(self.engine) as session:
+            run_ids = session.exec(
+                select(RunLog.run_id)
+                .outerjoin(RunLogCompaction, RunLogCompaction.run_id == RunLog.run_id)
+                .where(RunLog.type == AgentLogEventTypes.OUTPUT)
+                .group_by(RunLog.run_id)
+                .having(last_output < cutoff)
+                .having(func.count() > 1)
+                .having(or_(compacted_at.is_(None), last_output > compacted_at))
+                .order_by(last_output.asc(), RunLog.run_id)
+                .limit(limit)
+            ).all()
+        removed = 0
+        for run_id in run_ids:
+            removed += self.compact_output_logs(run_id)
+        print(f"Compacted output logs for {len(run_ids)} runs, removed {removed} rows")
+        return removed
+
     @staticmethod
     def generate_output(run: Run, message: str) -> RunLogBase:
         return RunLogBase(
@@ -107,5 +344,11 @@ def activate_chatlogger():
     async def startup(app: FastAPI) -> AsyncIterator[State]:
         await chat_logger.start()
         yield {"chat_logger": chat_logger}
+        await chat_logger.stop()
     
 
+if __name__ == "__main__":
+    # Compact the output logs of older runs:
+    #   python -m supercog.engine.chat_logger [days]
+    days = int(sys.argv[1]) if len(sys.argv) > 1 else 7
+    chat_logger.compact_old_runs(timedelta(days=days))
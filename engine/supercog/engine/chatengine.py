@@ -15,6 +15,7 @@ from uuid import uuid4
 
 from openai import OpenAI
 import pandas as pd
+import pyarrow as pa
 import re
 from typing import Union
 from langchain_openai import ChatOpenAI
@@ -31,7 +32,7 @@ import asyncio
 from typing import Dict, List, Any, Union, Optional, AsyncIterator
 
 
-from langchain_core.runnables.base import RunnableSequence, RunnableBinding
+from langchain_core.runnables.base import Runnable, RunnableSequence, RunnableBinding
 
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder, PromptTemplate, HumanMessagePromptTemplate
 from langchain_core.language_models.chat_models import BaseChatModel
@@ -53,7 +54,8 @@ from langchain.callbacks.manager import CallbackManager
 
 from sqlmodel import select
 
-from supercog.engine.all_tools import FACTORY_MAP, ToolFactory, ReadFileTool
+from supercog.engine.all_tools import FACTORY_MAP, ToolFactory
+from supercog.engine.tools.read_file import ReadFileTool
 from supercog.engine.tools.s3_utils import get_file_from_s3, put_file_to_s3, list_files
 
 from supercog.shared.utils import dict_safe_get, parse_markdown, NodeTypes
@@ -85,6 +87,7 @@ from .tools.agent_tool import AgentTool
 from .tools.dynamic_agent_tool import DynamicAgentTool
 from .tools.basic_data import BasicDataTool
 from .run_context import RunContext, ContextInit
+from .result_spool import SpooledResult
 from .history_compression_manager import HistoryCompressionManager
 from .tools.memory_compression_tool import MEMORY_COMPRESSION_TOOL_ID, MemoryCompressionTool
 from .rag_utils import get_available_indexes
@@ -152,6 +155,22 @@ class InterruptableAgentExecutor(AgentExecutor):
                 ]
             await self._update_llm_tools()
 
+    async def replace_llm(self, llm: Runnable) -> None:
+        """Swap the LLM step of the agent, keeping the prompt and the tools."""
+        async with self._tool_lock:
+            middle = self.agent.runnable.middle
+            for i in range(len(middle)):
+                if isinstance(middle[i], (BaseChatModel, RunnableBinding)):
+                    middle[i] = llm
+
+    def get_llm(self) -> Optional[Runnable]:
+        """Returns the LLM step of the agent."""
+        if hasattr(self.agent, 'runnable') and isinstance(self.agent.runnable, RunnableSequence):
+            for step in self.agent.runnable.middle:
+                if isinstance(step, (BaseChatModel, RunnableBinding)):
+                    return step
+        return None
+
     async def _update_llm_tools(self) -> None:
         """Update the LLM's knowledge of available tools."""
         if hasattr(self.agent, 'runnable') and isinstance(self.agent.runnable, RunnableSequence):
@@ -221,7 +240,13 @@ class ChatEngine(BaseCallbackHandler):
         self.history_compression_manager = HistoryCompressionManager()
         # The set of RAG indexes enabled for this agent
         self.doc_indexes: list[DocIndexReference] = []
-
+        self.agent_executor: InterruptableAgentExecutor|None = None
+        # What the current agent was built from, so create_agent only rebuilds what changed
+        self._build_keys: dict|None = None
+        # Tools built for this run, keyed by tool_cache_key, so we can reuse unchanged ones
+        self._tool_cache: dict[tuple, tuple[ToolFactory, list[Callable], Callable|None]] = {}
+        self._secrets_version: tuple|None = None
+        self._preset_tools: list[Callable] = []
 
     def reset(self):
         self.chat_history = []
@@ -234,6 +259,24 @@ class ChatEngine(BaseCallbackHandler):
             "generating": self.generating,
         }
 
+    def estimate_memory_size(self) -> int:
+        # Rough estimate of the memory held by this engine, used to budget the engine cache.
+        # We count the chat history and any DataFrames held for the tools, which dominate.
+        size = 64 * 1024 # baseline for the LLM client, prompt and tool factories
+        for msg in self.chat_history:
+            size += len(str(msg.content))
+        for value in self.tools_inmem_state.values():
+            if isinstance(value, pd.DataFrame):
+                size += int(value.memory_usage(deep=True).sum())
+            elif isinstance(value, pa.Table):
+                size += value.nbytes
+            elif isinstance(value, SpooledResult):
+                # Only the first batch is held in memory
+                size += value.head.nbytes
+            else:
+                size += sys.getsizeof(value)
+        return size
+
     @property
     def agent(self):
         if self._agent_model is None:
@@ -281,7 +324,9 @@ class ChatEngine(BaseCallbackHandler):
         )
 
         self.chat_history = []
-        await self.create_agent()
+        # New RunContext, so don't reuse anything built for the old one
+        self._tool_cache = {}
+        await self.create_agent(force=True)
 
     async def update_agent(self, newagent: AgentBase):
         if not self.generating:
@@ -305,6 +350,9 @@ class ChatEngine(BaseCallbackHandler):
         if self.pending_agent_updates:
             await self.update_agent(self.pending_agent_updates[-1])
             self.pending_agent_updates.clear()
+        elif self.agent_executor is not None and self._secrets_version != secrets_service.cache.version(self.tenant_id):
+            # The tenant's secrets changed since we built the tools, so rebuild the ones with credentials
+            await self.create_agent(self._preset_tools)
 
 
 
@@ -345,21 +393,70 @@ class ChatEngine(BaseCallbackHandler):
                 return cred
         return None
 
-    def make_agent_tool(self, tool: ToolBase) -> Callable:
+    def make_agent_tool(self, tool: ToolBase) -> tuple[ToolFactory, Callable]:
         agentTool = AgentTool()
         agentTool.run_context = self.run_context
         agentTool.inmem_state = self.tools_inmem_state
-        self.tool_factories.append(agentTool)
         agent_id = tool.tool_factory_id.split(":")[1]
-        return agentTool.get_tools(agent_id, tool.tool_name)[0]
+        return agentTool, agentTool.get_tools(agent_id, tool.tool_name)[0]
+
+    def tool_cache_key(self, tool: ToolBase) -> tuple:
+        # Tools with a credential are rebuilt when the tenant's secrets change
+        secrets_version = secrets_service.cache.version(self.tenant_id) if tool.credential_id else None
+        return (tool.tool_factory_id, tool.tool_name, tool.credential_id, secrets_version)
+
+    def build_agent_tool(self, tool: ToolBase) -> Optional[tuple[ToolFactory, list[Callable], Callable|None]]:
+        # Constructs the ToolFactory for one of the agent's tools, and returns it with its 
+        # tool functions and its LLM context function (if any). Returns None if we can't
+        # load the tool.
+        if tool.tool_factory_id.startswith("agent:"):
+            agentTool, func = self.make_agent_tool(tool)
+            return agentTool, [func], None
+
+        # handle normal tools
+        try:
+            factory: ToolFactory = FACTORY_MAP[tool.tool_factory_id]
+        except Exception as e:
+            # fixme: ARO: 6/8/24 this happens when load_agent_tools is called before the get_tools request
+            #        from the dashboard. That currently causes dynamic tools to load. Static tools
+            #        are loaded statically but we can't load the dynamic tools until we know the tenant_id.
+            error_msg = f"Failed to load tool missing from FACTORY_MAP {tool.tool_factory_id}. Error: {e}. Skipping tool"
+            logger.error(error_msg)
+            return None
+        tool_fact: ToolFactory = factory.__class__()
+        if tool.tool_name:
+            tool_fact.system_name = tool.tool_name
+        tool_fact.run_context = self.run_context
+        tool_fact.inmem_state = self.tools_inmem_state
+
+        if not tool.credential_id:
+            # special case for tool that needs no creds
+            return tool_fact, self._markup(tool_fact._get_full_agent_tools(), tool_fact.system_name), None
+
+        cred = self.get_tool_credential(tool)
+        if cred is None:
+            print("CANT FIND CRED FOR TOOL: ", tool)
+            print("Skipping tool")
+            return None
+        secrets = cred.retrieve_secrets()
+        secrets = tool_fact.prepare_creds(cred, secrets)
+        tool_fact.credentials = secrets
+        tool_fact.credential_id = tool.credential_id
+        llm_context = None
+        if hasattr(factory, "get_llm_context"):
+            func = getattr(factory, "get_llm_context")
+            llm_context = partial(func, secrets)
+        return tool_fact, self._markup(tool_fact._get_full_agent_tools(), tool_fact.system_name), llm_context
 
     def load_agent_tools(self) -> list[Callable]:
         # Load the tools for the LLM agent. For each tool we need to retrieve
         # it's Credential and load the plaintext secrets. Then we construct
         # a partial tool func that passes the secrets into the function so
-        # they can be used inside the tool.
+        # they can be used inside the tool. Tools we already built for this
+        # run are reused, so only new or changed tools are constructed.
         llm_tools: list[Callable] = []
         self.tool_factories = []
+        tool_cache: dict[tuple, tuple[ToolFactory, list[Callable], Callable|None]] = {}
 
         preset_tools = []
         auto_tools = ['basic_data_functions']
@@ -371,42 +468,17 @@ class ChatEngine(BaseCallbackHandler):
 
         self.inject_llm_context = None
         for tool in ((self.run_tools or self.agent.tool_list) + preset_tools):
-            if tool.tool_factory_id.startswith("agent:"):
-                llm_tools.append(self.make_agent_tool(tool))
-            else:
-                # handle normal tools
-                try:
-                    factory: ToolFactory = FACTORY_MAP[tool.tool_factory_id]
-                except Exception as e:
-                    # fixme: ARO: 6/8/24 this happens when load_agent_tools is called before the get_tools request
-                    #        from the dashboard. That currently causes dynamic tools to load. Static tools
-                    #        are loaded statically but we can't load the dynamic tools until we know the tenant_id.
-                    error_msg = f"Failed to load tool missing from FACTORY_MAP {tool.tool_factory_id}. Error: {e}. Skipping tool"
-                    logger.error(error_msg)
-                    continue
-                tool_fact: ToolFactory = factory.__class__()
-                if tool.tool_name:
-                    tool_fact.system_name = tool.tool_name
-                tool_fact.run_context = self.run_context
-                self.tool_factories.append(tool_fact)
-                tool_fact.inmem_state = self.tools_inmem_state
-
-                if not tool.credential_id:
-                    # special case for tool that needs no creds
-                    llm_tools.extend(self._markup(tool_fact._get_full_agent_tools(), tool_fact.system_name))
-                else:
-                    cred = self.get_tool_credential(tool)
-                    if cred is not None:
-                        secrets = cred.retrieve_secrets()
-                        secrets = tool_fact.prepare_creds(cred, secrets)
-                        tool_fact.credentials = secrets
-                        llm_tools.extend(self._markup(tool_fact._get_full_agent_tools(), tool_fact.system_name))
-                        if hasattr(factory, "get_llm_context"):
-                            func = getattr(factory, "get_llm_context")
-                            self.inject_llm_context = partial(func, secrets)
-                    else:
-                        print("CANT FIND CRED FOR TOOL: ", tool)
-                        print("Skipping tool")
+            key = self.tool_cache_key(tool)
+            built = tool_cache.get(key) or self._tool_cache.get(key) or self.build_agent_tool(tool)
+            if built is None:
+                continue
+            tool_cache[key] = built
+            tool_fact, funcs, llm_context = built
+            self.tool_factories.append(tool_fact)
+            llm_tools.extend(funcs)
+            if llm_context is not None:
+                self.inject_llm_context = llm_context
+        self._tool_cache = tool_cache
 
         # Remove any duplicate functions
         new_list = []
@@ -539,54 +611,32 @@ class ChatEngine(BaseCallbackHandler):
         return datetime_message
 
         
-    async def create_agent(self, preset_tools: list[Callable] = []):
-        print("Agent model is: ",self.agent.model)
-        if 'claude' in self.agent.model:
-            self.required_token_var = "CLAUDE_API_KEY"
-        elif self.agent.model in GROQ_MODELS:
-            self.required_token_var = "GROQ_API_KEY"
-        else:
-            self.required_token_var = "OPENAI_API_KEY"
-
-        api_key = self.run_context.secrets.get(self.required_token_var)
-
-        self.enabled_tool_funcs = []
+    def _create_llm(self, api_key: str|None, tool_funcs: list[Callable]) -> BaseChatModel:
+        # Constructs the LLM client for the agent's model, bound to the tool functions
         if self.agent.model and "mistral" in self.agent.model:
             # FIXME: Use the functions version
-            self.llm = ChatOllama(model="mistral:latest")
+            return ChatOllama(model="mistral:latest")
         elif self.agent.model and 'claude' in self.agent.model and api_key is not None:
-            self.llm = ChatAnthropic(
+            llm = ChatAnthropic(
                 model_name=self.agent.model,
                 temperature=self.agent.temperature or 0,
                 api_key=api_key,
             ) # type: ignore
-            self.enabled_tool_funcs = self.load_agent_tools()
-            self.enabled_tool_funcs.extend(preset_tools)
-
-            if len(self.enabled_tool_funcs) > 0:
-                self.llm = self.llm.bind_tools(self.enabled_tool_funcs) # type: ignore
         elif self.agent.model in GROQ_MODELS and api_key is not None:
-            self.llm = ChatGroq(
+            llm = ChatGroq(
                 api_key=api_key,
                 model=self.agent.model,
                 temperature=self.agent.temperature or 0,
                 streaming=False,
             ) # type: ignore
-            self.enabled_tool_funcs = self.load_agent_tools()
-            self.enabled_tool_funcs.extend(preset_tools)
-            if len(self.enabled_tool_funcs) > 0:
-                self.llm = self.llm.bind_tools(self.enabled_tool_funcs) # type: ignore
         else:
             # NOTE: We always allow a fallback to GPT4-mini so that people can run their agents.
             # At some level of usage we might decide not to offer this subsidy.
-            self.enabled_tool_funcs = self.load_agent_tools()
-
-            #logger.debug("Enabled tools: ", self.enabled_tools)
-            if len(self.enabled_tool_funcs) + len(preset_tools) > 0:
+            if len(tool_funcs) > 0:
                 model_args = {"parallel_tool_calls":False}
             else:
                 model_args = {}
-            self.llm = ChatOpenAI(
+            llm = ChatOpenAI(
                 api_key=api_key or self.DEFAULT_OPENAI_KEY,
                 model=self.agent.model if api_key else self.DEFAULT_MODEL, 
                 temperature=self.agent.temperature or 0,
@@ -596,9 +646,67 @@ class ChatEngine(BaseCallbackHandler):
                 callbacks=[file_logger],
                 model_kwargs=model_args,
             )
+        if len(tool_funcs) > 0:
+            return llm.bind_tools(tool_funcs) # type: ignore
+        return llm
+
+    def get_build_keys(self, api_key: str|None, preset_tools: list[Callable]) -> dict:
+        # Describes each layer of the agent, so create_agent can tell which ones changed.
+        # The system prompt and memories aren't here because 'respond' reads them every turn.
+        return {
+            "llm": (self.agent.model, self.agent.temperature, self.required_token_var, api_key),
+            "tools": (
+                tuple(self.tool_cache_key(t) for t in (self.run_tools or self.agent.tool_list)),
+                tuple(f.name for f in preset_tools),
+            ),
+            "executor": (
+                self.agent.max_agent_time,
+                any(tool.tool_factory_id == MEMORY_COMPRESSION_TOOL_ID for tool in self.agent.tool_list),
+            ),
+        }
+
+    async def create_agent(self, preset_tools: list[Callable] = [], force: bool=False):
+        print("Agent model is: ",self.agent.model)
+        if 'claude' in self.agent.model:
+            self.required_token_var = "CLAUDE_API_KEY"
+        elif self.agent.model in GROQ_MODELS:
+            self.required_token_var = "GROQ_API_KEY"
+        else:
+            self.required_token_var = "OPENAI_API_KEY"
+
+        api_key = self.run_context.secrets.get(self.required_token_var)
+
+        # Only rebuild the layers of the agent which have changed
+        self._secrets_version = secrets_service.cache.version(self.tenant_id)
+        self._preset_tools = preset_tools
+        build_keys = self.get_build_keys(api_key, preset_tools)
+        previous_keys, self._build_keys = self._build_keys, build_keys
+        if not force and previous_keys is not None and self.agent_executor is not None:
+            changed = {layer for layer in build_keys if build_keys[layer] != previous_keys[layer]}
+            uses_tools = not ("mistral" in (self.agent.model or ""))
+            if not changed:
+                print("Agent update needs no rebuild")
+                return
+            elif changed == {"tools"} and uses_tools and len(self.enabled_tool_funcs) > 0:
+                new_funcs = self.load_agent_tools() + preset_tools
+                if len(new_funcs) > 0:
+                    print("Updating agent tools")
+                    await self.agent_executor.add_tools(new_funcs, replace=True)
+                    self.enabled_tool_funcs = new_funcs
+                    self.llm = self.agent_executor.get_llm() or self.llm
+                    return
+            elif changed == {"llm"} and uses_tools and "mistral" not in previous_keys["llm"][0]:
+                print("Updating agent LLM")
+                self.llm = self._create_llm(api_key, self.enabled_tool_funcs)
+                await self.agent_executor.replace_llm(self.llm)
+                return
+
+        if self.agent.model and "mistral" in self.agent.model:
+            self.enabled_tool_funcs = []
+        else:
+            self.enabled_tool_funcs = self.load_agent_tools()
             self.enabled_tool_funcs.extend(preset_tools)
-            if len(self.enabled_tool_funcs) > 0:
-                self.llm = self.llm.bind_tools(self.enabled_tool_funcs) # type: ignore
+        self.llm = self._create_llm(api_key, self.enabled_tool_funcs)
 
         self.prompt = ChatPromptTemplate.from_messages(
             [
@@ -619,7 +727,7 @@ class ChatEngine(BaseCallbackHandler):
         tracers = list(filter(None, [langchain_tracer]))
         manager = CallbackManager(tracers)
                
-        has_compression_tool = any(tool.tool_factory_id == MEMORY_COMPRESSION_TOOL_ID for tool in self.agent.tool_list)
+        has_compression_tool = build_keys["executor"][1]
 
         self.lang_agent = (
            {
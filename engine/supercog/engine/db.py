@@ -19,9 +19,9 @@ lifespan_manager = LifespanManager()
 
 from supercog.shared.services import config, db_connect
 from supercog.shared.models import get_uuid4
-from supercog.shared.credentials import secrets_service, reset_secrets_connection
+from supercog.shared.credentials import secrets_service, reset_secrets_connection, SECRETS_INVALIDATE_CHANNEL
 from supercog.shared.logging import logger
-from supercog.shared.apubsub import AgentEvent
+from supercog.shared.apubsub import AgentEvent, pubsub
 from supercog.shared.models import (
     AgentBase, 
     RunCreate, 
@@ -66,6 +66,13 @@ class RunLog(RunLogBase, table=True):
     def __str__(self) -> str:
         return f"[{self.type.upper()}] {self.content} run: {self.run_id}"
     
+class RunLogCompaction(SQLModel, table=True):
+    # Records when the output logs of a run were last compacted, so compaction only
+    # revisits runs which have logged more output since.
+    __tablename__ = "run_log_compactions"
+    run_id: str = Field(primary_key=True)
+    compacted_at: datetime = Field(default_factory=datetime.utcnow)
+
 class Run(RunCreate, table=True):
     id: Optional[UUID] = Field(default_factory=uuid4, primary_key=True)
     status: str = "pending"
@@ -151,21 +158,21 @@ class Credential(CredentialBase, table=True):
         return json.loads(self.secrets_json or "{}").keys()
 
     def delete_secrets(self):
-        for secret in self.secret_keys():
-            secrets_service.delete_credential(
-                self.tenant_id, 
-                self.user_id, 
-                self._secret_key(secret)
-            )            
+        secrets_service.delete_credentials(
+            self.tenant_id, 
+            self.user_id, 
+            [self._secret_key(secret) for secret in self.secret_keys()]
+        )
 
     def retrieve_secrets(self) -> dict:
-        retrieved = {
-            key: secrets_service.get_credential(
-                tenant_id=self.tenant_id,
-                user_id=self.user_id,
-                credential_id=self._secret_key(key)
-            ) for key in self.secret_keys()
-        }
+        # Fetch all the keys at once (and from the secrets cache if we can)
+        keys = list(self.secret_keys())
+        values = secrets_service.get_credentials(
+            tenant_id=self.tenant_id,
+            user_id=self.user_id,
+            credential_ids=[self._secret_key(key) for key in keys],
+        )
+        retrieved = {key: values[self._secret_key(key)] for key in keys}
         self.secrets_json = json.dumps(retrieved)
         return retrieved
 
@@ -231,7 +238,7 @@ class DocSourceConfig(SQLModel, table=True):
 class DocIndex(DocIndexBase, table=True):
     __tablename__ = "doc_indexes"
     id: Optional[str] = Field(default_factory=get_uuid4, primary_key=True)
-    docs: list["IndexedDoc"] = Relationship(sa_relationship_kwargs={"lazy":"selectin"}, cascade_delete=True)
+    docs: list["IndexedDoc"] = Relationship(sa_relationship_kwargs={"lazy":"select"}, cascade_delete=True)
     source_description: Optional[str] = ""
     status: Optional[str] = Field(default="new")
     error_message: Optional[str] = Field(default="new")
@@ -245,8 +252,14 @@ class DocIndex(DocIndexBase, table=True):
 class IndexedDoc(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
     index_id: str = Field(foreign_key="doc_indexes.id", ondelete="CASCADE")
+    # The DocSourceConfig the document came from
+    source_id: str = Field(default="", index=True)
     doc_id: str = ""
     name: str = ""
+    # Used to skip unchanged documents when the source is synced again
+    content_hash: str = ""
+    # Ids of the document's chunks in the vector table
+    chunk_ids: List[str] = Field(sa_column=Column(JSON), default=[])
 
 ### END MODELS
 
@@ -264,8 +277,11 @@ async def lifespan(app: FastAPI) -> AsyncIterator[State]:
     #def receive_connect(dbapi_connection, connection_record):
     #    logger.info('############## !!!!!!!!!!! New database connection created')
 
+    # Drop cached secrets when another worker changes them
+    secrets_sub = await pubsub.subscribe(SECRETS_INVALIDATE_CHANNEL, secrets_service.receive_invalidation)
 
     yield {"engine": engine}
+    await secrets_sub.unsubscribe()
     engine.dispose()
 
 def reset_db_connections():
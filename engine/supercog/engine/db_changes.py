@@ -0,0 +1,342 @@
+import asyncio
+import hashlib
+import json
+import time
+from datetime import date, datetime
+from decimal import Decimal
+from typing import Awaitable, Callable, Optional
+
+import asyncpg
+
+from supercog.shared.apubsub import pubsub
+from supercog.shared.logging import logger
+from supercog.shared.services import config
+
+# Watches a Postgres table for new rows without blocking the event loop. New rows are
+# read after a high-water mark on a unique, indexed column (the primary key usually), so
+# each poll is an index range scan. We install a statement trigger that NOTIFYs us on
+# inserts, so we only query when something changed, and fall back to polling when we
+# aren't allowed to create the trigger. Tables without a suitable column are watched by
+# transaction id (xmin), which scans the table.
+#
+# Rows don't always commit in the order of their column values: a transaction can insert
+# id 10, and commit after another transaction has inserted and committed id 11. So we
+# keep re-reading the rows that we first saw within the last DB_TRIGGER_LAG_SECS, and
+# only dispatch the ones we haven't seen. Rows that commit later than that are missed.
+#
+# The position is saved in Redis after each batch is dispatched, so a restarted watcher
+# picks up where it stopped without replaying or missing rows. A batch that keeps failing
+# to dispatch is given up on after DB_TRIGGER_MAX_ATTEMPTS, and saved to a dead letter
+# list in Redis.
+#
+# Each watcher installs its own trigger, and drops it when it stops. The notify function
+# is dropped along with the last trigger that uses it. Triggers are left behind only if
+# the engine dies while watching, and are replaced when the watcher starts again.
+
+DB_TRIGGER_BATCH_SIZE = int(config.get_option("DB_TRIGGER_BATCH_SIZE", default=50))
+DB_TRIGGER_POLL_INTERVAL = float(config.get_option("DB_TRIGGER_POLL_INTERVAL", default=3))
+# With LISTEN we still query this often, in case a notification was lost
+DB_TRIGGER_LISTEN_INTERVAL = float(config.get_option("DB_TRIGGER_LISTEN_INTERVAL", default=60))
+# Wait this long after a notification so that a burst of inserts becomes one batch
+DB_TRIGGER_DEBOUNCE = 0.5
+DB_TRIGGER_LAG_SECS = float(config.get_option("DB_TRIGGER_LAG_SECS", default=10))
+DB_TRIGGER_MAX_ATTEMPTS = int(config.get_option("DB_TRIGGER_MAX_ATTEMPTS", default=5))
+DEAD_LETTER_ROWS = 1000
+CURSOR_KEY_PREFIX = "db_trigger_cursor:"
+DEAD_LETTER_KEY_PREFIX = "db_trigger_dead_letter:"
+NOTIFY_FUNCTION = "supercog_notify_insert"
+
+HWM_TYPES = ("smallint", "integer", "bigint", "timestamp without time zone", "timestamp with time zone")
+
+RowsCallback = Callable[[list[dict]], Awaitable[None]]
+
+def asyncpg_dsn(db_url: str) -> str:
+    # asyncpg wants a plain postgresql:// URL, without a SQLAlchemy driver
+    scheme, rest = db_url.split("://", 1)
+    return "postgresql://" + rest if scheme.startswith("postgres") else db_url
+
+def jsonable(row: asyncpg.Record|dict) -> dict:
+    return {
+        key: value if isinstance(value, (str, int, float, bool, datetime, type(None))) else
+            value.isoformat() if isinstance(value, date) else
+            float(value) if isinstance(value, Decimal) else str(value)
+        for key, value in dict(row).items()
+    }
+
+class CursorStore:
+    """ Saves each watcher's position in Redis. """
+    def __init__(self, get_client: Optional[Callable] = None):
+        self.get_client = get_client or pubsub.get_client
+
+    async def load(self, key: str) -> Optional[dict]:
+        client = await self.get_client()
+        value = await client.get(CURSOR_KEY_PREFIX + key)
+        return json.loads(value) if value else None
+
+    async def save(self, key: str, cursor: dict):
+        client = await self.get_client()
+        await client.set(CURSOR_KEY_PREFIX + key, json.dumps(cursor))
+
+    async def dead_letter(self, key: str, rows: list[dict]):
+        # Keeps the most recent rows that we gave up on, for inspection
+        client = await self.get_client()
+        await client.rpush(DEAD_LETTER_KEY_PREFIX + key, *[json.dumps(row, default=str) for row in rows])
+        await client.ltrim(DEAD_LETTER_KEY_PREFIX + key, -DEAD_LETTER_ROWS, -1)
+
+class HighWaterMark:
+    """ Reads rows after the last value of a unique, indexed column. """
+    # Whether a read can stop part way through the new rows
+    batched = True
+
+    def __init__(self, table: str, column: str, column_type: str):
+        self.table = table
+        self.column = column
+        self.is_timestamp = column_type.startswith("timestamp")
+        self.name = f"column:{column}"
+
+    def quoted_column(self) -> str:
+        return '"' + self.column.replace('"', '""') + '"'
+
+    async def current(self, conn: asyncpg.Connection):
+        return await conn.fetchval(f"SELECT max({self.quoted_column()}) FROM {self.table}")
+
+    async def fetch_after(self, conn: asyncpg.Connection, position, limit: int) -> list:
+        col = self.quoted_column()
+        if position is None:
+            sql = f"SELECT * FROM {self.table} WHERE {col} IS NOT NULL ORDER BY {col} LIMIT $1"
+            return await conn.fetch(sql, limit)
+        sql = f"SELECT * FROM {self.table} WHERE {col} > $1 ORDER BY {col} LIMIT $2"
+        return await conn.fetch(sql, position, limit)
+
+    def position_of(self, row):
+        return row[self.column]
+
+    def encode(self, position):
+        return position.isoformat() if isinstance(position, datetime) else position
+
+    def decode(self, value):
+        return datetime.fromisoformat(value) if self.is_timestamp and value is not None else value
+
+class TransactionIdMark(HighWaterMark):
+    """ Reads rows written by transactions after the last one we saw. This scans the table.
+        One transaction can write many rows with the same xmin, so we read all of the new
+        rows at once rather than stopping part way through a transaction. """
+    batched = False
+
+    def __init__(self, table: str):
+        super().__init__(table, "xmin", "bigint")
+        self.name = "xmin"
+
+    async def current(self, conn: asyncpg.Connection):
+        return await conn.fetchval(f"SELECT max(xmin::text::bigint) FROM {self.table}")
+
+    async def fetch_after(self, conn: asyncpg.Connection, position, limit: int) -> list:
+        sql = f"""
+            SELECT *, xmin::text::bigint AS xmin FROM {self.table}
+            WHERE xmin::text::bigint > $1 ORDER BY xmin::text::bigint
+        """
+        return await conn.fetch(sql, position or 0)
+
+class TableWatcher:
+    def __init__(
+        self,
+        db_url: str,
+        table_name: str,
+        cursor_key: str,
+        on_rows: RowsCallback,
+        is_running: Callable[[], Awaitable[bool]],
+        cursor_store: Optional[CursorStore] = None,
+        batch_size: int = DB_TRIGGER_BATCH_SIZE,
+        poll_interval: float = DB_TRIGGER_POLL_INTERVAL,
+        listen_interval: float = DB_TRIGGER_LISTEN_INTERVAL,
+        lag_secs: float = DB_TRIGGER_LAG_SECS,
+        max_attempts: int = DB_TRIGGER_MAX_ATTEMPTS,
+    ):
+        self.db_url = db_url
+        self.table_name = table_name
+        self.cursor_key = cursor_key
+        self.on_rows = on_rows
+        self.is_running = is_running
+        self.cursor_store = cursor_store or CursorStore()
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.listen_interval = listen_interval
+        self.lag_secs = lag_secs
+        self.max_attempts = max_attempts
+        self.changed = asyncio.Event()
+        self.listening = False
+        # The table and name of the trigger we installed
+        self.trigger: Optional[tuple[str, str]] = None
+        # The rows read after our position, by their position, with the time we read them
+        self.recent: dict = {}
+
+    async def connect(self) -> asyncpg.Connection:
+        return await asyncpg.connect(asyncpg_dsn(self.db_url))
+
+    async def find_mark(self, conn: asyncpg.Connection) -> tuple[str, int, HighWaterMark]:
+        """ Returns the quoted table name, its oid and how to find its new rows. """
+        row = await conn.fetchrow(
+            "SELECT to_regclass($1)::oid AS oid, to_regclass($1)::text AS name", self.table_name
+        )
+        if row["oid"] is None:
+            raise ValueError(f"Table '{self.table_name}' does not exist")
+        table, oid = row["name"], row["oid"]
+        # The leading column of a unique index, preferring the primary key
+        column = await conn.fetchrow(
+            """
+            SELECT a.attname, format_type(a.atttypid, a.atttypmod) AS type
+            FROM pg_index i
+            JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = i.indkey[0]
+            WHERE i.indrelid = $1 AND i.indisunique AND i.indnatts = 1
+              AND format_type(a.atttypid, NULL) = ANY($2::text[])
+            ORDER BY i.indisprimary DESC
+            LIMIT 1
+            """,
+            oid, list(HWM_TYPES),
+        )
+        if column:
+            return table, oid, HighWaterMark(table, column["attname"], column["type"])
+        logger.warn(f"Table {table} has no unique integer or timestamp column, watching it by xmin")
+        return table, oid, TransactionIdMark(table)
+
+    def trigger_name(self, oid: int) -> str:
+        # Watchers of the same table share the channel, but each has its own trigger
+        # so that stopping one doesn't silence the others
+        return f"supercog_insert_{oid}_" + hashlib.sha1(self.cursor_key.encode()).hexdigest()[:12]
+
+    async def listen(self, conn: asyncpg.Connection, table: str, oid: int):
+        # Installs a statement trigger that notifies our channel on insert. Needs the
+        # privilege to create triggers on the table, otherwise we poll.
+        channel = f"supercog_insert_{oid}"
+        trigger = self.trigger_name(oid)
+        try:
+            async with conn.transaction():
+                await conn.execute(f"""
+                    CREATE OR REPLACE FUNCTION {NOTIFY_FUNCTION}() RETURNS trigger
+                    LANGUAGE plpgsql AS $$
+                    BEGIN
+                        PERFORM pg_notify(TG_ARGV[0], '');
+                        RETURN NULL;
+                    END $$
+                """)
+                await conn.execute(f"DROP TRIGGER IF EXISTS {trigger} ON {table}")
+                await conn.execute(f"""
+                    CREATE TRIGGER {trigger} AFTER INSERT ON {table}
+                    FOR EACH STATEMENT EXECUTE FUNCTION {NOTIFY_FUNCTION}('{channel}')
+                """)
+            self.trigger = (table, trigger)
+            await conn.add_listener(channel, lambda *args: self.changed.set())
+            self.listening = True
+        except asyncpg.PostgresError as e:
+            logger.warn(f"Can't install the insert trigger on {table} ({e}), polling instead")
+
+    async def unlisten(self, conn: asyncpg.Connection):
+        # Removes our trigger, and the notify function if no other trigger uses it
+        if self.trigger is None:
+            return
+        table, trigger = self.trigger
+        try:
+            await conn.execute(f"DROP TRIGGER IF EXISTS {trigger} ON {table}")
+            self.trigger = None
+            try:
+                await conn.execute(f"DROP FUNCTION IF EXISTS {NOTIFY_FUNCTION}()")
+            except asyncpg.DependentObjectsStillExistError:
+                # Another watcher's trigger
+                pass
+        except (asyncpg.PostgresError, OSError) as e:
+            logger.warn(f"Can't remove the insert trigger from {table}: {e}")
+
+    async def load_position(self, conn: asyncpg.Connection, mark: HighWaterMark):
+        cursor = await self.cursor_store.load(self.cursor_key)
+        if cursor and cursor.get("mark") == mark.name:
+            self.recent = {mark.decode(p): read_at for p, read_at in cursor.get("recent", [])}
+            return mark.decode(cursor["position"])
+        # Start from the rows that exist now, as the old poller did
+        position = await mark.current(conn)
+        await self.save_position(mark, position)
+        return position
+
+    async def save_position(self, mark: HighWaterMark, position):
+        await self.cursor_store.save(self.cursor_key, {
+            "mark": mark.name,
+            "position": mark.encode(position),
+            "recent": [[mark.encode(p), read_at] for p, read_at in self.recent.items()],
+        })
+
+    def settle(self, position):
+        """ Moves the position past the rows that we read more than lag_secs ago, and
+            returns it. """
+        cutoff = time.time() - self.lag_secs
+        settled = [p for p, read_at in self.recent.items() if read_at <= cutoff]
+        if not settled:
+            return position
+        position = max(settled) if position is None else max(position, max(settled))
+        self.recent = {p: read_at for p, read_at in self.recent.items() if p > position}
+        return position
+
+    async def wait_for_change(self, last_query: float):
+        # Wake up regularly to check that we should keep running
+        try:
+            await asyncio.wait_for(self.changed.wait(), timeout=self.poll_interval)
+            await asyncio.sleep(DB_TRIGGER_DEBOUNCE)
+            return True
+        except asyncio.TimeoutError:
+            if self.listening:
+                return time.monotonic() - last_query >= self.listen_interval
+            return True
+
+    async def run(self):
+        conn = await self.connect()
+        try:
+            table, oid, mark = await self.find_mark(conn)
+            await self.listen(conn, table, oid)
+            position = await self.load_position(conn, mark)
+            logger.info(f"Watching {table} for new rows by {mark.name}, from {position}")
+
+            query_now = True
+            last_query = 0.0
+            attempts = 0
+            while await self.is_running():
+                if query_now:
+                    self.changed.clear()
+                    last_query = time.monotonic()
+                    # Re-read the recent rows too, so they don't use up the batch
+                    rows = await mark.fetch_after(conn, position, self.batch_size + len(self.recent))
+                    rows = [r for r in rows if mark.position_of(r) not in self.recent]
+                    if mark.batched:
+                        rows = rows[:self.batch_size]
+                    if rows:
+                        records = [jsonable(r) for r in rows]
+                        try:
+                            await self.on_rows(records)
+                            attempts = 0
+                        except Exception as e:
+                            attempts += 1
+                            if attempts < self.max_attempts:
+                                # Leave the position so these rows are dispatched again
+                                logger.error(f"Error dispatching rows from {table} (attempt {attempts}): {e}")
+                                await asyncio.sleep(self.poll_interval * attempts)
+                                continue
+                            logger.error(
+                                f"Giving up on {len(rows)} rows from {table} after {attempts} attempts, "
+                                f"saving them to the dead letter list: {e}"
+                            )
+                            await self.cursor_store.dead_letter(self.cursor_key, records)
+                            attempts = 0
+                        read_at = time.time()
+                        for row in rows:
+                            self.recent[mark.position_of(row)] = read_at
+                    old_position = position
+                    position = self.settle(position)
+                    if rows or position != old_position:
+                        await self.save_position(mark, position)
+                    if mark.batched and len(rows) >= self.batch_size:
+                        # There may be more waiting
+                        continue
+                query_now = await self.wait_for_change(last_query)
+        finally:
+            try:
+                await self.unlisten(conn)
+            finally:
+                await conn.close()
+        logger.info(f"Stopped watching {self.table_name}")
@@ -31,7 +31,7 @@ class DocSourceFactory(ToolFactory):
         from supercog.engine.all_tools import FACTORY_MAP
 
         if doc_source.tool_factory_id in FACTORY_MAP:
-            doc_factory = FACTORY_MAP.get(doc_source.tool_factory_id).__class__()
+            doc_factory = FACTORY_MAP.get(doc_source.tool_factory_id).factory_class()()
             doc_factory.credentials = doc_source.retrieve_secrets()
 
             return doc_factory
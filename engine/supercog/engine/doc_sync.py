@@ -0,0 +1,286 @@
+import asyncio
+from dataclasses import dataclass
+from typing import AsyncIterable, Optional
+
+from llama_index.core import Document
+from llama_index.core.ingestion import arun_transformations
+from llama_index.core.schema import BaseNode, MetadataMode, TransformComponent
+from llama_index.core.vector_stores.types import (
+    BasePydanticVectorStore,
+    FilterOperator,
+    MetadataFilter,
+    MetadataFilters,
+)
+from sqlmodel import Session, func, select
+
+from supercog.shared.logging import logger
+from supercog.shared.services import config
+
+from .db import DocSourceConfig, IndexedDoc
+from .embeddings import BatchEmbedder, content_hash
+
+# Keeps a vector index in step with a document source. Each indexed document is recorded
+# in the IndexedDoc table with a hash of its text and the ids of its chunks in the vector
+# table. When the source is synced again, unchanged documents are skipped, changed ones
+# have their chunks replaced and documents that are gone from the source have their
+# chunks deleted. Documents stream through the sync, they aren't all loaded first.
+#
+# Indexes built before the manifest existed already hold chunks with no IndexedDoc rows.
+# So the first sync of a source also deletes the chunks whose metadata identifies one of
+# its documents but which weren't written by a sync.
+
+# Changed documents are split and embedded in batches of this many documents, or
+# this much text
+SYNC_BATCH_DOCS = int(config.get_option("DOC_SYNC_BATCH_DOCS", default=50))
+SYNC_BATCH_CHARS = int(config.get_option("DOC_SYNC_BATCH_CHARS", default=2_000_000))
+# Batches waiting between stages
+SYNC_QUEUE_SIZE = 2
+
+# Metadata that identifies a document in its source, most specific first
+KEY_FIELDS = ("page_id", "file_id", "source_url", "url", "file_path")
+
+def as_documents(item) -> list[Document]:
+    # Doc sources yield Documents, lists of them, or plain text
+    if isinstance(item, Document):
+        return [item]
+    if isinstance(item, str):
+        return [Document(text=item)] if item.strip() else []
+    if isinstance(item, (list, tuple)):
+        return [doc for i in item for doc in as_documents(i)]
+    raise ValueError(f"Unexpected document from the doc source: {type(item).__name__}")
+
+def key_field(doc: Document) -> Optional[tuple[str, str]]:
+    for field in KEY_FIELDS:
+        value = doc.metadata.get(field)
+        if value and not (field == "file_path" and value == "notion"):
+            return field, str(value)
+    return None
+
+def document_key(doc: Document) -> str:
+    if field := key_field(doc):
+        return "%s:%s" % field
+    # Without an id we can only recognize the same text, so an edited document
+    # is indexed as a new one and the old version is deleted
+    return "hash:" + content_hash(doc.text)
+
+def is_document_key(doc_id: Optional[str]) -> bool:
+    # Chunks written by a sync point back to their document by its key, older chunks
+    # point to a random document id
+    return bool(doc_id) and doc_id.startswith(tuple(f"{field}:" for field in KEY_FIELDS) + ("hash:",))
+
+def document_name(doc: Document) -> str:
+    return str(doc.metadata.get("file_name") or doc.metadata.get("source_url") or doc.text[:80].strip())
+
+@dataclass
+class IndexedChange:
+    key: str
+    name: str
+    content_hash: str
+    # The metadata field and value which identify the document's chunks from before
+    # the manifest, if it has any
+    legacy: Optional[tuple[str, str]] = None
+
+@dataclass
+class SyncStats:
+    added: int = 0
+    updated: int = 0
+    unchanged: int = 0
+    deleted: int = 0
+    chunks: int = 0
+
+    def summary(self) -> str:
+        return (
+            f"{self.added} added, {self.updated} updated, {self.unchanged} unchanged, "
+            f"{self.deleted} deleted, {self.chunks} chunks embedded"
+        )
+
+class DocumentSync:
+    """ Syncs the documents of one doc source (a DocSourceConfig) into the vector index
+        of a DocIndex. """
+    def __init__(
+        self,
+        session: Session,
+        index_id: str,
+        source_id: str,
+        vector_store: BasePydanticVectorStore,
+        transformations: list[TransformComponent],
+        embedder: Optional[BatchEmbedder] = None,
+    ):
+        self.session = session
+        self.index_id = index_id
+        self.source_id = source_id
+        self.vector_store = vector_store
+        self.transformations = transformations
+        self.embedder = embedder
+        self.stats = SyncStats()
+        self.manifest: dict[str, IndexedDoc] = {}
+        self.seen: set[str] = set()
+        # Set on the first sync of the source, when older chunks may need replacing
+        self.backfill = False
+
+    def load_manifest(self):
+        rows = self.session.exec(
+            select(IndexedDoc).where(
+                IndexedDoc.index_id == self.index_id,
+                IndexedDoc.source_id == self.source_id,
+            )
+        ).all()
+        self.manifest = {row.doc_id: row for row in rows}
+
+    async def sync(self, documents: AsyncIterable) -> SyncStats:
+        """ Indexes the new and changed documents from 'documents', then removes the
+            documents which weren't seen. """
+        self.load_manifest()
+        self.backfill = not self.manifest
+        # Reading, embedding and writing run concurrently. The queues between them are
+        # bounded, so a slow stage holds back the ones before it, and at most a few
+        # batches of documents are in memory however big the source is.
+        to_embed: asyncio.Queue[Optional[list[Document]]] = asyncio.Queue(SYNC_QUEUE_SIZE)
+        to_write: asyncio.Queue[Optional[tuple[list[IndexedChange], list[BaseNode]]]] = asyncio.Queue(SYNC_QUEUE_SIZE)
+        try:
+            async with asyncio.TaskGroup() as stages:
+                stages.create_task(self.read(documents, to_embed))
+                stages.create_task(self.embed(to_embed, to_write))
+                stages.create_task(self.write(to_write))
+        except ExceptionGroup as e:
+            # The other stages were cancelled, report the error that stopped the sync
+            raise e.exceptions[0]
+        await self.delete_missing()
+        return self.stats
+
+    def is_changed(self, doc: Document) -> bool:
+        key = document_key(doc)
+        if key in self.seen:
+            return False
+        self.seen.add(key)
+        row = self.manifest.get(key)
+        if row is not None and row.content_hash == content_hash(doc.text):
+            self.stats.unchanged += 1
+            return False
+        # Chunks point back to the document by its key
+        doc.id_ = key
+        return True
+
+    async def read(self, documents: AsyncIterable, to_embed: asyncio.Queue):
+        # Groups the new and changed documents into batches
+        batch: list[Document] = []
+        size = 0
+        async for item in documents:
+            for doc in as_documents(item):
+                if self.is_changed(doc):
+                    batch.append(doc)
+                    size += len(doc.text)
+                    if len(batch) >= SYNC_BATCH_DOCS or size >= SYNC_BATCH_CHARS:
+                        await to_embed.put(batch)
+                        batch, size = [], 0
+        if batch:
+            await to_embed.put(batch)
+        await to_embed.put(None)
+
+    async def embed(self, to_embed: asyncio.Queue, to_write: asyncio.Queue):
+        # Splits each batch into chunks and embeds them
+        while (docs := await to_embed.get()) is not None:
+            nodes = await arun_transformations(docs, self.transformations)
+            texts = [node.get_content(metadata_mode=MetadataMode.EMBED) for node in nodes]
+            for node, embedding in zip(nodes, await self.embedder.embed(texts)):
+                node.embedding = embedding
+            # The documents aren't needed once they're chunked
+            changes = [
+                IndexedChange(doc.id_, document_name(doc), content_hash(doc.text), key_field(doc) if self.backfill else None)
+                for doc in docs
+            ]
+            await to_write.put((changes, nodes))
+        await to_write.put(None)
+
+    async def write(self, to_write: asyncio.Queue):
+        # Stores the chunks and updates the manifest
+        while (batch := await to_write.get()) is not None:
+            changes, nodes = batch
+            chunk_ids: dict[str, list[str]] = {change.key: [] for change in changes}
+            for node in nodes:
+                chunk_ids[node.ref_doc_id or node.node_id].append(node.node_id)
+
+            # Replace the old chunks only once the new ones are ready
+            old_chunks = [
+                chunk_id for change in changes if change.key in self.manifest
+                for chunk_id in self.manifest[change.key].chunk_ids
+            ]
+            await self.delete_chunks(old_chunks)
+            await self.delete_legacy_chunks(changes)
+            if nodes:
+                await asyncio.to_thread(self.vector_store.add, nodes)
+
+            for change in changes:
+                row = self.manifest.get(change.key)
+                if row is None:
+                    row = IndexedDoc(index_id=self.index_id, source_id=self.source_id, doc_id=change.key)
+                    self.manifest[change.key] = row
+                    self.stats.added += 1
+                else:
+                    self.stats.updated += 1
+                row.name = change.name
+                row.content_hash = change.content_hash
+                row.chunk_ids = chunk_ids[change.key]
+                self.session.add(row)
+            self.session.commit()
+            self.stats.chunks += len(nodes)
+            logger.info(f"Indexed {len(changes)} documents into {self.index_id}: {self.stats.summary()}")
+
+    async def delete_missing(self):
+        gone = [row for key, row in self.manifest.items() if key not in self.seen]
+        await self.delete_chunks([chunk_id for row in gone for chunk_id in row.chunk_ids])
+        for row in gone:
+            self.session.delete(row)
+            del self.manifest[row.doc_id]
+        self.session.commit()
+        self.stats.deleted += len(gone)
+
+    async def delete_legacy_chunks(self, changes: list[IndexedChange]):
+        values: dict[str, list[str]] = {}
+        for change in changes:
+            if change.legacy and change.key not in self.manifest:
+                field, value = change.legacy
+                # The store puts filter values into the SQL as literals
+                values.setdefault(field, []).append(value.replace("'", "''"))
+        if not values:
+            return
+        filters = MetadataFilters(
+            filters=[
+                MetadataFilter(key=field, value=field_values, operator=FilterOperator.IN)
+                for field, field_values in values.items()
+            ],
+            condition="or",
+        )
+        nodes = await asyncio.to_thread(self.vector_store.get_nodes, filters=filters)
+        await self.delete_chunks([node.node_id for node in nodes if not is_document_key(node.ref_doc_id)])
+
+    async def delete_all(self):
+        """ Removes every document of the source from the index. """
+        self.load_manifest()
+        if not self.manifest and self.is_only_source():
+            # The index was built before the manifest, but all of it came from this source
+            logger.info(f"Clearing index {self.index_id}, which has no manifest")
+            await asyncio.to_thread(self.vector_store.clear)
+        elif not self.manifest:
+            logger.warn(
+                f"Source {self.source_id} has no indexed documents in {self.index_id}, "
+                "chunks indexed from it before the manifest are kept"
+            )
+        await self.delete_missing()
+
+    def is_only_source(self) -> bool:
+        indexed = self.session.exec(
+            select(func.count()).select_from(IndexedDoc).where(IndexedDoc.index_id == self.index_id)
+        ).one()
+        other_sources = self.session.exec(
+            select(func.count()).select_from(DocSourceConfig).where(
+                DocSourceConfig.doc_index_id == self.index_id,
+                DocSourceConfig.id != self.source_id,
+            )
+        ).one()
+        return indexed == 0 and other_sources == 0
+
+    async def delete_chunks(self, chunk_ids: list[str]):
+        if chunk_ids:
+            await asyncio.to_thread(self.vector_store.delete_nodes, node_ids=chunk_ids)
+
@@ -0,0 +1,91 @@
+import os
+import threading
+from contextlib import contextmanager
+from typing import Iterator
+
+import duckdb
+
+from supercog.shared.logging import logger
+from supercog.shared.services import config
+
+from .tables import Table, duckdb_source
+
+DUCKDB_MEMORY_LIMIT = config.get_option("DUCKDB_MEMORY_LIMIT", default="1GB")
+DUCKDB_THREADS = int(config.get_option("DUCKDB_THREADS", default=2))
+# Queries that don't fit in memory spill here, under the user's directory
+DUCKDB_TEMP_DIR = ".duckdb_tmp"
+IN_MEMORY = ":memory:"
+
+class DuckdbSession:
+    """ The DuckDB connections used by the tools in one run. Connections are opened on
+        first use. The in-memory connection is kept open until the run's ChatEngine is
+        evicted, so in-memory tables are registered as views once instead of on every
+        query. Connections to database files are closed at the end of each turn, so an
+        idle run doesn't hold the files (and their memory) open.
+
+        DuckDB connections aren't safe to share between threads, so use is serialized
+        with a lock. """
+    def __init__(self, user_dir: str):
+        self.user_dir = user_dir
+        self.connections: dict[str, duckdb.DuckDBPyConnection] = {}
+        # For each connection, the table registered under each view name
+        self.views: dict[str, dict[str, Table]] = {}
+        self.lock = threading.RLock()
+        self.connects = 0
+
+    def _connect(self, db_file: str) -> duckdb.DuckDBPyConnection:
+        self.connects += 1
+        return duckdb.connect(
+            db_file,
+            config={
+                "memory_limit": DUCKDB_MEMORY_LIMIT,
+                "threads": DUCKDB_THREADS,
+                "temp_directory": os.path.join(self.user_dir, DUCKDB_TEMP_DIR),
+            },
+        )
+
+    @contextmanager
+    def connection(
+        self,
+        db_file: str = IN_MEMORY,
+        tables: dict[str, Table]|None = None,
+    ) -> Iterator[duckdb.DuckDBPyConnection]:
+        """ Returns the connection to 'db_file' (or the in-memory database), with 'tables'
+            registered as views. """
+        with self.lock:
+            con = self.connections.get(db_file)
+            if con is None:
+                con = self.connections[db_file] = self._connect(db_file)
+                self.views[db_file] = {}
+            views = self.views[db_file]
+            for name, table in (tables or {}).items():
+                # DuckDB scans the table in place, so we only re-register if it was replaced
+                if views.get(name) is not table:
+                    con.register(name, duckdb_source(table))
+                    views[name] = table
+            yield con
+
+    def unregister(self, name: str):
+        with self.lock:
+            for db_file, views in self.views.items():
+                if views.pop(name, None) is not None:
+                    self.connections[db_file].unregister(name)
+
+    def _close(self, db_file: str):
+        con = self.connections.pop(db_file)
+        self.views.pop(db_file, None)
+        try:
+            con.close()
+        except Exception as e:
+            logger.error(f"Error closing DuckDB connection to {db_file}: {e}")
+
+    def close_files(self):
+        """ Closes the connections to database files, keeping the in-memory one. """
+        with self.lock:
+            for db_file in [db_file for db_file in self.connections if db_file != IN_MEMORY]:
+                self._close(db_file)
+
+    def close(self):
+        with self.lock:
+            for db_file in list(self.connections):
+                self._close(db_file)
@@ -0,0 +1,200 @@
+import asyncio
+import hashlib
+from typing import Awaitable, Callable, Optional
+
+import psycopg2
+from sqlalchemy import make_url
+
+from supercog.shared.logging import logger
+from supercog.shared.services import config
+
+from .retries import with_retries
+
+# Embeds text chunks for the RAG indexes. Chunks are sent to the embedding API in
+# batches, a few batches at a time, and transient API errors are retried with backoff.
+# Embeddings are cached in Postgres, next to the vector tables, by tenant, embedding
+# model and a hash of the normalized text, so the same text is only embedded once no
+# matter which of the tenant's indexes it is added to. The cache isn't shared between
+# tenants, since a cache hit would tell one tenant that another has indexed the text.
+
+EMBED_BATCH_SIZE = int(config.get_option("EMBED_BATCH_SIZE", default=100))
+EMBED_CONCURRENCY = int(config.get_option("EMBED_CONCURRENCY", default=4))
+# Report progress after this many chunks
+EMBED_PROGRESS_EVERY = int(config.get_option("EMBED_PROGRESS_EVERY", default=100))
+EMBED_MAX_RETRIES = 4
+EMBEDDING_CACHE_TABLE = "tenant_embedding_cache"
+
+EmbedBatch = Callable[[list[str]], Awaitable[list[list[float]]]]
+ProgressCallback = Callable[[str], Awaitable[None]]
+
+def content_hash(text: str) -> str:
+    # Whitespace differences don't change the embedding enough to matter
+    return hashlib.sha256(" ".join(text.split()).encode()).hexdigest()
+
+class EmbeddingCache:
+    """ One tenant's embeddings, stored in Postgres by (model, content hash). Cache errors
+        are logged and otherwise ignored, since we can always call the embedding API. """
+    def __init__(self, conn: psycopg2.extensions.connection, tenant_id: str):
+        self.conn = conn
+        self.tenant_id = tenant_id
+        self.is_setup = False
+
+    @classmethod
+    def connect(cls, db_url: str, tenant_id: str) -> "EmbeddingCache":
+        # psycopg2 doesn't understand SQLAlchemy driver names, like postgresql+psycopg2
+        url = make_url(db_url).set(drivername="postgresql")
+        return cls(psycopg2.connect(url.render_as_string(hide_password=False)), tenant_id)
+
+    def _setup(self):
+        if self.is_setup:
+            return
+        with self.conn.cursor() as cur:
+            cur.execute("CREATE EXTENSION IF NOT EXISTS vector")
+            cur.execute(f"""
+            CREATE TABLE IF NOT EXISTS {EMBEDDING_CACHE_TABLE} (
+                tenant_id TEXT NOT NULL,
+                model TEXT NOT NULL,
+                content_hash TEXT NOT NULL,
+                embedding vector NOT NULL,
+                created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                PRIMARY KEY (tenant_id, model, content_hash)
+            )
+            """)
+        self.conn.commit()
+        self.is_setup = True
+
+    def _get_many(self, model: str, hashes: list[str]) -> dict[str, list[float]]:
+        self._setup()
+        with self.conn.cursor() as cur:
+            cur.execute(f"""
+            SELECT content_hash, embedding::real[] FROM {EMBEDDING_CACHE_TABLE}
+            WHERE tenant_id = %s AND model = %s AND content_hash = ANY(%s)
+            """, (self.tenant_id, model, hashes))
+            rows = cur.fetchall()
+        self.conn.commit()
+        return {h: list(embedding) for h, embedding in rows}
+
+    def _put_many(self, model: str, embeddings: dict[str, list[float]]):
+        self._setup()
+        hashes = list(embeddings.keys())
+        vectors = ["[" + ",".join(map(str, embeddings[h])) + "]" for h in hashes]
+        with self.conn.cursor() as cur:
+            cur.execute(f"""
+            INSERT INTO {EMBEDDING_CACHE_TABLE} (tenant_id, model, content_hash, embedding)
+            SELECT %s, %s, h, e::vector FROM unnest(%s::text[], %s::text[]) AS t(h, e)
+            ON CONFLICT DO NOTHING
+            """, (self.tenant_id, model, hashes, vectors))
+        self.conn.commit()
+
+    async def get_many(self, model: str, hashes: list[str]) -> dict[str, list[float]]:
+        if not hashes:
+            return {}
+        try:
+            return await asyncio.to_thread(self._get_many, model, hashes)
+        except Exception as e:
+            logger.error(f"Embedding cache lookup failed: {e}")
+            self.conn.rollback()
+            return {}
+
+    async def put_many(self, model: str, embeddings: dict[str, list[float]]):
+        if not embeddings:
+            return
+        try:
+            await asyncio.to_thread(self._put_many, model, embeddings)
+        except Exception as e:
+            logger.error(f"Embedding cache update failed: {e}")
+            self.conn.rollback()
+
+    def close(self):
+        self.conn.close()
+
+class BatchEmbedder:
+    """ Embeds texts with 'embed_batch', an async function that embeds a list of texts,
+        like LangChain's Embeddings.aembed_documents. With a 'cache', texts that were
+        already embedded by 'model' are read from the cache instead. """
+    def __init__(
+        self,
+        embed_batch: EmbedBatch,
+        model: str = "",
+        cache: Optional[EmbeddingCache] = None,
+        batch_size: Optional[int] = None,
+        concurrency: Optional[int] = None,
+        progress: Optional[ProgressCallback] = None,
+        progress_every: Optional[int] = None,
+    ):
+        self.embed_batch = embed_batch
+        self.model = model
+        self.cache = cache
+        self.batch_size = batch_size or EMBED_BATCH_SIZE
+        self.semaphore = asyncio.Semaphore(concurrency or EMBED_CONCURRENCY)
+        self.progress = progress
+        self.progress_every = progress_every or EMBED_PROGRESS_EVERY
+        self.stats = {"chunks": 0, "cached": 0, "embedded": 0, "batches": 0, "retries": 0}
+
+    async def embed_with_retry(self, texts: list[str]) -> list[list[float]]:
+        async def request() -> list[list[float]]:
+            self.stats["batches"] += 1
+            vectors = await self.embed_batch(texts)
+            if len(vectors) != len(texts):
+                raise ValueError(f"Got {len(vectors)} embeddings for {len(texts)} texts")
+            return vectors
+
+        def count_retry():
+            self.stats["retries"] += 1
+
+        return await with_retries(
+            request, self.semaphore, EMBED_MAX_RETRIES, "Embedding request", on_retry=count_retry,
+        )
+
+    async def report(self, message: str):
+        if self.progress:
+            try:
+                await self.progress(message)
+            except Exception as e:
+                logger.error(f"Embedding progress callback failed: {e}")
+
+    @property
+    def hit_rate(self) -> float:
+        return self.stats["cached"] / self.stats["chunks"] if self.stats["chunks"] else 0.0
+
+    def cache_summary(self) -> str:
+        return f"{self.stats['cached']} of {self.stats['chunks']} chunks from the embedding cache ({self.hit_rate:.0%})"
+
+    async def embed(self, texts: list[str]) -> list[list[float]]:
+        """ Returns the embedding of each text, in order. """
+        hashes = [content_hash(t) for t in texts]
+        found = {}
+        if self.cache is not None:
+            found = await self.cache.get_many(self.model, list(set(hashes)))
+        # Each distinct text is embedded once
+        missing = {}
+        for h, text in zip(hashes, texts):
+            if h not in found and h not in missing:
+                missing[h] = text
+        self.stats["chunks"] += len(texts)
+        self.stats["cached"] += sum(1 for h in hashes if h in found)
+
+        vectors = await self.embed_all(list(missing.values()))
+        embedded = dict(zip(missing.keys(), vectors))
+        self.stats["embedded"] += len(embedded)
+        if self.cache is not None:
+            await self.cache.put_many(self.model, embedded)
+        return [found.get(h) or embedded[h] for h in hashes]
+
+    async def embed_all(self, texts: list[str]) -> list[list[float]]:
+        total = len(texts)
+        done = 0
+        reported = 0
+
+        async def embed_batch(batch: list[str]) -> list[list[float]]:
+            nonlocal done, reported
+            vectors = await self.embed_with_retry(batch)
+            done += len(batch)
+            if done - reported >= self.progress_every and done < total:
+                reported = done
+                await self.report(f"Embedded {done}/{total} chunks")
+            return vectors
+
+        batches = [texts[i:i + self.batch_size] for i in range(0, total, self.batch_size)]
+        results = await asyncio.gather(*[embed_batch(b) for b in batches])
+        return [vector for vectors in results for vector in vectors]
@@ -0,0 +1,176 @@
+# A bounded cache of running ChatEngine instances.
+#
+# The EngineManager keeps a ChatEngine in memory for every active run. Each one holds
+# chat history, in-memory DataFrames, tool factories and LLM clients, so we bound the
+# cache by count and by (estimated) bytes, and drop engines that have been idle too long.
+# Eviction is LRU, but we never evict an engine that is generating, is locked or is
+# pinned. Idle engines are dropped when the cache changes, and by a periodic sweep.
+#
+# Evicting an engine is safe because EngineManager.continue_run will rebuild it and
+# reload the chat history from the RunLogs when the run gets new input.
+
+import time
+from collections import OrderedDict
+from typing import Callable, Iterator, Optional
+from uuid import UUID
+
+from supercog.shared.services import config
+from supercog.shared.logging import logger
+
+from .chatengine import ChatEngine
+
+ENGINE_CACHE_MAX_ENGINES = int(config.get_option("ENGINE_CACHE_MAX_ENGINES", default=200))
+ENGINE_CACHE_MAX_MB = int(config.get_option("ENGINE_CACHE_MAX_MB", default=2048))
+ENGINE_CACHE_IDLE_TTL = int(config.get_option("ENGINE_CACHE_IDLE_TTL", default=3600))  # seconds
+
+EvictCallback = Callable[[ChatEngine], None]
+BusyCheck = Callable[[ChatEngine], bool]
+
+class EngineCache:
+    def __init__(
+            self,
+            max_engines: int = ENGINE_CACHE_MAX_ENGINES,
+            max_bytes: int = ENGINE_CACHE_MAX_MB * 1024 * 1024,
+            idle_ttl: float = ENGINE_CACHE_IDLE_TTL,
+        ):
+        self.max_engines = max_engines
+        self.max_bytes = max_bytes
+        self.idle_ttl = idle_ttl
+        # Ordered from least to most recently used
+        self._engines: OrderedDict[UUID, ChatEngine] = OrderedDict()
+        self._last_used: dict[UUID, float] = {}
+        self._sizes: dict[UUID, int] = {}
+        self._on_evict: list[EvictCallback] = []
+        self._is_busy: list[BusyCheck] = []
+        self._pins: dict[UUID, int] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def add_evict_listener(self, callback: EvictCallback):
+        self._on_evict.append(callback)
+
+    def add_busy_check(self, check: BusyCheck):
+        # Lets the owner veto eviction, eg. if it holds a lock on the engine
+        self._is_busy.append(check)
+
+    def pin(self, engine_id: UUID):
+        # Keeps an engine from being evicted until it is unpinned. Pins are counted.
+        self._pins[engine_id] = self._pins.get(engine_id, 0) + 1
+
+    def unpin(self, engine_id: UUID):
+        count = self._pins.get(engine_id, 0) - 1
+        if count > 0:
+            self._pins[engine_id] = count
+        else:
+            self._pins.pop(engine_id, None)
+
+    def lookup(self, engine_id: Optional[UUID]) -> Optional[ChatEngine]:
+        # Returns the engine and marks it as recently used, and counts cache hits/misses.
+        chatengine = self._engines.get(engine_id) if engine_id is not None else None
+        if chatengine is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.touch(engine_id)
+        return chatengine
+
+    def touch(self, engine_id: UUID):
+        if engine_id in self._engines:
+            self._engines.move_to_end(engine_id)
+            self._last_used[engine_id] = time.time()
+
+    def update_size(self, engine_id: UUID):
+        # Re-measure an engine, which we do after each turn since that's when it grows
+        chatengine = self._engines.get(engine_id)
+        if chatengine is not None:
+            self._sizes[engine_id] = chatengine.estimate_memory_size()
+            self.evict()
+
+    def __setitem__(self, engine_id: UUID, chatengine: ChatEngine):
+        self._engines[engine_id] = chatengine
+        self._engines.move_to_end(engine_id)
+        self._last_used[engine_id] = time.time()
+        self._sizes[engine_id] = chatengine.estimate_memory_size()
+        self.evict(keep=engine_id)
+
+    def __getitem__(self, engine_id: UUID) -> ChatEngine:
+        return self._engines[engine_id]
+
+    def __contains__(self, engine_id) -> bool:
+        return engine_id in self._engines
+
+    def __len__(self) -> int:
+        return len(self._engines)
+
+    def __iter__(self) -> Iterator[UUID]:
+        return iter(list(self._engines))
+
+    def get(self, engine_id, default=None) -> Optional[ChatEngine]:
+        return self._engines.get(engine_id, default)
+
+    def values(self) -> list[ChatEngine]:
+        # Return a copy so callers can await while iterating
+        return list(self._engines.values())
+
+    def total_bytes(self) -> int:
+        return sum(self._sizes.values())
+
+    def can_evict(self, chatengine: ChatEngine) -> bool:
+        if chatengine.generating or chatengine.id in self._pins:
+            return False
+        return not any(check(chatengine) for check in self._is_busy)
+
+    def evict(self, keep: Optional[UUID] = None) -> list[UUID]:
+        # First drop idle engines, then evict LRU engines until we are within budget.
+        evicted = []
+        now = time.time()
+        for engine_id in list(self._engines):
+            if engine_id == keep:
+                continue
+            if (now - self._last_used[engine_id]) > self.idle_ttl and self.can_evict(self._engines[engine_id]):
+                self._remove(engine_id, "idle")
+                evicted.append(engine_id)
+
+        for engine_id in list(self._engines):
+            if len(self._engines) <= self.max_engines and self.total_bytes() <= self.max_bytes:
+                break
+            if engine_id == keep or not self.can_evict(self._engines[engine_id]):
+                continue
+            self._remove(engine_id, "lru")
+            evicted.append(engine_id)
+
+        return evicted
+
+    def pop(self, engine_id: UUID, default=None) -> Optional[ChatEngine]:
+        if engine_id not in self._engines:
+            return default
+        chatengine = self._engines[engine_id]
+        self._remove(engine_id, "removed", count=False)
+        return chatengine
+
+    def _remove(self, engine_id: UUID, reason: str, count: bool=True):
+        chatengine = self._engines.pop(engine_id)
+        self._last_used.pop(engine_id, None)
+        self._sizes.pop(engine_id, None)
+        if count:
+            self.evictions += 1
+        logger.info(f"Evicting ChatEngine {engine_id} for run {chatengine.run_context.run_id} ({reason})")
+        for callback in self._on_evict:
+            try:
+                callback(chatengine)
+            except Exception as e:
+                logger.error(f"Error in engine evict callback: {e}")
+
+    def stats(self) -> dict:
+        return {
+            "engines": len(self._engines),
+            "max_engines": self.max_engines,
+            "bytes": self.total_bytes(),
+            "max_bytes": self.max_bytes,
+            "idle_ttl": self.idle_ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "pinned": len(self._pins),
+        }
@@ -9,7 +9,6 @@
 # are then wrapped in RunLog events and published to Redis.
 
 import asyncio
-from datetime import datetime, timedelta
 from uuid import UUID
 import os
 import time
@@ -37,7 +36,7 @@ from supercog.shared.services import config
 from supercog.shared.services import db_connect
 from supercog.shared.models import ToolBase
 from supercog.shared.apubsub import (
-    pubsub, AGENT_EVENTS_CHANNEL, 
+    pubsub, AGENT_EVENTS_CHANNEL, RUN_EVENT_STREAMS,
     AgentEvent,
     AgentErrorEvent,
     AgentLogEventTypes, 
@@ -48,16 +47,19 @@ from supercog.shared.apubsub import (
     AddMemoryEvent,
     AgentSavedEvent,
     AssetTypeEnum,
+    AssetUploadEvent,
 )
 
 from supercog.shared.logging import logger
 from supercog.shared.utils import (
-    upload_file_to_s3, 
     get_file_mimetype, 
 )
 
 from .chatengine import ChatEngine
+from .engine_cache import EngineCache
+from .output_coalescer import OutputCoalescer
 from .chat_logger import chat_logger
+from .upload_queue import upload_queue
 
 from .db import Run, RunLog, Agent, session_context
 from .db import lifespan as db_lifespan, reset_db_connections
@@ -67,12 +69,13 @@ from .jwt_auth import User
 from .filesystem import (
     get_user_directory,
     get_agent_filesystem, 
-    list_modified_files, 
 )
 
 EventCallback = Callable[[AgentEvent], None]
 
 IDLE_TIMEOUT = int(config.get_option("AGENT_WORKER_IDLE", default=120))  # Seconds before we exit from no activity
+WORKER_CONCURRENCY = int(config.get_option("AGENT_WORKER_CONCURRENCY", default=20))  # Max agent tasks running at once per worker
+WORKER_BATCH_SIZE = int(config.get_option("AGENT_WORKER_BATCH_SIZE", default=10))  # Max tasks pulled per stream read
 
 class AgentTask(BaseModel):
     action: str
@@ -91,12 +94,16 @@ class EngineManager:
     # Manages creating and running ChatEngine instances which are instances of
     # executing agents.
 
-    # Map of user id's to running engines. We should clone this map via Redis, but note
-    # that requires we can pickle the full ChatEngine object.
-    RUNNING_ENGINES: dict[UUID, ChatEngine] = {} 
+    # Map of chatengine id's to running engines. We should clone this map via Redis, but note
+    # that requires we can pickle the full ChatEngine object. The cache is bounded, and evicted
+    # engines are rebuilt from the run history by continue_run.
+    RUNNING_ENGINES: EngineCache = EngineCache()
+    # Locks for each chatengine to prevent concurrent access, which can happen if you
+    # modify an agent while it is running a request. Shared like the engines themselves.
+    chatengine_mod_locks: dict[str, asyncio.Lock] = {}
     END_EVENT = {"type": "end"}
 
-    def __init__(self, tenant_id_list: list[str]):
+    def __init__(self, tenant_id_list: list[str], max_concurrency: int = WORKER_CONCURRENCY):
         self.tenant_id_list = tenant_id_list
         self.group_name = 'consumer_group'
         self.consumer_name = f'consumer_{"-".join(tenant_id_list)}'
@@ -106,9 +113,13 @@ class EngineManager:
         self.dbengine = db_connect("engine") 
         self.last_event = time.time()
         self.subscribed: bool = False
-        # Locks for each chatengine to prevent concurrent access, which can happen if you
-        # modify an agent while it is running a request.
-        self.chatengine_mod_locks: dict[str, asyncio.Lock] = {}
+        # The worker loop runs up to 'max_concurrency' agent tasks at once. Tasks for the same
+        # run are serialized (in stream order) by the run task locks.
+        self.max_concurrency = max_concurrency
+        self.task_semaphore = asyncio.Semaphore(max_concurrency)
+        self.run_task_locks: dict[str, asyncio.Lock] = {}
+        self.run_task_counts: dict[str, int] = {}
+        self.inflight_tasks: set[asyncio.Task] = set()
 
     @asynccontextmanager
     async def acquire_chatengine_lock(self, chatengine: ChatEngine):
@@ -122,6 +133,17 @@ class EngineManager:
         finally:
             lock.release()            
 
+    @classmethod
+    def chatengine_is_locked(cls, chatengine: ChatEngine) -> bool:
+        lock = cls.chatengine_mod_locks.get(str(chatengine.id))
+        return lock is not None and lock.locked()
+
+    @classmethod
+    def on_chatengine_evicted(cls, chatengine: ChatEngine):
+        # Drop the engine's lock together with the engine
+        cls.chatengine_mod_locks.pop(str(chatengine.id), None)
+        chatengine.run_context.close()
+
     async def handle_agent_meta_event(self, channel, event: dict):
         print("Agent changed event: ", event)
         
@@ -187,10 +209,11 @@ class EngineManager:
         self.RUNNING_ENGINES[chatengine.id] = chatengine  
         print("********** SAVED CHATENGINE UNDER ID: ", chatengine.id)
         if run_db.input is not None:
+            self.RUNNING_ENGINES.pin(chatengine.id)
             if synchronous:
-                await self.dispatch_input(run_db, chatengine, run_db.input, user)
+                await self.dispatch_pinned_input(run_db, chatengine, run_db.input, user)
             else:
-                asyncio.create_task(self.dispatch_input(run_db, chatengine, run_db.input, user))
+                asyncio.create_task(self.dispatch_pinned_input(run_db, chatengine, run_db.input, user))
 
         return run_db
 
@@ -208,10 +231,11 @@ class EngineManager:
 
         print("Continuing Run with chatengine ID: ", rundb.chatengine_id)
             
-        if rundb.chatengine_id is None or rundb.chatengine_id not in self.RUNNING_ENGINES:
+        chatengine = self.RUNNING_ENGINES.lookup(rundb.chatengine_id)
+        if chatengine is None:
             # There is no ChatEngine in memory for this run, but maybe we ran
-            # the chat before. Let's load any chat history and refresh the
-            # chatengine with it.
+            # the chat before (or the engine was evicted). Let's load any chat 
+            # history and refresh the chatengine with it.
             chatengine = ChatEngine()
             agent = session.get(Agent, rundb.agent_id)
             if agent is None:
@@ -234,19 +258,25 @@ class EngineManager:
             session.refresh(rundb)
         else:
             print("------------- ChatEngine already exists")
-            chatengine: ChatEngine = self.RUNNING_ENGINES[rundb.chatengine_id]
 
-        if attached_file:
-            # Make sure the agent has a tool to read the file uploaded in the chat
-            await chatengine.attach_file_reading(attached_file)
+        # Pin the engine before we await anything, so it can't be evicted (which closes its
+        # RunContext) before the turn has run
+        self.RUNNING_ENGINES.pin(chatengine.id)
+        try:
+            if attached_file:
+                # Make sure the agent has a tool to read the file uploaded in the chat
+                await chatengine.attach_file_reading(attached_file)
 
-        if run_data:
-            chatengine.run_context.update_env_vars(run_data)
+            if run_data:
+                chatengine.run_context.update_env_vars(run_data)
+        except BaseException:
+            self.RUNNING_ENGINES.unpin(chatengine.id)
+            raise
 
         if synchronous:
-            await self.dispatch_input(rundb, chatengine, run_input, user)
+            await self.dispatch_pinned_input(rundb, chatengine, run_input, user)
         else:
-            asyncio.create_task(self.dispatch_input(rundb, chatengine, run_input, user))
+            asyncio.create_task(self.dispatch_pinned_input(rundb, chatengine, run_input, user))
 
     async def cancel_run(
             self,
@@ -296,6 +326,7 @@ class EngineManager:
             chatengine = self.RUNNING_ENGINES[rundb.chatengine_id]
             if df_name in chatengine.tools_inmem_state:
                 del chatengine.tools_inmem_state[df_name]
+                chatengine.run_context.unregister_table(df_name)
     
     async def list_tables(self, session, rundb: Run) -> list[str]:
         return []
@@ -322,10 +353,13 @@ class EngineManager:
             run_log.version = 3
             logger.debug(run_log, f"[{run.logs_channel}]")
             ctx = start_timeit(f"REDIS PUBLISH: {str(run_log.model_dump())[0:50]}")
+            payload = run_log.model_dump()
             await pubsub.publish(
                 run.logs_channel or "logs", 
-                run_log.model_dump(),
+                payload,
             )
+            if RUN_EVENT_STREAMS and run.id:
+                await pubsub.append_run_event(str(run.id), payload)
             end_timeit(ctx)
         return mypublish
 
@@ -341,6 +375,8 @@ class EngineManager:
 
             logger.debug(run_log, f"[{logs_channel}]")
             await pubsub.publish(logs_channel, run_log.model_dump())
+            if RUN_EVENT_STREAMS and task.run.get("id"):
+                await pubsub.append_run_event(str(task.run["id"]), run_log.model_dump())
 
     async def dispatch_input(
             self, 
@@ -352,6 +388,21 @@ class EngineManager:
         # Make sure no previous cancel flag is set
         async with self.acquire_chatengine_lock(chatengine):
             await self.dispatch_input_with_lock(run, chatengine, question, user)
+        # The engine grows with each turn, so re-measure it for the cache budget
+        self.RUNNING_ENGINES.update_size(chatengine.id)
+
+    async def dispatch_pinned_input(
+            self, 
+            run: Run, 
+            chatengine: ChatEngine, 
+            question: str,
+            user: User,
+        ):
+        # Runs a turn on an engine which the caller pinned in the cache, and unpins it after
+        try:
+            await self.dispatch_input(run, chatengine, question, user)
+        finally:
+            self.RUNNING_ENGINES.unpin(chatengine.id)
 
     async def dispatch_input_with_lock(
             self, 
@@ -367,9 +418,6 @@ class EngineManager:
         print("###### SENDING INPUT EVENT FOR question: ", question)
         await mypublish(AgentInputEvent, prompt=question, role="user")
 
-        # File uploads will have already been saved, so open our "file mod" window a bit for this
-        start_time = datetime.now() - timedelta(seconds=30)
-
         async def check_run_canceled():
             if chatengine.agent_is_canceled():
                 print("Run canceled!!")
@@ -396,36 +444,42 @@ class EngineManager:
                     print("SKIPPING bad event: ", e)
 
         print("###### Setup Agent filesystem")
-        with get_agent_filesystem(run.tenant_id, run.user_id):
-            output_events: list[AgentOutputEvent] = []
-            batch_size = 25
-            async for event in chatengine.respond(question, log_function, check_run_canceled, user):
-                # Add the question and answer to the current chat.
-                if await check_run_canceled():
-                    break
-                if event.type == AgentLogEventTypes.OUTPUT:
-                    output_events.append(event)
-                if event.type != AgentLogEventTypes.OUTPUT or len(output_events) > batch_size:
-                    if output_events:
-                        await log_function(output_events)
-                        output_events = []
-                    if event.type != AgentLogEventTypes.OUTPUT:
+        with get_agent_filesystem(run.tenant_id, run.user_id) as journal:
+            # Streamed output chunks are merged into segments before we publish them
+            coalescer = OutputCoalescer(log_function)
+            try:
+                async for event in chatengine.respond(question, log_function, check_run_canceled, user):
+                    # Add the question and answer to the current chat.
+                    if await check_run_canceled():
+                        break
+                    if event.type == AgentLogEventTypes.OUTPUT:
+                        await coalescer.add(event)
+                    else:
+                        # flush pending output first to preserve event order
+                        await coalescer.flush()
                         await log_function([event])
 
-            if output_events:
-                await log_function(batch=output_events)
+                await coalescer.flush()
+            finally:
+                # Don't hold DuckDB files open between turns. This also means we upload
+                # the files below in their closed state. A tool thread may still hold the
+                # session's lock, so wait for it off the event loop.
+                await asyncio.to_thread(chatengine.run_context.close_duckdb_files)
 
         logger.debug("channel ", run.logs_channel, " **EVENT** ")
         logger.info(f"[{run.logs_channel}] -> END")
 
+        # The files written during this turn
+        modified_files = journal.modified_files()
+
         # Send asset created events for any files created
-        self.gather_file_assets(chatengine.run_context, run.tenant_id, run.user_id, start_time)
+        self.gather_file_assets(chatengine.run_context, run.tenant_id, run.user_id, modified_files)
         async for asset_event in chatengine.run_context.get_queued_asset_events():
             await log_function(asset_event)
 
         await mypublish(AgentEndEvent)
         
-        self.upload_agent_files(run.tenant_id, run.user_id, start_time)
+        self.upload_agent_files(run.tenant_id, run.user_id, modified_files, mypublish)
         print("###### AGENT DONE FOR question: ", question)
 
 
@@ -447,40 +501,48 @@ class EngineManager:
     def get_file_asset_type(self, file):
         return AssetTypeEnum.TABLE
 
-    def gather_file_assets(self, run_context: RunContext, tenant_id, user_id, start_time):
+    def gather_file_assets(self, run_context: RunContext, tenant_id, user_id, modified_files: list[str]):
         # Send Asset events for any files created by the agent
         user_dir = get_user_directory(tenant_id, user_id)
-        for file in list_modified_files(start_time, tenant_id, user_id):
+        for file in modified_files:
             folder = os.path.dirname(file)
             folder = os.path.relpath(folder, user_dir)
             name = os.path.basename(file)
             full_name = os.path.join(folder, name)
             run_context.queue_asset_event(full_name, self.get_file_asset_type(file), name)
 
-    def upload_agent_files(self, tenant_id, user_id, start_time):
-        # Upload any files created by the agent to the user's directory
+    def upload_agent_files(self, tenant_id, user_id, modified_files: list[str], publish=None):
+        # Queue any files created by the agent for upload to the user's directory. This
+        # returns right away, and the upload progress is published as AssetUploadEvents.
         user_dir = get_user_directory(tenant_id, user_id)
-        for file in list_modified_files(start_time, tenant_id, user_id):
+        for file in modified_files:
             folder = os.path.dirname(file)
             folder = os.path.relpath(folder, user_dir)
             if folder == ".":
                 folder = ""
-            self.upload_user_file_to_s3(tenant_id, user_id, file, folder=folder)
+            self.upload_user_file_to_s3(tenant_id, user_id, file, folder=folder, publish=publish)
 
-    def upload_user_file_to_s3(self, tenant_id, user_id, file_path, folder=""):
+    def upload_user_file_to_s3(self, tenant_id, user_id, file_path, folder="", publish=None) -> asyncio.Task:
         bucket = config.get_global("S3_FILES_BUCKET_NAME")
 
+        asset_id = os.path.join(folder, os.path.basename(file_path))
         folder = f"{user_id}/{folder}"    
         if not folder.endswith("/"):
             folder = folder + "/"
         file_name = os.path.basename(file_path)
         object_name = f"{tenant_id}/{folder}{file_name}"
-        print(f"Uploading {file_path} as {object_name}")
-        return upload_file_to_s3(
+
+        async def report_upload(status: str, **fields):
+            if publish:
+                await publish(AssetUploadEvent, asset_id=asset_id, status=status, **fields)
+
+        print(f"Queueing upload of {file_path} as {object_name}")
+        return upload_queue.submit(
             file_path, 
             bucket, 
             object_name,
             get_file_mimetype(file_name),
+            callback=report_upload,
         )
 
     async def connect(self):
@@ -501,12 +563,14 @@ class EngineManager:
                 'timestamp': time.time(),
                 'streams': self.tenant_id_list
             }))
+            # Eviction otherwise only happens when the cache changes, so a quiet worker would
+            # hold on to idle engines
+            self.RUNNING_ENGINES.evict()
             try:
                 #print("SENDING HEARTBEAT", self)
                 await asyncio.wait_for(self.shutdown_event.wait(), timeout=self.heartbeat_interval)
             except asyncio.TimeoutError:
                 continue
-        await self.redis.close()
 
     async def remove_heartbeat(self):
         heartbeat_key = f"heartbeat:{self.consumer_name}"
@@ -520,11 +584,23 @@ class EngineManager:
         heartbeat_task = asyncio.create_task(self.send_heartbeat())
 
         try:
-            while not self.shutdown_event.is_set() and (self.last_event + IDLE_TIMEOUT) > time.time():
+            while not self.shutdown_event.is_set() and (
+                self.inflight_tasks or (self.last_event + IDLE_TIMEOUT) > time.time()
+            ):
+                free_slots = self.max_concurrency - len(self.inflight_tasks)
+                if free_slots <= 0:
+                    # All slots busy, so leave tasks on the stream until one finishes
+                    await asyncio.wait(self.inflight_tasks, timeout=1.0, return_when=asyncio.FIRST_COMPLETED)
+                    continue
                 try:
                     streams = {f'agents:{t}': '>' for t in self.tenant_id_list}
                     messages = await asyncio.wait_for(
-                        self.redis.xreadgroup(self.group_name, self.consumer_name, streams, count=1),
+                        self.redis.xreadgroup(
+                            self.group_name, 
+                            self.consumer_name, 
+                            streams, 
+                            count=min(free_slots, WORKER_BATCH_SIZE),
+                        ),
                         timeout=1.0
                     )
                     
@@ -532,9 +608,7 @@ class EngineManager:
                         for task_id, task in tasks:
                             task_data = json.loads(task["task"])
                             self.last_event = time.time()
-                            await self._process_task(task_data)
-                            self.last_event = time.time()
-                            await self.redis.xack(stream, self.group_name, task_id)
+                            self.start_task(stream, task_id, task_data)
                 
                 except asyncio.TimeoutError:
                     continue
@@ -543,12 +617,48 @@ class EngineManager:
                     await asyncio.sleep(0.2)
             print("AGENT IDLE, SHUTTING DOWN")
         finally:
+            # The in-flight tasks ack their messages when they finish, so Redis stays
+            # open until they are done
+            if self.inflight_tasks:
+                print(f"Waiting for {len(self.inflight_tasks)} agent tasks to finish")
+                await asyncio.gather(*self.inflight_tasks, return_exceptions=True)
             heartbeat_task.cancel()
             try:
                 await heartbeat_task
             except asyncio.CancelledError:
                 pass
             await self.remove_heartbeat()
+            await self.redis.close()
+
+    def start_task(self, stream: str, task_id: str, task_data: dict) -> asyncio.Task:
+        # Claim the run's lock slot now, in stream order, so that prompts for the same run
+        # execute in the order they were queued.
+        run_key = str(task_data.get("run", {}).get("id", task_id))
+        if run_key not in self.run_task_locks:
+            self.run_task_locks[run_key] = asyncio.Lock()
+        self.run_task_counts[run_key] = self.run_task_counts.get(run_key, 0) + 1
+
+        task = asyncio.create_task(self._consume_task(stream, task_id, task_data, run_key))
+        self.inflight_tasks.add(task)
+        task.add_done_callback(self.inflight_tasks.discard)
+        return task
+
+    async def _consume_task(self, stream: str, task_id: str, task_data: dict, run_key: str):
+        try:
+            async with self.run_task_locks[run_key]:
+                async with self.task_semaphore:
+                    self.last_event = time.time()
+                    await self._process_task(task_data)
+                    self.last_event = time.time()
+            # Only ack once the task is done, so tasks from a crashed worker stay pending
+            await self.redis.xack(stream, self.group_name, task_id)
+        except Exception as e:
+            print(f"Error processing task {task_id}: {e}")
+        finally:
+            self.run_task_counts[run_key] -= 1
+            if self.run_task_counts[run_key] == 0:
+                del self.run_task_counts[run_key]
+                del self.run_task_locks[run_key]
 
     async def _process_task(self, task_data, synchronous=True):
         try:
@@ -591,8 +701,6 @@ class EngineManager:
             traceback.print_exc()
             await self.report_unhandled_error(task, e)
 
-        await asyncio.sleep(1)
-
     def shutdown(self):
         print("Shutting down...")
         self.shutdown_event.set()
@@ -606,6 +714,7 @@ class EngineManager:
         chat_logger.reconnect()
         async for i in db_lifespan(None):
             await self.process_tasks_until_canceled()
+            await upload_queue.drain()
 
     @staticmethod
     def reset_db_connections():
@@ -615,6 +724,9 @@ class EngineManager:
         chat_logger.reconnect()
         reset_db_connections()
 
+# The engine cache is shared by every EngineManager, so it gets its hooks once
+EngineManager.RUNNING_ENGINES.add_evict_listener(EngineManager.on_chatengine_evicted)
+EngineManager.RUNNING_ENGINES.add_busy_check(EngineManager.chatengine_is_locked)
 
 def signal_handler(consumer):
     print("Received exit signal. Initiating shutdown...")
@@ -13,6 +13,7 @@ import email
 from email import policy
 from email.parser import BytesParser
 from supercog.engine.email_utils import process_email
+from supercog.engine.filesystem import resolve_agent_path
 
 def read_eml(file: Union[str, BytesIO], agent_dir: str, run_context) -> Dict[str, Any]:
     """
@@ -188,7 +189,8 @@ async def read_and_return_file(file_path: str) -> Response:
             elif file_path.endswith(".csv"):
                 df = pd.read_csv(file_path)
             elif file_path.endswith(".parquet"):
-                df = pd.read_parquet(file_path)
+                # pyarrow opens the file natively
+                df = pd.read_parquet(resolve_agent_path(file_path))
             elif file_path.endswith(".xlsx"):
                 df = pd.read_excel(file_path)
             else:
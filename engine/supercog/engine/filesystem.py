@@ -1,10 +1,12 @@
 import os
+import io
 import builtins
 import sys
+import functools
+import time
 from contextlib import contextmanager
-from pathlib import Path
+from contextvars import ContextVar
 from datetime import datetime
-from unittest.mock import patch
 
 from supercog.shared.services import config
 
@@ -15,6 +17,14 @@ orig_os_open = os.open
 orig_listdir = os.listdir
 orig_exists = os.path.exists
 orig_makedirs = os.makedirs
+orig_getcwd = os.getcwd
+orig_realpath = os.path.realpath
+orig_stat = os.stat
+orig_islink = os.path.islink
+orig_isfile = os.path.isfile
+
+# Size of the cache of resolved (symlink free) directory paths
+RESOLVE_CACHE_SIZE = int(config.get_option("FILESYSTEM_RESOLVE_CACHE_SIZE", default="4096"))
 
 WHITELIST_PATHS = [
     "/usr/lib/os-release",
@@ -45,6 +55,12 @@ if site_packages:
 #
 # Security is enforced by patching the system `open` call to enfore the
 # permissions, and to treat the user's directory as the root. 
+#
+# We can't chdir into the user's directory because the working directory is global
+# to the process, and we run many agents concurrently. So instead the user's directory
+# is kept in a ContextVar (every asyncio task has its own copy) and the patched `os`
+# functions resolve relative paths against it. The patches are installed once, and
+# they just call through to the original functions when no agent filesystem is active.
 
 def setup_filesystem():
     if not os.path.exists(SYSTEM_ROOT_PATH):
@@ -58,72 +74,242 @@ def setup_filesystem():
             )
     os.chdir(SYSTEM_ROOT_PATH)
 
-def access_allowed(file_path, user_dir):
-    p = Path(file_path)
-    pres = str(p.resolve())
-    if pres.startswith(user_dir) or file_path.startswith("/etc/"):
+class WriteJournal:
+    """ Records the files an agent writes through the sandboxed functions, so after
+        a turn we know which files to publish and upload without scanning the user's
+        directory. Tools that write files some other way (like running a subprocess)
+        should call `record_external_writes` to fall back to a scan. """
+    def __init__(self, user_dir: str):
+        self.user_dir = user_dir
+        self.start_time = time.time()
+        self.paths: dict[str, None] = {}
+        self.needs_scan = False
+
+    def record(self, path: str):
+        self.paths[os.path.normpath(path)] = None
+
+    def discard(self, path: str):
+        self.paths.pop(os.path.normpath(path), None)
+
+    def modified_files(self) -> list[str]:
+        # Files in the user's directory (not the tenant's shared folder) which were
+        # written during the turn and still exist.
+        paths = list(self.paths)
+        if self.needs_scan:
+            paths += _scan_modified_files(self.user_dir, self.start_time)
+        user_prefix = self.user_dir + os.sep
+        return [
+            path for path in dict.fromkeys(paths)
+            if path.startswith(user_prefix) and _resolve_path(path).startswith(user_prefix) and orig_isfile(path)
+        ]
+
+class AgentRoot:
+    """ The directories visible to the agent running in the current context. """
+    def __init__(self, user_dir: str, shared_dir: str, restricted: bool=True, journal: WriteJournal|None=None):
+        self.user_dir = user_dir
+        self.shared_dir = shared_dir
+        self.restricted = restricted
+        self.journal = journal
+        self.allowed_prefixes = tuple(
+            [user_dir + os.sep, shared_dir + os.sep, "/etc/"] + WHITELIST_PATHS
+        )
+
+    def unrestricted(self) -> "AgentRoot":
+        return AgentRoot(self.user_dir, self.shared_dir, restricted=False, journal=self.journal)
+
+    def join(self, path) -> str:
+        # Relative paths are relative to the user's directory
+        path = os.fspath(path)
+        if isinstance(path, bytes):
+            path = path.decode("utf-8")
+        return os.path.join(self.user_dir, path)
+
+    def resolve(self, path) -> str:
+        # Returns the absolute path to the file, or raises PermissionError if the agent
+        # can't access it.
+        file_path = self.join(path)
+        if not self.restricted:
+            return file_path
+        # Resolving the path calls the (patched) os.lstat, which must not check it again
+        token = _agent_root.set(None)
+        try:
+            allowed = access_allowed(file_path, self)
+        finally:
+            _agent_root.reset(token)
+        if allowed:
+            return file_path
+        raise PermissionError(f"Access to the file '{path}' is denied")
+
+_agent_root: ContextVar[AgentRoot|None] = ContextVar("agent_root", default=None)
+
+@functools.lru_cache(maxsize=RESOLVE_CACHE_SIZE)
+def _resolve_dir_cached(dirname: str) -> tuple[str, int, int]:
+    real_path = orig_realpath(dirname)
+    st = orig_stat(real_path)
+    return real_path, st.st_dev, st.st_ino
+
+def _resolve_dir(dirname: str) -> str:
+    # A cached directory can be swapped for a symlink without going through our patches
+    # (by a subprocess or native code), so only trust the cached path while it's still
+    # the same directory.
+    try:
+        st = orig_stat(dirname)
+    except OSError:
+        return orig_realpath(dirname)
+    real_path, st_dev, st_ino = _resolve_dir_cached(dirname)
+    if (st.st_dev, st.st_ino) != (st_dev, st_ino):
+        _resolve_dir_cached.cache_clear()
+        real_path, _, _ = _resolve_dir_cached(dirname)
+    return real_path
+
+def clear_resolve_cache():
+    _resolve_dir_cached.cache_clear()
+
+def _resolve_path(file_path: str) -> str:
+    # Resolving every path component is slow, so we cache the resolved directory
+    # and only check whether the file itself is a symlink.
+    dirname, name = os.path.split(file_path)
+    if name in ("", ".", "..") or orig_islink(file_path):
+        return orig_realpath(file_path)
+    return os.path.join(_resolve_dir(dirname), name)
+
+def access_allowed(file_path: str, root: AgentRoot) -> bool:
+    if file_path.startswith("/etc/"):
         return True
-    for whitep in WHITELIST_PATHS:
-        if pres.startswith(whitep):
-            return True
-    return False
-
-def get_open_function(user_dir):
-    def restricted_open(file, mode='r', *args, **kwargs):
-        if isinstance(file, bytes):
-            file = file.decode("utf-8")
-        print("Builtins open: ", file)
-        if access_allowed(file, user_dir):
-            return orig_open(file, mode, *args, **kwargs)  # Use the real open function here
-        else:
-            raise PermissionError(f"Access to the file '{file}' is denied")
-    return restricted_open
-
-def get_os_open_function(user_dir):
-    def restricted_os_open(file, flags, mode=0o777, *args, **kwargs):
-        if access_allowed(file, user_dir):
-            return orig_os_open(file, flags, mode, *args, **kwargs)  # Use the real open function here
-        else:
-            raise PermissionError(f"Access to the file '{file}' is denied")
-    return restricted_os_open
-
-def get_listdir_function(user_dir):
-    def internal_listdir(dir):
-        return orig_listdir(os.path.join(user_dir, dir))
-    return internal_listdir
-
-def get_makedirs_function(user_dir):
-    def internal_makedirs(dir):
-        return orig_makedirs(os.path.join(user_dir, dir))
-    return internal_makedirs
-
-
-def get_exists_function(user_dir):
-    def internal_exists(dir):
-        return orig_exists(os.path.join(user_dir, dir))
-    return internal_exists
+    return (_resolve_path(file_path) + os.sep).startswith(root.allowed_prefixes)
+
+def resolve_agent_path(path) -> str:
+    # Libraries that open files natively (like DuckDB) don't see our patches, so
+    # give them the absolute path in the current agent's filesystem.
+    root = _agent_root.get()
+    return path if root is None else root.resolve(path)
+
+def record_file_write(path):
+    # For files written natively, see `resolve_agent_path`
+    root = _agent_root.get()
+    if root is not None and root.journal is not None:
+        root.journal.record(root.join(path))
+
+def record_external_writes():
+    # Call this when files may have been written without going through our patches
+    # (like by a subprocess), so the journal scans the user's directory. Call it again
+    # once the subprocess is done, since it may also have replaced directories.
+    clear_resolve_cache()
+    root = _agent_root.get()
+    if root is not None and root.journal is not None:
+        root.journal.needs_scan = True
+
+OS_WRITE_FLAGS = os.O_WRONLY | os.O_RDWR | os.O_CREAT | os.O_TRUNC | os.O_APPEND
+
+def _sandboxed_open(file, mode='r', *args, **kwargs):
+    root = _agent_root.get()
+    if root is None or isinstance(file, int):
+        return orig_open(file, mode, *args, **kwargs)
+    file_path = root.resolve(file)
+    if root.journal is not None and mode.strip("rbt") != "":
+        root.journal.record(file_path)
+    return orig_open(file_path, mode, *args, **kwargs)
+
+def _sandboxed_os_open(path, flags, mode=0o777, *args, **kwargs):
+    root = _agent_root.get()
+    if root is None or kwargs.get("dir_fd") is not None:
+        return orig_os_open(path, flags, mode, *args, **kwargs)
+    file_path = root.resolve(path)
+    if root.journal is not None and flags & OS_WRITE_FLAGS:
+        root.journal.record(file_path)
+    return orig_os_open(file_path, flags, mode, *args, **kwargs)
+
+def _sandboxed_getcwd():
+    root = _agent_root.get()
+    return orig_getcwd() if root is None else root.user_dir
+
+def _rooted(func, nargs: int=1, modifies: bool=False):
+    # Wraps an os function so its path arguments are relative to the user's directory,
+    # with the same access check as `open`, so '../' can't reach outside the sandbox.
+    # Functions that remove or rename paths clear the resolved directory cache, and
+    # update the write journal.
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        root = _agent_root.get()
+        if modifies:
+            clear_resolve_cache()
+        if root is None or kwargs.get("dir_fd") is not None:
+            return func(*args, **kwargs)
+        if "path" in kwargs:
+            kwargs["path"] = root.resolve(kwargs["path"])
+        elif nargs == 1 and (not args or args[0] is None):
+            # listdir() and scandir() default to the current directory
+            args = (".",) + args[1:]
+        args = [
+            root.resolve(arg) if i < nargs and arg is not None and not isinstance(arg, int) else arg
+            for i, arg in enumerate(args)
+        ]
+        result = func(*args, **kwargs)
+        if modifies and root.journal is not None and args and not isinstance(args[0], int):
+            root.journal.discard(args[0])
+            if nargs == 2:
+                root.journal.record(args[1])
+        return result
+    return wrapper
+
+# os.path.exists, isfile, getsize, makedirs, walk, glob... all go through these
+ROOTED_OS_FUNCTIONS = {
+    "stat": {},
+    "lstat": {},
+    "listdir": {},
+    "scandir": {},
+    "mkdir": {},
+    "chmod": {},
+    "utime": {},
+    "access": {},
+    "rmdir": {"modifies": True},
+    "remove": {"modifies": True},
+    "unlink": {"modifies": True},
+    "rename": {"nargs": 2, "modifies": True},
+    "replace": {"nargs": 2, "modifies": True},
+}
+
+_sandbox_installed = False
+
+def install_filesystem_sandbox():
+    global _sandbox_installed
+    if _sandbox_installed:
+        return
+    builtins.open = _sandboxed_open
+    io.open = _sandboxed_open
+    os.open = _sandboxed_os_open
+    os.getcwd = _sandboxed_getcwd
+    for name, opts in ROOTED_OS_FUNCTIONS.items():
+        setattr(os, name, _rooted(getattr(os, name), **opts))
+    _sandbox_installed = True
 
 def get_user_directory(tenant_id, user_id) -> str:
     path = os.path.join(SYSTEM_ROOT_PATH, tenant_id, user_id)
-    if not os.path.exists(path):
-        os.makedirs(path)
+    with unrestricted_filesystem():
+        if not os.path.exists(path):
+            os.makedirs(path)
     return path
 
 def get_tenant_directory(tenant_id) -> str:
     path = os.path.abspath(os.path.join(SYSTEM_ROOT_PATH, tenant_id))
-    if not os.path.exists(path):
-        os.makedirs(path)
+    with unrestricted_filesystem():
+        if not os.path.exists(path):
+            os.makedirs(path)
     return path
 
-@contextmanager
-def get_agent_filesystem(tenant_id, user_id):
+def get_agent_root(tenant_id, user_id) -> AgentRoot:
+    # We may be called from inside another agent's filesystem
+    with unrestricted_filesystem():
+        return _make_agent_root(tenant_id, user_id)
+
+def _make_agent_root(tenant_id, user_id) -> AgentRoot:
     # Ensure the tenant directory exists
-    tenant_dir = os.path.join(SYSTEM_ROOT_PATH, tenant_id)
+    tenant_dir = os.path.abspath(os.path.join(SYSTEM_ROOT_PATH, tenant_id))
     if not os.path.exists(tenant_dir):
         os.makedirs(tenant_dir)
     
     # Ensure the user directory exists
-    user_dir = str(Path(os.path.join(tenant_dir, user_id)).resolve())
+    user_dir = orig_realpath(os.path.join(tenant_dir, user_id))
     if not os.path.exists(user_dir):
         os.makedirs(user_dir)
     
@@ -139,33 +325,38 @@ def get_agent_filesystem(tenant_id, user_id):
         os.makedirs(common_shared)
 
     shared_dir = os.path.join(user_dir, "shared")
-    if not os.path.exists(shared_dir):
+    if not os.path.lexists(shared_dir):
         os.symlink(common_shared, shared_dir)
-       
-    # Change to the user's directory
-    os.chdir(user_dir)
-
-    with patch("builtins.open", get_open_function(user_dir)):
-        with patch.multiple(
-            "os", 
-            open=get_os_open_function(user_dir), listdir=get_listdir_function(user_dir)
-        ):
-            with patch("os.path.exists", get_exists_function(user_dir)):
-                yield
+
+    return AgentRoot(user_dir, orig_realpath(common_shared))
+
+@contextmanager
+def get_agent_filesystem(tenant_id, user_id):
+    # Yields the WriteJournal of files written inside the block
+    install_filesystem_sandbox()
+    root = get_agent_root(tenant_id, user_id)
+    root.journal = WriteJournal(root.user_dir)
+    token = _agent_root.set(root)
+    try:
+        yield root.journal
+    finally:
+        _agent_root.reset(token)
 
 @contextmanager
 def unrestricted_filesystem():
-    with patch("builtins.open", orig_open), \
-         patch("os.open", orig_os_open), \
-         patch("os.listdir", orig_listdir), \
-         patch("os.makedirs", orig_makedirs), \
-         patch("os.path.exists", orig_exists):
+    # Lifts the access checks, but relative paths are still in the user's directory
+    root = _agent_root.get()
+    token = _agent_root.set(root.unrestricted() if root else None)
+    try:
         yield
+    finally:
+        _agent_root.reset(token)
         
 def list_modified_files(from_time: datetime, tenant_id, user_id):
-    user_dir = get_user_directory(tenant_id, user_id)
+    return _scan_modified_files(get_user_directory(tenant_id, user_id), from_time.timestamp())
+
+def _scan_modified_files(user_dir: str, comp_time: float) -> list[str]:
     recent_files = []
-    comp_time = from_time.timestamp()
     for dirpath, dirnames, files in os.walk(user_dir):
         for file in files:
             file_path = os.path.join(dirpath, file)
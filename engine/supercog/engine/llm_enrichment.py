@@ -0,0 +1,171 @@
+import asyncio
+import hashlib
+import time
+from typing import Awaitable, Callable, Optional
+
+import pyarrow as pa
+import pyarrow.compute as pc
+from openai import AsyncOpenAI
+
+from supercog.shared.apubsub import pubsub
+from supercog.shared.logging import logger
+from supercog.shared.services import config
+
+from .retries import with_retries
+
+# Enriches a column by asking an LLM about each value. We only ask about distinct values,
+# results are cached in Redis by (prompt, model, value), and the remaining requests are
+# sent concurrently behind a rate limiter.
+
+ENRICH_CONCURRENCY = int(config.get_option("LLM_ENRICH_CONCURRENCY", default=8))
+ENRICH_REQUESTS_PER_MINUTE = int(config.get_option("LLM_ENRICH_REQUESTS_PER_MINUTE", default=500))
+ENRICH_CACHE_TTL = int(config.get_option("LLM_ENRICH_CACHE_TTL", default=60*60*24*30))
+ENRICH_MAX_RETRIES = 4
+CACHE_KEY_PREFIX = "llm_enrich:"
+MISSING_RESULT = "LLM result missing"
+
+ProgressCallback = Callable[[str], Awaitable[None]]
+
+class RateLimiter:
+    """ Spaces out requests so we send at most 'per_minute' of them. """
+    def __init__(self, per_minute: int):
+        self.interval = 60.0 / per_minute if per_minute > 0 else 0
+        self.next_time = 0.0
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            now = time.monotonic()
+            wait = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+class EnrichmentCache:
+    def __init__(self, get_client: Optional[Callable] = None, ttl: int = ENRICH_CACHE_TTL):
+        self.get_client = get_client or pubsub.get_client
+        self.ttl = ttl
+
+    @staticmethod
+    def key(prompt: str, model: str, value: str) -> str:
+        digest = hashlib.sha256("\0".join([model, prompt, value]).encode()).hexdigest()
+        return CACHE_KEY_PREFIX + digest
+
+    async def get_many(self, prompt: str, model: str, values: list[str]) -> dict[str, str]:
+        if not values:
+            return {}
+        try:
+            client = await self.get_client()
+            results = await client.mget([self.key(prompt, model, v) for v in values])
+        except Exception as e:
+            # The cache is an optimization, so carry on without it
+            logger.error(f"LLM enrichment cache lookup failed: {e}")
+            return {}
+        return {v: r for v, r in zip(values, results) if r is not None}
+
+    async def put_many(self, prompt: str, model: str, results: dict[str, str]):
+        if not results:
+            return
+        try:
+            client = await self.get_client()
+            async with client.pipeline(transaction=False) as pipe:
+                for value, result in results.items():
+                    pipe.set(self.key(prompt, model, value), result, ex=self.ttl)
+                await pipe.execute()
+        except Exception as e:
+            logger.error(f"LLM enrichment cache update failed: {e}")
+
+class ColumnEnricher:
+    def __init__(
+        self,
+        client: AsyncOpenAI,
+        prompt: str,
+        model: str,
+        cache: Optional[EnrichmentCache] = None,
+        concurrency: int = ENRICH_CONCURRENCY,
+        requests_per_minute: int = ENRICH_REQUESTS_PER_MINUTE,
+        progress: Optional[ProgressCallback] = None,
+    ):
+        self.client = client
+        self.prompt = prompt
+        self.model = model
+        self.cache = cache or EnrichmentCache()
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.limiter = RateLimiter(requests_per_minute)
+        self.progress = progress
+        self.stats = {"values": 0, "distinct": 0, "cached": 0, "requests": 0, "retries": 0, "failed": 0}
+
+    async def complete(self, value: str) -> str:
+        messages = [
+            {"role": "system", "content": "You are a helpful assistant."},
+            {"role": "user", "content": f"{self.prompt}: {value}"}
+        ]
+
+        async def request() -> str:
+            await self.limiter.acquire()
+            self.stats["requests"] += 1
+            response = await self.client.chat.completions.create(model=self.model, messages=messages)
+            if response.choices:
+                return response.choices[0].message.content or ""
+            return MISSING_RESULT
+
+        def count_retry():
+            self.stats["retries"] += 1
+
+        return await with_retries(
+            request, self.semaphore, ENRICH_MAX_RETRIES, "LLM enrichment request", on_retry=count_retry,
+        )
+
+    async def report(self, message: str):
+        if self.progress:
+            try:
+                await self.progress(message)
+            except Exception as e:
+                logger.error(f"LLM enrichment progress callback failed: {e}")
+
+    async def enrich_values(self, values: list[str]) -> dict[str, Optional[str]]:
+        """ Returns the LLM result for each of the distinct 'values'. Values whose request
+            failed map to None. """
+        distinct = list(dict.fromkeys(values))
+        self.stats["distinct"] = len(distinct)
+        results: dict[str, Optional[str]] = await self.cache.get_many(self.prompt, self.model, distinct)
+        self.stats["cached"] = len(results)
+        misses = [v for v in distinct if v not in results]
+        await self.report(
+            f"Enriching {len(distinct)} distinct values, {len(results)} from the cache, {len(misses)} to request"
+        )
+
+        done = 0
+        step = max(1, len(misses) // 10)
+        new_results = {}
+
+        async def enrich(value: str):
+            nonlocal done
+            try:
+                result = await self.complete(value)
+                new_results[value] = result
+                results[value] = result
+            except Exception as e:
+                self.stats["failed"] += 1
+                logger.error(f"LLM enrichment failed for '{value[:100]}': {e}")
+                results[value] = None
+            done += 1
+            if done % step == 0 and done < len(misses):
+                await self.report(f"Enriched {done} of {len(misses)} values")
+
+        await asyncio.gather(*[enrich(v) for v in misses])
+        await self.cache.put_many(self.prompt, self.model, new_results)
+        await self.report(
+            f"Enrichment done: {self.stats['requests']} requests, {self.stats['cached']} cached, {self.stats['failed']} failed"
+        )
+        return results
+
+    async def enrich_column(self, column: pa.ChunkedArray|pa.Array) -> pa.Array:
+        """ Returns the result for each row of 'column'. Nulls stay null. """
+        column = pc.cast(column, pa.string())
+        self.stats["values"] = len(column)
+        distinct = pc.unique(column).drop_null()
+        results = await self.enrich_values(distinct.to_pylist())
+        # Map every row to its result in one step
+        indices = pc.index_in(column, value_set=distinct)
+        return pc.take(pa.array([results[v] for v in distinct.to_pylist()], type=pa.string()), indices)
@@ -37,7 +37,7 @@ from sqlalchemy import text
 
 from fastapi import FastAPI, Request, status
 from fastapi.exceptions import RequestValidationError
-from fastapi.responses import JSONResponse, FileResponse, Response
+from fastapi.responses import JSONResponse, FileResponse, Response, StreamingResponse
 import pandas as pd
 
 # Allow us to mount a Flask app for FlaskDance oauth
@@ -85,7 +85,7 @@ from .run_context import RunContext
 from .rag_utils import get_user_personal_index, get_ragie_partition
 
 # This import is really slow. Probably langchain?
-from .all_tools import ToolFactory, TOOL_FACTORIES, FACTORY_MAP
+from .all_tools import ToolFactory, TOOL_FACTORIES, FACTORY_MAP, tool_factory_info
 from .doc_source_factory import DocSourceFactory
 from .filesystem import (
     get_user_directory,
@@ -93,13 +93,15 @@ from .filesystem import (
     get_agent_filesystem,
 )
 from .tool_factory import TOOL_REGISTRY
+from .tables import to_pandas, table_ready
+from .sql_engines import sql_engines
 
 from supercog.engine.tools.website_docs import WebsiteDocSource
 from supercog.engine.tools.google_drive import GoogleDriveDocSource
 from supercog.engine.doc_source_factory import DocSourceFactory
 
 # Need this import to register chat_logger with the FastAPI app
-from .chat_logger import activate_chatlogger
+from .chat_logger import activate_chatlogger, chat_logger
 activate_chatlogger()
 
 from .agent_learning import AgentLearning
@@ -224,15 +226,19 @@ async def admin_list_runs(
         "info": {
             "git_sha": sha, 
             "start_time": STARTUP_TIME, 
-            "address":address
+            "address":address,
+            "engine_cache": enginemgr.RUNNING_ENGINES.stats(),
+            "chat_logger": chat_logger.stats(),
+            "sql_engines": sql_engines.stats(),
         }
     }
 
-@app.get("/tenant/{tenant_id}/tool_factories", response_model=List[ToolFactory])
+@app.get("/tenant/{tenant_id}/tool_factories", response_model=List[dict])
 async def get_tools(*, tenant_id: str, user: User = Depends(requires_jwt)):
     # Load the dynamic tools. They will get put into TOOL_FACTORIES for return
     TOOL_REGISTRY.load_registry_from_filesystem(tenant_id)
-    return TOOL_FACTORIES
+    # Static tools are described from the tool manifest, so this doesn't import them
+    return [tool_factory_info(tf) for tf in TOOL_FACTORIES]
 
 @app.get("/models", response_model=List[str])
 async def get_models():
@@ -943,7 +949,13 @@ async def get_single_datum(*,
             logger.debug("Retrieving dataframe")
             df = await enginemgr.get_dataframe(rundb, name)
             if df is not None:
-                result = handle_other_files(file_path, df.to_csv(), "csv")
+                if not await table_ready(df):
+                    return JSONResponse(
+                        status_code=202,
+                        content={"type": "status", "content": f"Dataframe {name} is {df.status()}"},
+                    )
+                csv = await asyncio.to_thread(lambda: to_pandas(df).to_csv())
+                result = handle_other_files(file_path, csv, "csv")
                 return JSONResponse(content={"type": "csv", "content": result})
             else:
                 logger.warn(f"Dataframe {name} not found")
@@ -1078,7 +1090,7 @@ async def get_asset(*,
     content, content_type = await RunContext.get_asset(tenant_id, user_id, asset_id)
     if content is None:
         raise HTTPException(status_code=404, detail="Asset not found")
-    return Response(content=content, media_type=content_type)
+    return StreamingResponse(content, media_type=content_type)
 
 @app.get("/runs/{run_id}/run_logs", response_model=List[RunLogBase])
 async def list_run_logs(*,
@@ -1273,8 +1285,10 @@ async def test_cred(*,
     env_var_list = secrets_service.list_credentials(cred.tenant_id, user.user_id, "ENV:", include_values=True)
     env_vars = {k[4:]: v for k, v in env_var_list}
 
-    run_context = RunContext.create_squib_context(cred.tenant_id, user.user_id, env_vars)
-    tool_factory.run_context = run_context
+    # Test with our own instance, the ones in TOOL_FACTORIES are shared (and may be
+    # lazy stand-ins which don't accept attributes)
+    tool_factory = tool_factory.factory_class()()
+    tool_factory.run_context = RunContext.create_squib_context(cred.tenant_id, user.user_id, env_vars)
 
     # FIXME: I don't like that this is here or required, but I don't an alternative other than
     # to now allow tools to require the filesystem to test creds.    
@@ -1862,7 +1876,7 @@ def get_doc_source_factory_instance(doc_source: DocSourceConfig) -> DocSourceFac
     factory: DocSourceFactory = FACTORY_MAP.get(doc_source.doc_source_factory_id)
     if factory is None:
         raise HTTPException(status_code=404, detail="DocSource factory not found")
-    return factory.__class__()
+    return factory.factory_class()()
 
 @app.get("/tenant/{tenant_id}/doc_indexes/{index_id}/sources/{source_id}/authorize")
 async def get_doc_source_authorize_url(
@@ -0,0 +1,72 @@
+# Coalesces the streamed AgentOutputEvent chunks from ChatEngine.respond before they are
+# published. Each chunk from the LLM is tiny, so publishing them one at a time means
+# hundreds of Redis messages and RunLog rows per answer. Instead we buffer chunks and
+# flush them as a single merged event every 'max_delay' seconds or once 'max_bytes'
+# of text has accumulated, which keeps the dashboard stream live but cuts the row count.
+
+import asyncio
+from typing import Awaitable, Callable, Optional
+
+from supercog.shared.apubsub import AgentOutputEvent
+from supercog.shared.services import config
+
+OUTPUT_FLUSH_MS = int(config.get_option("OUTPUT_FLUSH_MS", default=50))
+OUTPUT_FLUSH_BYTES = int(config.get_option("OUTPUT_FLUSH_BYTES", default=2048))
+
+FlushFunction = Callable[[list[AgentOutputEvent]], Awaitable[None]]
+
+class OutputCoalescer:
+    def __init__(
+            self,
+            flush_function: FlushFunction,
+            max_delay: float = OUTPUT_FLUSH_MS / 1000.0,
+            max_bytes: int = OUTPUT_FLUSH_BYTES,
+        ):
+        self.flush_function = flush_function
+        self.max_delay = max_delay
+        self.max_bytes = max_bytes
+        self.buffer: list[AgentOutputEvent] = []
+        self.buffer_bytes = 0
+        self.flush_lock = asyncio.Lock()
+        self.timer: Optional[asyncio.Task] = None
+        # An error raised by a timed flush (like a cancel), re-raised to the caller
+        self.error: Optional[Exception] = None
+
+    async def add(self, event: AgentOutputEvent):
+        self.raise_pending_error()
+        # A segment is one LLM call, so don't merge chunks across lc_run_ids
+        if self.buffer and self.buffer[-1].lc_run_id != event.lc_run_id:
+            await self.flush()
+        self.buffer.append(event)
+        self.buffer_bytes += len(event.str_result or "")
+        if self.buffer_bytes >= self.max_bytes:
+            await self.flush()
+        elif self.timer is None:
+            self.timer = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.max_delay)
+        self.timer = None
+        try:
+            await self._flush_buffer()
+        except Exception as e:
+            self.error = e
+
+    async def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        await self._flush_buffer()
+        self.raise_pending_error()
+
+    async def _flush_buffer(self):
+        async with self.flush_lock:
+            batch, self.buffer = self.buffer, []
+            self.buffer_bytes = 0
+            if batch:
+                await self.flush_function(batch)
+
+    def raise_pending_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
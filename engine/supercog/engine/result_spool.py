@@ -0,0 +1,188 @@
+import asyncio
+import itertools
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, Optional
+
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from supercog.shared.logging import logger
+from supercog.shared.services import config
+
+# Large query results are streamed to a Parquet file in the user's directory. The tool
+# returns its preview from the first batch of rows, and the rest of the rows are written
+# in the background. Each run has a budget of rows and bytes that it may spool.
+
+SPOOL_MAX_ROWS = int(config.get_option("RESULT_SPOOL_MAX_ROWS", default=10_000_000))
+SPOOL_MAX_BYTES = int(config.get_option("RESULT_SPOOL_MAX_MB", default=1024)) * 1024 * 1024
+SPOOL_WORKERS = int(config.get_option("RESULT_SPOOL_WORKERS", default=4))
+# How long a reader waits for the rest of a result before reporting that it is still loading
+SPOOL_WAIT_SECS = float(config.get_option("RESULT_SPOOL_WAIT_SECS", default=30))
+SPOOL_DIR = ".query_results"
+
+_executor: Optional[ThreadPoolExecutor] = None
+
+def get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=SPOOL_WORKERS, thread_name_prefix="result_spool")
+    return _executor
+
+class ResultBudget:
+    """ The rows and bytes that one run may spool, across all of its results. """
+    def __init__(self, max_rows: int = SPOOL_MAX_ROWS, max_bytes: int = SPOOL_MAX_BYTES):
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.rows = 0
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+    def take(self, rows: int, nbytes: int) -> bool:
+        with self.lock:
+            if self.rows + rows > self.max_rows or self.bytes + nbytes > self.max_bytes:
+                return False
+            self.rows += rows
+            self.bytes += nbytes
+            return True
+
+class SpooledResult:
+    """ A result being written to a Parquet file. The first batch is kept in memory for
+        previews, anything else waits for the file to be complete. """
+    def __init__(self, path: str, head: pa.Table):
+        self.path = path
+        self.head = head
+        self.schema = head.schema
+        self.rows_written = 0
+        self.truncated = False
+        self.error: Optional[str] = None
+        self.done = threading.Event()
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        return self.done.wait(timeout)
+
+    def wait_ready(self) -> bool:
+        """ Waits up to SPOOL_WAIT_SECS, returning False if the result is still loading. """
+        return self.wait(SPOOL_WAIT_SECS)
+
+    async def wait_ready_async(self) -> bool:
+        # Like wait_ready, without blocking the event loop
+        return self.done.is_set() or await asyncio.to_thread(self.wait_ready)
+
+    def _wait_for_file(self):
+        if not self.wait_ready():
+            raise TimeoutError(f"The result is {self.status()}, try again shortly")
+
+    @property
+    def column_names(self) -> list[str]:
+        return self.schema.names
+
+    @property
+    def num_rows(self) -> int:
+        # The rows written so far. This is the total once the result is done.
+        return self.rows_written
+
+    def dataset(self) -> ds.Dataset:
+        """ The spooled rows, to be scanned lazily (eg. by DuckDB). """
+        self._wait_for_file()
+        return ds.dataset(self.path, format="parquet")
+
+    def read(self, limit: Optional[int] = None) -> pa.Table:
+        if limit is not None and limit <= self.head.num_rows:
+            return self.head.slice(0, limit)
+        if limit is None:
+            return self.dataset().to_table()
+        return self.dataset().head(limit)
+
+    def status(self) -> str:
+        if not self.done.is_set():
+            return f"still loading, {self.rows_written} rows so far"
+        if self.error:
+            return f"loading failed after {self.rows_written} rows: {self.error}"
+        if self.truncated:
+            return f"truncated at {self.rows_written} rows by the result size limit"
+        return f"complete, {self.rows_written} rows"
+
+def _schema_for(table: pa.Table) -> pa.Schema:
+    # A column that is all nulls in the first batch gets its type from later batches,
+    # so write it as strings
+    return pa.schema([
+        field.with_type(pa.string()) if pa.types.is_null(field.type) else field
+        for field in table.schema
+    ])
+
+def _conform(table: pa.Table, schema: pa.Schema) -> pa.Table:
+    if table.schema.equals(schema):
+        return table
+    return table.select(schema.names).cast(schema)
+
+def _write(result: SpooledResult, batches: Iterator[pa.Table], budget: ResultBudget):
+    writer = None
+    try:
+        os.makedirs(os.path.dirname(result.path), exist_ok=True)
+        writer = pq.ParquetWriter(result.path, result.schema)
+        for batch in batches:
+            batch = _conform(batch, result.schema)
+            if not budget.take(batch.num_rows, batch.nbytes):
+                result.truncated = True
+                break
+            writer.write_table(batch)
+            result.rows_written += batch.num_rows
+    except Exception as e:
+        logger.error(f"Error spooling result to {result.path}: {e}")
+        result.error = str(e)
+    finally:
+        try:
+            if writer is not None:
+                writer.close()
+            # Lets the source release its cursor or connection
+            batches.close()
+        except Exception as e:
+            logger.error(f"Error closing spooled result {result.path}: {e}")
+            result.error = result.error or str(e)
+        finally:
+            result.done.set()
+
+def spool_batches(
+    batches: Iterator[pa.Table],
+    path: str,
+    budget: ResultBudget,
+    first: Optional[pa.Table] = None,
+) -> pa.Table|SpooledResult:
+    """ Reads the result from the 'batches' generator, which must yield at least one
+        (possibly empty) table, unless the caller already read the 'first' one. A result
+        with one batch is returned as a table. Otherwise this returns a SpooledResult as
+        soon as the second batch arrives, and writes all of the batches to 'path' from a
+        background thread. """
+    try:
+        if first is None:
+            first = next(batches)
+        # Skip empty batches, like the one after a result that filled its last batch
+        second = next(batches, None)
+        while second is not None and second.num_rows == 0:
+            second = next(batches, None)
+    except BaseException:
+        batches.close()
+        raise
+    if second is None:
+        return first
+
+    schema = _schema_for(first)
+    result = SpooledResult(path, _conform(first, schema))
+    remaining = itertools.chain([result.head, second], batches)
+    get_executor().submit(_write, result, _Closing(remaining, batches), budget)
+    return result
+
+class _Closing:
+    # An iterator over 'chained' whose close() closes the 'source' generator
+    def __init__(self, chained: Iterator, source: Iterator):
+        self.chained = chained
+        self.source = source
+
+    def __iter__(self):
+        return self.chained
+
+    def close(self):
+        self.source.close()
@@ -0,0 +1,45 @@
+import asyncio
+import random
+from typing import Awaitable, Callable, Optional, TypeVar
+
+import openai
+
+from supercog.shared.logging import logger
+
+# Retries for the requests we send to the OpenAI API in bulk, like column enrichment
+# and embedding batches.
+
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 30
+
+RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.APIConnectionError,
+    openai.APITimeoutError,
+    openai.InternalServerError,
+)
+
+T = TypeVar("T")
+
+async def with_retries(
+    request: Callable[[], Awaitable[T]],
+    semaphore: asyncio.Semaphore,
+    max_retries: int,
+    description: str = "Request",
+    on_retry: Optional[Callable[[], None]] = None,
+) -> T:
+    """ Calls 'request' while holding 'semaphore', retrying transient API errors with
+        jittered exponential backoff. We back off outside of the semaphore, so other
+        requests can proceed in the meantime. """
+    for attempt in range(max_retries + 1):
+        async with semaphore:
+            try:
+                return await request()
+            except RETRYABLE_ERRORS as e:
+                if attempt == max_retries:
+                    raise
+                if on_retry:
+                    on_retry()
+                delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt) * (0.5 + random.random())
+                logger.warn(f"{description} failed ({e}), retrying in {delay:.1f}s")
+        await asyncio.sleep(delay)
@@ -1,9 +1,9 @@
 from contextlib import contextmanager
 import re
-from typing import Optional, Any, Type
+from typing import Optional, Any, Type, AsyncIterator
 import traceback
 from collections import namedtuple
-from uuid import UUID
+from uuid import UUID, uuid4
 import os
 import mimetypes
 from collections import defaultdict
@@ -30,16 +30,19 @@ from supercog.shared.models import DocIndexReference
 
 from .db import session_context, Agent, Run, DocIndex
 from .jwt_auth import User as JWTUser
-from .filesystem import get_user_directory
+from .filesystem import get_user_directory, get_agent_root, AgentRoot
+from .upload_queue import upload_queue
+from .asset_store import asset_store
+from .duckdb_session import DuckdbSession
+from .result_spool import ResultBudget, SPOOL_DIR
 
 from supercog.shared.utils import (
     get_boto_client, 
-    upload_file_to_s3, 
     create_presigned_url,
-    upload_file_to_s3, 
 )
 
 from supercog.shared.services import config
+from supercog.shared.logging import logger
 
 ContextInit = namedtuple("ContextInit", [
     "tenant_id", 
@@ -126,35 +129,47 @@ class RunContext:
 
         return create_presigned_url(s3, bucket_name, object_name, expiration=(60*60*24))
     
-    def upload_user_file_to_s3(self, file_name, original_folder="", mime_type="", return_download_url=False) -> dict:
+    def _get_upload_target(self, file_name, original_folder="", mime_type="") -> tuple[str, str, str, str]:
+        # Returns the file path, bucket, object name and mime type to upload a user file
         bucket = config.get_global("S3_FILES_BUCKET_NAME")
         folder = f"{self.user_id}/{original_folder}"    
         if not folder.endswith("/"):
             folder = folder + "/"
         object_name = f"{self.tenant_id}/{folder}{file_name}"
 
-        file_path = os.path.join(original_folder, file_name)
+        file_path = self.resolve_file_path(os.path.join(original_folder, file_name))
 
         if not mime_type:
             mime_type, _ = mimetypes.guess_type(file_path)
             if not mime_type:
                 mime_type = "application/octet-stream"
+        return file_path, bucket, object_name, mime_type
 
+    def upload_user_file_to_s3(self, file_name, original_folder="", mime_type="", return_download_url=False) -> dict:
+        # This blocks, so async tools should use 'aupload_user_file_to_s3' instead
+        file_path, bucket, object_name, mime_type = self._get_upload_target(file_name, original_folder, mime_type)
         try:
-            with open(file_path, 'rb') as file_obj:
-                private_url = upload_file_to_s3(
-                    file_obj, 
-                    bucket, 
-                    object_name,
-                    mime_type,
-                )
-                if return_download_url:
-                    return self.get_file_url(file_name, original_folder)
-                else:
-                    return {"url": private_url}
-            
+            private_url, _ = upload_queue.upload_file(file_path, bucket, object_name, mime_type)
         except IOError as e:
             raise RuntimeError(f"Error opening file {file_path}: {e}")
+        except Exception as e:
+            raise RuntimeError(f"File upload to S3 failed: {e}")
+
+        if return_download_url:
+            return self.get_file_url(file_name, original_folder)
+        else:
+            return {"url": private_url}
+
+    async def aupload_user_file_to_s3(self, file_name, original_folder="", mime_type="", return_download_url=False) -> dict:
+        file_path, bucket, object_name, mime_type = self._get_upload_target(file_name, original_folder, mime_type)
+        private_url = await upload_queue.upload(file_path, bucket, object_name, mime_type)
+        if private_url is None:
+            raise RuntimeError(f"File upload to S3 failed: {file_path}")
+
+        if return_download_url:
+            return self.get_file_url(file_name, original_folder)
+        else:
+            return {"url": private_url}
 
     
     def set_extras(self, extras: dict) -> None:
@@ -180,10 +195,8 @@ class RunContext:
             content: Optional[bytes] = None,
             content_type: Optional[str] = None) -> AgentEvent:
         
-        cache_key = self.calculate_cache_key(asset_id)
-
         if content and content_type:
-            self.asset_contents[cache_key] = [content, content_type]
+            self.asset_contents[asset_id] = [content, content_type]
 
         self.asset_events.append(
             self.create_asset_event(asset_id, asset_type, asset_name)
@@ -194,19 +207,15 @@ class RunContext:
         while self.asset_events:
             agevent: AssetCreatedEvent = self.asset_events.pop(0)
             if agevent.asset_id in self.asset_contents:
-                content, content_type = self.asset_contents[agevent.asset_id]
-                cache_key = self.calculate_cache_key(agevent.asset_id)
-                # keeping assets for 24 hours, but we should probably store them in a persistent store
-                await pubsub.set(cache_key, content, ttl=60*60*24)
-                await pubsub.set(cache_key + "/content_type", content_type, ttl=60*60*24)
+                content, content_type = self.asset_contents.pop(agevent.asset_id)
+                # Assets are kept for ASSET_TTL (24 hours by default)
+                await asset_store.put(self.calculate_cache_key(agevent.asset_id), content, content_type)
             yield agevent
 
     @staticmethod
-    async def get_asset(tenant_id: str, user_id: str, asset_id: str) -> tuple[bytes, str]:
-        cache_key = f"{tenant_id}/{user_id}/{asset_id}"
-        content = await pubsub.get(cache_key)
-        content_type = await pubsub.get(cache_key + "/content_type")
-        return content, content_type
+    async def get_asset(tenant_id: str, user_id: str, asset_id: str) -> tuple[AsyncIterator[bytes]|None, str|None]:
+        # Returns an iterator over the content of the asset, and its content type
+        return await asset_store.get(f"{tenant_id}/{user_id}/{asset_id}")
 
     def create_asset_event(
             self, 
@@ -274,7 +283,7 @@ class RunContext:
         safe_agent_name = re.sub(r'[^\w\-_\. ]', '_', self.agent_name)
         agent_dir_name = f"{safe_agent_name}_{self.agent_id}"
         agent_dir = agent_dir_name
-        os.makedirs(agent_dir, exist_ok=True)
+        os.makedirs(self.resolve_file_path(agent_dir), exist_ok=True)
         return agent_dir
 
     def resolve_secrets(self, text: Any, require_value: bool=False) -> Any:
@@ -315,6 +324,71 @@ class RunContext:
     
     def _get_real_file_path(self, file_name: str) -> str:
         return os.path.join(get_user_directory(self.tenant_id, self.user_id), file_name)
+
+    # File access for tools. These work whether or not the agent filesystem is active
+    # in the current task, so prefer them to relying on the patched 'open'.
+    def _get_agent_root(self) -> AgentRoot:
+        if getattr(self, "_agent_root", None) is None:
+            self._agent_root = get_agent_root(self.tenant_id, self.user_id)
+        return self._agent_root
+
+    def get_user_directory(self) -> str:
+        return self._get_agent_root().user_dir
+
+    def resolve_file_path(self, file_name: str) -> str:
+        """ Returns the absolute path to a file in the agent's filesystem. Raises
+            PermissionError if the path is outside of the filesystem. """
+        return self._get_agent_root().resolve(file_name)
+
+    def open_file(self, file_name: str, mode: str = "r", **kwargs):
+        return open(self.resolve_file_path(file_name), mode, **kwargs)
+
+    def list_files(self, folder: str = "") -> list[str]:
+        return sorted(os.listdir(self.resolve_file_path(folder or ".")))
+
+    def get_duckdb_session(self) -> DuckdbSession:
+        # DuckDB connections for the tools, kept for the life of the run. See DuckdbSession.
+        if getattr(self, "_duckdb_session", None) is None:
+            self._duckdb_session = DuckdbSession(self.get_user_directory())
+        return self._duckdb_session
+
+    def close_duckdb_files(self):
+        # Called at the end of each turn
+        if getattr(self, "_duckdb_session", None) is not None:
+            self._duckdb_session.close_files()
+
+    def unregister_table(self, name: str):
+        if getattr(self, "_duckdb_session", None) is not None:
+            self._duckdb_session.unregister(name)
+
+    def get_result_budget(self) -> ResultBudget:
+        # The rows and bytes of query results that the run may spool to disk
+        if getattr(self, "_result_budget", None) is None:
+            self._result_budget = ResultBudget()
+        return self._result_budget
+
+    def get_spool_path(self, name: str) -> str:
+        """ Returns a new path for spooling a query result. The file is removed when the
+            run is closed. """
+        path = os.path.join(self.get_user_directory(), SPOOL_DIR, f"{name}_{uuid4().hex[:8]}.parquet")
+        if getattr(self, "_spool_paths", None) is None:
+            self._spool_paths = []
+        self._spool_paths.append(path)
+        return path
+
+    def close(self):
+        # Releases what we hold for the run. Called when the ChatEngine is evicted.
+        if getattr(self, "_duckdb_session", None) is not None:
+            self._duckdb_session.close()
+            self._duckdb_session = None
+        for path in getattr(self, "_spool_paths", None) or []:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                logger.error(f"Error removing spooled result {path}: {e}")
+        self._spool_paths = []
     
     def __getstate__(self) -> object:
         state = self.__dict__.copy()
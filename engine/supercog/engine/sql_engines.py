@@ -0,0 +1,87 @@
+import threading
+import time
+from typing import AsyncIterator, Optional
+
+from fastapi import FastAPI
+from fastapi_lifespan_manager import State
+from sqlalchemy import create_engine, make_url
+from sqlalchemy.engine import Engine
+
+from supercog.shared.logging import logger
+from supercog.shared.services import config
+
+from .db import lifespan_manager
+
+SQL_POOL_SIZE = int(config.get_option("SQL_POOL_SIZE", default=2))
+SQL_POOL_MAX_OVERFLOW = int(config.get_option("SQL_POOL_MAX_OVERFLOW", default=3))
+SQL_POOL_RECYCLE = int(config.get_option("SQL_POOL_RECYCLE", default=30*60))
+SQL_ENGINE_IDLE_TTL = int(config.get_option("SQL_ENGINE_IDLE_TTL", default=10*60))
+
+class SQLEngineCache:
+    # Tools that connect to user databases share one SQLAlchemy engine (and so one
+    # connection pool) per connection string and credential, instead of creating an
+    # engine for every query. Engines that haven't been used for 'idle_ttl' seconds
+    # are disposed, which closes their pooled connections.
+    def __init__(self, idle_ttl: int = SQL_ENGINE_IDLE_TTL):
+        self.idle_ttl = idle_ttl
+        self.engines: dict[tuple[str, str], Engine] = {}
+        self.last_used: dict[tuple[str, str], float] = {}
+        self.lock = threading.Lock()
+        self.created = 0
+
+    @staticmethod
+    def normalize(url: str) -> str:
+        return make_url(url).render_as_string(hide_password=False)
+
+    def _create_engine(self, url: str) -> Engine:
+        options = {"pool_pre_ping": True}
+        if make_url(url).get_backend_name() != "sqlite":
+            options |= {
+                "pool_size": SQL_POOL_SIZE,
+                "max_overflow": SQL_POOL_MAX_OVERFLOW,
+                "pool_recycle": SQL_POOL_RECYCLE,
+            }
+        self.created += 1
+        return create_engine(url, **options)
+
+    def get_engine(self, url: str, credential_id: Optional[str] = None) -> Engine:
+        key = (credential_id or "", self.normalize(url))
+        with self.lock:
+            engine = self.engines.get(key)
+            if engine is None:
+                engine = self.engines[key] = self._create_engine(key[1])
+            self.last_used[key] = time.monotonic()
+        self.dispose_idle()
+        return engine
+
+    def dispose_idle(self) -> int:
+        now = time.monotonic()
+        with self.lock:
+            idle = [key for key, used in self.last_used.items() if now - used > self.idle_ttl]
+            engines = [self.engines.pop(key) for key in idle]
+            for key in idle:
+                del self.last_used[key]
+        for engine in engines:
+            engine.dispose()
+        return len(engines)
+
+    def dispose_all(self):
+        with self.lock:
+            engines = list(self.engines.values())
+            self.engines.clear()
+            self.last_used.clear()
+        for engine in engines:
+            try:
+                engine.dispose()
+            except Exception as e:
+                logger.error(f"Error disposing SQL engine: {e}")
+
+    def stats(self) -> dict:
+        return {"engines": len(self.engines), "created": self.created}
+
+sql_engines = SQLEngineCache()
+
+@lifespan_manager.add
+async def lifespan(app: FastAPI) -> AsyncIterator[State]:
+    yield {"sql_engines": sql_engines}
+    sql_engines.dispose_all()
@@ -0,0 +1,88 @@
+import re
+from typing import Union
+
+import duckdb
+import pandas as pd
+import pyarrow as pa
+
+from .result_spool import SpooledResult
+
+# Tabular results are passed between tools as Arrow tables where we can. DuckDB reads
+# and produces Arrow without copying, and we only convert to pandas for the tools that
+# need a DataFrame, or for the rows that are actually shown. Large query results are
+# a SpooledResult, which reads its rows from disk once they have all arrived.
+
+Table = Union[pd.DataFrame, pa.Table, SpooledResult]
+
+def is_table(value) -> bool:
+    return isinstance(value, (pd.DataFrame, pa.Table, SpooledResult))
+
+def to_arrow(table: Table|duckdb.DuckDBPyRelation) -> pa.Table:
+    if isinstance(table, pa.Table):
+        return table
+    if isinstance(table, duckdb.DuckDBPyRelation):
+        return table.fetch_arrow_table()
+    if isinstance(table, SpooledResult):
+        return table.read()
+    return pa.Table.from_pandas(table, preserve_index=False)
+
+def duckdb_source(table: Table):
+    # What to register with DuckDB. A spooled result is scanned from its file.
+    if isinstance(table, SpooledResult):
+        return table.dataset()
+    return table
+
+def to_pandas(table: Table, limit: int|None = None) -> pd.DataFrame:
+    """ Returns the table (or its first 'limit' rows) as a DataFrame. """
+    if isinstance(table, pd.DataFrame):
+        return table if limit is None else table.head(limit)
+    if isinstance(table, SpooledResult):
+        return table.read(limit).to_pandas()
+    if limit is not None:
+        table = table.slice(0, limit)
+    return table.to_pandas()
+
+async def table_ready(table: Table) -> bool:
+    """ Waits, off the event loop, for a spooled result to finish. Returns False if it
+        is still loading. """
+    if isinstance(table, SpooledResult):
+        return await table.wait_ready_async()
+    return True
+
+def loading_status(table: SpooledResult, name: str) -> dict:
+    return {"status": "loading", "message": f"{name} is {table.status()}. Try again shortly."}
+
+def row_count(table: Table) -> int:
+    # For a spooled result, the rows written so far
+    return table.num_rows if isinstance(table, (pa.Table, SpooledResult)) else table.shape[0]
+
+def column_names(table: Table) -> list[str]:
+    return table.column_names if isinstance(table, (pa.Table, SpooledResult)) else table.columns.tolist()
+
+def rename_columns(table: Table, rename) -> Table:
+    """ Renames the columns by calling 'rename' on each name. DataFrames are renamed in
+        place. Spooled results keep the names they were written with. """
+    if isinstance(table, SpooledResult):
+        return table
+    if isinstance(table, pa.Table):
+        return table.rename_columns([rename(col) for col in table.column_names])
+    table.rename(columns={col: rename(col) for col in table.columns}, inplace=True)
+    return table
+
+def clean_column_name(name: str) -> str:
+    # Strip whitespace, lowercase, replace special characters, remove trailing underscore
+    return re.sub(r'_$', '', re.sub(r'\W+', '_', str(name).strip().lower()))
+
+def preview_rows(table: Table, max_rows: int) -> list[list[str]]:
+    # Only the preview rows are materialized
+    return to_pandas(table, limit=max_rows).astype(str).values.tolist()
+
+def records_to_arrow(rows: list, columns: list[str]) -> pa.Table:
+    df = pd.DataFrame.from_records(rows, columns=columns)
+    try:
+        return pa.Table.from_pandas(df, preserve_index=False)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        # Arrow can't store every object column (like mixed types), so those become strings
+        for column in df.select_dtypes(include="object").columns:
+            df[column] = df[column].astype(str)
+        return pa.Table.from_pandas(df, preserve_index=False)
@@ -6,8 +6,8 @@ from functools import wraps, partial
 from typing import Callable, Optional, final
 from pydantic import Field, computed_field
 import random
-import pickle
 
+import duckdb
 import pandas as pd
 import rollbar
 
@@ -22,6 +22,9 @@ from supercog.shared.services import config, get_public_service_host
 from supercog.shared.apubsub import RequestVarsEvent, ToolLogEvent, AssetTypeEnum
 
 from .run_context import RunContext, LangChainCallback
+from .asset_store import dataframe_to_parquet, PARQUET_CONTENT_TYPE
+from .result_spool import SpooledResult
+from .tables import Table, to_arrow, to_pandas, row_count, column_names, rename_columns, preview_rows
 
 # **The ToolFactory contract**
 #
@@ -45,6 +48,20 @@ class LLMFullResult(str):
 class ToolConfigError(RuntimeError):
     pass
 
+class ToolSpec:
+    """ The parts of a wrapped tool function which are the same for every instance of a 
+        ToolFactory class: the LangChain tool (with its pydantic args schema), the function
+        signature, and whether the function wants the LangChain 'callbacks' arg. """
+    def __init__(self, func: Callable, signature: inspect.Signature, accepts_callbacks: bool, template):
+        self.func = func
+        self.signature = signature
+        self.accepts_callbacks = accepts_callbacks
+        self.template = template
+
+# Keyed by (ToolFactory class, function name). Deriving the args schema in 'langchain.tool'
+# is slow, so we only do it the first time a tool function is wrapped.
+TOOL_SPECS: dict[tuple[type, str], ToolSpec] = {}
+
 class ToolCategory:
     CATEGORY_GENAI    = "GenAI"
     CATEGORY_BUILTINS = "System Tools"
@@ -72,6 +89,8 @@ class ToolFactory(BaseModel):
     help: str|None = None
     category: str|None = None
     credentials: dict = {}
+    # The id of the Credential that 'credentials' came from, if any
+    credential_id: str|None = None
     inmem_state: dict = {}
     run_context: RunContext = Field(exclude=True, default=None)
     tool_uses_env_vars: bool = False
@@ -129,11 +148,26 @@ class ToolFactory(BaseModel):
         if not tool_func.__doc__:
             print (f"Error: Tool function {tool_func.__name__} must have a docstring. Skipping.")
             return None
-        myfunc = partial(self.return_error_as_string(tool_func))
+
+        key = (type(self), tool_func.__name__)
+        spec = TOOL_SPECS.get(key)
+        if spec is not None and spec.func is getattr(tool_func, "__func__", None):
+            # Already built for this class, so just bind the wrapper to this instance
+            myfunc = partial(self.return_error_as_string(tool_func, spec.accepts_callbacks))
+            myfunc.__name__ = tool_func.__name__
+            myfunc.__doc__ = tool_func.__doc__
+            myfunc.__signature__ = spec.signature
+            if spec.template.coroutine is not None:
+                return spec.template.copy(update={"coroutine": myfunc})
+            else:
+                return spec.template.copy(update={"func": myfunc})
+
+        accepts_callbacks = 'callbacks' in inspect.signature(tool_func).parameters
+        myfunc = partial(self.return_error_as_string(tool_func, accepts_callbacks))
         myfunc.__name__ = tool_func.__name__
         myfunc.__doc__ = tool_func.__doc__
         # Keep the original arg list
-        myfunc.__annotations__ = tool_func.__annotations__
+        myfunc.__annotations__ = dict(tool_func.__annotations__)
         if 'callbacks' not in myfunc.__annotations__:
             # This is some foo to "jam" the callbacks param that Langchain expects so that we receive
             # it in our wrapper function and can set it as `lc_run_id` when the function is called.
@@ -146,6 +180,12 @@ class ToolFactory(BaseModel):
 
         t = tool(myfunc)
         t.handle_validation_error = True
+
+        # Only methods defined on the class are the same for every instance. Dynamic tools
+        # generate their functions per instance, so we can't cache those.
+        if inspect.ismethod(tool_func) and tool_func.__self__ is self and \
+            getattr(type(self), tool_func.__name__, None) is tool_func.__func__:
+            TOOL_SPECS[key] = ToolSpec(tool_func.__func__, inspect.signature(myfunc), accepts_callbacks, t)
         return t
 
 
@@ -153,7 +193,7 @@ class ToolFactory(BaseModel):
     # them as strings to the LLM. It also shrinks results if they are too big.
     # Finally, it attempts to always accept the "callbacks" parameter from LangChain
     # and to setup the lc_run_id attribute so that we can link tool events to their tool call parent.
-    def return_error_as_string(self, tool_func):
+    def return_error_as_string(self, tool_func, accepts_callbacks: bool|None=None):
 
         def format_exc(e):
             if isinstance(e, ToolConfigError):
@@ -164,6 +204,10 @@ class ToolFactory(BaseModel):
             # Join the formatted traceback frames into a single string
             formatted_tb_str = ''.join(formatted_tb)
             return f"Error: {e}\n" + formatted_tb_str
+
+        # Check the signature once here rather than on every call
+        if accepts_callbacks is None:
+            accepts_callbacks = 'callbacks' in inspect.signature(tool_func).parameters
         
         if inspect.iscoroutinefunction(tool_func):
             async def wrapped_async_func(*args, callbacks: LangChainCallback|None=None, **kwargs):
@@ -175,7 +219,7 @@ class ToolFactory(BaseModel):
                     rollbar.report_message("LC run Id is blank", extra_data={"func":str(tool_func)})
 
                 try:
-                    if 'callbacks' in inspect.signature(tool_func).parameters:
+                    if accepts_callbacks:
                         kwargs['callbacks'] = callbacks
                     return self.shrink_tool_result(await tool_func(*args, **kwargs))
                 except Exception as e:
@@ -190,7 +234,7 @@ class ToolFactory(BaseModel):
                 elif self.lc_run_id is None:
                     rollbar.report_message("LC run Id is blank", extra_data={"func":str(tool_func)})
                 try:
-                    if 'callbacks' in inspect.signature(tool_func).parameters:
+                    if accepts_callbacks:
                         kwargs['callbacks'] = callbacks
                     return self.shrink_tool_result(tool_func(*args, **kwargs))
                 except Exception as e:
@@ -254,23 +298,25 @@ class ToolFactory(BaseModel):
         else:
             return name_hint
     
-    def get_dataframe_preview(self, df: pd.DataFrame, max_rows=5, name_hint:str|None=None,
+    def get_dataframe_preview(self, df: Table|duckdb.DuckDBPyRelation, max_rows=5, name_hint:str|None=None,
                               sanitize_column_names=True) -> dict:
+        # Accepts a DataFrame, an Arrow table or a DuckDB relation. Tables are kept in
+        # Arrow form, and only the preview rows are converted to pandas.
+        if isinstance(df, duckdb.DuckDBPyRelation):
+            df = to_arrow(df)
+        # A spooled result is previewed from its first batch while the rest is written
+        spooled = isinstance(df, SpooledResult)
         row_label = "all_rows"
         includes_all = True
-        if df.shape[0] > max_rows:
+        if spooled or row_count(df) > max_rows:
             row_label = "preview"
             includes_all = False
 
-        preview_rows = df.head(max_rows).astype(str).values.tolist()
+        rows = preview_rows(df, max_rows)
         name = self.make_dataframe_name(name_hint)
 
         if sanitize_column_names:
-            newnames = {}
-            for col in df.columns.tolist():
-                newname = col.lower().replace(r"\s+", "_")
-                newnames[col] = newname
-            df.rename(columns=newnames, inplace=True)
+            df = rename_columns(df, lambda col: col.lower().replace(r"\s+", "_"))
         
         if not name_hint:
             name_hint = ""
@@ -280,25 +326,30 @@ class ToolFactory(BaseModel):
             "dataframe:" + name,
             AssetTypeEnum.TABLE,
             name,
-            pickle.dumps(df),
-            content_type="application/pickle",
+            dataframe_to_parquet(df.head if spooled else df),
+            content_type=PARQUET_CONTENT_TYPE,
         )
         if includes_all:
             hint = {}
         else:
             hint = {"hint": "On request, use load_full_preview_content to get all rows"}
 
+        if spooled:
+            hint["status"] = "More rows are loading in the background. " + \
+                "Use load_full_preview_content or query the dataframe to read them."
+
         return {
             "type":"dataframe",
             "name": name,
             "source_file": name_hint,
-            "columns": df.columns.tolist(),
-            "row_count": df.shape[0],
-            row_label: preview_rows,
+            "columns": column_names(df),
+            "row_count": f"{df.head.num_rows}+" if spooled else row_count(df),
+            row_label: rows,
             
         } | hint
 
-    def get_dataframe_from_handle(self, handle: any) -> tuple[pd.DataFrame, str]:
+    def get_table_from_handle(self, handle: any) -> tuple[Table, str]:
+        # Returns the table as it is stored, which may be an Arrow table or a DataFrame
         if isinstance(handle, str) and handle in self.inmem_state:
             return self.inmem_state[handle], handle
         elif isinstance(handle, dict) and 'name' in handle:
@@ -307,6 +358,14 @@ class ToolFactory(BaseModel):
         else:
             raise RuntimeError(f"Could not find dataframe '{handle}'")
 
+    def get_dataframe_from_handle(self, handle: any) -> tuple[pd.DataFrame, str]:
+        table, name = self.get_table_from_handle(handle)
+        if not isinstance(table, pd.DataFrame):
+            # Keep the DataFrame so that changes made by the caller are seen by later tools
+            table = to_pandas(table)
+            self.inmem_state[name] = table
+        return table, name
+
     def get_data_from_handle(self, handle: any) -> any:
         if isinstance(handle, str) and handle in self.inmem_state:
             return self.inmem_state[handle]
@@ -332,6 +391,10 @@ class ToolFactory(BaseModel):
         """
         return secrets
 
+    def factory_class(self) -> type["ToolFactory"]:
+        """ The class of this factory, for creating a fresh instance of it. """
+        return type(self)
+
     def test_credential(self, cred, secrets: dict) -> str:
         """ Test that the given credential secrets are valid. Return None if OK, otherwise
             return an error message.
@@ -1,8 +1,10 @@
+import asyncio
 from typing import List, Callable
 import pandas as pd
-import duckdb
 
 from supercog.engine.tool_factory import ToolFactory, ToolCategory, LLMFullResult, LangChainCallback
+from supercog.engine.tables import is_table, to_pandas, table_ready, loading_status
+from supercog.engine.result_spool import SpooledResult
 
 
 class BasicDataTool(ToolFactory):
@@ -28,8 +30,10 @@ class BasicDataTool(ToolFactory):
         except:
             return f"No data found with name {var_name}."
 
-        if isinstance(data, pd.DataFrame):
-            return LLMFullResult(str(data[0:1000].to_csv(index=False)))
+        if isinstance(data, SpooledResult) and not data.wait_ready():
+            return loading_status(data, var_name)["message"]
+        if is_table(data):
+            return LLMFullResult(str(to_pandas(data, limit=1000).to_csv(index=False)))
         elif data is not None:
             if isinstance(data, str):
                 return LLMFullResult(data)
@@ -48,10 +52,15 @@ class BasicDataTool(ToolFactory):
             from the query result. Use this function to rename columns, or add or
             drop columns from a dataframe.
         """
-        df, df_name = self.get_dataframe_from_handle(dataframe_var)
-        globals()[df_name] = df
+        df, df_name = self.get_table_from_handle(dataframe_var)
+        if not await table_ready(df):
+            return loading_status(df, df_name)
         await self.log(f"Querying DataFrame {df_name} with query: '{sql_query}'")
-        result = duckdb.sql(sql_query)
-        df = result.df()
+
+        def run_query():
+            with self.run_context.get_duckdb_session().connection(tables={df_name: df}) as con:
+                return con.sql(sql_query).fetch_arrow_table()
+
+        df = await asyncio.to_thread(run_query)
         return self.get_dataframe_preview(df, name_hint=result_name or df_name, sanitize_column_names=False)
     
@@ -1,21 +1,27 @@
 import asyncio
 import io
-from typing import Any, Callable
+from typing import Any, Callable, Iterator
 import re
 
 import pandas as pd
-import psycopg2
-from psycopg2.extras import DictCursor
-import psycopg2.extras
+import pyarrow as pa
 
 from urllib.parse import urlparse, urlunparse, parse_qs, urlencode
-from sqlalchemy import create_engine, text
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
 from sqlalchemy.exc import SQLAlchemyError
 
 from supercog.engine.tool_factory import ToolFactory, ToolCategory
 from supercog.engine.triggerable import Triggerable
+from supercog.engine.db_changes import TableWatcher
+from supercog.engine.sql_engines import sql_engines
+from supercog.engine.result_spool import spool_batches
+from supercog.engine.tables import records_to_arrow
 from supercog.shared.logging import logger
 
+# Query results are read in batches of FETCH_SIZE rows
+FETCH_SIZE = 5000
+
 
 class DatabaseConnectionError(Exception):
     pass
@@ -94,7 +100,8 @@ General access to most types of databases.
                 # Reconstruct the connection string
                 return urlunparse((new_scheme, f"{user}:{password}@{host}", '', '', new_query, ''))
             else:
-                new_scheme = scheme  # Keep the original scheme for other databases
+                # Keep other URLs as they are (urlunparse would mangle sqlite:////absolute/path)
+                return connection_string
             # Reconstruct the connection string with the new scheme
             return urlunparse((new_scheme, parsed.netloc, parsed.path, parsed.params, parsed.query, parsed.fragment))
         else:  # CLI command
@@ -189,10 +196,10 @@ General access to most types of databases.
         raise ValueError("Unable to parse connection string")
 
     def create_engine(self, connection_string: str):
-        """Create a SQLAlchemy engine from the connection string or CLI command."""
+        """Returns the pooled SQLAlchemy engine for the connection string or CLI command."""
         try:
             parsed_connection_string = self.parse_connection_string(connection_string)
-            return create_engine(parsed_connection_string)
+            return sql_engines.get_engine(parsed_connection_string, credential_id=self.credential_id)
         except LocalhostConnectionError as e:
             raise e
         except Exception as e:
@@ -205,25 +212,19 @@ General access to most types of databases.
             return {"status": "Connection string is missing"}
         try:
             engine = self.create_engine(connection_string)
-            with engine.begin() as connection:
-                # Execute the query
-                result = connection.execute(text(sql_query))
-                
-                # Check if the query returns rows
-                if result.returns_rows:
-                    # Try to read it into a DataFrame
-                    try:
-                        df = pd.read_sql(sql_query, connection)
-                        return self.get_dataframe_preview(df)
-                    except:
-                        # If it can't be read into a DataFrame, return as list of dicts
-                        return {"result": [dict(row) for row in result.mappings()]}
-                else:
-                    # Query didn't return any rows
-                    if result.rowcount is not None and result.rowcount >= 0:
-                        return {"status": f"Query executed successfully. Rows affected: {result.rowcount}"}
-                    else:
-                        return {"status": "Query executed successfully"}
+            batches = self.stream_query(engine, sql_query)
+            first = next(batches)
+            if isinstance(first, str):
+                # Query didn't return any rows
+                return {"status": first}
+            # Results larger than one batch are spooled to a file while we return the preview
+            df = spool_batches(
+                batches,
+                self.run_context.get_spool_path("query"),
+                self.run_context.get_result_budget(),
+                first=first,
+            )
+            return self.get_dataframe_preview(df)
         except LocalhostConnectionError as e:
             return {"status": f"Error: {str(e)}"}
         except DatabaseConnectionError as e:
@@ -235,6 +236,37 @@ General access to most types of databases.
         except Exception as e:
             return {"status": f"Unexpected error: {str(e)}"}
 
+    @staticmethod
+    def stream_query(engine: Engine, sql_query: str) -> Iterator[pa.Table|str]:
+        """ Executes the query once, with a server-side cursor where the driver supports it.
+            Yields the rows as Arrow tables of up to FETCH_SIZE rows (at least one, which
+            may be empty), or a status message for statements that don't return rows. The
+            connection is held until the generator is exhausted or closed. """
+        with engine.begin() as connection:
+            result = connection.execution_options(
+                stream_results=True, max_row_buffer=FETCH_SIZE
+            ).execute(text(sql_query))
+            if result.returns_rows:
+                # Lowercase names, as get_dataframe_preview does, since spooled results keep theirs
+                columns = [str(col).lower() for col in result.keys()]
+                try:
+                    while True:
+                        rows = result.fetchmany(FETCH_SIZE)
+                        yield records_to_arrow(rows, columns)
+                        if len(rows) < FETCH_SIZE:
+                            break
+                except GeneratorExit:
+                    # The reader stopped early, which still commits the transaction
+                    pass
+                result.close()
+                return
+            if result.rowcount is not None and result.rowcount >= 0:
+                status = f"Query executed successfully. Rows affected: {result.rowcount}"
+            else:
+                status = "Query executed successfully"
+        # Only report success once the transaction has committed
+        yield status
+
     def get_database_type(self) -> str:
         """ Returns the type and SQL dialect of the connected database """
         connection_string = self.credentials.get("database_url")
@@ -358,44 +390,23 @@ class DatabaseTriggerable(Triggerable):
         try: 
             await self.__run()
         except Exception as e:
-            logger.error("Error running database poller: ", e)
+            logger.error("Error running database watcher: ", e)
 
     async def __run(self):
-        # Polls for the new records in the indicated table. The table should have some sorting
-        # key that allows us to detect "new" records. For now we use the implicit 'ctid'
-        # column as a hack (since those values can change if the table is modified).
-        print("running database trigger on ", self.db_url)
-        #conn = psycopg2.connect(self.db_url)
-        conn = psycopg2.extras.DictConnection(self.db_url)
-        curs = conn.cursor(cursor_factory=DictCursor)
-
-        def get_last_xmin():
-            curs.execute(f"SELECT max(xmin::text::bigint) FROM {self.table_name}")
-            row = curs.fetchone()
-            if row:
-                if isinstance(row[0], dict):
-                    return row.values()[0]
-                else:
-                    return row[0]
-            return '(0,0)' # assuming this will work for an empty table - we should test it
-
-        last_xmin = get_last_xmin()
-        print("last xmin is: ", last_xmin)
-        while await self.run_state.is_running():
-            query = f""" 
-    SELECT *, xmin::text::bigint as xmin FROM {self.table_name} WHERE xmin::text::bigint > %s ORDER BY ctid
-            """
-            #print(query, (last_xmin,))
-            curs.execute(query, (last_xmin,))
-            rows = curs.fetchall()
-            for row in rows:
-                print("New record: ", row)
-                last_xmin = int(row['xmin'])
-                try:
-                    run = self.create_run(dict(row))
-                    print("Ran agent: ", run)
-                except Exception as e:
-                    logger.error("Error running agent: ", e)
-            await asyncio.sleep(3) # poll db every 3 seconds. This should be configurable
-        logger.info("Quitting db poller thread by flag")            
+        # Watches the indicated table for new rows and runs the agent on each batch of them.
+        # See TableWatcher for how new rows are found.
+        print("running database trigger on ", self.table_name)
+        watcher = TableWatcher(
+            self.db_url,
+            self.table_name,
+            cursor_key=f"{self.agent_id}:{self.table_name}",
+            on_rows=self.dispatch_rows,
+            is_running=self.run_state.is_running,
+        )
+        await watcher.run()
+        logger.info("Quitting db watcher by flag")
 
+    async def dispatch_rows(self, rows: list[dict]):
+        # One run per batch. A single row is sent as before, as one record.
+        run = await asyncio.to_thread(self.create_run, rows[0] if len(rows) == 1 else rows)
+        print(f"Ran agent on {len(rows)} new records: ", run)
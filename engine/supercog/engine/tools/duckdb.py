@@ -1,12 +1,16 @@
+import asyncio
 import os
 import re
 from typing import Any, Callable
 from io import StringIO
 from contextlib import contextmanager
 
-from openai import OpenAI
+from openai import AsyncOpenAI
 
 from supercog.engine.tool_factory import ToolFactory, ToolCategory, LangChainCallback
+from supercog.engine.filesystem import resolve_agent_path, record_file_write
+from supercog.engine.tables import to_arrow, rename_columns, clean_column_name, table_ready, loading_status
+from supercog.engine.llm_enrichment import ColumnEnricher
 from supercog.shared.utils import sanitize_string
 from supercog.shared.services import config
 
@@ -51,7 +55,7 @@ Use DuckDB to load and store tabular data, and manipulate it with SQL.
         """Tests the provided credentials by attempting to connect to the database."""
         if 'database_file' in secrets:
             try:
-                con = duckdb.connect(secrets["database_file"])
+                con = duckdb.connect(resolve_agent_path(secrets["database_file"]))
                 con.execute("SELECT 1")
                 con.close()
             except Exception as e:
@@ -73,18 +77,27 @@ Use DuckDB to load and store tabular data, and manipulate it with SQL.
     def _get_db_file(self):
         """Returns the database file path from credentials or a default value."""
         if 'database_file' in self.credentials:
-            return self.credentials['database_file']
+            return resolve_agent_path(self.credentials['database_file'])
         else:
-            return "duckdb.db"
+            return resolve_agent_path("duckdb.db")
 
     @contextmanager
     def duckdb_connection(self):
-        """Context manager for handling DuckDB connections."""
-        con = duckdb.connect(self._get_db_file())
-        try:
-            yield con
-        finally:
-            con.close()
+        """ Returns the run's connection to the database file. """
+        db_file = self._get_db_file()
+        mtime = os.path.getmtime(db_file) if os.path.exists(db_file) else None
+        with self.run_context.get_duckdb_session().connection(db_file) as con:
+            try:
+                yield con
+                # The connection stays open, so write any changes through to the file
+                con.execute("CHECKPOINT")
+            finally:
+                if os.path.exists(db_file) and os.path.getmtime(db_file) != mtime:
+                    record_file_write(db_file)
+
+    def dataframe_connection(self, **tables):
+        """ Returns the run's in-memory connection with 'tables' registered as views. """
+        return self.run_context.get_duckdb_session().connection(tables=tables)
 
     def read_file_as_dataframe(
         self,
@@ -103,27 +116,26 @@ Use DuckDB to load and store tabular data, and manipulate it with SQL.
         
         if file_format == "infer":
             file_format = self._infer_format_from_name(file_uri)
+        file_path = file_uri if file_uri.startswith("http") else resolve_agent_path(file_uri)
 
         with self.duckdb_connection() as con:
             if file_format == "csv":
-                sql = f"SELECT * FROM read_csv('{file_uri}');"
+                sql = f"SELECT * FROM read_csv('{file_path}');"
                 print("SQL: ", sql)
-                df = con.execute(sql).df()
+                df = con.execute(sql).fetch_arrow_table()
             elif file_format == "parquet":
-                sql = f"SELECT * FROM read_parquet('{file_uri}');"
+                sql = f"SELECT * FROM read_parquet('{file_path}');"
                 print("SQL: ", sql)
-                df = con.execute(sql).df()
+                df = con.execute(sql).fetch_arrow_table()
             elif file_format == "json":
-                df = con.execute(f"SELECT * FROM read_json('{file_uri}');").df()
+                df = con.execute(f"SELECT * FROM read_json('{file_path}');").fetch_arrow_table()
             elif file_format == "excel":
                 df = pd.read_excel(file_uri, skiprows=skip_rows)
             else:
                 return {"status": "error", "message": "File format not recognized"}
 
         if cleanup_col_names:
-            df.columns = (
-                df.columns.str.strip().str.lower().str.replace(r'\W+', '_', regex=True).str.replace(r'_$', '', regex=True)
-            )
+            df = rename_columns(df, clean_column_name)
         
         return self.get_dataframe_preview(df, name_hint=file_uri)
 
@@ -164,7 +176,26 @@ Use DuckDB to load and store tabular data, and manipulate it with SQL.
             df[column_name] = column_data[:len(df)]
             return {"status": "success", "dataframe":df_name}
 
-    def write_dataframe_to_file(
+    def _write_dataframe(self, dataframe_var: str, file_name: str, file_format: str) -> str:
+        # Writes the file and returns its mime type
+        supercog_df, df_name = self.get_table_from_handle(dataframe_var)
+
+        if file_format == "csv":
+            with self.dataframe_connection(**{df_name: supercog_df}) as con:
+                con.sql(f"SELECT * from {df_name}").write_csv(resolve_agent_path(file_name))
+            mime_type = "text/csv"
+        elif file_format == "parquet":
+            with self.dataframe_connection(**{df_name: supercog_df}) as con:
+                con.sql(f"SELECT * from {df_name}").write_parquet(resolve_agent_path(file_name))
+            mime_type = "application/parquet"
+        else:
+            supercog_df, _ = self.get_dataframe_from_handle(dataframe_var)
+            supercog_df.to_excel(file_name, index=False)
+            mime_type = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+        record_file_write(file_name)
+        return mime_type
+
+    async def write_dataframe_to_file(
         self,
         dataframe_var: str,
         file_name,
@@ -173,25 +204,13 @@ Use DuckDB to load and store tabular data, and manipulate it with SQL.
         """ Writes the indicated DataFrame to the indicated file. File_format
             can be one of: "infer", "csv", "parquet", or "excel".
         """
-        supercog_df, df_name = self.get_dataframe_from_handle(dataframe_var)
-        duckdb.register('supercog_df', supercog_df)
-
         if file_format == "infer":
             file_format = self._infer_format_from_name(file_name)
-
-        if file_format == "csv":
-            duckdb.sql("SELECT * from supercog_df").write_csv(file_name)
-            mime_type = "text/csv"
-        elif file_format == "parquet":
-            duckdb.sql("SELECT * from supercog_df").write_parquet(file_name)
-            mime_type = "application/parquet"
-        elif file_format == "excel":
-            supercog_df.to_excel(file_name, index=False)
-            mime_type = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-        else:
+        if file_format not in ("csv", "parquet", "excel"):
             return {"status": "error", "message": f"File format '{file_format}' not recognized"}
 
-        download_url = self.run_context.upload_user_file_to_s3(
+        mime_type = await asyncio.to_thread(self._write_dataframe, dataframe_var, file_name, file_format)
+        download_url = await self.run_context.aupload_user_file_to_s3(
             file_name=file_name,
             mime_type=mime_type,
             return_download_url=True,
@@ -207,12 +226,14 @@ Use DuckDB to load and store tabular data, and manipulate it with SQL.
         """ Stores the data from the indicated dataframe to a duckdb table with the given name. 
             Will replace any existing table if 'force_overwrite' is True.
         """
-        df, df_name = self.get_dataframe_from_handle(dataframe_var)
+        df, df_name = self.get_table_from_handle(dataframe_var)
         with self.duckdb_connection() as con:
             name = sanitize_string(table_name)
             if force_overwrite:
                 con.execute(f"DROP TABLE IF EXISTS {name}")
-            con.execute(f"CREATE TABLE {name} AS SELECT * FROM df")
+            con.register("supercog_df", df)
+            con.execute(f"CREATE TABLE {name} AS SELECT * FROM supercog_df")
+            con.unregister("supercog_df")
 
         return f"Saved table: '{name}'"
 
@@ -234,7 +255,7 @@ Use DuckDB to load and store tabular data, and manipulate it with SQL.
                     limit = f" LIMIT {max_rows}"
                 else:
                     limit = ""
-                df = con.execute(f"SELECT * FROM {table_name}{limit}").df()
+                df = con.execute(f"SELECT * FROM {table_name}{limit}").fetch_arrow_table()
                 return self.get_dataframe_preview(
                     df, 
                     name_hint=table_name, 
@@ -253,7 +274,7 @@ Use DuckDB to load and store tabular data, and manipulate it with SQL.
         """ Executes the given SQL "alter table" statement to modify a Duckdb table.
         """
         with self.duckdb_connection() as con:
-            df = con.execute(sql_statement).df()
+            df = con.execute(sql_statement).fetch_arrow_table()
             return self.get_dataframe_preview(df)
 
     def query_duckdb_tables(
@@ -269,7 +290,7 @@ Use DuckDB to load and store tabular data, and manipulate it with SQL.
                 view_name = m.group(1)
                 con.execute(f"DROP VIEW IF EXISTS {view_name};")
 
-            df = con.execute(sql_query).df()
+            df = con.execute(sql_query).fetch_arrow_table()
             return self.get_dataframe_preview(df, name_hint=name_hint)
 
     def list_duckdb_tables(self) -> str:
@@ -308,14 +329,20 @@ Use DuckDB to load and store tabular data, and manipulate it with SQL.
             Remember to use single quotes to quote column names.
             Returns a new dataframe, and uses 'result_name' as the variable name if provided.
         """
-        df, df_name = self.get_dataframe_from_handle(dataframe_var)
-        globals()[df_name] = df
+        df, df_name = self.get_table_from_handle(dataframe_var)
+        if not await table_ready(df):
+            return loading_status(df, df_name)
         await self.log(f"Querying DataFrame {df_name} with query: '{query}'", callbacks=callbacks)
-        result = duckdb.sql(query)
-        df = result.df()
+
+        def run_query():
+            with self.dataframe_connection(**{df_name: df}) as con:
+                return con.sql(query).fetch_arrow_table()
+
+        # The session lock may be held by a tool running in another thread
+        df = await asyncio.to_thread(run_query)
         return self.get_dataframe_preview(df, name_hint=result_name or df_name, sanitize_column_names=False)
     
-    def llm_enrich_column(
+    async def llm_enrich_column(
             self, 
             dataframe_var: str, 
             source_column: str, 
@@ -327,36 +354,29 @@ Use DuckDB to load and store tabular data, and manipulate it with SQL.
             prompt and the source_column value for each row. Returns a new dataframe with the
             additional column added. 
         """
-        client = OpenAI(api_key=config.get_global("OPENAI_API_KEY"))
-
-        with self.duckdb_connection() as con:
-            df, df_name = self.get_dataframe_from_handle(dataframe_var)
-
-            def llm_enricher(target_val: str) -> str:
-                messages = [
-                    {"role": "system", "content": "You are a helpful assistant."},
-                    {"role": "user", "content": f"{prompt}: {target_val}"}
-                ]
-                print("Running LLM enricher with messages: ", messages)
-                response = client.chat.completions.create(
-                    model=llm_model,
-                    messages=messages,
-                )
-                if hasattr(response, 'choices') and len(response.choices) > 0:
-                    result = response.choices[0].message.content or ""
-                    print(f"Result: {result}", callbacks)
-                else:
-                    result = "LLM result missing"
-                return result
-            
-            con.create_function("llm_enricher", llm_enricher)
-            
-            globals()[df_name] = df
-            result = con.execute(f"SELECT *, llm_enricher({source_column}) AS {result_column} FROM {df_name}")
-            df = result.df()
-
-        return self.get_dataframe_preview(df, name_hint=dataframe_var)
+        df, df_name = self.get_table_from_handle(dataframe_var)
+        if not await table_ready(df):
+            return loading_status(df, df_name)
+        table = await asyncio.to_thread(to_arrow, df)
+        if source_column not in table.column_names:
+            return {"status": "error", "message": f"Column '{source_column}' not found in {df_name}"}
+
+        async def progress(message: str):
+            await self.log(message, callbacks=callbacks)
+
+        enricher = ColumnEnricher(
+            # The enricher does its own retries
+            AsyncOpenAI(api_key=config.get_global("OPENAI_API_KEY"), max_retries=0),
+            prompt,
+            llm_model,
+            progress=progress,
+        )
+        results = await enricher.enrich_column(table.column(source_column))
+        if result_column in table.column_names:
+            table = table.drop([result_column])
+        table = table.append_column(result_column, results)
 
+        return self.get_dataframe_preview(table, name_hint=dataframe_var)
 
 
 ###### ASYNCIO VERSION
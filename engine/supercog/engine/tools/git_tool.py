@@ -15,6 +15,8 @@ from datetime import datetime
 from git import Repo, GitCommandError
 import os
 
+from supercog.engine.filesystem import record_external_writes
+
 
 class GitTool(ToolFactory):
     repo_dir: str = "~/source"  # Local path to store the git repos
@@ -75,6 +77,7 @@ Use this tool to manipulate git repositories
         """
         try:
             Repo.clone_from(repo_url, os.path.join(self.repo_dir, self.run_context.tenant_id))
+            record_external_writes()
             return "Repository cloned successfully."
         except GitCommandError as e:
             return f"Error cloning repository: {str(e)}"
@@ -149,6 +152,7 @@ Use this tool to manipulate git repositories
             repo = Repo(os.path.join(self.repo_dir, repo_path))
             origin = repo.remote(name='origin')
             origin.pull(branch)
+            record_external_writes()
             return "Changes pulled successfully."
         except GitCommandError as e:
             return f"Error pulling changes: {str(e)}"
@@ -181,6 +185,7 @@ Use this tool to manipulate git repositories
         try:
             repo = Repo(os.path.join(self.repo_dir, repo_path))
             repo.git.checkout(branch_name)
+            record_external_writes()
             return f"Checked out branch {branch_name} successfully."
         except GitCommandError as e:
             return f"Error checking out branch {branch_name}: {str(e)}"
@@ -9,6 +9,7 @@ from contextlib import asynccontextmanager
 
 from supercog.engine.tool_factory import ToolFactory, ToolCategory, LangChainCallback
 from supercog.engine.run_context import RunContext
+from supercog.engine.filesystem import record_external_writes
 
 import code
 import textwrap
@@ -86,11 +87,14 @@ Use this tool to allow the agent to execute sandboxed code
         :return: str
             The resulting stdout of the code execution
         """
+        # Arbitrary code can write files any way it likes
+        record_external_writes()
         async with self.get_interp() as interp:
             try:
                 code_to_run = textwrap.dedent(code)
                 await self.log(code_to_run, callbacks)
                 result = self.catch_code(code_to_run)
+                record_external_writes()
                 print("-----------------")
                 print(result)
                 return result
@@ -99,14 +103,18 @@ Use this tool to allow the agent to execute sandboxed code
 
     async def execute_system_commands(self, commands: str, callbacks: LangChainCallback=None) -> str:
         """Executes commands on the underlying linux system inside the container."""
+        record_external_writes()
         result = ""
         for cmd in commands.split("\n"):
             if cmd.strip():  # Ensure we don't process empty lines
                 try:
                     await self.log(cmd + "\n", callbacks)
 
-                    process = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+                    process = subprocess.Popen(
+                        cmd, shell=True, cwd=os.getcwd(), stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True
+                    )
                     stdout, stderr = process.communicate()
+                    record_external_writes()
 
                     # Log and accumulate stdout
                     if stdout:
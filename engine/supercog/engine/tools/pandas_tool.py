@@ -1,6 +1,8 @@
 from supercog.engine.tool_factory import ToolFactory, ToolCategory
+from supercog.engine.filesystem import resolve_agent_path, record_file_write
 import pandas as pd
 import numpy as np
+import pyarrow.parquet as pq
 
 from typing   import Any, Callable
 
@@ -49,7 +51,7 @@ Manipulate dataframes, and convert file formats into dataframes.
         if file_format == "csv":
             df = pd.read_csv(file_name)
         elif file_format == "parquet":
-            df = pd.read_parquet(file_name)
+            df = pq.read_table(resolve_agent_path(file_name))
         elif file_format == "excel":
             df = pd.read_excel(file_name, engine='openpyxl')
         else:
@@ -112,15 +114,21 @@ Manipulate dataframes, and convert file formats into dataframes.
         """ Writes the indicated DataFrame to the indicated file. File_format
             can be one of: "infer", "csv", "parquet", or "excel".
         """
-        df, df_name = self.get_dataframe_from_handle(dataframe_var)
-
         if file_format == "infer":
             file_format = self._infer_format_from_name(file_name)
 
+        if file_format == "parquet":
+            table, _ = self.get_table_from_handle(dataframe_var)
+            if isinstance(table, pd.DataFrame):
+                table.to_parquet(resolve_agent_path(file_name))
+            else:
+                pq.write_table(table, resolve_agent_path(file_name))
+            record_file_write(file_name)
+            return {"status":"success"}
+
+        df, df_name = self.get_dataframe_from_handle(dataframe_var)
         if file_format == "csv":
             df.to_csv(file_name, index=False)
-        elif file_format == "parquet":
-            df.to_parquet(file_name)
         elif file_format == "excel":
             df.to_excel(file_name, index=False)
         else:
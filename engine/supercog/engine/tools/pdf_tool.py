@@ -1,3 +1,4 @@
+import asyncio
 import io
 import tempfile
 import os
@@ -154,7 +155,7 @@ Interact with PDF files: read, write content, index PDFs, and perform hybrid sea
     #             self.conn.rollback()
     #         return f"Error indexing PDF content: {str(e)}"
 
-    def save_pdf_file(self, content: str, filename: str = None, source_format: str="markdown"):
+    async def save_pdf_file(self, content: str, filename: str = None, source_format: str="markdown"):
         """ 
         Saves the given text as a PDF file, uploads it to S3, and indexes the content.
 
@@ -176,30 +177,27 @@ Interact with PDF files: read, write content, index PDFs, and perform hybrid sea
             elif not filename.lower().endswith('.pdf'):
                 filename += '.pdf'
 
-            pdf = FPDF()
-            pdf.add_page()
-            pdf.set_font("Arial", size=12)
-            pdf.write_html(html)
-            pdf.output(filename)
+            await asyncio.to_thread(self._write_pdf, filename, html)
 
-            self.run_context.upload_user_file_to_s3(
+            await self.run_context.aupload_user_file_to_s3(
                 file_name=filename,
                 mime_type="application/pdf"
             )
             download_url: dict = self.run_context.get_file_url(filename)
 
-            # Extract text from the generated PDF
-            with open(filename, 'rb') as file:
-                pdf_reader = PdfReader(file)
-                text = ""
-                for page in pdf_reader.pages:
-                    text += page.extract_text() + "\n"
-
             result = f"PDF file saved, download link: {download_url.get('url', '')}"
             return result
         except Exception as e:
             return f"Error saving and indexing PDF file: {str(e)}"
 
+    @staticmethod
+    def _write_pdf(filename: str, html: str):
+        pdf = FPDF()
+        pdf.add_page()
+        pdf.set_font("Arial", size=12)
+        pdf.write_html(html)
+        pdf.output(filename)
+
     def _create_db_connection(self):
         try:
             database_url = os.environ.get('PGVECTOR_DB_URL')
@@ -384,7 +382,34 @@ Interact with PDF files: read, write content, index PDFs, and perform hybrid sea
         else:
             return os.path.basename(source)
 
-    def convert_pdf_to_images(self, file_name: str) -> dict:
+    def _render_pdf_pages(self, file_name: str) -> list[str]:
+        # Renders each page of the PDF stored in S3 as a PNG file, returning the file names
+        tenant_id = self.run_context.tenant_id
+        folder_name = self.run_context.user_id
+        s3_client = get_boto_client('s3')
+        bucket_name = config.get_global("S3_FILES_BUCKET_NAME")
+        object_name = f"{tenant_id}/{folder_name}/{file_name}"
+
+        response = s3_client.get_object(Bucket=bucket_name, Key=object_name)
+        pdf_content = response['Body'].read()
+
+        # Get the base name of the PDF file (without extension)
+        pdf_base_name = os.path.splitext(file_name)[0]
+        image_filenames = []
+
+        with unrestricted_filesystem(), fitz.open(stream=pdf_content, filetype="pdf") as pdf_document:
+            for page_num in range(len(pdf_document)):
+                # Convert the page to a PIL Image
+                pix = pdf_document[page_num].get_pixmap()
+                img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
+
+                # Create a meaningful filename for the image
+                image_filename = f"{pdf_base_name}_page_{page_num + 1}.png"
+                img.save(image_filename, format='PNG')
+                image_filenames.append(image_filename)
+        return image_filenames
+
+    async def convert_pdf_to_images(self, file_name: str) -> dict:
         """
         Converts a PDF file to a set of images (one per page), uploads them to S3,
         and returns their S3 links in a dictionary.
@@ -396,57 +421,27 @@ Interact with PDF files: read, write content, index PDFs, and perform hybrid sea
             dict: A dictionary containing the S3 links of the images.
         """
         try:
-            tenant_id = self.run_context.tenant_id
-            folder_name = self.run_context.user_id
-            s3_client = get_boto_client('s3')
-            bucket_name = config.get_global("S3_FILES_BUCKET_NAME")
-            object_name = f"{tenant_id}/{folder_name}/{file_name}"
-
-            response = s3_client.get_object(Bucket=bucket_name, Key=object_name)
-            pdf_content = response['Body'].read()
-
-            # Open the PDF file
-            pdf_document = fitz.open(stream=pdf_content, filetype="pdf")
+            image_filenames = await asyncio.to_thread(self._render_pdf_pages, file_name)
             images_data = []
 
-            # Get the base name of the PDF file (without extension)
-            pdf_base_name = os.path.splitext(file_name)[0]
-
             with unrestricted_filesystem():
-                for page_num in range(len(pdf_document)):
-                    # Get the page
-                    page = pdf_document[page_num]
-                    
-                    # Convert page to image
-                    pix = page.get_pixmap()
-                    
-                    # Convert pixmap to PIL Image
-                    img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-                    
-                    # Create a meaningful filename for the image
-                    image_filename = f"{pdf_base_name}_page_{page_num + 1}.png"
-                    img.save(image_filename, format='PNG')
-                    
-                    # Upload image to S3 with the new filename
-                    self.run_context.upload_user_file_to_s3(
-                        file_name=image_filename,
-                        mime_type="image/png"
-                    )
-
-                    download_url: dict = self.run_context.get_file_url(image_filename)
-
-                    s3_link = download_url.get('url', '')
-
-                    images_data.append({
-                        'page_number': page_num + 1,
-                        'image_url': s3_link
-                    })
-
-                    # Remove the temporary file
-                    os.remove(image_filename)
-
-            # Close the PDF document
-            pdf_document.close()
+                try:
+                    # The upload queue sends the pages in parallel
+                    await asyncio.gather(*[
+                        self.run_context.aupload_user_file_to_s3(file_name=image_filename, mime_type="image/png")
+                        for image_filename in image_filenames
+                    ])
+                finally:
+                    # Remove the temporary files
+                    for image_filename in image_filenames:
+                        os.remove(image_filename)
+
+            for page_num, image_filename in enumerate(image_filenames):
+                download_url: dict = self.run_context.get_file_url(image_filename)
+                images_data.append({
+                    'page_number': page_num + 1,
+                    'image_url': download_url.get('url', '')
+                })
 
             return {
                 "status": "success",
@@ -1,5 +1,6 @@
 from playwright.sync_api import sync_playwright
 from supercog.engine.tool_factory import ToolFactory, ToolCategory
+from supercog.engine.filesystem import record_external_writes
 from contextlib import contextmanager
 
 import json
@@ -91,13 +92,16 @@ Use this tool to manipulate and test websites.
         
         # Function to run the script asynchronously and capture stdout and stderr
         async def run_subprocess():
+            record_external_writes()
             process = await asyncio.create_subprocess_exec(
                 'python', script_file,
+                cwd=os.getcwd(),
                 stdout=subprocess.PIPE,
                 stderr=subprocess.PIPE
             )
             
             stdout, stderr = await process.communicate()
+            record_external_writes()
             return stdout.decode(), stderr.decode()
         
         # Run the subprocess and capture the output
@@ -35,6 +35,8 @@ from uuid import UUID
 import re
 from openai import AsyncOpenAI
 from supercog.engine.tools.basic_data import BasicDataTool
+from supercog.engine.embeddings import BatchEmbedder, EmbeddingCache, content_hash
+from supercog.engine.filesystem import resolve_agent_path
 import time
 
 @dataclass
@@ -250,21 +252,57 @@ Perform Retrieval-Augmented Generation tasks using pgvector for storage.
             return content.decode(detected_encoding or 'utf-8', errors='replace')
 
     async def _process_documents(self, documents: List[LangchainDocument], source: str) -> str:
-        # Process and store documents in the database
+        # Embeds the chunks in batches and stores them with one COPY
         self._setup_database()
         embedding_table_name = self._get_safe_table_name()
         total_docs = len(documents)
+        if total_docs == 0:
+            return f"No text found in {source} to add to the index."
+        await self.log(f"Embedding {total_docs} chunks from {source}")
+        contents = [self._clean_text(doc.page_content) for doc in documents]
+        indexed = await asyncio.to_thread(self._indexed_hashes, embedding_table_name, source)
+        if indexed == [content_hash(content) for content in contents]:
+            return f"{source} is already in the index, unchanged."
+        embedder = BatchEmbedder(
+            self.embeddings.aembed_documents,
+            model=self.embeddings.model,
+            cache=EmbeddingCache(self.conn, self._get_tenant_id()),
+            progress=self.log,
+        )
+        embeddings = await embedder.embed(contents)
+        await self.log(f"Used {embedder.cache_summary()}")
+        await asyncio.to_thread(self._insert_chunks, embedding_table_name, contents, source, embeddings)
+        if indexed:
+            return f"Replaced {len(indexed)} text chunks from {source} with {len(documents)} new ones."
+        return f"Added {len(documents)} text chunks from {source} to the index."
+
+    def _indexed_hashes(self, table_name: str, source: str) -> List[str]:
+        # Hashes of the chunks already in the index from this source, in order
         with self.conn.cursor() as cur:
-            for i, doc in enumerate(documents):
-                await self.log(f"Adding doc {i + 1}/{total_docs} to index")
-                clean_content = self._clean_text(doc.page_content)
-                embedding = self.embeddings.embed_query(clean_content)
-                cur.execute(sql.SQL("""
-                INSERT INTO {} (content, source, line_number, embedding)
-                VALUES (%s, %s, %s, %s::vector)
-                """).format(sql.Identifier(embedding_table_name)), (clean_content, source, i, embedding))
+            cur.execute(sql.SQL("""
+            SELECT content FROM {} WHERE source = %s ORDER BY line_number, id
+            """).format(sql.Identifier(table_name)), (source,))
+            rows = cur.fetchall()
         self.conn.commit()
-        return f"Added {len(documents)} text chunks from {source} to the index."
+        return [content_hash(content) for (content,) in rows]
+
+    def _insert_chunks(self, table_name: str, contents: List[str], source: str, embeddings: List[List[float]]):
+        # Replaces the source's chunks in one transaction, writing the new ones with COPY
+        buffer = StringIO()
+        writer = csv.writer(buffer)
+        for i, (content, embedding) in enumerate(zip(contents, embeddings)):
+            writer.writerow([content, source, i, "[" + ",".join(map(str, embedding)) + "]"])
+        buffer.seek(0)
+        try:
+            with self.conn.cursor() as cur:
+                cur.execute(sql.SQL("DELETE FROM {} WHERE source = %s").format(sql.Identifier(table_name)), (source,))
+                cur.copy_expert(sql.SQL("""
+                COPY {} (content, source, line_number, embedding) FROM STDIN WITH (FORMAT csv)
+                """).format(sql.Identifier(table_name)), buffer)
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
 
     def _get_dataframe(self, data_source: str, file_format: str, skip_rows: int, cleanup_col_names: bool) -> pd.DataFrame:
         # Load data into a DataFrame based on the file format
@@ -274,7 +312,8 @@ Perform Retrieval-Augmented Generation tasks using pgvector for storage.
         if file_format == "csv":
             df = pd.read_csv(data_source, skiprows=skip_rows)
         elif file_format == "parquet":
-            df = pd.read_parquet(data_source)
+            # pyarrow opens local files natively
+            df = pd.read_parquet(data_source if data_source.startswith("http") else resolve_agent_path(data_source))
         elif file_format == "json":
             # Read JSON file and handle different structures
             with open(data_source, 'r') as file:
@@ -123,11 +123,11 @@ Read, save, list, and extract content from files.
         
     def save_file(self, filename: str, content: str):
         """ Saves the given text content using the provided filename. """
-        with open(filename, 'w') as f:
+        with self.run_context.open_file(filename, 'w') as f:
             f.write(content)
         return "file saved"
     
-    def save_pdf_file(self, filename: str, content: str, source_format: str="markdown"):
+    async def save_pdf_file(self, filename: str, content: str, source_format: str="markdown"):
         """ Saves the given text as a PDF file using the provided filename. 
             Source format can be 'markdown', 'text'.
         """
@@ -135,14 +135,9 @@ Read, save, list, and extract content from files.
         link = """\n\n_Report created by_ [Supercog](https://supercog.ai)\n"""
 
         html = markdown2.markdown(content + link)
+        await asyncio.to_thread(self._write_pdf, filename, html)
 
-        pdf = FPDF()
-        pdf.add_page()
-        pdf.set_font("Arial", size=12)
-        pdf.write_html(html)
-        pdf.output(filename)
-
-        self.run_context.upload_user_file_to_s3(
+        await self.run_context.aupload_user_file_to_s3(
             file_name=filename,
             mime_type="application/pdf"
         )
@@ -150,9 +145,17 @@ Read, save, list, and extract content from files.
 
         return "PDF file saved, download link: " + download_url.get("url", "")
 
+    @staticmethod
+    def _write_pdf(filename: str, html: str):
+        pdf = FPDF()
+        pdf.add_page()
+        pdf.set_font("Arial", size=12)
+        pdf.write_html(html)
+        pdf.output(filename)
+
     def mkdir(self, path: str):
         """Create a directory."""
-        os.makedirs(path, exist_ok=True)  # Create directory if it doesn't exist
+        os.makedirs(self.run_context.resolve_file_path(path), exist_ok=True)  # Create directory if it doesn't exist
         return "driectory created"
         
     async def list_filesystem_files(self, folder: str=".", callbacks: LangChainCallback=None) -> list[tuple]:
@@ -165,7 +168,11 @@ Read, save, list, and extract content from files.
             folder = ""
     
         glob_pat = os.path.join(folder, "*")
-        files_with_sizes = [(filename, os.path.getsize(filename)) for filename in glob.glob(glob_pat)]
+        user_dir = self.run_context.get_user_directory()
+        files_with_sizes = [
+            (filename, os.path.getsize(os.path.join(user_dir, filename)))
+            for filename in glob.glob(glob_pat, root_dir=user_dir)
+        ]
         return files_with_sizes
         #await self._delay_for_testing(callbacks)
         #return os.listdir(path)
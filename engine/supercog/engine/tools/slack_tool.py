@@ -13,6 +13,7 @@ from slack_sdk.errors import SlackApiError
 
 from supercog.shared.services import config
 from supercog.shared.logging import logger
+from supercog.shared.apubsub import pubsub
 from supercog.engine.triggerable import Triggerable
 
 from typing import Any, Callable
@@ -354,10 +355,13 @@ class SlackHandler:
                 run["_triggerable"] = triggerable
                 run["slack_thread_id"] = convo_thread_id
                 self.thread_runs[convo_thread_id] = run
+                # A new run's event stream starts empty, so read it from the beginning
+                cursor = "0-0"
             else:
+                cursor = await pubsub.get_run_events_cursor(run['id'])
                 triggerable.continue_run(run['id'], message['text'])
             full_reply = ""
-            async for reply in triggerable.wait_for_agent_reply(run['logs_channel']):
+            async for reply in triggerable.wait_for_agent_reply(run['logs_channel'], run_id=run['id'], cursor=cursor):
                 reply = reply.replace("\n", " ")
                 full_reply += reply
                 print("Sending update to slack: ", full_reply)
@@ -1,14 +1,22 @@
+import asyncio
 import csv
 from contextlib import contextmanager
 import pandas as pd
-from typing import Callable, Any, Optional
+import pyarrow as pa
+from typing import Callable, Any, Iterator, Optional
 from supercog.engine.tool_factory import ToolFactory, ToolCategory, LangChainCallback
+from supercog.engine.result_spool import spool_batches
+from supercog.engine.tables import records_to_arrow
+from supercog.engine.filesystem import resolve_agent_path
 import snowflake.connector
 
 from langchain.callbacks.manager import (
     AsyncCallbackManager
 )
 
+# Rows are read in batches of FETCH_SIZE when Arrow batches aren't available
+FETCH_SIZE = 5000
+
 #"protocol": "https",
 #"host": "<host>",
 #"port": "443",
@@ -89,12 +97,41 @@ Access Snowflake data
             return await self.result_as_dataframe(await self.runsql(cursor, sqlstring), cursor)                     
 
     async def result_as_dataframe(self, result, cursor):
+        # Snowflake returns large results in chunks. The preview is made from the first
+        # one and the rest are spooled to a file in the background.
+        columns = [x[0].lower() for x in cursor.description]
         try:
-            return self.get_dataframe_preview(result.fetch_pandas_all())
+            batches = self.arrow_batches(result.fetch_arrow_batches(), columns)
         except Exception as e:
-            print("Conver to pandas failed first: ", e)
-            df = pd.DataFrame.from_records(iter(cursor), columns=[x[0] for x in cursor.description])
-            return self.get_dataframe_preview(df)
+            print("Conver to arrow failed first: ", e)
+            batches = self.record_batches(cursor, columns)
+        # Reading the first batches fetches them from Snowflake
+        df = await asyncio.to_thread(
+            spool_batches,
+            batches,
+            self.run_context.get_spool_path("snowflake"),
+            self.run_context.get_result_budget(),
+        )
+        return self.get_dataframe_preview(df)
+
+    @staticmethod
+    def arrow_batches(batches, columns: list[str]) -> Iterator[pa.Table]:
+        # Yields at least one table. Columns are lowercased, as get_dataframe_preview
+        # would, since spooled results keep their names.
+        empty = True
+        for batch in batches:
+            empty = False
+            yield batch.rename_columns(columns)
+        if empty:
+            yield records_to_arrow([], columns)
+
+    @staticmethod
+    def record_batches(cursor, columns: list[str]) -> Iterator[pa.Table]:
+        while True:
+            rows = cursor.fetchmany(FETCH_SIZE)
+            yield records_to_arrow(rows, columns)
+            if len(rows) < FETCH_SIZE:
+                break
 
     def test_credential(self, cred, secrets: dict) -> Optional[str]:
             """ Test that the given credential secrets are valid. Return None if OK, otherwise
@@ -146,12 +183,14 @@ Access Snowflake data
                 await self.runsql(cursor, table_create_statement)
 
             df, df_name = self.get_dataframe_from_handle(dataframe_var)
+            # pyarrow and the Snowflake connector open the file natively, outside our sandbox
             filename = "upload1.parquet"
-            df.to_parquet(filename, index=False)
+            file_path = resolve_agent_path(filename)
+            df.to_parquet(file_path, index=False)
 
             await self.runsql(cursor, "CREATE FILE FORMAT IF NOT EXISTS sc_parquet_format;");
             await self.runsql(cursor, "CREATE OR REPLACE STAGE supercog FILE_FORMAT = sc_parquet_format;")
-            await self.runsql(cursor, f"PUT file://{filename} @supercog")
+            await self.runsql(cursor, f"PUT file://{file_path} @supercog")
             cmd = f"""
             COPY INTO {database}.{snowflake_schema}.{table_name} 
                  FROM @supercog
@@ -132,7 +132,7 @@ Use this tool to convert speech to text using OpenAI's Whisper API
         # play back the audio
         return self._local_play_back(byte_io_wav)
 
-    def extract_from_file_to_file(self,
+    async def extract_from_file_to_file(self,
                                   speech_input_file_name: str,
                                   start_pos_in_secs: int,
                                   end_pos_in_secs: int,
@@ -151,15 +151,16 @@ Use this tool to convert speech to text using OpenAI's Whisper API
         Returns:
             None. Plays audio segment from start_pos_in_secs to end_pos_in_secs.
         """
-        byte_io_wav = self._extract_wav_from_file(speech_input_file_name,
-                                                  start_pos_in_secs,
-                                                  end_pos_in_secs,
-                                                  language)
+        byte_io_wav = await asyncio.to_thread(self._extract_wav_from_file,
+                                              speech_input_file_name,
+                                              start_pos_in_secs,
+                                              end_pos_in_secs,
+                                              language)
         filename, save_path = self._unique_file_name("real_voices",
                                                      speech_input_file_name,
                                                      start_pos_in_secs,
                                                      end_pos_in_secs)
-        file_info = self._save_audio_to_s3(byte_io_wav, filename, save_path)
+        file_info = await self._save_audio_to_s3(byte_io_wav, filename, save_path)
         data = json.loads(file_info)
         audio_url = data.get("audio_url")
         return json.dumps({
@@ -185,16 +186,17 @@ Use this tool to convert speech to text using OpenAI's Whisper API
         Returns:
             None. Plays audio segment from start_pos_in_secs to end_pos_in_secs.
         """
-        byte_io_wav = self._extract_wav_from_file(speech_input_file_name,
-                                                  start_pos_in_secs,
-                                                  end_pos_in_secs,
-                                                  language)
+        byte_io_wav = await asyncio.to_thread(self._extract_wav_from_file,
+                                              speech_input_file_name,
+                                              start_pos_in_secs,
+                                              end_pos_in_secs,
+                                              language)
 
         filename, save_path = self._unique_file_name("real_voices",
                                                      speech_input_file_name,
                                                      start_pos_in_secs,
                                                      end_pos_in_secs)
-        file_info = self._save_audio_to_s3(byte_io_wav, filename, save_path)
+        file_info = await self._save_audio_to_s3(byte_io_wav, filename, save_path)
         return file_info
         #await self.run_context.publish(
         #    self.run_context.create_event(AudioStreamEvent, callbacks, audio_url = file_info.audio_url)
@@ -212,7 +214,7 @@ Use this tool to convert speech to text using OpenAI's Whisper API
         os.makedirs(os.path.dirname(save_path), exist_ok=True)
         return filename, save_path
     
-    def _save_audio_to_s3(self, audio_data, filename, save_path) -> str:
+    async def _save_audio_to_s3(self, audio_data, filename, save_path) -> str:
         """
         Save audio data to a local file and then upload it to an S3 bucket.
 
@@ -245,7 +247,7 @@ Use this tool to convert speech to text using OpenAI's Whisper API
                 print(f"File exists. Size: {file_size} bytes")
 
                 # Upload to S3
-                raw_url = self.run_context.upload_user_file_to_s3(
+                raw_url = await self.run_context.aupload_user_file_to_s3(
                     file_name=filename,
                     original_folder="audio",
                     mime_type="audio/mpeg"
@@ -1,7 +1,7 @@
 from supercog.engine.tool_factory import ToolFactory, ToolCategory
 from supercog.shared.services import config
 import openai
-from openai import OpenAI
+from openai import AsyncOpenAI, OpenAI
 from pydub import AudioSegment
 from pydub.playback import play
 from io import BytesIO
@@ -124,7 +124,7 @@ Use this tool to convert text to speech using OpenAI's API
             return f"Error generating speech: {str(e)}"
         return "Success converting text to speech"
 
-    def _save_audio_to_s3(self, voice: str, audio_data) -> str:
+    async def _save_audio_to_s3(self, voice: str, audio_data) -> str:
          """
          Save audio data to a local file and then upload it to an S3 bucket.
 
@@ -163,7 +163,7 @@ Use this tool to convert text to speech using OpenAI's API
                     raise ValueError("File was created but is empty")
 
                 # Upload to S3
-                raw_url = self.run_context.upload_user_file_to_s3(
+                raw_url = await self.run_context.aupload_user_file_to_s3(
                     file_name=filename,
                     original_folder="audio",
                     mime_type="audio/mpeg"
@@ -189,7 +189,7 @@ Use this tool to convert text to speech using OpenAI's API
             print(error_message)
             return json.dumps({"error": error_message})
         
-    def generate_speech_file_from_text(self, voice: str, text: str) -> str:
+    async def generate_speech_file_from_text(self, voice: str, text: str) -> str:
         """
         Generate speech from the given text using OpenAI's Text-to-Speech API and save it to a file.
 
@@ -200,15 +200,15 @@ Use this tool to convert text to speech using OpenAI's API
             The URL of the generated audio file.
         """
         try:
-            client = OpenAI(api_key=self.openai_api_key)
-            response = client.audio.speech.create(
+            client = AsyncOpenAI(api_key=self.openai_api_key)
+            response = await client.audio.speech.create(
                 model="tts-1",
                 voice=voice,
                 input=text,
             )
             audio_data = response.content
             print(f"Audio data type: {type(audio_data)}, length: {len(audio_data)} bytes")
-            return_str = self._save_audio_to_s3(voice, audio_data)
+            return_str = await self._save_audio_to_s3(voice, audio_data)
         except Exception as e:
             error_message = f"Error generating speech: {str(e)}"
             print(error_message)
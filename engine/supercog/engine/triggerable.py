@@ -5,6 +5,7 @@ import time
 import hashlib
 import os
 from datetime import datetime, UTC
+from typing import Optional
 from pydantic import BaseModel
 
 
@@ -97,9 +98,9 @@ class Triggerable:
                 "Authorization": f"Bearer {TRIGGER_PASSKEY}"
         }
 
-    def create_run(self, message: str | dict):
+    def create_run(self, message: str | dict | list):
         self.lat_run = datetime.now(UTC)
-        if isinstance(message, dict):
+        if isinstance(message, (dict, list)):
             message = json.dumps(message, cls=DateTimeEncoder)
 
         run_data = {
@@ -129,7 +130,15 @@ class Triggerable:
             rollbar.report_message(msg, extra_data={"agent_id": self.agent_id})
 
 
-    async def wait_for_agent_reply(self, reply_channel: str, timeout=90):
+    async def wait_for_agent_reply(
+            self, 
+            reply_channel: str, 
+            timeout=90, 
+            run_id: Optional[str]=None, 
+            cursor: Optional[str]=None,
+        ):
+        # Pass the run_id and the run events 'cursor' from before the input was sent to
+        # read from the durable run stream (if enabled) without missing events.
         def capture_event(event: dict) -> str:
             runlog = RunLogBase.model_validate(event)
             agevent: AgentEvent = EventRegistry.get_event(runlog)
@@ -138,25 +147,28 @@ class Triggerable:
             else:
                 return ""
 
-        channel = await pubsub.subscribe(reply_channel) # type: ignore
+        channel = await pubsub.subscribe_run_events(run_id, reply_channel, cursor)
         start = time.time()
         reply = ""
-        while time.time() - start < timeout:
-            message = await channel.get_message(ignore_subscribe_messages=True, timeout=0.5)
-            if message:
-                print(message)
-                try:
-                    event = json.loads(message['data'])
-                    yield capture_event(event)
-                    if event.get("type") == "end":
-                        message = await channel.get_message(ignore_subscribe_messages=True, timeout=0.5)
-                        if message is None:
-                            return
-                        else:
-                            # Seems like more messages, so keep going
-                            event = json.loads(message['data'])
-                            yield capture_event(event)
-                except Exception as e:
-                    print(e)
+        try:
+            while time.time() - start < timeout:
+                message = await channel.get_message(timeout=timeout - (time.time() - start))
+                if message:
+                    print(message)
+                    try:
+                        event = json.loads(message['data'])
+                        yield capture_event(event)
+                        if event.get("type") == "end":
+                            message = await channel.get_message(timeout=0.5)
+                            if message is None:
+                                return
+                            else:
+                                # Seems like more messages, so keep going
+                                event = json.loads(message['data'])
+                                yield capture_event(event)
+                    except Exception as e:
+                        print(e)
+        finally:
+            await channel.unsubscribe()
 
 
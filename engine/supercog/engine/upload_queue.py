@@ -0,0 +1,185 @@
+import asyncio
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Awaitable, Callable, Optional
+
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
+from fastapi import FastAPI
+from fastapi_lifespan_manager import State
+
+from supercog.shared.logging import logger
+from supercog.shared.services import config
+from supercog.shared.utils import get_boto_client, calc_s3_url
+
+from .db import lifespan_manager
+
+UPLOAD_CONCURRENCY = int(config.get_option("S3_UPLOAD_CONCURRENCY", default=4))
+MULTIPART_THRESHOLD = int(config.get_option("S3_MULTIPART_THRESHOLD_MB", default=16)) * 1024 * 1024
+MULTIPART_CHUNKSIZE = int(config.get_option("S3_MULTIPART_CHUNKSIZE_MB", default=8)) * 1024 * 1024
+HASH_CACHE_SIZE = 10000
+HASH_METADATA_KEY = "sha256"
+
+# Called with the upload status: "uploading", "uploaded", "skipped" or "failed", plus
+# bytes_uploaded, total_bytes, asset_url and message.
+UploadCallback = Callable[..., Awaitable[None]]
+
+class UploadQueue:
+    # Uploads agent files to S3 from a thread pool, so that boto3 never blocks the event
+    # loop. Large files are sent as concurrent multipart uploads. We remember the SHA-256
+    # of each object we upload (and store it in the object metadata) so that files whose
+    # content hasn't changed are skipped.
+    def __init__(self, concurrency: int = UPLOAD_CONCURRENCY, client_factory: Callable = get_boto_client):
+        self.concurrency = concurrency
+        self.client_factory = client_factory
+        self.executor: Optional[ThreadPoolExecutor] = None
+        self._client = None
+        self.transfer_config = TransferConfig(
+            multipart_threshold=MULTIPART_THRESHOLD,
+            multipart_chunksize=MULTIPART_CHUNKSIZE,
+            max_concurrency=concurrency,
+        )
+        self.hashes: OrderedDict[str, str] = OrderedDict()
+        self.pending: set[asyncio.Task] = set()
+        self.stats = {"uploaded": 0, "skipped": 0, "failed": 0, "bytes": 0}
+
+    def get_client(self):
+        # boto3 clients are thread safe, so all of our workers share one
+        if self._client is None:
+            self._client = self.client_factory("s3")
+        return self._client
+
+    def get_executor(self) -> ThreadPoolExecutor:
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="s3_upload")
+        return self.executor
+
+    @staticmethod
+    def file_hash(file_path: str) -> str:
+        with open(file_path, "rb") as f:
+            return hashlib.file_digest(f, "sha256").hexdigest()
+
+    def _remember_hash(self, key: str, digest: str):
+        self.hashes[key] = digest
+        self.hashes.move_to_end(key)
+        while len(self.hashes) > HASH_CACHE_SIZE:
+            self.hashes.popitem(last=False)
+
+    def _is_unchanged(self, bucket: str, object_name: str, digest: str) -> bool:
+        key = f"{bucket}/{object_name}"
+        if key in self.hashes:
+            return self.hashes[key] == digest
+        try:
+            head = self.get_client().head_object(Bucket=bucket, Key=object_name)
+        except ClientError:
+            return False
+        return head.get("Metadata", {}).get(HASH_METADATA_KEY) == digest
+
+    def upload_file(
+            self,
+            file_path: str,
+            bucket: str,
+            object_name: str,
+            mime_type: str = "application/octet-stream",
+            progress: Optional[Callable[[int], None]] = None,
+        ) -> tuple[str, bool]:
+        """ Uploads the file (blocking) and returns (url, uploaded). 'uploaded' is False if
+            the object already had the same content. """
+        s3_client = self.get_client()
+        digest = self.file_hash(file_path)
+        if self._is_unchanged(bucket, object_name, digest):
+            self._remember_hash(f"{bucket}/{object_name}", digest)
+            self.stats["skipped"] += 1
+            return calc_s3_url(s3_client, bucket, object_name), False
+
+        s3_client.upload_file(
+            file_path,
+            bucket,
+            object_name,
+            ExtraArgs={"ContentType": mime_type, "Metadata": {HASH_METADATA_KEY: digest}},
+            Callback=progress,
+            Config=self.transfer_config,
+        )
+        self._remember_hash(f"{bucket}/{object_name}", digest)
+        self.stats["uploaded"] += 1
+        self.stats["bytes"] += os.path.getsize(file_path)
+        return calc_s3_url(s3_client, bucket, object_name), True
+
+    async def upload(
+            self,
+            file_path: str,
+            bucket: str,
+            object_name: str,
+            mime_type: str = "application/octet-stream",
+            callback: Optional[UploadCallback] = None,
+        ) -> str|None:
+        """ Uploads the file from our thread pool and returns its URL, or None if the
+            upload failed. Progress is reported to 'callback' in 25% steps for multipart
+            uploads. """
+        loop = asyncio.get_running_loop()
+        total_bytes = os.path.getsize(file_path)
+        sent = [0, 0]  # bytes uploaded, last reported quarter
+        lock = threading.Lock()
+        reports = []
+
+        async def report(status: str, **fields):
+            if callback:
+                try:
+                    await callback(status, total_bytes=total_bytes, **fields)
+                except Exception as e:
+                    logger.error(f"Upload callback failed for {object_name}: {e}")
+
+        def progress(nbytes: int):
+            # Runs on the upload threads
+            with lock:
+                sent[0] += nbytes
+                quarter = int(4 * sent[0] / total_bytes) if total_bytes else 4
+                if quarter <= sent[1] or quarter >= 4:
+                    return
+                sent[1] = quarter
+                reports.append(
+                    asyncio.run_coroutine_threadsafe(report("uploading", bytes_uploaded=sent[0]), loop)
+                )
+
+        if total_bytes >= MULTIPART_THRESHOLD:
+            await report("uploading", bytes_uploaded=0)
+        error = None
+        try:
+            url, uploaded = await loop.run_in_executor(
+                self.get_executor(),
+                self.upload_file, file_path, bucket, object_name, mime_type, progress,
+            )
+        except Exception as e:
+            error = e
+        # Make sure progress is reported before the final status
+        await asyncio.gather(*[asyncio.wrap_future(f) for f in reports])
+
+        if error is not None:
+            self.stats["failed"] += 1
+            logger.error(f"Upload of {file_path} to {object_name} failed: {error}")
+            await report("failed", bytes_uploaded=sent[0], message=str(error))
+            return None
+        await report("uploaded" if uploaded else "skipped", bytes_uploaded=total_bytes, asset_url=url)
+        return url
+
+    def submit(self, *args, **kwargs) -> asyncio.Task:
+        """ Queues an upload in the background. Takes the same arguments as 'upload'. """
+        task = asyncio.create_task(self.upload(*args, **kwargs))
+        self.pending.add(task)
+        task.add_done_callback(self.pending.discard)
+        return task
+
+    async def drain(self):
+        # Waits for all queued uploads to finish
+        while self.pending:
+            await asyncio.gather(*list(self.pending), return_exceptions=True)
+
+upload_queue = UploadQueue()
+
+@lifespan_manager.add
+async def lifespan(app: FastAPI) -> AsyncIterator[State]:
+    yield {"upload_queue": upload_queue}
+    await upload_queue.drain()
@@ -0,0 +1,152 @@
+# Cached handles for the pgvector indexes behind DocIndexes.
+#
+# Building a PGVectorStore is expensive: each one creates its own SQLAlchemy engines,
+# and the first use runs the table, extension and HNSW index setup statements. So we
+# keep a handle for each recently used index, evicting the least recently used, and
+# all of the stores share one pooled engine (and one async engine). Repeated queries
+# against a hot index then reuse pooled connections and SQLAlchemy's compiled
+# statement cache.
+
+import threading
+from collections import OrderedDict
+from functools import cached_property
+from typing import AsyncIterator, Optional
+
+from fastapi import FastAPI
+from fastapi_lifespan_manager import State
+from llama_index.core import VectorStoreIndex
+from llama_index.vector_stores.postgres import PGVectorStore
+from sqlalchemy import URL, Engine, create_engine, make_url
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+
+from supercog.shared.logging import logger
+from supercog.shared.services import config
+
+from .db import lifespan_manager
+
+VECTOR_INDEX_CACHE_SIZE = int(config.get_option("VECTOR_INDEX_CACHE_SIZE", default=32))
+PGVECTOR_POOL_SIZE = int(config.get_option("PGVECTOR_POOL_SIZE", default=5))
+PGVECTOR_MAX_OVERFLOW = int(config.get_option("PGVECTOR_MAX_OVERFLOW", default=10))
+
+EMBED_DIM = 1536  # openai embedding dimension
+HNSW_KWARGS = {
+    "hnsw_m": 16,
+    "hnsw_ef_construction": 64,
+    "hnsw_ef_search": 40,
+    "hnsw_dist_method": "vector_cosine_ops",
+}
+
+def make_index_name(index_id: str, prefix="idx_"):
+    return prefix + index_id.replace("-", "_")
+
+class SharedEnginePGVectorStore(PGVectorStore):
+    """ A PGVectorStore which uses the cache's engines instead of creating its own. """
+    _shared_engines: Optional[tuple[Engine, AsyncEngine]] = None
+
+    def _connect(self):
+        self._engine, self._async_engine = self._shared_engines
+        self._session = sessionmaker(self._engine)
+        self._async_session = sessionmaker(self._async_engine, class_=AsyncSession)
+
+    async def close(self):
+        # The engines belong to the cache
+        pass
+
+class IndexHandle:
+    def __init__(self, index_id: str, vector_store: PGVectorStore):
+        self.index_id = index_id
+        self.vector_store = vector_store
+
+    @cached_property
+    def index(self) -> VectorStoreIndex:
+        return VectorStoreIndex.from_vector_store(self.vector_store)
+
+class VectorIndexCache:
+    def __init__(self, db_url: Optional[str] = None, max_size: int = VECTOR_INDEX_CACHE_SIZE):
+        self._db_url = db_url
+        self.max_size = max_size
+        # Ordered from least to most recently used
+        self.handles: OrderedDict[str, IndexHandle] = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @cached_property
+    def db_url(self) -> URL:
+        return make_url(self._db_url or config.get_global("PGVECTOR_DB_URL"))
+
+    @cached_property
+    def engine(self) -> Engine:
+        return create_engine(
+            self.db_url.set(drivername="postgresql+psycopg2"),
+            pool_size=PGVECTOR_POOL_SIZE,
+            max_overflow=PGVECTOR_MAX_OVERFLOW,
+            pool_pre_ping=True,
+        )
+
+    @cached_property
+    def async_engine(self) -> AsyncEngine:
+        return create_async_engine(
+            self.db_url.set(drivername="postgresql+asyncpg"),
+            pool_size=PGVECTOR_POOL_SIZE,
+            max_overflow=PGVECTOR_MAX_OVERFLOW,
+            pool_pre_ping=True,
+        )
+
+    def create_store(self, index_id: str) -> PGVectorStore:
+        url = self.db_url
+        store = SharedEnginePGVectorStore.from_params(
+            database=url.database,
+            host=url.host,
+            password=url.password,
+            port=str(url.port or 5432),
+            user=url.username,
+            table_name=make_index_name(index_id),
+            hybrid_search=True,
+            embed_dim=EMBED_DIM,
+            # Our column types are safe to cache, so SQLAlchemy can reuse compiled statements
+            cache_ok=True,
+            hnsw_kwargs=dict(HNSW_KWARGS),
+        )
+        store._shared_engines = (self.engine, self.async_engine)
+        return store
+
+    def get(self, index_id: str) -> IndexHandle:
+        with self.lock:
+            handle = self.handles.get(index_id)
+            if handle is not None:
+                self.handles.move_to_end(index_id)
+                self.hits += 1
+                return handle
+            self.misses += 1
+            handle = IndexHandle(index_id, self.create_store(index_id))
+            self.handles[index_id] = handle
+            while len(self.handles) > self.max_size:
+                evicted, _ = self.handles.popitem(last=False)
+                logger.info(f"Evicted vector index {evicted} from the cache")
+            return handle
+
+    def __contains__(self, index_id: str) -> bool:
+        return index_id in self.handles
+
+    def __len__(self) -> int:
+        return len(self.handles)
+
+    def stats(self) -> dict:
+        return {"indexes": len(self.handles), "hits": self.hits, "misses": self.misses}
+
+    async def close(self):
+        with self.lock:
+            self.handles.clear()
+        if "engine" in self.__dict__:
+            self.engine.dispose()
+        if "async_engine" in self.__dict__:
+            await self.async_engine.dispose()
+
+vector_indexes = VectorIndexCache()
+
+@lifespan_manager.add
+async def lifespan(app: FastAPI) -> AsyncIterator[State]:
+    yield {"vector_indexes": vector_indexes}
+    await vector_indexes.close()
@@ -7,14 +7,17 @@ import uuid
 import pandas as pd
 import json
 from collections import defaultdict
+from dataclasses import asdict
 
 from supercog.shared.services import config, serve, db_connect
 from supercog.engine.db import lifespan_manager, Agent, get_session, DocSourceConfig, DocIndex, DocSource
 from supercog.engine.doc_source_factory import DocSourceFactory
 from supercog.engine.run_context import RunContext, ContextInit
+from supercog.engine.embeddings import BatchEmbedder, EmbeddingCache
+from supercog.engine.doc_sync import DocumentSync
+from supercog.engine.vector_indexes import vector_indexes, make_index_name
 
-from llama_index.core import VectorStoreIndex, SimpleDirectoryReader, Document, StorageContext
-from llama_index.vector_stores.postgres import PGVectorStore
+from llama_index.core import VectorStoreIndex, SimpleDirectoryReader, Document, StorageContext, Settings
 import openai
 from sqlalchemy import make_url, text
 
@@ -24,9 +27,6 @@ SERVICE = "ragservice"
 # In-memory job storage (replace with a database in production)
 indexing_jobs = {}
 
-def make_index_name(index_id: str, prefix="idx_"):
-    return prefix + index_id.replace("-", "_")
-
 @app.get("/hello")
 def hello(session: Session = Depends(get_session)):
     # Load the first agent
@@ -91,50 +91,45 @@ async def index_documents(
     ):
     await asyncio.sleep(1.0)
     print("Now indexing documents")
+    embedding_cache = None
     with Session(db_connect("engine")) as session:
         try:
-            # Initialize PostgreSQL vector store
-            db_url = make_url(config.get_global("PGVECTOR_DB_URL"))
             openai.api_key = config.get_global("OPENAI_API_KEY")
-            
-            index_name = make_index_name(doc_index.id or "")
-            vector_store = PGVectorStore.from_params(
-                database=db_url.database,
-                host=db_url.host,
-                password=db_url.password,
-                port=str(db_url.port or 5432),
-                user=db_url.username,
-                table_name=index_name,
-                hybrid_search=True,
-                embed_dim=1536,  # openai embedding dimension
-                hnsw_kwargs={
-                    "hnsw_m": 16,
-                    "hnsw_ef_construction": 64,
-                    "hnsw_ef_search": 40,
-                    "hnsw_dist_method": "vector_cosine_ops",
-                },
+            vector_store = vector_indexes.get(doc_index.id or "").vector_store
+
+            embedding_cache = EmbeddingCache.connect(config.get_global("PGVECTOR_DB_URL"), doc_index.tenant_id)
+            embed_model = Settings.embed_model
+            embedder = BatchEmbedder(
+                embed_model.aget_text_embedding_batch,
+                model=embed_model.model_name,
+                cache=embedding_cache,
             )
 
-            storage_context = StorageContext.from_defaults(vector_store=vector_store)
-
             # Initialize the document source
             docs_source.run_context = run_context
             docs_source.credentials = run_context.secrets
-            documents = []
             folders = doc_source_config.folder_ids
             if len(folders) == 0:
                 folders = [None]
-            for folder in folders:
-                async for doc in docs_source.get_documents(folder):
-                    # Add the document to the index
-                    documents.append(doc)
-
-            # Create the index
-            index = VectorStoreIndex.from_documents(
-                documents,
-                storage_context=storage_context,
-                show_progress=True,
+
+            async def source_documents():
+                for folder in folders:
+                    async for doc in docs_source.get_documents(folder):
+                        yield doc
+
+            # Documents are indexed as they arrive from the source. Only new and changed
+            # documents are embedded, and documents that were removed from the source are
+            # removed from the index.
+            doc_sync = DocumentSync(
+                session,
+                doc_index.id,
+                doc_source_config.id,
+                vector_store,
+                Settings.transformations,
+                embedder,
             )
+            stats = await doc_sync.sync(source_documents())
+            print(f"Synced documents: {stats.summary()}, {embedder.cache_summary()}")
 
             # Update the DocIndex status
             doc_index.status = "indexed"
@@ -142,7 +137,12 @@ async def index_documents(
             session.commit()
             print("INDEXING DONE")
 
-            indexing_jobs[job_id] = {"status": "completed", "message": f"Indexing completed for index {doc_index.id}"}
+            indexing_jobs[job_id] = {
+                "status": "completed",
+                "message": f"Indexing completed for index {doc_index.id}",
+                "documents": asdict(stats),
+                "embedding_cache_hit_rate": embedder.hit_rate,
+            }
 
         except Exception as e:
             # Handle exceptions and update the DocIndex status
@@ -152,6 +152,9 @@ async def index_documents(
             session.add(doc_index)
             session.commit()
             indexing_jobs[job_id] = {"status": "error", "message": f"Error during indexing: {str(e)}"}
+        finally:
+            if embedding_cache is not None:
+                embedding_cache.close()
 
 @app.get("/indexing_job/{job_id}")
 async def get_indexing_job_status(job_id: str):
@@ -171,32 +174,11 @@ async def detach_docsource_from_index(
     session: Session = Depends(get_session)
 ):
     try:
-        # Initialize PostgreSQL vector store
-        db_url = make_url(config.get_global("PGVECTOR_DB_URL"))
-        index_name = make_index_name(index_id)
-        vector_store = PGVectorStore.from_params(
-            database=db_url.database,
-            host=db_url.host,
-            password=db_url.password,
-            port=str(db_url.port or 5432),
-            user=db_url.username,
-            table_name=index_name,
-            hybrid_search=True,
-            embed_dim=1536,
-            hnsw_kwargs={
-                    "hnsw_m": 16,
-                    "hnsw_ef_construction": 64,
-                    "hnsw_ef_search": 40,
-                    "hnsw_dist_method": "vector_cosine_ops",
-                },
-        )
-
-        storage_context = StorageContext.from_defaults(vector_store=vector_store)
-        index = VectorStoreIndex.from_vector_store(vector_store, storage_context=storage_context)
-
-
-        index.delete(doc_id)
+        vector_store = vector_indexes.get(index_id).vector_store
 
+        # Delete the chunks of each document that was indexed from the source
+        doc_sync = DocumentSync(session, index_id, doc_id, vector_store, transformations=[])
+        await doc_sync.delete_all()
 
         return {"message": f"Successfully detached doc_source {doc_id} from index {index_id}"}
 
@@ -216,30 +198,8 @@ async def query_index(
     session: Session = Depends(get_session)
 ):
 
-    # Initialize PostgreSQL vector store
-    db_url = make_url(config.get_global("PGVECTOR_DB_URL"))
     openai.api_key = config.get_global("OPENAI_API_KEY")
-    
-    index_name = make_index_name(index_id) #I assume index_id will be passed to endpoint
-    vector_store = PGVectorStore.from_params(
-        database=db_url.database,
-        host=db_url.host,
-        password=db_url.password,
-        port=str(db_url.port or 5432),
-        user=db_url.username,
-        table_name=index_name,
-        hybrid_search=True,
-        embed_dim=1536,  # openai embedding dimension
-        hnsw_kwargs={
-            "hnsw_m": 16,
-            "hnsw_ef_construction": 64,
-            "hnsw_ef_search": 40,
-            "hnsw_dist_method": "vector_cosine_ops",
-        },
-    )
-
-    storage_context = StorageContext.from_defaults(vector_store=vector_store)
-    index = VectorStoreIndex.from_vector_store(vector_store, storage_context=storage_context)
+    index = vector_indexes.get(index_id).index
 
     # Use hybrid search
     query_engine = index.as_query_engine(
@@ -268,12 +228,10 @@ async def list_index_metadata(
     session: Session = Depends(get_session)
 ):
 
-    # Initialize PostgreSQL connection
-    db_url = make_url(config.get_global("PGVECTOR_DB_URL"))
     index_name = make_index_name(index_id, prefix="data_idx_") #It seems llamaindex adds "data_" in front of table name
 
-    # Connect to the database
-    engine = create_engine(db_url)
+    # Use the vector indexes' connection pool
+    engine = vector_indexes.engine
     with engine.connect() as connection:
         # Query to fetch metadata
         query = text(f"""
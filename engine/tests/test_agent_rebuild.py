@@ -0,0 +1,150 @@
+import itertools
+import json
+import time
+from typing import Awaitable
+from uuid import uuid4
+
+import pytest
+import pytest_asyncio
+from langchain_core.language_models.fake_chat_models import GenericFakeChatModel
+from langchain_core.messages import AIMessage
+
+from supercog.shared.models import AgentBase
+from supercog.shared.apubsub import AgentOutputEvent
+from supercog.shared.credentials import secrets_service
+from supercog.engine.chatengine import ChatEngine
+from supercog.engine.jwt_auth import User
+
+# Checks that ChatEngine.create_agent only rebuilds the layers that changed, and
+# benchmarks agent-save to first-token latency for each kind of change.
+
+class FakeToolChatModel(GenericFakeChatModel):
+    # GenericFakeChatModel doesn't support tools, so just record the tool names
+    def bind_tools(self, tools, **kwargs):
+        return self.bind(tools=[t.name for t in tools])
+
+def fake_create_llm(self, api_key, tool_funcs):
+    llm = FakeToolChatModel(messages=itertools.cycle([AIMessage(content="hello there world")]))
+    if tool_funcs:
+        return llm.bind_tools(tool_funcs)
+    return llm
+
+def make_agent(**kwargs) -> AgentBase:
+    tools = kwargs.pop("tools", ["weather_connector", "pandas_tools"])
+    args = {
+        "id": "a1",
+        "name": "Rebuild Agent",
+        "model": ChatEngine.DEFAULT_MODEL,
+        "system_prompt": "You are helpful.",
+        "tools": json.dumps([
+            {"id": f"t{i}", "tool_factory_id": tool_id, "agent_id": "a1"} for i, tool_id in enumerate(tools)
+        ]),
+    }
+    return AgentBase(**(args | kwargs))
+
+@pytest_asyncio.fixture
+async def chatengine(monkeypatch):
+    monkeypatch.setattr(ChatEngine, "_create_llm", fake_create_llm)
+    chatengine = ChatEngine()
+    await chatengine.set_agent(make_agent(), tenant_id="t1", user_id="u1", run_id=str(uuid4()))
+    return chatengine
+
+async def first_token_latency(chatengine: ChatEngine, update: Awaitable) -> float:
+    # Time from saving the agent until it streams its first token. We run the turn to
+    # completion so the engine isn't left 'generating'.
+    async def log_function(events):
+        pass
+
+    async def run_aborted():
+        return False
+
+    start = time.time()
+    latency = None
+    await update
+    async for event in chatengine.respond("hi", log_function, run_aborted, User(user_id="u1", tenant_id="t1")):
+        if isinstance(event, AgentOutputEvent) and latency is None:
+            latency = time.time() - start
+    assert latency is not None, "No output from the agent"
+    return latency
+
+@pytest.mark.asyncio
+async def test_prompt_change_keeps_tools(chatengine):
+    factories = list(chatengine.tool_factories)
+    llm = chatengine.llm
+    await chatengine.update_agent(make_agent(system_prompt="You are terse."))
+    assert chatengine.tool_factories == factories
+    assert chatengine.llm is llm
+    assert chatengine.agent.system_prompt == "You are terse."
+
+@pytest.mark.asyncio
+async def test_tool_change_reuses_factories(chatengine):
+    weather = chatengine.tool_factories[0]
+    await chatengine.update_agent(make_agent(tools=["weather_connector", "csv_connector"]))
+    assert chatengine.tool_factories[0] is weather
+    assert [tf.id for tf in chatengine.tool_factories][:2] == ["weather_connector", "csv_connector"]
+    names = {tool.name for tool in chatengine.agent_executor.tools}
+    assert names == {f.name for f in chatengine.enabled_tool_funcs}
+    assert chatengine.agent_executor.get_llm().kwargs["tools"] == [f.name for f in chatengine.enabled_tool_funcs]
+
+@pytest.mark.asyncio
+async def test_model_change_swaps_llm(chatengine):
+    factories = list(chatengine.tool_factories)
+    executor = chatengine.agent_executor
+    llm = chatengine.llm
+    await chatengine.update_agent(make_agent(temperature=0.5))
+    assert chatengine.tool_factories == factories
+    assert chatengine.agent_executor is executor
+    assert chatengine.llm is not llm
+    assert executor.get_llm() is chatengine.llm
+
+@pytest.mark.asyncio
+async def test_save_to_first_token_benchmark(chatengine):
+    # warm up
+    await first_token_latency(chatengine, chatengine.create_agent())
+    timings = {
+        "prompt": await first_token_latency(
+            chatengine, chatengine.update_agent(make_agent(system_prompt="You are terse."))
+        ),
+        "model": await first_token_latency(
+            chatengine, chatengine.update_agent(make_agent(temperature=0.5))
+        ),
+        "tools": await first_token_latency(
+            chatengine, chatengine.update_agent(make_agent(tools=["weather_connector", "csv_connector"]))
+        ),
+        "full_rebuild": await first_token_latency(chatengine, chatengine.create_agent(force=True)),
+    }
+    print("\nAgent save to first token (ms): ", {k: round(v * 1000, 1) for k, v in timings.items()})
+    assert all(v < 5 for v in timings.values())
+
+class FakeCredential:
+    def __init__(self, secrets: dict):
+        self.secrets = secrets
+
+    def retrieve_secrets(self) -> dict:
+        return dict(self.secrets)
+
+@pytest.mark.asyncio
+async def test_secret_change_rebuilds_credentialed_tools(monkeypatch):
+    monkeypatch.setattr(ChatEngine, "_create_llm", fake_create_llm)
+    credential = FakeCredential({"api_key": "old"})
+    monkeypatch.setattr(ChatEngine, "get_tool_credential", lambda self, tool: credential)
+    agent = make_agent(tools=[])
+    agent.tools = json.dumps([
+        {"id": "t0", "tool_factory_id": "weather_connector", "agent_id": "a1", "credential_id": "cred1"},
+        {"id": "t1", "tool_factory_id": "pandas_tools", "agent_id": "a1"},
+    ])
+    chatengine = ChatEngine()
+    await chatengine.set_agent(agent, tenant_id="t1", user_id="u1", run_id=str(uuid4()))
+    weather, pandas = chatengine.tool_factories[:2]
+    assert weather.credentials == {"api_key": "old"}
+
+    # Nothing changed, so nothing is rebuilt
+    await chatengine.process_pending_agent_updates()
+    assert chatengine.tool_factories[0] is weather
+
+    credential.secrets = {"api_key": "new"}
+    secrets_service.cache.invalidate("t1", "u1", ["cred1:api_key"])
+    await chatengine.process_pending_agent_updates()
+    assert chatengine.tool_factories[0] is not weather
+    assert chatengine.tool_factories[0].credentials == {"api_key": "new"}
+    assert chatengine.tool_factories[1] is pandas
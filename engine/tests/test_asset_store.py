@@ -0,0 +1,109 @@
+import io
+
+import pandas as pd
+import pytest
+
+from supercog.engine import asset_store as asset_module
+from supercog.engine.asset_store import (
+    AssetStore,
+    LocalSpillStore,
+    dataframe_to_parquet,
+    PARQUET_CONTENT_TYPE,
+)
+
+class FakePipeline:
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    def set(self, key, value, ex=None):
+        self.commands.append((key, value, ex))
+
+    async def execute(self):
+        self.redis.round_trips += 1
+        for key, value, ex in self.commands:
+            if isinstance(value, str):
+                value = value.encode()
+            self.redis.values[key] = value
+            self.redis.expires[key] = ex
+
+class FakeRedis:
+    # Just enough of a binary (decode_responses=False) redis client for the asset store
+    def __init__(self):
+        self.values: dict[str, bytes] = {}
+        self.expires: dict[str, int] = {}
+        self.round_trips = 0
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    async def mget(self, keys):
+        self.round_trips += 1
+        return [self.values.get(key) for key in keys]
+
+@pytest.fixture
+def store(tmp_path):
+    redis = FakeRedis()
+    async def get_client():
+        return redis
+    store = AssetStore(spill_store=LocalSpillStore(str(tmp_path)), get_client=get_client)
+    store.redis = redis
+    return store
+
+async def read_asset(store, key) -> tuple[bytes|None, str|None]:
+    content, content_type = await store.get(key)
+    if content is None:
+        return None, None
+    return b"".join([chunk async for chunk in content]), content_type
+
+@pytest.mark.asyncio
+async def test_small_assets_stay_in_redis(store, tmp_path):
+    await store.put("t1/u1/a1", "short text", "text/plain")
+    assert store.redis.round_trips == 1
+    assert store.redis.values["t1/u1/a1"] == b"short text"
+    assert set(store.redis.expires.values()) == {asset_module.ASSET_TTL}
+    assert list(tmp_path.iterdir()) == []
+
+    assert await read_asset(store, "t1/u1/a1") == (b"short text", "text/plain")
+    assert store.redis.round_trips == 2
+    assert await read_asset(store, "t1/u1/missing") == (None, None)
+
+@pytest.mark.asyncio
+async def test_large_assets_spill(store, tmp_path, monkeypatch):
+    monkeypatch.setattr(asset_module, "ASSET_INLINE_MAX_BYTES", 1000)
+    monkeypatch.setattr(asset_module, "READ_CHUNK_SIZE", 1000)
+    content = bytes(range(256)) * 20
+
+    await store.put("t1/u1/big", content, "application/octet-stream")
+    # Redis only has the pointer
+    assert "t1/u1/big" not in store.redis.values
+    assert len(list(tmp_path.iterdir())) == 1
+
+    stream, content_type = await store.get("t1/u1/big")
+    chunks = [chunk async for chunk in stream]
+    assert len(chunks) == 6
+    assert b"".join(chunks) == content
+    assert content_type == "application/octet-stream"
+
+    for path in tmp_path.iterdir():
+        path.unlink()
+    assert await read_asset(store, "t1/u1/big") == (None, None)
+
+@pytest.mark.asyncio
+async def test_dataframes_are_stored_as_parquet(store):
+    df = pd.DataFrame({"name": ["a", "b", "c"], "value": [1.5, 2.5, None], "mixed": [1, "two", 3.0]})
+    await store.put("t1/u1/df", dataframe_to_parquet(df), PARQUET_CONTENT_TYPE)
+
+    content, content_type = await read_asset(store, "t1/u1/df")
+    assert content_type == PARQUET_CONTENT_TYPE
+    result = pd.read_parquet(io.BytesIO(content))
+    assert list(result.columns) == ["name", "value", "mixed"]
+    assert result["name"].tolist() == ["a", "b", "c"]
+    assert result["value"].tolist()[:2] == [1.5, 2.5]
+    assert result["mixed"].tolist() == ["1", "two", "3.0"]
@@ -0,0 +1,193 @@
+import json
+import pytest
+from datetime import datetime, timedelta
+from uuid import uuid4
+
+from sqlalchemy import create_engine
+from sqlalchemy.exc import OperationalError
+from sqlmodel import Session, SQLModel, select
+
+from supercog.shared.apubsub import AgentOutputEvent, TokenUsageEvent
+from supercog.engine.chat_logger import ChatLogger
+from supercog.engine.db import Agent, Run, RunLog, RunLogCompaction
+
+@pytest.fixture
+def chat_logger(tmp_path):
+    logger = ChatLogger()
+    logger.engine = create_engine(f"sqlite:///{tmp_path}/engine.db")
+    SQLModel.metadata.create_all(logger.engine)
+    yield logger
+
+def make_run(chat_logger: ChatLogger) -> Run:
+    with Session(chat_logger.engine) as session:
+        agent = Agent(id="a1", name="agent", tenant_id="t1", user_id="u1")
+        run = Run(tenant_id="t1", user_id="u1", agent_id="a1")
+        session.add(agent)
+        session.add(run)
+        session.commit()
+        session.refresh(run)
+        return run
+
+def log_event(event, run_id: str) -> dict:
+    log = RunLog.from_agent_event(event, run_id=run_id)
+    return log.model_dump()
+
+@pytest.mark.asyncio
+async def test_write_behind_batches(chat_logger: ChatLogger):
+    run = make_run(chat_logger)
+    run_id = str(run.id)
+
+    for i in range(50):
+        event = AgentOutputEvent(agent_id="a1", user_id="u1", run_id=run_id, str_result=f"chunk {i}")
+        await chat_logger.receive_message(event.type, log_event(event, run_id))
+    for _ in range(3):
+        event = TokenUsageEvent(
+            agent_id="a1", user_id="u1", run_id=run_id,
+            usage_metadata={"input_tokens": 10, "output_tokens": 5},
+        )
+        await chat_logger.receive_message(event.type, log_event(event, run_id))
+
+    # Nothing is written until we flush
+    assert chat_logger.stats()["queue_depth"] == 53
+    with Session(chat_logger.engine) as session:
+        assert session.exec(select(RunLog)).all() == []
+
+    history = await chat_logger.retrieve_run_history(run_id)
+    assert len(history) == 53
+    assert chat_logger.stats()["queue_depth"] == 0
+    assert chat_logger.stats()["rows_flushed"] == 53
+
+    with Session(chat_logger.engine) as session:
+        run = session.get(Run, run.id)
+        assert run.input_tokens == 30
+        assert run.output_tokens == 15
+
+@pytest.mark.asyncio
+async def test_flush_on_size_threshold(chat_logger: ChatLogger, monkeypatch):
+    monkeypatch.setattr("supercog.engine.chat_logger.FLUSH_MAX_ROWS", 10)
+    run_id = str(uuid4())
+    for i in range(25):
+        event = AgentOutputEvent(agent_id="a1", user_id="u1", run_id=run_id, str_result=f"chunk {i}")
+        await chat_logger.receive_message(event.type, log_event(event, run_id))
+    assert chat_logger.stats()["rows_flushed"] == 20
+    await chat_logger.stop()
+    assert chat_logger.stats()["rows_flushed"] == 25
+
+def test_compact_output_logs(chat_logger: ChatLogger):
+    run_id = str(uuid4())
+    with Session(chat_logger.engine) as session:
+        for lc_run_id in ["lc1", "lc2", "lc3"]:
+            for i in range(5):
+                event = AgentOutputEvent(
+                    agent_id="a1", user_id="u1", run_id=run_id, lc_run_id=lc_run_id, str_result=f"{i} "
+                )
+                session.add(RunLog.from_agent_event(event))
+            if lc_run_id != "lc2":
+                session.add(RunLog.from_agent_event(
+                    TokenUsageEvent(agent_id="a1", user_id="u1", run_id=run_id, lc_run_id=lc_run_id, usage_metadata={})
+                ))
+        session.commit()
+
+    assert chat_logger.compact_output_logs(run_id) == 12
+    with Session(chat_logger.engine) as session:
+        logs = session.exec(select(RunLog).where(RunLog.run_id == run_id).order_by(RunLog.id)).all()
+        assert [log.type for log in logs] == ["output", "token_usage", "output", "output", "token_usage"]
+        assert json.loads(logs[0].content)["str_result"] == "0 1 2 3 4 "
+        assert json.loads(logs[2].content)["lc_run_id"] == "lc2"
+        assert json.loads(logs[3].content)["lc_run_id"] == "lc3"
+
+def output_log(run_id: str, text: str) -> dict:
+    return log_event(AgentOutputEvent(agent_id="a1", user_id="u1", run_id=run_id, str_result=text), run_id)
+
+@pytest.mark.asyncio
+async def test_bad_rows_are_dead_lettered(chat_logger: ChatLogger, monkeypatch):
+    write_batch = chat_logger._write_batch
+
+    def failing_write_batch(logs, tokens):
+        if any("poison" in log["content"] for log in logs):
+            raise ValueError("bad row")
+        write_batch(logs, tokens)
+    monkeypatch.setattr(chat_logger, "_write_batch", failing_write_batch)
+
+    run_id = str(uuid4())
+    for text in ["one", "poison", "two"]:
+        chat_logger.queue_event(output_log(run_id, text))
+    await chat_logger.flush()
+
+    stats = chat_logger.stats()
+    assert (stats["queue_depth"], stats["rows_flushed"], stats["rows_dead_lettered"]) == (0, 2, 1)
+    assert "poison" in chat_logger.dead_letters[0]["content"]
+    with Session(chat_logger.engine) as session:
+        assert len(session.exec(select(RunLog)).all()) == 2
+
+@pytest.mark.asyncio
+async def test_failing_database_is_retried_then_dead_lettered(chat_logger: ChatLogger, monkeypatch):
+    monkeypatch.setattr("supercog.engine.chat_logger.MAX_FLUSH_ATTEMPTS", 3)
+    def database_down(logs, tokens):
+        raise ConnectionError("database is down")
+    monkeypatch.setattr(chat_logger, "_write_batch", database_down)
+
+    run_id = str(uuid4())
+    chat_logger.queue_event(output_log(run_id, "one"))
+    chat_logger.queue_event(output_log(run_id, "two"))
+    for _ in range(2):
+        with pytest.raises(ConnectionError):
+            await chat_logger.flush()
+        assert chat_logger.stats()["queue_depth"] == 2
+    chat_logger.queue_event(output_log(run_id, "three"))
+
+    with pytest.raises(ConnectionError):
+        await chat_logger.flush()
+    assert chat_logger.stats()["queue_depth"] == 0
+    assert chat_logger.stats()["rows_dead_lettered"] == 3
+
+@pytest.mark.asyncio
+async def test_queue_is_capped_and_subscriber_never_raises(chat_logger: ChatLogger, monkeypatch):
+    monkeypatch.setattr("supercog.engine.chat_logger.MAX_QUEUE_ROWS", 10)
+    monkeypatch.setattr("supercog.engine.chat_logger.FLUSH_MAX_ROWS", 5)
+    def database_down(logs, tokens):
+        raise OperationalError("INSERT", {}, ConnectionError("database is down"))
+    monkeypatch.setattr(chat_logger, "_write_batch", database_down)
+
+    run_id = str(uuid4())
+    for i in range(25):
+        event = AgentOutputEvent(agent_id="a1", user_id="u1", run_id=run_id, str_result=f"chunk {i}")
+        await chat_logger.receive_message(event.type, log_event(event, run_id))
+    stats = chat_logger.stats()
+    assert stats["queue_depth"] == 10
+    assert stats["rows_dropped"] == 15
+    # The newest rows are kept
+    assert "chunk 24" in chat_logger.pending_logs[-1]["content"]
+
+def add_output_logs(chat_logger: ChatLogger, run_id: str, lc_run_id: str|None, count: int, created_at=None):
+    with Session(chat_logger.engine) as session:
+        for i in range(count):
+            event = AgentOutputEvent(agent_id="a1", user_id="u1", run_id=run_id, lc_run_id=lc_run_id, str_result=f"{i} ")
+            log = RunLog.from_agent_event(event)
+            if created_at is not None:
+                log.created_at = created_at
+            session.add(log)
+        session.commit()
+
+def test_compaction_skips_rows_without_lc_run_id(chat_logger: ChatLogger):
+    run_id = str(uuid4())
+    add_output_logs(chat_logger, run_id, None, 3)
+    assert chat_logger.compact_output_logs(run_id) == 0
+
+def test_compact_old_runs_only_revisits_runs_with_new_output(chat_logger: ChatLogger):
+    old = datetime.utcnow() - timedelta(days=30)
+    runs = [str(uuid4()) for _ in range(3)]
+    for run_id in runs:
+        add_output_logs(chat_logger, run_id, "lc1", 4, created_at=old)
+
+    assert chat_logger.compact_old_runs(timedelta(days=7), limit=2) == 6
+    # The first two runs were compacted, so the next call moves on to the third
+    assert chat_logger.compact_old_runs(timedelta(days=7), limit=2) == 3
+    assert chat_logger.compact_old_runs(timedelta(days=7), limit=2) == 0
+
+    # A run that logs more output after it was compacted is compacted again
+    with Session(chat_logger.engine) as session:
+        session.get(RunLogCompaction, runs[0]).compacted_at = old + timedelta(days=1)
+        session.commit()
+    add_output_logs(chat_logger, runs[0], "lc2", 2, created_at=old + timedelta(days=2))
+    assert chat_logger.compact_old_runs(timedelta(days=7)) == 1
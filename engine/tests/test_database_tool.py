@@ -0,0 +1,82 @@
+import time
+
+import pyarrow as pa
+import pytest
+from sqlalchemy import event
+
+from supercog.engine.result_spool import SpooledResult
+from supercog.engine.sql_engines import SQLEngineCache, sql_engines
+from supercog.engine.tables import to_pandas
+from supercog.engine.tools import database_tool
+from supercog.engine.tools.database_tool import DatabaseTool
+
+from .test_helpers import run_context
+
+@pytest.fixture
+def db_url(tmp_path):
+    return f"sqlite:///{tmp_path / 'test.db'}"
+
+@pytest.fixture
+def db_tool(db_url, run_context):
+    tool = DatabaseTool()
+    tool.run_context = run_context
+    tool.inmem_state = {}
+    tool.credentials = {"database_url": db_url}
+    tool.credential_id = "cred1"
+    tool.run_database_query("CREATE TABLE items (id INTEGER PRIMARY KEY, name TEXT)")
+    tool.run_database_query(
+        "INSERT INTO items (name) " +
+        " UNION ALL ".join(f"SELECT 'item{i}'" for i in range(500))
+    )
+    yield tool
+    run_context.close()
+    sql_engines.dispose_all()
+
+def test_queries_share_a_pooled_engine(db_tool, db_url):
+    engine = db_tool.create_engine(db_url)
+    statements = []
+    event.listen(engine, "before_cursor_execute", lambda conn, cursor, sql, *args: statements.append(sql))
+    created = sql_engines.created
+
+    for i in range(5):
+        result = db_tool.run_database_query("SELECT * FROM items WHERE id <= 10")
+        assert result["row_count"] == 10
+    assert sql_engines.created == created
+    assert db_tool.create_engine(db_url) is engine
+    # Each query is executed once
+    assert statements == ["SELECT * FROM items WHERE id <= 10"] * 5
+
+    other = DatabaseTool()
+    other.credential_id = "cred2"
+    assert other.create_engine(db_url) is not engine
+
+def test_large_results_are_spooled(db_tool, monkeypatch):
+    monkeypatch.setattr(database_tool, "FETCH_SIZE", 64)
+    result = db_tool.run_database_query("SELECT * FROM items WHERE id <= 64")
+    assert result["row_count"] == 64
+    assert isinstance(db_tool.inmem_state[result["name"]], pa.Table)
+
+    result = db_tool.run_database_query("SELECT * FROM items")
+    assert result["row_count"] == "64+"
+    assert result["columns"] == ["id", "name"]
+    assert result["preview"][0] == ["1", "item0"]
+    spooled = db_tool.inmem_state[result["name"]]
+    assert isinstance(spooled, SpooledResult)
+    assert spooled.wait(5)
+    assert spooled.num_rows == 500
+    assert spooled.status() == "complete, 500 rows"
+    assert to_pandas(spooled)["name"].tolist() == [f"item{i}" for i in range(500)]
+
+    assert db_tool.run_database_query("UPDATE items SET name = 'x' WHERE id < 4") == \
+        {"status": "Query executed successfully. Rows affected: 3"}
+    assert db_tool.run_database_query("SELECT count(*) AS n FROM items WHERE name = 'x'")["all_rows"] == [["3"]]
+    assert db_tool.run_database_query("SELECT * FROM nope")["status"].startswith("Database error")
+
+def test_idle_engines_are_disposed(db_url):
+    cache = SQLEngineCache(idle_ttl=0.05)
+    engine = cache.get_engine(db_url, "cred1")
+    assert cache.get_engine(db_url, "cred1") is engine
+    time.sleep(0.1)
+    assert cache.dispose_idle() == 1
+    assert cache.get_engine(db_url, "cred1") is not engine
+    assert cache.stats() == {"engines": 1, "created": 2}
@@ -0,0 +1,225 @@
+import asyncio
+import json
+import re
+from contextlib import asynccontextmanager
+
+import asyncpg
+import pytest
+
+from supercog.engine import db_changes
+from supercog.engine.db_changes import CursorStore, TableWatcher, asyncpg_dsn
+
+class FakeConnection:
+    # Enough of an asyncpg connection to watch an 'items' table with an integer primary key
+    def __init__(self, rows: list[dict], can_create_trigger: bool = True):
+        self.rows = rows
+        self.can_create_trigger = can_create_trigger
+        self.listeners = {}
+        self.statements = []
+        self.closed = False
+        self.triggers = set()
+        self.has_function = False
+
+    async def fetchrow(self, sql, *args):
+        if "to_regclass" in sql:
+            return {"oid": 1234, "name": "items"}
+        if "pg_index" in sql:
+            return {"attname": "id", "type": "integer"}
+
+    async def fetchval(self, sql, *args):
+        return max((r["id"] for r in self.rows), default=None)
+
+    async def fetch(self, sql, *args):
+        self.statements.append(sql)
+        after, limit = (args if len(args) == 2 else (None, args[0]))
+        rows = sorted(self.rows, key=lambda r: r["id"])
+        return [r for r in rows if after is None or r["id"] > after][:limit]
+
+    async def execute(self, sql):
+        if not self.can_create_trigger:
+            raise asyncpg.InsufficientPrivilegeError("permission denied for table items")
+        if "CREATE OR REPLACE FUNCTION" in sql:
+            self.has_function = True
+        elif m := re.search(r"CREATE TRIGGER (\w+)", sql):
+            self.triggers.add(m.group(1))
+        elif m := re.search(r"DROP TRIGGER IF EXISTS (\w+)", sql):
+            self.triggers.discard(m.group(1))
+        elif "DROP FUNCTION" in sql:
+            if self.triggers:
+                raise asyncpg.DependentObjectsStillExistError("other objects depend on it")
+            self.has_function = False
+
+    @asynccontextmanager
+    async def transaction(self):
+        yield
+
+    async def add_listener(self, channel, callback):
+        # Watchers share the fake connection, so keep each of their callbacks
+        self.listeners.setdefault(channel, []).append(callback)
+
+    async def close(self):
+        self.closed = True
+
+    def insert(self, *ids):
+        self.rows.extend({"id": i, "name": f"item{i}"} for i in ids)
+        for callback in self.listeners.get("supercog_insert_1234", []):
+            callback(self, 0, "supercog_insert_1234", "")
+
+class FakeRedis:
+    def __init__(self):
+        self.values = {}
+
+    async def get(self, key):
+        return self.values.get(key)
+
+    async def set(self, key, value):
+        self.values[key] = value
+
+    async def rpush(self, key, *values):
+        self.values.setdefault(key, []).extend(values)
+
+    async def ltrim(self, key, start, end):
+        self.values[key] = self.values[key][start:]
+
+@pytest.fixture
+def cursor_store():
+    redis = FakeRedis()
+    async def get_client():
+        return redis
+    return CursorStore(get_client=get_client)
+
+@pytest.fixture(autouse=True)
+def no_debounce(monkeypatch):
+    monkeypatch.setattr(db_changes, "DB_TRIGGER_DEBOUNCE", 0)
+
+class Dispatcher:
+    # Collects the batches, and stops the watcher once 'expected' rows have arrived
+    def __init__(self, expected: int, fail_first: bool = False, fail_ids: set[int] = set()):
+        self.expected = expected
+        self.fail_first = fail_first
+        self.fail_ids = fail_ids
+        self.attempts = 0
+        self.batches = []
+
+    async def on_rows(self, rows):
+        self.attempts += 1
+        if self.fail_first or self.fail_ids & {r["id"] for r in rows}:
+            self.fail_first = False
+            raise RuntimeError("agent service unavailable")
+        self.batches.append([r["id"] for r in rows])
+
+    async def is_running(self):
+        return sum(len(b) for b in self.batches) < self.expected
+
+def make_watcher(conn, dispatcher, cursor_store, cursor_key="agent1:items", **kwargs) -> TableWatcher:
+    kwargs.setdefault("lag_secs", 0)
+    watcher = TableWatcher(
+        "postgresql+psycopg2://u:p@db/test", "items", cursor_key,
+        on_rows=dispatcher.on_rows, is_running=dispatcher.is_running,
+        cursor_store=cursor_store, batch_size=3, poll_interval=0.05, **kwargs,
+    )
+    async def connect():
+        return conn
+    watcher.connect = connect
+    return watcher
+
+async def run_with_inserts(watcher, conn, *ids):
+    task = asyncio.create_task(watcher.run())
+    await asyncio.sleep(0.1)
+    conn.insert(*ids)
+    await asyncio.wait_for(task, timeout=5)
+
+@pytest.mark.asyncio
+async def test_new_rows_are_batched_and_the_cursor_is_kept(cursor_store):
+    conn = FakeConnection([{"id": i, "name": f"item{i}"} for i in range(1, 4)])
+    dispatcher = Dispatcher(expected=5)
+    watcher = make_watcher(conn, dispatcher, cursor_store, listen_interval=60)
+    await run_with_inserts(watcher, conn, 4, 5, 6, 7, 8)
+
+    assert watcher.listening
+    # Existing rows aren't dispatched, new ones are read in batches
+    assert dispatcher.batches == [[4, 5, 6], [7, 8]]
+    assert conn.closed
+    assert await cursor_store.load("agent1:items") == {"mark": "column:id", "position": 8, "recent": []}
+
+    # A new watcher resumes from the saved position
+    conn.insert(9, 10)
+    dispatcher = Dispatcher(expected=3)
+    await run_with_inserts(make_watcher(conn, dispatcher, cursor_store), conn, 11)
+    assert dispatcher.batches == [[9, 10], [11]]
+
+@pytest.mark.asyncio
+async def test_polls_when_the_trigger_cant_be_installed(cursor_store):
+    conn = FakeConnection([], can_create_trigger=False)
+    dispatcher = Dispatcher(expected=2, fail_first=True)
+    watcher = make_watcher(conn, dispatcher, cursor_store)
+    await run_with_inserts(watcher, conn, 1, 2)
+
+    assert not watcher.listening
+    # The failed batch was dispatched again
+    assert dispatcher.batches == [[1, 2]]
+    assert await cursor_store.load("agent1:items") == {"mark": "column:id", "position": 2, "recent": []}
+
+@pytest.mark.asyncio
+async def test_rows_committed_out_of_order_are_dispatched(cursor_store):
+    conn = FakeConnection([{"id": i, "name": f"item{i}"} for i in range(1, 4)])
+    dispatcher = Dispatcher(expected=2)
+    task = asyncio.create_task(make_watcher(conn, dispatcher, cursor_store, lag_secs=60).run())
+    await asyncio.sleep(0.1)
+    conn.insert(5)
+    await asyncio.sleep(0.1)
+    # The transaction that inserted 4 commits after the one that inserted 5
+    conn.insert(4)
+    await asyncio.wait_for(task, timeout=5)
+    assert dispatcher.batches == [[5], [4]]
+
+    # The position stays behind the lag window, and the rows in it aren't dispatched again
+    cursor = await cursor_store.load("agent1:items")
+    assert cursor["position"] == 3
+    assert sorted(p for p, _ in cursor["recent"]) == [4, 5]
+    dispatcher = Dispatcher(expected=1)
+    await run_with_inserts(make_watcher(conn, dispatcher, cursor_store, lag_secs=60), conn, 6)
+    assert dispatcher.batches == [[6]]
+
+@pytest.mark.asyncio
+async def test_failing_batches_are_dead_lettered(cursor_store):
+    conn = FakeConnection([], can_create_trigger=False)
+    dispatcher = Dispatcher(expected=1, fail_ids={1})
+    watcher = make_watcher(conn, dispatcher, cursor_store, max_attempts=3)
+    task = asyncio.create_task(watcher.run())
+    await asyncio.sleep(0.1)
+    conn.insert(1, 2)
+    while dispatcher.attempts < 3:
+        await asyncio.sleep(0.05)
+    conn.insert(3)
+    await asyncio.wait_for(task, timeout=5)
+
+    assert dispatcher.batches == [[3]]
+    assert dispatcher.attempts == 4
+    redis = await cursor_store.get_client()
+    assert [json.loads(row)["id"] for row in redis.values["db_trigger_dead_letter:agent1:items"]] == [1, 2]
+
+@pytest.mark.asyncio
+async def test_stopped_watchers_remove_their_trigger(cursor_store):
+    conn = FakeConnection([])
+    first, second = Dispatcher(expected=1), Dispatcher(expected=2)
+    tasks = [
+        asyncio.create_task(make_watcher(conn, first, cursor_store, cursor_key="agent1:items").run()),
+        asyncio.create_task(make_watcher(conn, second, cursor_store, cursor_key="agent2:items").run()),
+    ]
+    await asyncio.sleep(0.1)
+    assert len(conn.triggers) == 2 and conn.has_function
+
+    conn.insert(1)
+    await asyncio.wait_for(tasks[0], timeout=5)
+    # The other watcher still gets notified
+    assert len(conn.triggers) == 1 and conn.has_function
+
+    conn.insert(2)
+    await asyncio.wait_for(tasks[1], timeout=5)
+    assert second.batches == [[1], [2]]
+    assert conn.triggers == set() and not conn.has_function
+
+def test_asyncpg_dsn():
+    assert asyncpg_dsn("postgresql+psycopg2://u:p@db:5432/test") == "postgresql://u:p@db:5432/test"
+    assert asyncpg_dsn("postgres://u@db/test") == "postgresql://u@db/test"
@@ -0,0 +1,186 @@
+import time
+import uuid
+
+import pytest
+from llama_index.core import Document
+from llama_index.core.node_parser import SentenceSplitter
+from llama_index.core.schema import NodeRelationship, RelatedNodeInfo, TextNode
+from sqlmodel import Session, SQLModel, create_engine, select
+
+from supercog.engine.db import DocIndex, DocSourceConfig, IndexedDoc
+from supercog.engine import doc_sync
+from supercog.engine.doc_sync import DocumentSync, document_key
+from supercog.engine.embeddings import BatchEmbedder
+
+from .test_rag_tool import FakeEmbedder
+
+class FakeVectorStore:
+    def __init__(self, delay: float = 0):
+        self.nodes = {}
+        self.delay = delay
+
+    def add(self, nodes):
+        time.sleep(self.delay)
+        for node in nodes:
+            self.nodes[node.node_id] = node
+        return [node.node_id for node in nodes]
+
+    def delete_nodes(self, node_ids=None):
+        for node_id in node_ids:
+            del self.nodes[node_id]
+
+    def get_nodes(self, filters=None):
+        # Only the IN filters which the sync uses
+        assert filters.condition == "or"
+        return [
+            node for node in self.nodes.values()
+            if any(str(node.metadata.get(f.key)).replace("'", "''") in f.value for f in filters.filters)
+        ]
+
+    def clear(self):
+        self.nodes.clear()
+
+    def texts(self) -> list[str]:
+        return sorted(node.text for node in self.nodes.values())
+
+@pytest.fixture
+def session():
+    engine = create_engine("sqlite://")
+    SQLModel.metadata.create_all(engine, tables=[DocIndex.__table__, DocSourceConfig.__table__, IndexedDoc.__table__])
+    with Session(engine) as session:
+        doc_index = DocIndex(id="index1", name="Docs", tenant_id="t1", user_id="u1")
+        session.add(doc_index)
+        session.commit()
+        yield session
+
+async def documents(*items):
+    for item in items:
+        yield item
+
+def make_sync(session, store, embedder=None) -> DocumentSync:
+    return DocumentSync(
+        session, "index1", "source1", store, [SentenceSplitter(chunk_size=64, chunk_overlap=0)],
+        BatchEmbedder((embedder or FakeEmbedder(delay=0)).aembed_documents),
+    )
+
+async def sync(session, store, embedder, *items):
+    return await make_sync(session, store, embedder).sync(documents(*items))
+
+def page(page_id: str, text: str) -> Document:
+    return Document(text=text, metadata={"page_id": page_id, "file_name": f"Page {page_id}"})
+
+@pytest.mark.asyncio
+async def test_only_changed_documents_are_reindexed(session):
+    store = FakeVectorStore()
+    embedder = FakeEmbedder(delay=0)
+    stats = await sync(session, store, embedder, [page("a", "alpha"), page("b", "beta")], "plain text")
+    assert (stats.added, stats.unchanged, stats.chunks) == (3, 0, 3)
+    assert store.texts() == ["alpha", "beta", "plain text"]
+    rows = session.exec(select(IndexedDoc).order_by(IndexedDoc.doc_id)).all()
+    assert [(row.doc_id, row.name) for row in rows] == [
+        (document_key(Document(text="plain text")), "plain text"),
+        ("page_id:a", "Page a"),
+        ("page_id:b", "Page b"),
+    ]
+    assert all(len(row.chunk_ids) == 1 and row.chunk_ids[0] in store.nodes for row in rows)
+
+    # Nothing changed, so nothing is embedded
+    embedder.batches.clear()
+    stats = await sync(session, store, embedder, [page("a", "alpha"), page("b", "beta")], "plain text")
+    assert (stats.added, stats.updated, stats.unchanged, stats.deleted) == (0, 0, 3, 0)
+    assert embedder.batches == []
+
+    # A changed page replaces its chunks, and documents no longer in the source are removed
+    stats = await sync(session, store, embedder, page("a", "alpha, edited"), page("c", "gamma"))
+    assert (stats.added, stats.updated, stats.unchanged, stats.deleted) == (1, 1, 0, 2)
+    assert [text.split("\n\n")[-1] for batch in embedder.batches for text in batch] == ["alpha, edited", "gamma"]
+    assert store.texts() == ["alpha, edited", "gamma"]
+    assert sorted(row.doc_id for row in session.exec(select(IndexedDoc)).all()) == ["page_id:a", "page_id:c"]
+
+@pytest.mark.asyncio
+async def test_delete_all_removes_the_source(session):
+    store = FakeVectorStore()
+    await sync(session, store, FakeEmbedder(delay=0), page("a", "alpha"))
+    other = DocumentSync(session, "index1", "source2", store, [], BatchEmbedder(FakeEmbedder(delay=0).aembed_documents))
+    await other.sync(documents(page("b", "beta")))
+
+    await DocumentSync(session, "index1", "source1", store, transformations=[]).delete_all()
+    assert store.texts() == ["beta"]
+    assert [row.source_id for row in session.exec(select(IndexedDoc)).all()] == ["source2"]
+
+def legacy_chunk(page_id: str, text: str) -> TextNode:
+    # A chunk indexed before the manifest, pointing to a random document id
+    return TextNode(
+        text=text,
+        metadata={"page_id": page_id},
+        relationships={NodeRelationship.SOURCE: RelatedNodeInfo(node_id=str(uuid.uuid4()))},
+    )
+
+@pytest.mark.asyncio
+async def test_first_sync_replaces_chunks_from_before_the_manifest(session):
+    store = FakeVectorStore()
+    store.add([legacy_chunk("a", "alpha"), legacy_chunk("o'brien", "old text"), legacy_chunk("z", "zeta")])
+
+    await sync(session, store, FakeEmbedder(delay=0), page("a", "alpha"), page("o'brien", "new text"))
+    # Page z wasn't synced, so its chunk is left alone
+    assert store.texts() == ["alpha", "new text", "zeta"]
+    assert all(node.ref_doc_id.startswith("page_id:") for node in store.nodes.values() if node.text != "zeta")
+
+    # Later syncs don't look for older chunks
+    stats = await sync(session, store, FakeEmbedder(delay=0), page("a", "alpha, edited"), page("o'brien", "new text"))
+    assert (stats.updated, stats.unchanged) == (1, 1)
+    assert store.texts() == ["alpha, edited", "new text", "zeta"]
+
+@pytest.mark.asyncio
+async def test_detaching_the_only_source_clears_an_index_without_a_manifest(session):
+    store = FakeVectorStore()
+    store.add([legacy_chunk("a", "alpha")])
+    session.add(DocSourceConfig(id="source1", doc_index_id="index1"))
+    session.add(DocSourceConfig(id="source2", doc_index_id="index1"))
+    session.commit()
+
+    # Another source may have indexed the chunk
+    await DocumentSync(session, "index1", "source1", store, transformations=[]).delete_all()
+    assert store.texts() == ["alpha"]
+
+    session.delete(session.get(DocSourceConfig, "source2"))
+    session.commit()
+    await DocumentSync(session, "index1", "source1", store, transformations=[]).delete_all()
+    assert store.texts() == []
+
+@pytest.mark.asyncio
+async def test_slow_writes_hold_back_the_source(session, monkeypatch):
+    monkeypatch.setattr(doc_sync, "SYNC_BATCH_DOCS", 2)
+    store = FakeVectorStore(delay=0.01)
+    read = 0
+    ahead = 0
+
+    async def source():
+        nonlocal read, ahead
+        for i in range(40):
+            read += 1
+            ahead = max(ahead, read - len(store.nodes))
+            yield page(str(i), f"page {i}")
+
+    stats = await make_sync(session, store).sync(source())
+    assert stats.added == 40
+    assert len(store.nodes) == 40
+    # At most two batches in each queue and one in each stage
+    assert ahead <= 2 * (2 + 2 + 3)
+
+@pytest.mark.asyncio
+async def test_errors_stop_the_sync(session):
+    class FailingStore(FakeVectorStore):
+        def add(self, nodes):
+            raise RuntimeError("vector table is gone")
+
+    read = 0
+    async def source():
+        nonlocal read
+        for i in range(1000):
+            read += 1
+            yield page(str(i), f"page {i}")
+
+    with pytest.raises(RuntimeError, match="vector table is gone"):
+        await make_sync(session, FailingStore()).sync(source())
+    assert read < 1000
@@ -0,0 +1,132 @@
+import asyncio
+import time
+from types import SimpleNamespace
+from uuid import uuid4
+
+import pandas as pd
+import pytest
+
+from supercog.engine.chatengine import ChatEngine
+from supercog.engine.engine_cache import EngineCache
+from supercog.engine.enginemgr import EngineManager
+
+class FakeEngine:
+    def __init__(self, size: int = 1000):
+        self.id = uuid4()
+        self.generating = False
+        self.size = size
+        self.run_context = SimpleNamespace(run_id=str(uuid4()))
+
+    def estimate_memory_size(self) -> int:
+        return self.size
+
+def test_lru_eviction_by_count():
+    cache = EngineCache(max_engines=2, max_bytes=10**9, idle_ttl=3600)
+    evicted = []
+    cache.add_evict_listener(lambda ce: evicted.append(ce.id))
+
+    e1, e2, e3 = FakeEngine(), FakeEngine(), FakeEngine()
+    cache[e1.id] = e1
+    cache[e2.id] = e2
+    assert cache.lookup(e1.id) is e1 # e2 is now least recently used
+    cache[e3.id] = e3
+
+    assert e2.id not in cache
+    assert e1.id in cache and e3.id in cache
+    assert evicted == [e2.id]
+    assert cache.stats()["evictions"] == 1
+
+def test_never_evicts_busy_engines():
+    cache = EngineCache(max_engines=1, max_bytes=10**9, idle_ttl=3600)
+    locked = set()
+    cache.add_busy_check(lambda ce: ce.id in locked)
+
+    e1, e2, e3 = FakeEngine(), FakeEngine(), FakeEngine()
+    e1.generating = True
+    cache[e1.id] = e1
+    cache[e2.id] = e2
+    assert e1.id in cache
+
+    locked.add(e2.id)
+    cache[e3.id] = e3
+    assert len(cache) == 3
+
+    e1.generating = False
+    locked.clear()
+    cache.evict()
+    assert list(cache) == [e3.id]
+
+def test_pinned_engines_are_not_evicted():
+    cache = EngineCache(max_engines=1, max_bytes=10**9, idle_ttl=3600)
+    e1, e2 = FakeEngine(), FakeEngine()
+    cache[e1.id] = e1
+    cache.pin(e1.id)
+    cache.pin(e1.id)
+    cache[e2.id] = e2
+    assert e1.id in cache
+
+    cache.unpin(e1.id)
+    cache.evict(keep=e2.id)
+    assert e1.id in cache
+    cache.unpin(e1.id)
+    cache.evict(keep=e2.id)
+    assert list(cache) == [e2.id]
+    assert cache.stats()["pinned"] == 0
+
+def test_eviction_by_bytes_and_idle():
+    cache = EngineCache(max_engines=10, max_bytes=2500, idle_ttl=3600)
+    e1, e2, e3 = FakeEngine(1000), FakeEngine(1000), FakeEngine(1000)
+    cache[e1.id] = e1
+    cache[e2.id] = e2
+    cache[e3.id] = e3
+    assert e1.id not in cache
+    assert cache.total_bytes() == 2000
+
+    cache.idle_ttl = 0.01
+    time.sleep(0.02)
+    cache.evict()
+    assert len(cache) == 0
+
+def test_hit_miss_counters():
+    cache = EngineCache()
+    e1 = FakeEngine()
+    cache[e1.id] = e1
+    assert cache.lookup(uuid4()) is None
+    assert cache.lookup(None) is None
+    assert cache.lookup(e1.id) is e1
+    stats = cache.stats()
+    assert stats["hits"] == 1
+    assert stats["misses"] == 2
+
+def test_chatengine_memory_estimate():
+    chatengine = ChatEngine()
+    base = chatengine.estimate_memory_size()
+    chatengine.tools_inmem_state["df"] = pd.DataFrame({"a": range(10000)})
+    assert chatengine.estimate_memory_size() > base + 80000
+
+def test_engine_managers_share_the_cache_hooks():
+    listeners = len(EngineManager.RUNNING_ENGINES._on_evict)
+    checks = len(EngineManager.RUNNING_ENGINES._is_busy)
+    EngineManager(["t1"])
+    EngineManager(["t2"])
+    assert len(EngineManager.RUNNING_ENGINES._on_evict) == listeners
+    assert len(EngineManager.RUNNING_ENGINES._is_busy) == checks
+
+class FakeHeartbeatRedis:
+    async def setex(self, key, ttl, value):
+        pass
+
+@pytest.mark.asyncio
+async def test_heartbeat_sweeps_idle_engines():
+    manager = EngineManager(["test"])
+    manager.redis = FakeHeartbeatRedis()
+    manager.heartbeat_interval = 0.01
+    manager.RUNNING_ENGINES = EngineCache(idle_ttl=0.01)
+    e1 = FakeEngine()
+    manager.RUNNING_ENGINES[e1.id] = e1
+
+    heartbeat = asyncio.create_task(manager.send_heartbeat())
+    await asyncio.sleep(0.1)
+    manager.shutdown_event.set()
+    await heartbeat
+    assert len(manager.RUNNING_ENGINES) == 0
@@ -14,7 +14,7 @@ def tool(run_context):
 @pytest.mark.asyncio
 async def test_writing_pdf(tool):
     content = open("../docs/USE_CASES.md").read()
-    res = tool.save_pdf_file("test.pdf", content)
+    res = await tool.save_pdf_file("test.pdf", content)
     print(res)
 
 
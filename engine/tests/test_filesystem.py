@@ -0,0 +1,172 @@
+import asyncio
+import os
+import subprocess
+import time
+
+import pytest
+
+from supercog.engine import filesystem
+from supercog.engine.filesystem import (
+    get_agent_filesystem,
+    unrestricted_filesystem,
+    resolve_agent_path,
+    record_file_write,
+    record_external_writes,
+)
+
+from .test_helpers import run_context
+
+@pytest.fixture
+def system_root(tmp_path, monkeypatch):
+    monkeypatch.setattr(filesystem, "SYSTEM_ROOT_PATH", str(tmp_path))
+    return tmp_path
+
+async def agent_run(tenant_id: str, user_id: str, count: int) -> list[str]:
+    # Writes and reads files with relative paths, yielding to the other agents in between
+    with get_agent_filesystem(tenant_id, user_id):
+        for i in range(count):
+            with open(f"file{i}.txt", "w") as f:
+                f.write(f"{tenant_id}/{user_id} {i}")
+            await asyncio.sleep(0)
+            os.makedirs("reports", exist_ok=True)
+            with open(os.path.join("reports", f"report{i}.txt"), "w") as f:
+                f.write(tenant_id)
+            await asyncio.sleep(0)
+            assert os.getcwd().endswith(os.path.join(tenant_id, user_id))
+            with open(f"file{i}.txt") as f:
+                assert f.read() == f"{tenant_id}/{user_id} {i}"
+            assert os.path.exists(f"file{i}.txt")
+            # Threads started from the run see the same filesystem
+            assert await asyncio.to_thread(os.path.getsize, f"file{i}.txt") > 0
+        return sorted(os.listdir())
+
+@pytest.mark.asyncio
+async def test_concurrent_agents_are_isolated(system_root):
+    cwd = os.getcwd()
+    count = 200
+    start = time.time()
+    results = await asyncio.gather(
+        agent_run("t1", "u1", count),
+        agent_run("t2", "u2", count),
+        agent_run("t1", "u3", count),
+    )
+    print(f"\n{3 * count * 4} interleaved file operations in {time.time() - start:.2f}s")
+
+    expected = sorted([f"file{i}.txt" for i in range(count)] + ["reports", "shared", "uploads"])
+    assert results == [expected] * 3
+    for tenant_id, user_id in [("t1", "u1"), ("t2", "u2"), ("t1", "u3")]:
+        user_dir = system_root / tenant_id / user_id
+        assert (user_dir / "file7.txt").read_text() == f"{tenant_id}/{user_id} 7"
+        assert (user_dir / "reports" / "report7.txt").read_text() == tenant_id
+    # The process working directory is never changed
+    assert os.getcwd() == cwd
+
+def test_access_outside_user_directory(system_root):
+    with get_agent_filesystem("t2", "u2"):
+        with open("secret.txt", "w") as f:
+            f.write("secret")
+    with get_agent_filesystem("t1", "u1"):
+        with open("../shared/notes.txt", "w") as f:
+            f.write("shared")
+        assert open("shared/notes.txt").read() == "shared"
+        assert resolve_agent_path("data.db") == str(system_root / "t1" / "u1" / "data.db")
+        for path in [
+            str(system_root / "t2" / "u2" / "secret.txt"),
+            "../../t2/u2/secret.txt",
+            "shared/../../t2/u2/secret.txt",
+        ]:
+            with pytest.raises(PermissionError):
+                open(path)
+        os.symlink(system_root / "t2" / "u2", system_root / "t1" / "u1" / "escape")
+        with pytest.raises(PermissionError):
+            open("escape/secret.txt")
+
+        with unrestricted_filesystem():
+            assert open(str(system_root / "t2" / "u2" / "secret.txt")).read() == "secret"
+            # Relative paths are still in the user's directory
+            assert os.path.exists("shared/notes.txt")
+
+def test_os_functions_stay_in_the_sandbox(system_root):
+    with get_agent_filesystem("t2", "u2"):
+        with open("secret.txt", "w") as f:
+            f.write("secret")
+    secret = system_root / "t2" / "u2" / "secret.txt"
+    with get_agent_filesystem("t1", "u1"):
+        other = "../../t2/u2"
+        for call in [
+            lambda: os.remove(f"{other}/secret.txt"),
+            lambda: os.rename(f"{other}/secret.txt", "stolen.txt"),
+            lambda: os.rename("mine.txt", f"{other}/planted.txt"),
+            lambda: os.rmdir(other),
+            lambda: os.mkdir(f"{other}/new"),
+            lambda: os.chmod(f"{other}/secret.txt", 0o777),
+            lambda: os.listdir(other),
+            lambda: os.stat(f"{other}/secret.txt"),
+            lambda: os.listdir(path=other),
+        ]:
+            with pytest.raises(PermissionError):
+                call()
+        assert not os.path.exists(f"{other}/secret.txt")
+        # The user's own files and the shared folder still work
+        os.mkdir("reports")
+        assert os.listdir("../shared") == []
+        assert "reports" in os.listdir()
+    assert secret.read_text() == "secret"
+
+def test_directory_swapped_for_a_symlink(system_root):
+    with get_agent_filesystem("t2", "u2"):
+        os.mkdir("reports")
+        with open("reports/secret.txt", "w") as f:
+            f.write("secret")
+    user_dir = system_root / "t1" / "u1"
+    with get_agent_filesystem("t1", "u1"):
+        os.mkdir("reports")
+        with open("reports/secret.txt", "w") as f:
+            f.write("mine")
+        assert open("reports/secret.txt").read() == "mine"
+
+        # A subprocess doesn't go through our patches, so nothing clears the cache
+        subprocess.run(
+            f"rm -rf reports && ln -s {system_root / 't2' / 'u2' / 'reports'} reports",
+            shell=True, cwd=user_dir, check=True,
+        )
+        with pytest.raises(PermissionError):
+            open("reports/secret.txt")
+
+def test_run_context_file_api(system_root, run_context):
+    with run_context.open_file("hello.txt", "w") as f:
+        f.write("hello")
+    assert (system_root / "t1" / "u1" / "hello.txt").read_text() == "hello"
+    assert "hello.txt" in run_context.list_files()
+    with pytest.raises(PermissionError):
+        run_context.resolve_file_path("../../t2/u2/secret.txt")
+
+def test_write_journal(system_root):
+    with get_agent_filesystem("t1", "u1"):
+        with open("old.txt", "w") as f:
+            f.write("from an earlier turn")
+
+    with get_agent_filesystem("t1", "u1") as journal:
+        assert open("old.txt").read() == "from an earlier turn"
+        os.makedirs("out", exist_ok=True)
+        with open("out/a.csv", "w") as f:
+            f.write("a")
+        with open("tmp.txt", "w") as f:
+            f.write("tmp")
+        os.rename("tmp.txt", "out/b.txt")
+        with open("gone.txt", "w") as f:
+            f.write("gone")
+        os.remove("gone.txt")
+        with open("../shared/notes.txt", "w") as f:
+            f.write("shared")
+        record_file_write("native.db")
+        with open("native.db", "wb"):
+            pass
+
+    user_dir = system_root / "t1" / "u1"
+    assert journal.modified_files() == [str(user_dir / "out" / "a.csv"), str(user_dir / "out" / "b.txt"), str(user_dir / "native.db")]
+
+    with get_agent_filesystem("t1", "u1") as journal:
+        record_external_writes()
+    (user_dir / "external.txt").write_text("written by a subprocess")
+    assert journal.modified_files() == [str(user_dir / "external.txt")]
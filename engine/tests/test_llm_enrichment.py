@@ -0,0 +1,184 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pyarrow as pa
+import pytest
+from openai import AsyncOpenAI
+
+from supercog.engine import llm_enrichment, retries
+from supercog.engine.llm_enrichment import ColumnEnricher, EnrichmentCache
+from supercog.engine.tools.duckdb import DuckdbTool
+
+from .test_helpers import run_context
+
+class FakeOpenAIServer(ThreadingHTTPServer):
+    # Answers chat completions with the upper-cased value, after 'delay' seconds.
+    # Values listed in 'rate_limited' get a 429 the first time they are requested.
+    def __init__(self, delay: float = 0.0, rate_limited: set[str] = set()):
+        self.delay = delay
+        self.rate_limited = set(rate_limited)
+        self.requests: list[str] = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+        super().__init__(("127.0.0.1", 0), FakeOpenAIHandler)
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/v1"
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        server: FakeOpenAIServer = self.server
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        value = body["messages"][-1]["content"].split(": ", 1)[1]
+        with server.lock:
+            server.requests.append(value)
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+            limited = value in server.rate_limited
+            server.rate_limited.discard(value)
+        time.sleep(server.delay)
+        with server.lock:
+            server.in_flight -= 1
+
+        if limited:
+            self.reply(429, {"error": {"message": "Rate limit reached", "type": "requests"}})
+        else:
+            self.reply(200, {
+                "id": "chatcmpl-1",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": body["model"],
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": value.upper()},
+                    "finish_reason": "stop",
+                }],
+            })
+
+    def reply(self, status: int, data: dict):
+        content = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def openai_server():
+    server = FakeOpenAIServer(delay=0.05)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+
+class FakePipeline:
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    def set(self, key, value, ex=None):
+        self.commands.append((key, value))
+
+    async def execute(self):
+        self.redis.values.update(self.commands)
+
+class FakeRedis:
+    def __init__(self):
+        self.values: dict[str, str] = {}
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    async def mget(self, keys):
+        return [self.values.get(key) for key in keys]
+
+@pytest.fixture
+def cache():
+    redis = FakeRedis()
+    async def get_client():
+        return redis
+    return EnrichmentCache(get_client=get_client)
+
+def make_enricher(server, cache, prompt="Capitalize", **kwargs) -> ColumnEnricher:
+    client = AsyncOpenAI(api_key="sk-fake", base_url=server.base_url, max_retries=0)
+    return ColumnEnricher(client, prompt, "gpt-test", cache=cache, **kwargs)
+
+@pytest.mark.asyncio
+async def test_enriches_distinct_values_concurrently(openai_server, cache):
+    values = [f"city{i % 50}" for i in range(5000)] + [None] * 10
+    messages = []
+    async def progress(message):
+        messages.append(message)
+
+    enricher = make_enricher(openai_server, cache, concurrency=8, requests_per_minute=60000, progress=progress)
+    results = await enricher.enrich_column(pa.chunked_array([values[:2500], values[2500:]]))
+
+    assert results.to_pylist() == [v.upper() if v else None for v in values]
+    # One request per distinct value, sent concurrently but never more than 8 at a time
+    assert sorted(openai_server.requests) == sorted(f"city{i}" for i in range(50))
+    assert enricher.stats["requests"] == 50
+    assert 1 < openai_server.max_in_flight <= 8
+    assert messages[0] == "Enriching 50 distinct values, 0 from the cache, 50 to request"
+    assert any(m.startswith("Enriched 10 of 50") for m in messages)
+
+    # The same prompt and model are served from the cache
+    openai_server.requests.clear()
+    enricher = make_enricher(openai_server, cache)
+    results = await enricher.enrich_column(pa.array(["city1", "city2", "new city"]))
+    assert results.to_pylist() == ["CITY1", "CITY2", "NEW CITY"]
+    assert openai_server.requests == ["new city"]
+    assert enricher.stats["cached"] == 2
+
+    openai_server.requests.clear()
+    await make_enricher(openai_server, cache, prompt="Shout").enrich_column(pa.array(["city1"]))
+    assert openai_server.requests == ["city1"]
+
+@pytest.mark.asyncio
+async def test_rate_limited_requests_are_retried(openai_server, cache, monkeypatch):
+    monkeypatch.setattr(retries, "RETRY_BASE_DELAY", 0.01)
+    openai_server.rate_limited = {"b", "c"}
+    enricher = make_enricher(openai_server, cache)
+    results = await enricher.enrich_column(pa.array(["a", "b", "c", "b"]))
+    assert results.to_pylist() == ["A", "B", "C", "B"]
+    assert enricher.stats["retries"] == 2
+    assert enricher.stats["failed"] == 0
+
+@pytest.mark.asyncio
+async def test_rate_limiter_spaces_requests(openai_server, cache):
+    start = time.time()
+    await make_enricher(openai_server, cache, requests_per_minute=600).enrich_column(pa.array(["a", "b", "c", "d"]))
+    # Four requests at 10 per second
+    assert time.time() - start >= 0.3
+
+@pytest.mark.asyncio
+async def test_duckdb_tool_enrich_column(openai_server, cache, run_context, monkeypatch):
+    monkeypatch.setenv("OPENAI_BASE_URL", openai_server.base_url)
+    monkeypatch.setattr(llm_enrichment, "EnrichmentCache", lambda: cache)
+    logs = []
+    async def log(self, *msgs, callbacks=None):
+        logs.append("".join(msgs))
+    monkeypatch.setattr(DuckdbTool, "log", log)
+
+    tool = DuckdbTool()
+    tool.run_context = run_context
+    tool.inmem_state = {}
+    preview = tool.get_dataframe_preview(pa.table({"name": ["x", "y", "x", None], "n": [1, 2, 3, 4]}), name_hint="names")
+    result = await tool.llm_enrich_column(preview["name"], "name", "upper", "Capitalize")
+
+    assert result["columns"] == ["name", "n", "upper"]
+    assert result["all_rows"] == [["x", "1", "X"], ["y", "2", "Y"], ["x", "3", "X"], ["None", "4", "None"]]
+    assert sorted(openai_server.requests) == ["x", "y"]
+    assert logs[0].startswith("Enriching 2 distinct values")
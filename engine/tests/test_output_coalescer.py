@@ -0,0 +1,54 @@
+import asyncio
+import pytest
+
+from supercog.shared.apubsub import AgentOutputEvent
+from supercog.engine.output_coalescer import OutputCoalescer
+
+def chunk(text: str, lc_run_id: str = "lc1") -> AgentOutputEvent:
+    return AgentOutputEvent(agent_id="a1", user_id="u1", run_id="r1", lc_run_id=lc_run_id, str_result=text)
+
+@pytest.mark.asyncio
+async def test_coalesce_by_size_and_segment():
+    batches: list[list[AgentOutputEvent]] = []
+
+    async def publish(batch):
+        batches.append(batch)
+
+    coalescer = OutputCoalescer(publish, max_delay=10, max_bytes=10)
+    for _ in range(12):
+        await coalescer.add(chunk("ab"))
+    # 5 chunks reach the size limit
+    assert [len(b) for b in batches] == [5, 5]
+
+    await coalescer.add(chunk("next", lc_run_id="lc2"))
+    assert [len(b) for b in batches] == [5, 5, 2]
+    await coalescer.flush()
+    assert [len(b) for b in batches] == [5, 5, 2, 1]
+    assert batches[-1][0].lc_run_id == "lc2"
+
+@pytest.mark.asyncio
+async def test_coalesce_flushes_on_timer():
+    batches: list[list[AgentOutputEvent]] = []
+
+    async def publish(batch):
+        batches.append(batch)
+
+    coalescer = OutputCoalescer(publish, max_delay=0.02, max_bytes=2048)
+    await coalescer.add(chunk("hello "))
+    await coalescer.add(chunk("world"))
+    assert batches == []
+    await asyncio.sleep(0.05)
+    assert len(batches) == 1
+    merged = AgentOutputEvent.coalese_output_events(batches[0])
+    assert merged[0].str_result == "hello world"
+
+@pytest.mark.asyncio
+async def test_timer_flush_error_is_raised():
+    async def publish(batch):
+        raise RuntimeError("Function aborted by cancel request")
+
+    coalescer = OutputCoalescer(publish, max_delay=0.01, max_bytes=2048)
+    await coalescer.add(chunk("hello"))
+    await asyncio.sleep(0.03)
+    with pytest.raises(RuntimeError):
+        await coalescer.add(chunk("world"))
@@ -0,0 +1,192 @@
+import asyncio
+import csv
+import hashlib
+import json
+from io import StringIO
+from types import SimpleNamespace
+
+import httpx
+import openai
+import pytest
+from langchain_core.documents import Document as LangchainDocument
+
+from supercog.engine import embeddings, retries
+from supercog.engine.embeddings import BatchEmbedder
+from supercog.engine.tools.rag_tool import RAGTool
+
+class FakeEmbedder:
+    # Deterministic embeddings from a hash of the text. Fails with a connection error
+    # for the first 'failures' requests.
+    model = "fake-embedding"
+
+    def __init__(self, dim: int = 4, delay: float = 0.01, failures: int = 0):
+        self.dim = dim
+        self.delay = delay
+        self.failures = failures
+        self.batches: list[list[str]] = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    @staticmethod
+    def vector(text: str, dim: int = 4) -> list[float]:
+        digest = hashlib.sha256(text.encode()).digest()
+        return [b / 255 for b in digest[:dim]]
+
+    async def aembed_documents(self, texts: list[str]) -> list[list[float]]:
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.delay)
+            if self.failures > 0:
+                self.failures -= 1
+                raise openai.APIConnectionError(request=httpx.Request("POST", "https://api.openai.com/v1/embeddings"))
+            self.batches.append(texts)
+            return [self.vector(t, self.dim) for t in texts]
+        finally:
+            self.in_flight -= 1
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, sql, args=None):
+        sql = sql if isinstance(sql, str) else repr(sql)
+        self.conn.statements.append(sql)
+        # The chunk table queries
+        if "SELECT content FROM" in sql:
+            self.results = [(row[0],) for row in self.conn.rows if row[1] == args[0]]
+        elif "DELETE FROM" in sql:
+            self.conn.rows = [row for row in self.conn.rows if row[1] != args[0]]
+        # The embedding cache queries
+        elif "SELECT content_hash" in sql:
+            tenant_id, model, hashes = args
+            cache = self.conn.cache
+            self.results = [(h, cache[(tenant_id, model, h)]) for h in hashes if (tenant_id, model, h) in cache]
+        elif "INSERT INTO tenant_embedding_cache" in sql:
+            tenant_id, model, hashes, vectors = args
+            for h, vector in zip(hashes, vectors):
+                self.conn.cache.setdefault((tenant_id, model, h), json.loads(vector))
+
+    def fetchone(self):
+        return (True,)
+
+    def fetchall(self):
+        return self.results
+
+    def copy_expert(self, sql, file):
+        self.conn.copies.append(file.read())
+        self.conn.rows.extend(csv.reader(StringIO(self.conn.copies[-1])))
+
+class FakeConnection:
+    def __init__(self):
+        self.statements = []
+        self.copies = []
+        self.rows = []
+        self.cache = {}
+        self.commits = 0
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        pass
+
+@pytest.fixture
+def logs(monkeypatch):
+    logs = []
+    async def log(self, *msgs, callbacks=None):
+        logs.append("".join(msgs))
+    monkeypatch.setattr(RAGTool, "log", log)
+    return logs
+
+@pytest.fixture
+def rag_tool(logs):
+    tool = RAGTool()
+    tool.embeddings = FakeEmbedder()
+    tool.conn = FakeConnection()
+    return tool
+
+@pytest.mark.asyncio
+async def test_process_documents_embeds_in_batches(rag_tool, logs, monkeypatch):
+    monkeypatch.setattr(embeddings, "EMBED_BATCH_SIZE", 16)
+    documents = [LangchainDocument(page_content=f"chunk\\t{i}\n\"quoted\"", metadata={}) for i in range(250)]
+
+    result = await rag_tool._process_documents(documents, "doc.pdf")
+
+    assert result == "Added 250 text chunks from doc.pdf to the index."
+    embedder: FakeEmbedder = rag_tool.embeddings
+    assert len(embedder.batches) == 16
+    assert max(len(b) for b in embedder.batches) == 16
+    assert 1 < embedder.max_in_flight <= 4
+    # All rows are written with one COPY and one commit
+    assert len(rag_tool.conn.copies) == 1
+    rows = list(csv.reader(StringIO(rag_tool.conn.copies[0])))
+    assert len(rows) == 250
+    content = rag_tool._clean_text("chunk\\t7\n\"quoted\"")
+    assert rows[7] == [content, "doc.pdf", "7", "[" + ",".join(map(str, FakeEmbedder.vector(content))) + "]"]
+    assert rag_tool.conn.commits >= 1
+    # Progress is logged every 100 chunks, not for each one
+    assert logs == [
+        "Embedding 250 chunks from doc.pdf",
+        "Embedded 112/250 chunks",
+        "Embedded 224/250 chunks",
+        "Used 0 of 250 chunks from the embedding cache (0%)",
+    ]
+
+@pytest.mark.asyncio
+async def test_embeddings_are_cached_across_indexes(rag_tool, logs):
+    documents = [LangchainDocument(page_content=f"chunk {i}", metadata={}) for i in range(10)]
+    await rag_tool._process_documents(documents, "a.txt")
+    embedder: FakeEmbedder = rag_tool.embeddings
+    assert sum(len(b) for b in embedder.batches) == 10
+
+    # The same text in another index isn't embedded again
+    rag_tool.credentials = {"embedding_index_name": "other"}
+    embedder.batches.clear()
+    documents = [LangchainDocument(page_content=f"chunk  {i}\n", metadata={}) for i in range(15)]
+    await rag_tool._process_documents(documents, "b.txt")
+    assert embedder.batches == [[f"chunk {i}" for i in range(10, 15)]]
+    assert logs[-1] == "Used 10 of 15 chunks from the embedding cache (67%)"
+    rows = list(csv.reader(StringIO(rag_tool.conn.copies[-1])))
+    assert rows[3][3] == "[" + ",".join(map(str, FakeEmbedder.vector("chunk 3"))) + "]"
+
+    # Other tenants don't share the cache
+    rag_tool.run_context = SimpleNamespace(tenant_id="t2")
+    embedder.batches.clear()
+    await rag_tool._process_documents(documents, "c.txt")
+    assert sum(len(b) for b in embedder.batches) == 15
+    assert logs[-1] == "Used 0 of 15 chunks from the embedding cache (0%)"
+
+@pytest.mark.asyncio
+async def test_batch_embedder_retries(monkeypatch):
+    monkeypatch.setattr(retries, "RETRY_BASE_DELAY", 0.01)
+    fake = FakeEmbedder(failures=2)
+    embedder = BatchEmbedder(fake.aembed_documents, batch_size=3, concurrency=1)
+    texts = [f"text {i}" for i in range(7)]
+    vectors = await embedder.embed(texts)
+    assert vectors == [FakeEmbedder.vector(t) for t in texts]
+    assert embedder.stats["retries"] == 2
+    assert sorted(len(b) for b in fake.batches) == [1, 3, 3]
+
+@pytest.mark.asyncio
+async def test_unchanged_sources_are_not_added_again(rag_tool):
+    documents = [LangchainDocument(page_content=f"chunk {i}", metadata={}) for i in range(5)]
+    await rag_tool._process_documents(documents, "a.txt")
+    result = await rag_tool._process_documents(documents, "a.txt")
+    assert result == "a.txt is already in the index, unchanged."
+    assert len(rag_tool.conn.copies) == 1
+
+    # A changed source replaces its chunks
+    documents = [LangchainDocument(page_content=f"chunk {i}", metadata={}) for i in range(3)]
+    result = await rag_tool._process_documents(documents, "a.txt")
+    assert result == "Replaced 5 text chunks from a.txt with 3 new ones."
+    assert [row[0] for row in rag_tool.conn.rows] == ["chunk 0", "chunk 1", "chunk 2"]
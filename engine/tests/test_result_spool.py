@@ -0,0 +1,140 @@
+import asyncio
+import os
+import threading
+
+import pyarrow as pa
+import pytest
+
+from supercog.engine import result_spool
+from supercog.engine.result_spool import ResultBudget, SpooledResult, spool_batches
+from supercog.engine.tables import to_pandas, row_count
+from supercog.engine.tools.basic_data import BasicDataTool
+from supercog.engine.tools.snowflake_tool import SnowflakeTool
+
+from .test_helpers import run_context
+
+def make_batches(count: int, size: int = 10, release: threading.Event|None = None):
+    for i in range(count):
+        if i == 2 and release is not None:
+            release.wait(5)
+        yield pa.table({"n": list(range(i * size, (i + 1) * size)), "tag": [f"b{i}"] * size})
+
+@pytest.fixture
+def spool_context(run_context):
+    yield run_context
+    run_context.close()
+
+def test_preview_returns_before_spooling_finishes(spool_context):
+    release = threading.Event()
+    result = spool_batches(make_batches(5, release=release), spool_context.get_spool_path("test"), ResultBudget())
+    assert isinstance(result, SpooledResult)
+    assert not result.done.is_set()
+    assert to_pandas(result, limit=5)["n"].tolist() == [0, 1, 2, 3, 4]
+
+    release.set()
+    assert result.wait(5)
+    assert row_count(result) == 50
+    assert to_pandas(result)["n"].tolist() == list(range(50))
+    assert result.status() == "complete, 50 rows"
+
+    # DuckDB scans the spooled file
+    with spool_context.get_duckdb_session().connection(tables={"spooled": result}) as con:
+        assert con.execute("SELECT count(*), max(n) FROM spooled WHERE tag = 'b4'").fetchall() == [(10, 49)]
+
+    assert os.path.exists(result.path)
+    spool_context.close()
+    assert not os.path.exists(result.path)
+
+def test_single_batch_stays_in_memory(spool_context):
+    result = spool_batches(make_batches(1), spool_context.get_spool_path("test"), ResultBudget())
+    assert isinstance(result, pa.Table)
+    assert result.num_rows == 10
+
+def test_budget_is_shared_by_the_run(spool_context):
+    budget = ResultBudget(max_rows=35)
+    first = spool_batches(make_batches(5), spool_context.get_spool_path("test"), budget)
+    assert first.wait(5)
+    assert first.num_rows == 30
+    assert first.truncated
+    assert first.status() == "truncated at 30 rows by the result size limit"
+
+    second = spool_batches(make_batches(5), spool_context.get_spool_path("test"), budget)
+    assert second.wait(5)
+    assert second.num_rows == 0
+    assert second.truncated
+
+    budget = ResultBudget(max_bytes=pa.table({"n": [0] * 10, "tag": ["b0"] * 10}).nbytes * 2)
+    third = spool_batches(make_batches(5), spool_context.get_spool_path("test"), budget)
+    assert third.wait(5)
+    assert third.num_rows == 20
+
+def test_null_columns_take_later_types(spool_context):
+    def batches():
+        yield pa.table({"n": [1, 2], "note": [None, None]})
+        yield pa.table({"n": [3], "note": ["text"]})
+    result = spool_batches(batches(), spool_context.get_spool_path("test"), ResultBudget())
+    assert to_pandas(result)["note"].tolist() == [None, None, "text"]
+    assert result.error is None
+
+@pytest.mark.asyncio
+async def test_loading_results_dont_block_the_event_loop(spool_context, monkeypatch):
+    monkeypatch.setattr(result_spool, "SPOOL_WAIT_SECS", 0.2)
+    async def log(self, *args, **kwargs):
+        pass
+    monkeypatch.setattr(BasicDataTool, "log", log)
+    release = threading.Event()
+    result = spool_batches(make_batches(5, release=release), spool_context.get_spool_path("test"), ResultBudget())
+    tool = BasicDataTool()
+    tool.run_context = spool_context
+    tool.inmem_state = {"spooled": result}
+    ticks = 0
+
+    async def ticker():
+        nonlocal ticks
+        while True:
+            ticks += 1
+            await asyncio.sleep(0.01)
+
+    ticker_task = asyncio.create_task(ticker())
+    status = await tool.query_dataframe("spooled", "SELECT count(*) AS n FROM spooled")
+    ticker_task.cancel()
+    assert status == {"status": "loading", "message": "spooled is still loading, 20 rows so far. Try again shortly."}
+    # The loop kept running while we waited for the result
+    assert ticks > 1
+    assert tool.load_full_preview_content("spooled").startswith("spooled is still loading")
+
+    release.set()
+    preview = await tool.query_dataframe("spooled", "SELECT count(*) AS n FROM spooled")
+    assert preview["all_rows"] == [["50"]]
+
+class FakeSnowflakeResult:
+    def __init__(self, batches):
+        self.batches = batches
+        self.fetch_threads = set()
+
+    def fetch_arrow_batches(self):
+        for batch in self.batches:
+            self.fetch_threads.add(threading.get_ident())
+            yield batch
+
+class FakeSnowflakeCursor:
+    description = [("N",), ("TAG",)]
+
+@pytest.mark.asyncio
+async def test_snowflake_results_are_spooled(spool_context):
+    tool = SnowflakeTool()
+    tool.run_context = spool_context
+    tool.inmem_state = {}
+    batches = [pa.table({"N": [i], "TAG": [f"b{i}"]}) for i in range(3)]
+    result = FakeSnowflakeResult(batches)
+    preview = await tool.result_as_dataframe(result, FakeSnowflakeCursor())
+    # Batches are fetched off the event loop
+    assert threading.get_ident() not in result.fetch_threads
+    assert preview["columns"] == ["n", "tag"]
+    assert preview["row_count"] == "1+"
+    spooled = tool.inmem_state[preview["name"]]
+    assert to_pandas(spooled)["tag"].tolist() == ["b0", "b1", "b2"]
+
+    preview = await tool.result_as_dataframe(FakeSnowflakeResult([]), FakeSnowflakeCursor())
+    assert preview["columns"] == ["n", "tag"]
+    assert preview["row_count"] == 0
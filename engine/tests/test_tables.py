@@ -0,0 +1,154 @@
+import time
+
+import duckdb
+import pandas as pd
+import pyarrow as pa
+import pytest
+
+from supercog.engine import tables
+from supercog.engine.tools import duckdb as duckdb_module
+from supercog.engine.duckdb_session import DUCKDB_THREADS
+from supercog.engine.tools.duckdb import DuckdbTool
+from supercog.engine.tools.basic_data import BasicDataTool
+from supercog.engine.tools.pandas_tool import PandasTool
+from supercog.engine.filesystem import get_agent_filesystem
+from supercog.engine import filesystem
+
+from .test_helpers import run_context
+
+@pytest.fixture
+def duckdb_tool(tmp_path, monkeypatch, run_context):
+    monkeypatch.setattr(filesystem, "SYSTEM_ROOT_PATH", str(tmp_path))
+    async def log(self, *args, **kwargs):
+        pass
+    monkeypatch.setattr(DuckdbTool, "log", log)
+    tool = DuckdbTool()
+    tool.run_context = run_context
+    tool.inmem_state = {}
+    tool.credentials = {}
+    with get_agent_filesystem("t1", "u1"):
+        with open("sales.csv", "w") as f:
+            f.write("Region Name,Units\n")
+            for i in range(100):
+                f.write(f"r{i % 4},{i}\n")
+        yield tool
+    run_context.close()
+
+@pytest.mark.asyncio
+async def test_tables_stay_in_arrow_between_tools(duckdb_tool):
+    preview = duckdb_tool.read_file_as_dataframe("sales.csv")
+    assert preview["columns"] == ["region_name", "units"]
+    assert preview["row_count"] == 100
+    assert preview["preview"] == [["r0", "0"], ["r1", "1"], ["r2", "2"], ["r3", "3"], ["r0", "4"]]
+    assert isinstance(duckdb_tool.inmem_state[preview["name"]], pa.Table)
+
+    result = await duckdb_tool.query_dataframe(
+        preview["name"],
+        f"SELECT region_name, sum(units) AS total FROM {preview['name']} GROUP BY 1 ORDER BY 1",
+        result_name="totals",
+    )
+    assert result["all_rows"] == [["r0", "1200"], ["r1", "1225"], ["r2", "1250"], ["r3", "1275"]]
+    assert isinstance(duckdb_tool.inmem_state[result["name"]], pa.Table)
+    # Tables are registered with a connection, not stuffed into module globals
+    assert preview["name"] not in vars(duckdb_module)
+
+    # Other tools share the same state
+    basic = BasicDataTool()
+    basic.run_context = duckdb_tool.run_context
+    basic.inmem_state = duckdb_tool.inmem_state
+    full = basic.load_full_preview_content(result["name"])
+    assert full.splitlines()[0] == "region_name,total"
+
+def test_pandas_parquet_files_stay_in_the_sandbox(duckdb_tool, tmp_path):
+    pandas_tool = PandasTool()
+    pandas_tool.run_context = duckdb_tool.run_context
+    pandas_tool.inmem_state = duckdb_tool.inmem_state
+    preview = pandas_tool.read_file_as_dataframe("sales.csv")
+    assert pandas_tool.write_dataframe_to_file(preview["name"], "sales.parquet") == {"status": "success"}
+    assert (tmp_path / "t1" / "u1" / "sales.parquet").exists()
+    assert pandas_tool.read_file_as_dataframe("sales.parquet")["row_count"] == 100
+    with pytest.raises(PermissionError):
+        pandas_tool.write_dataframe_to_file(preview["name"], "../../t2/u2/sales.parquet")
+
+@pytest.mark.asyncio
+async def test_dataframe_changes_are_kept(duckdb_tool):
+    preview = duckdb_tool.read_file_as_dataframe("sales.csv")
+    duckdb_tool.add_column_to_dataframe(preview["name"], "flag", ["x"])
+    assert isinstance(duckdb_tool.inmem_state[preview["name"]], pd.DataFrame)
+
+    result = await duckdb_tool.query_dataframe(
+        preview["name"], f"SELECT DISTINCT flag FROM {preview['name']}"
+    )
+    assert result["all_rows"] == [["x"]]
+
+def test_preview_matches_pandas_and_only_converts_preview_rows(monkeypatch):
+    df = pd.DataFrame({"a": range(1000), "b": [1.5, None] * 500, "c": ["x"] * 1000})
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    assert tables.preview_rows(table, 5) == df.head(5).astype(str).values.tolist()
+
+    converted = []
+    to_pandas = tables.to_pandas
+    def spy(table, limit=None):
+        df = to_pandas(table, limit)
+        converted.append(len(df))
+        return df
+    monkeypatch.setattr(tables, "to_pandas", spy)
+    tables.preview_rows(table, 5)
+    assert converted == [5]
+
+@pytest.mark.asyncio
+async def test_run_reuses_duckdb_session(duckdb_tool, tmp_path):
+    preview = duckdb_tool.read_file_as_dataframe("sales.csv")
+    name = preview["name"]
+    duckdb_tool.save_duckdb_table(name, "sales")
+    assert duckdb_tool.load_duckdb_table("sales")["row_count"] == 100
+    assert duckdb_tool.query_duckdb_tables("SELECT count(*) AS n FROM sales")["all_rows"] == [["100"]]
+    for i in range(3):
+        await duckdb_tool.query_dataframe(name, f"SELECT count(*) FROM {name} WHERE units > {i}")
+
+    session = duckdb_tool.run_context.get_duckdb_session()
+    # One connection to the database file and one in-memory connection for the whole run
+    assert session.connects == 2
+    assert session.views[":memory:"][name] is duckdb_tool.inmem_state[name]
+    with session.connection() as con:
+        assert con.execute("SELECT current_setting('threads')").fetchone()[0] == DUCKDB_THREADS
+
+    # Changes are checkpointed to the file while the session is open
+    db_file = str(tmp_path / "t1" / "u1" / "duckdb.db")
+    assert duckdb.connect(db_file).execute("SELECT count(*) FROM sales").fetchone()[0] == 100
+
+    # The end of the turn closes the file, but keeps the in-memory tables
+    duckdb_tool.run_context.close_duckdb_files()
+    assert list(session.connections) == [":memory:"]
+    assert session.views[":memory:"][name] is duckdb_tool.inmem_state[name]
+    assert duckdb_tool.load_duckdb_table("sales")["row_count"] == 100
+    assert session.connects == 3
+
+    duckdb_tool.run_context.close()
+    assert session.connections == {}
+    assert duckdb_tool.list_duckdb_tables().count("sales") == 1
+
+@pytest.mark.asyncio
+async def test_duckdb_session_benchmark(duckdb_tool):
+    preview = duckdb_tool.read_file_as_dataframe("sales.csv")
+    table = duckdb_tool.inmem_state[preview["name"]]
+    query = "SELECT region_name, sum(units) FROM sales GROUP BY 1"
+    runs = 200
+
+    start = time.time()
+    for i in range(runs):
+        con = duckdb.connect()
+        con.register("sales", table)
+        con.sql(query).fetch_arrow_table()
+        con.close()
+    connect_secs = time.time() - start
+
+    session = duckdb_tool.run_context.get_duckdb_session()
+    start = time.time()
+    for i in range(runs):
+        with session.connection(tables={"sales": table}) as con:
+            con.sql(query).fetch_arrow_table()
+    session_secs = time.time() - start
+
+    print(f"\n{runs} queries: connect per query {connect_secs:.2f}s, run session {session_secs:.2f}s")
+    assert session_secs < connect_secs
@@ -0,0 +1,98 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+from supercog.engine import all_tools
+from supercog.engine.all_tools import (
+    MANIFEST_PATH,
+    FACTORY_MAP,
+    LazyToolFactory,
+    ToolFactoryMap,
+    build_manifest,
+    tool_factory_info,
+)
+from supercog.engine.tools.weather_tool import WeatherTool
+
+def load_manifest_file() -> list[dict]:
+    with open(MANIFEST_PATH) as f:
+        return json.load(f)
+
+def test_manifest_is_current():
+    # If this fails, regenerate the manifest with: python -m supercog.engine.all_tools
+    def summary(manifest):
+        return {
+            (info["module"], info["class_name"]): (
+                info["id"], 
+                info["system_name"], 
+                info["category"], 
+                info["auth_config"],
+                info["help"],
+                info["logo_url"],
+                [f["name"] for f in info["agent_functions"]],
+            )
+            for info in manifest
+        }
+    assert summary(load_manifest_file()) == summary(build_manifest())
+
+def test_factory_map_loads_on_demand():
+    factories = ToolFactoryMap(load_manifest_file())
+    assert "weather_connector" in factories
+    assert not factories.is_loaded("weather_connector")
+
+    weather = factories["weather_connector"]
+    assert isinstance(weather, WeatherTool)
+    assert factories.is_loaded("weather_connector")
+    assert factories["weather_connector"] is weather
+    assert factories.get("no_such_tool") is None
+
+def test_lazy_factory_reads_manifest():
+    info = next(i for i in load_manifest_file() if i["id"] == "weather_connector")
+    lazy = LazyToolFactory(info)
+    assert lazy.system_name == info["system_name"]
+    assert not isinstance(lazy, WeatherTool)
+    assert isinstance(lazy.factory_class()(), WeatherTool)
+    assert "module" not in tool_factory_info(lazy)
+    assert [f["name"] for f in tool_factory_info(lazy)["agent_functions"]] == \
+        [f["name"] for f in tool_factory_info(FACTORY_MAP["weather_connector"])["agent_functions"]]
+@pytest.mark.asyncio
+async def test_listing_tool_factories_doesnt_load_them(monkeypatch):
+    from supercog.engine import main
+
+    # Start from a cold map, other tests have loaded some of the factories
+    manifest = load_manifest_file()
+    factories = ToolFactoryMap(manifest)
+    lazy = [LazyToolFactory(info) for info in manifest]
+    monkeypatch.setattr(all_tools, "FACTORY_MAP", factories)
+    monkeypatch.setattr(main, "TOOL_FACTORIES", lazy)
+    monkeypatch.setattr(main.TOOL_REGISTRY, "load_registry_from_filesystem", lambda tenant_id=None: None)
+
+    listed = await main.get_tools(tenant_id="t1", user=None)
+    assert [info["id"] for info in listed] == [info["id"] for info in manifest]
+    assert not any(isinstance(tf, WeatherTool) for tf in lazy)
+    assert not any(factories.is_loaded(info["id"]) for info in manifest)
+
+STARTUP_SCRIPT = """
+import re, sys, time
+start = time.time()
+import supercog.engine.all_tools
+rss = re.search(r"VmRSS:\s+(\d+)", open("/proc/self/status").read()).group(1)
+print(time.time() - start, rss, "playwright" in sys.modules)
+"""
+
+def measure_startup(lazy: bool) -> tuple[float, int, bool]:
+    env = os.environ | {"LAZY_TOOL_FACTORIES": "1" if lazy else "0"}
+    result = subprocess.run(
+        [sys.executable, "-c", STARTUP_SCRIPT], env=env, capture_output=True, text=True, check=True
+    )
+    secs, rss, playwright = result.stdout.strip().splitlines()[-1].split()
+    return float(secs), int(rss), playwright == "True"
+
+def test_startup_benchmark():
+    eager_secs, eager_rss, eager_playwright = measure_startup(lazy=False)
+    lazy_secs, lazy_rss, lazy_playwright = measure_startup(lazy=True)
+    print(f"\nImport all_tools: eager {eager_secs:.2f}s {eager_rss // 1024}MB, lazy {lazy_secs:.2f}s {lazy_rss // 1024}MB")
+    assert eager_playwright and not lazy_playwright
+    assert lazy_rss < eager_rss
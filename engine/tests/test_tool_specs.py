@@ -0,0 +1,73 @@
+import time
+from types import SimpleNamespace
+from typing import Callable
+from uuid import uuid4
+
+import pytest
+
+from supercog.engine.all_tools import FACTORY_MAP
+from supercog.engine.tool_factory import TOOL_SPECS, ToolFactory
+from supercog.engine.tools.weather_tool import WeatherTool
+
+class FailingTool(ToolFactory):
+    def __init__(self):
+        super().__init__(id="failing_tool", system_name="Failing", auth_config={})
+
+    def get_tools(self) -> list[Callable]:
+        return self.wrap_tool_functions([self.explode])
+
+    async def explode(self, reason: str) -> str:
+        """ Always raises an error with the given reason. """
+        raise RuntimeError(reason)
+
+def test_wrappers_reuse_cached_spec():
+    first = WeatherTool()._get_full_agent_tools()
+    second_factory = WeatherTool()
+    second = second_factory._get_full_agent_tools()
+
+    assert [t.name for t in first] == [t.name for t in second]
+    for t1, t2 in zip(first, second):
+        assert t1.args_schema is t2.args_schema
+        assert t1.description == t2.description
+        assert (type(second_factory), t2.name) in TOOL_SPECS
+        # But each wrapper is bound to its own factory instance
+        bound = t2.coroutine or t2.func
+        assert "callbacks" in bound.__signature__.parameters
+        assert bound.func.__wrapped__.__self__ is second_factory
+
+@pytest.mark.asyncio
+async def test_cached_wrapper_sets_lc_run_id():
+    first = FailingTool().get_tools()[0]
+    factory = FailingTool()
+    tool = factory.get_tools()[0]
+    # The second build comes from the cached spec, bound to the new factory
+    assert (FailingTool, "explode") in TOOL_SPECS
+    assert tool.args_schema is first.args_schema
+    assert tool.coroutine is not first.coroutine
+    assert tool.coroutine.__signature__.parameters["callbacks"].default is None
+
+    # Errors come back as strings, and the lc_run_id is taken from the callbacks
+    run_id = uuid4()
+    result = await tool.coroutine(reason="boom", callbacks=SimpleNamespace(parent_run_id=run_id))
+    assert result.startswith("Error: boom")
+    assert factory.lc_run_id == str(run_id)
+
+def test_build_all_factories_benchmark():
+    factories = [f for f in FACTORY_MAP.values() if not f.id.startswith(("dynamic", "auto_dynamic"))]
+    # Other tests may have already built some tools, so start cold
+    TOOL_SPECS.clear()
+    timings = []
+    spec_counts = []
+    for _ in range(3):
+        start = time.time()
+        for factory in factories:
+            try:
+                factory.__class__()._get_full_agent_tools()
+            except Exception:
+                pass
+        timings.append(time.time() - start)
+        spec_counts.append(len(TOOL_SPECS))
+    print(f"\nBuilding {len(factories)} tool factories (ms): ", [round(t * 1000, 1) for t in timings])
+    # The first pass cached every spec, so later passes only bind wrappers
+    assert spec_counts[0] > 0
+    assert spec_counts == [spec_counts[0]] * 3
@@ -31,7 +31,7 @@ def test_basic_tool_factory(run_context: RunContext):
     for x in range(3):
         tool = random.choice(TOOL_FACTORIES)
         print(tool)
-        tool_fact = tool.__class__()
+        tool_fact = tool.factory_class()()
         tool_fact.run_context = run_context
         print(tool.get_tools())
         print("------------------\n")
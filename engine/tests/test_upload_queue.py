@@ -0,0 +1,124 @@
+import asyncio
+import threading
+import time
+
+import pytest
+from botocore.exceptions import ClientError
+
+from supercog.engine import upload_queue as upload_module
+from supercog.engine.upload_queue import UploadQueue
+
+class FakeS3:
+    # Minimal in-memory stand-in for the boto3 S3 client
+    def __init__(self, delay: float = 0.0, fail: bool = False):
+        self.objects: dict[tuple[str, str], dict] = {}
+        self.delay = delay
+        self.fail = fail
+        self.upload_count = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+    def upload_file(self, file_name, bucket, key, ExtraArgs=None, Callback=None, Config=None):
+        if self.fail:
+            raise ClientError({"Error": {"Code": "500", "Message": "S3 is down"}}, "PutObject")
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(self.delay)
+        with self.lock:
+            self.in_flight -= 1
+        with open(file_name, "rb") as f:
+            data = f.read()
+        # Report progress in chunks, like a multipart upload
+        chunk = Config.multipart_chunksize if Config else len(data)
+        if Callback:
+            for start in range(0, len(data), chunk):
+                Callback(len(data[start:start + chunk]))
+        self.objects[(bucket, key)] = {"Body": data, "Metadata": (ExtraArgs or {}).get("Metadata", {})}
+        self.upload_count += 1
+
+    def head_object(self, Bucket, Key):
+        if (Bucket, Key) not in self.objects:
+            raise ClientError({"Error": {"Code": "404", "Message": "Not Found"}}, "HeadObject")
+        return {"Metadata": self.objects[(Bucket, Key)]["Metadata"]}
+
+    def get_bucket_location(self, Bucket):
+        return {"LocationConstraint": None}
+
+def make_queue(s3: FakeS3, concurrency: int = 4) -> UploadQueue:
+    return UploadQueue(concurrency=concurrency, client_factory=lambda service: s3)
+
+def write_files(tmp_path, count: int, size: int = 100) -> list[str]:
+    paths = []
+    for i in range(count):
+        path = tmp_path / f"file{i}.csv"
+        path.write_bytes(bytes([i]) * size)
+        paths.append(str(path))
+    return paths
+
+@pytest.mark.asyncio
+async def test_uploads_run_in_parallel_off_the_event_loop(tmp_path):
+    s3 = FakeS3(delay=0.05)
+    queue = make_queue(s3, concurrency=4)
+    loop_thread = threading.get_ident()
+    upload_threads = set()
+    upload_file = s3.upload_file
+
+    def tracking_upload_file(*args, **kwargs):
+        upload_threads.add(threading.get_ident())
+        return upload_file(*args, **kwargs)
+
+    s3.upload_file = tracking_upload_file
+    for path in write_files(tmp_path, 8):
+        queue.submit(path, "bucket", f"t1/u1/{path.split('/')[-1]}", "text/csv")
+    await queue.drain()
+
+    assert s3.upload_count == 8
+    # The uploads overlap, but never more than the queue's concurrency
+    assert 1 < s3.max_in_flight <= 4
+    assert loop_thread not in upload_threads
+
+@pytest.mark.asyncio
+async def test_unchanged_files_are_skipped(tmp_path):
+    s3 = FakeS3()
+    path = write_files(tmp_path, 1)[0]
+    statuses = []
+
+    async def callback(status, **fields):
+        statuses.append(status)
+
+    queue = make_queue(s3)
+    url = await queue.upload(path, "bucket", "t1/u1/file0.csv", callback=callback)
+    assert url.endswith("bucket/t1/u1/file0.csv") or url.endswith("bucket.s3.amazonaws.com/t1/u1/file0.csv")
+    await queue.upload(path, "bucket", "t1/u1/file0.csv", callback=callback)
+    # A new process only knows the hash from the object metadata
+    await make_queue(s3).upload(path, "bucket", "t1/u1/file0.csv", callback=callback)
+    with open(path, "ab") as f:
+        f.write(b"more")
+    await queue.upload(path, "bucket", "t1/u1/file0.csv", callback=callback)
+
+    assert statuses == ["uploaded", "skipped", "skipped", "uploaded"]
+    assert s3.upload_count == 2
+
+@pytest.mark.asyncio
+async def test_progress_and_failure_events(tmp_path, monkeypatch):
+    monkeypatch.setattr(upload_module, "MULTIPART_THRESHOLD", 1000)
+    queue = make_queue(FakeS3())
+    queue.transfer_config.multipart_chunksize = 1000
+    path = write_files(tmp_path, 1, size=8000)[0]
+    events = []
+
+    async def callback(status, **fields):
+        events.append((status, fields["bytes_uploaded"], fields["total_bytes"]))
+
+    await queue.upload(path, "bucket", "big.csv", callback=callback)
+    assert events[0] == ("uploading", 0, 8000)
+    assert ("uploading", 2000, 8000) in events
+    assert events[-1] == ("uploaded", 8000, 8000)
+
+    events.clear()
+    failing = make_queue(FakeS3(fail=True))
+    assert await failing.upload(path, "bucket", "big.csv", callback=callback) is None
+    assert events[-1][0] == "failed"
+    assert failing.stats["failed"] == 1
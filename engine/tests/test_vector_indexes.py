@@ -0,0 +1,67 @@
+import time
+
+import pytest
+import pytest_asyncio
+from llama_index.core import StorageContext, VectorStoreIndex
+from llama_index.vector_stores.postgres import PGVectorStore
+
+from supercog.engine.vector_indexes import HNSW_KWARGS, VectorIndexCache, make_index_name
+
+# Engines connect lazily, so none of this needs a database
+DB_URL = "postgresql://user:pw@localhost:5432/rag"
+
+@pytest_asyncio.fixture
+async def cache():
+    cache = VectorIndexCache(DB_URL, max_size=2)
+    yield cache
+    await cache.close()
+
+@pytest.mark.asyncio
+async def test_handles_are_reused_and_evicted(cache):
+    first = cache.get("index-1")
+    assert first.vector_store.table_name == "idx_index_1"
+    assert cache.get("index-1") is first
+    cache.get("index-2")
+    cache.get("index-1") # index-2 is now least recently used
+    cache.get("index-3")
+    assert "index-2" not in cache
+    assert "index-1" in cache and "index-3" in cache
+    assert cache.stats() == {"indexes": 2, "hits": 2, "misses": 3}
+
+@pytest.mark.asyncio
+async def test_stores_share_the_pooled_engines(cache):
+    stores = [cache.get(f"index-{i}").vector_store for i in range(2)]
+    for store in stores:
+        store._connect()
+        assert store._engine is cache.engine
+        assert store._async_engine is cache.async_engine
+    assert cache.engine.pool.size() > 1
+
+def per_request_index(index_id: str) -> VectorStoreIndex:
+    # What the query endpoint did before the cache
+    store = PGVectorStore.from_params(
+        database="rag", host="localhost", password="pw", port="5432", user="user",
+        table_name=make_index_name(index_id), hybrid_search=True, embed_dim=1536,
+        hnsw_kwargs=dict(HNSW_KWARGS),
+    )
+    store._connect()
+    storage_context = StorageContext.from_defaults(vector_store=store)
+    return VectorStoreIndex.from_vector_store(store, storage_context=storage_context)
+
+@pytest.mark.asyncio
+async def test_repeated_query_setup_benchmark(cache):
+    # Only measures building the handles. With a database, each uncached store also
+    # opens new connections and runs its table and index setup statements.
+    runs = 50
+    start = time.perf_counter()
+    for i in range(runs):
+        per_request_index("hot-index")
+    uncached_secs = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for i in range(runs):
+        cache.get("hot-index").index
+    cached_secs = time.perf_counter() - start
+
+    print(f"\n{runs} queries: index per request {uncached_secs * 1000:.1f}ms, cached {cached_secs * 1000:.1f}ms")
+    assert cached_secs < uncached_secs
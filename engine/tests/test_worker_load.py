@@ -0,0 +1,138 @@
+import asyncio
+import json
+import time
+from collections import deque
+
+import pytest
+
+from supercog.engine.enginemgr import EngineManager, AgentTask
+
+# Load test for the EngineManager worker loop. We feed N synthetic tasks through a fake
+# Redis stream, and each task "runs the agent" against a fake LLM that streams tokens
+# with some latency. Reports throughput and verifies per-run ordering.
+
+NUM_TASKS = 200
+NUM_RUNS = 50
+FAKE_TOKENS = 10
+FAKE_TOKEN_LATENCY = 0.01
+
+
+class FakeStreamRedis:
+    def __init__(self, tasks: list[dict]):
+        self.pending = deque(
+            (f"{i}-0", {"task": json.dumps(task)}) for i, task in enumerate(tasks)
+        )
+        self.acked: list[str] = []
+        self.closed = False
+
+    async def xreadgroup(self, group, consumer, streams, count=1, block=None):
+        if not self.pending:
+            await asyncio.sleep(0.05)
+            return []
+        batch = [self.pending.popleft() for _ in range(min(count, len(self.pending)))]
+        return [(list(streams.keys())[0], batch)]
+
+    async def xack(self, stream, group, task_id):
+        if self.closed:
+            raise ConnectionError("Connection closed by server.")
+        self.acked.append(task_id)
+
+    async def setex(self, key, ttl, value):
+        pass
+
+    async def delete(self, key):
+        pass
+
+    async def close(self):
+        self.closed = True
+
+
+class FakeLLMEngineManager(EngineManager):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.completed: list[tuple[str, int]] = []
+        self.active_runs: set[str] = set()
+        self.overlapping_runs: set[str] = set()
+
+    async def _process_task(self, task_data, synchronous=True):
+        task = AgentTask.model_validate(task_data)
+        run_id = task.run["id"]
+        if run_id in self.active_runs:
+            self.overlapping_runs.add(run_id)
+        self.active_runs.add(run_id)
+        # Our fake LLM just streams some tokens
+        for _ in range(FAKE_TOKENS):
+            await asyncio.sleep(FAKE_TOKEN_LATENCY)
+        self.active_runs.discard(run_id)
+        self.completed.append((run_id, task.run_input["seq"]))
+
+
+def make_tasks(num_tasks: int) -> list[dict]:
+    return [
+        AgentTask(
+            action=AgentTask.ACTION_PROMPT,
+            user={"user_id": "u1", "tenant_id": "test"},
+            run={"id": f"run{i % NUM_RUNS}", "agent_id": "a1"},
+            run_input={"input": f"prompt {i}", "seq": i},
+            headers={},
+            query_params={},
+        ).model_dump()
+        for i in range(num_tasks)
+    ]
+
+async def run_worker(concurrency: int, num_tasks: int) -> tuple[FakeLLMEngineManager, float]:
+    manager = FakeLLMEngineManager(["test"], max_concurrency=concurrency)
+    manager.redis = FakeStreamRedis(make_tasks(num_tasks))
+
+    async def stop_when_done():
+        while len(manager.redis.acked) < num_tasks:
+            await asyncio.sleep(0.01)
+        manager.shutdown()
+
+    start = time.time()
+    await asyncio.gather(manager.process_tasks_until_canceled(), stop_when_done())
+    return manager, time.time() - start
+
+@pytest.mark.asyncio
+async def test_worker_throughput():
+    manager, elapsed = await run_worker(concurrency=50, num_tasks=NUM_TASKS)
+    print(f"Processed {NUM_TASKS} tasks in {elapsed:.2f}s: {NUM_TASKS / elapsed:.1f} tasks/sec")
+
+    assert len(manager.redis.acked) == NUM_TASKS
+    assert not manager.overlapping_runs
+    assert not manager.inflight_tasks
+    assert not manager.run_task_locks
+
+    # Prompts for the same run must complete in the order they were queued
+    by_run: dict[str, list[int]] = {}
+    for run_id, seq in manager.completed:
+        by_run.setdefault(run_id, []).append(seq)
+    for seqs in by_run.values():
+        assert seqs == sorted(seqs)
+
+    serial_time = NUM_TASKS * FAKE_TOKENS * FAKE_TOKEN_LATENCY
+    assert elapsed < serial_time / 4
+
+@pytest.mark.asyncio
+async def test_worker_concurrency_limit():
+    num_tasks = 20
+    manager, elapsed = await run_worker(concurrency=1, num_tasks=num_tasks)
+    print(f"Processed {num_tasks} tasks serially in {elapsed:.2f}s: {num_tasks / elapsed:.1f} tasks/sec")
+    assert len(manager.redis.acked) == num_tasks
+    assert [seq for _, seq in manager.completed] == list(range(num_tasks))
+
+@pytest.mark.asyncio
+async def test_shutdown_waits_for_inflight_tasks():
+    num_tasks = 10
+    manager = FakeLLMEngineManager(["test"], max_concurrency=num_tasks)
+    manager.redis = FakeStreamRedis(make_tasks(num_tasks))
+
+    async def shutdown_while_running():
+        while len(manager.inflight_tasks) < num_tasks:
+            await asyncio.sleep(0.01)
+        manager.shutdown()
+
+    await asyncio.gather(manager.process_tasks_until_canceled(), shutdown_while_running())
+    # Every task was acked before Redis was closed
+    assert len(manager.redis.acked) == num_tasks
+    assert manager.redis.closed